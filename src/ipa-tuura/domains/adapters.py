@@ -26,4 +26,5 @@ class DomainSerializer(ModelSerializer):
             "users_dn",
             "ldap_tls_cacert",
             "keycloak_hostname",
+            "member_refresh_interval",
         )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 22:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("domains", "0002_alter_domain_user_extra_attrs_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="domain",
+            name="member_refresh_interval",
+            field=models.PositiveIntegerField(default=60),
+        ),
+    ]
@@ -70,6 +70,10 @@ class Domain(models.Model):
     # TODO: base64 decode CA cert from HTTP request
     ldap_tls_cacert = models.CharField(max_length=100, blank=True)
 
+    # Minimum interval in seconds between two refreshes of the member list
+    # of a group from the identity server, 0 to refresh on every read
+    member_refresh_interval = models.PositiveIntegerField(default=60)
+
     def __str__(self):
         return self.name
 
@@ -20,5 +20,6 @@ class DomainSerializerTestCase(TestCase):
             "user_object_classes",
             "users_dn",
             "ldap_tls_cacert",
+            "member_refresh_interval",
         ]:
             self.assertEqual(serializer.data[field_name], getattr(domain, field_name))
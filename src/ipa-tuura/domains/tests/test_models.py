@@ -1,5 +1,6 @@
 from django.test import TestCase
 from domains.tests.factories import DomainFactory
+from scim.sssd import _IdentityCache, get_member_refresh_interval
 
 
 class DomainTestCase(TestCase):
@@ -7,3 +8,22 @@ class DomainTestCase(TestCase):
         """Test for string representation."""
         domain = DomainFactory()
         self.assertEqual(str(domain), domain.name)
+
+    def test_member_refresh_interval(self):
+        """The identity cache reads the refresh interval of the domain."""
+        self.assertEqual(get_member_refresh_interval(), 60)
+        DomainFactory(member_refresh_interval=300)
+        self.assertEqual(get_member_refresh_interval(), 300)
+
+    def test_identity_cache_refresh_interval(self):
+        """The interval is read on first use, and again after a reset."""
+        with self.assertNumQueries(0):
+            cache = _IdentityCache()
+        domain = DomainFactory(member_refresh_interval=300)
+        self.assertEqual(cache.member_refresh_interval, 300)
+        domain.member_refresh_interval = 600
+        domain.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.member_refresh_interval, 300)
+        cache._reset_instance()
+        self.assertEqual(cache.member_refresh_interval, 600)
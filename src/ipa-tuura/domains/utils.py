@@ -13,7 +13,9 @@ import ipalib.errors
 import SSSDConfig
 from ipalib import api
 from ipalib.facts import is_ipa_client_configured
+from scim.directory import DirectoryIndex
 from scim.models import User
+from scim.sssd import IdentityCache
 
 try:
     from ipalib.install.kinit import kinit_password
@@ -154,6 +156,10 @@ def restart_sssd():
     if proc.returncode != 0:
         raise Exception("Error restarting SSSD:\n{}".format(proc.stderr))
 
+    # the cached identities may come from the previous configuration
+    IdentityCache()._reset_instance()
+    DirectoryIndex()._reset_instance()
+
 
 def ipa_api_connect(domain):
     backend = None
@@ -19,6 +19,7 @@ from rest_framework.mixins import (
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
 from scim.ipa import IPA
+from scim.sssd import IdentityCache
 
 logger = logging.getLogger(__name__)
 
@@ -52,6 +53,8 @@ class DomainViewSet(
             # reset the writable interface
             ipa = IPA()
             ipa._reset_instance()
+            # and the identity cache, which reads the domain settings
+            IdentityCache()._reset_instance()
 
         # Run the domain creation logic in a separate thread
         thread = threading.Thread(target=process_domain_creation)
@@ -16,5 +16,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "root.settings")
+# The SCIM reads are served by asyncio views when running under ASGI
+os.environ.setdefault("SCIM_ASYNC_READS", "True")
 
 application = get_asgi_application()
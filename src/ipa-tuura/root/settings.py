@@ -56,6 +56,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'scim.middleware.IdentityMapMiddleware',
 ]
 
 ROOT_URLCONF = 'root.urls'
@@ -135,12 +136,93 @@ os.environ["KRB5_CLIENT_KTNAME"] = '/var/lib/ipa/ipatuura/service.keytab'
 
 AUTH_USER_MODEL = 'scim.User'
 
+# SSSD identity cache, maximum number of cached users and groups and time
+# to live of the entries in seconds (None: entry_cache_timeout from sssd.conf)
+SSSD_CACHE_SIZE = 10000
+SSSD_CACHE_TIMEOUT = None
+# Same for the unknown users and groups (None: entry_negative_timeout)
+SSSD_NEGATIVE_CACHE_SIZE = 1000
+SSSD_NEGATIVE_CACHE_TIMEOUT = None
+# Maximum number of DBus proxies and object paths kept by a SSSD client
+SSSD_PROXY_CACHE_SIZE = 10000
+# Number of SSSD clients shared by the request threads, and maximum time in
+# seconds a request waits for a client
+SSSD_POOL_SIZE = 4
+SSSD_POOL_TIMEOUT = 30
+# Number of bound connections of the ldap and ad writable interfaces, maximum
+# time in seconds a request waits for a connection, and time in seconds after
+# which an idle connection is probed before it is used
+LDAP_POOL_SIZE = 4
+LDAP_POOL_TIMEOUT = 30
+LDAP_POOL_PROBE_INTERVAL = 60
+# Maximum time in seconds spent reconnecting to a restarted SSSD infopipe
+SSSD_RECONNECT_TIMEOUT = 5
+# Minimum interval in seconds between two refreshes of a group member list,
+# None to use the member_refresh_interval of the integration domain
+SSSD_MEMBER_REFRESH_INTERVAL = None
+# Threads reading the members of large groups, by batches of users
+SSSD_MEMBER_WORKERS = 8
+SSSD_MEMBER_BATCH_SIZE = 500
+# Maximum time in seconds spent reading the members of a group
+SSSD_MEMBER_TIMEOUT = 60
+# Maximum number of calls waiting for a reply on the asyncio D-Bus connection
+SSSD_ASYNC_MAX_CALLS = 256
+# Maximum number of users or groups enumerated by SSSD (0: wildcard_limit
+# from sssd.conf), and time in seconds the enumeration is reused by the pages
+SSSD_LIST_LIMIT = 0
+SSSD_LIST_CACHE_TIMEOUT = 60
+# Maximum number of resources returned in a page of a SCIM listing or search
+SCIM_MAX_RESULTS = 200
+# Maximum number of operations and size in bytes of a SCIM bulk request
+SCIM_BULK_MAX_OPERATIONS = 1000
+SCIM_BULK_MAX_PAYLOAD_SIZE = 1048576
+# Maximum age in seconds of a cached user compared with a modification to
+# leave out the attributes which did not change, an older entry is read again
+IPA_WRITE_COMPARE_MAX_AGE = 5
+# Time in seconds after which the directory index used by the filters is
+# reloaded, from the local mirror when it was synchronized
+DIRECTORY_INDEX_REFRESH_INTERVAL = 300
+# Load the directory index from the SSSD enumeration when the local mirror
+# was not synchronized. The enumeration is truncated to the wildcard_limit of
+# sssd.conf, without it the filters other than an equality on the id or the
+# name, and the sorted listings, are rejected until the mirror is loaded
+DIRECTORY_INDEX_SSSD_ENUMERATION = False
+# Local mirror maintained by "manage.py syncdirectory": time in seconds
+# between two refreshes of the worker, number of entries read per page, and
+# time in seconds between two listings of all the names to find the entries
+# removed from an LDAP server
+DIRECTORY_SYNC_INTERVAL = 60
+DIRECTORY_SYNC_PAGE_SIZE = 500
+DIRECTORY_SYNC_RECONCILE_INTERVAL = 3600
+# Serve GET /Users/<id> and /Groups/<id> with asyncio views, set by asgi.py
+SCIM_ASYNC_READS = os.environ.get('SCIM_ASYNC_READS', 'False') == 'True'
+# Write the SCIM responses incrementally, so that the memory they use does
+# not depend on the number of resources or group members, and compress them
+# with gzip when the client accepts it
+SCIM_STREAMING = os.environ.get('SCIM_STREAMING', 'False') == 'True'
+SCIM_STREAMING_GZIP = True
+# Queue the writes of the users requested with a 'Prefer: respond-async'
+# header, run by 'manage.py provisionusers --worker': number of worker
+# threads, maximum number of attempts of a job failing with a backend error,
+# time in seconds between two attempts (times the number of attempts), time
+# in seconds between two polls of the queue, time in seconds the jobs are
+# kept once done or failed, and time in seconds after which a job left
+# running by a stopped worker is queued again
+SCIM_ASYNC_WRITES = os.environ.get('SCIM_ASYNC_WRITES', 'False') == 'True'
+PROVISIONING_WORKERS = 4
+PROVISIONING_MAX_ATTEMPTS = 3
+PROVISIONING_RETRY_DELAY = 30
+PROVISIONING_POLL_INTERVAL = 1
+PROVISIONING_JOB_RETENTION = 604800
+PROVISIONING_LEASE_TIMEOUT = 300
+
 SCIM_SERVICE_PROVIDER = {
     'NETLOC': 'localhost',
     'USER_ADAPTER': 'scim.adapters.SCIMUser',
     'GROUP_MODEL': 'scim.models.Group',
     'GROUP_ADAPTER': 'scim.adapters.SCIMGroup',
     'SERVICE_PROVIDER_CONFIG_MODEL': 'scim.models.ServiceProviderConfig',
+    'AUTH_CHECK_MIDDLEWARE': 'scim.middleware.StreamingAuthCheckMiddleware',
     'USER_FILTER_PARSER': 'scim.utils.SCIMUserFilterQuery',
     'GROUP_FILTER_PARSER': 'scim.utils.SCIMGroupFilterQuery',
     'DOCUMENTATION_URI': 'https://www.rfc-editor.org/rfc/rfc7644',
@@ -17,13 +17,60 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
 from django.urls import include, path, re_path
+from scim import sssd_async, views
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    # Honour the attributes and excludedAttributes of the request, and
+    # list the SSSD users and groups page by page
+    re_path(
+        r"^scim/v2/Users/\.search$",
+        views.UserSearchView.as_view(),
+        name="users-search",
+    ),
+    re_path(
+        r"^scim/v2/Groups/\.search$",
+        views.GroupSearchView.as_view(),
+        name="groups-search",
+    ),
+    re_path(
+        r"^scim/v2/Users(?:/(?P<uuid>(?!\.search$)[^/]+))?$",
+        views.UsersView.as_view(),
+        name="users",
+    ),
+    re_path(
+        r"^scim/v2/Groups(?:/(?P<uuid>(?!\.search$)[^/]+))?$",
+        views.GroupsView.as_view(),
+        name="groups",
+    ),
+    # Users written in batches, see scim.bulk.Bulk
+    re_path(r"^scim/v2/Bulk$", views.BulkView.as_view(), name="bulk"),
+    # Status of the writes queued with "Prefer: respond-async"
+    path(
+        "scim/v2/Jobs/<uuid:uuid>",
+        views.JobView.as_view(),
+        name="provisioning-job",
+    ),
     path("scim/v2/", include("django_scim.urls")),
     path("creds/", include("creds.urls")),
     path("domains/v1/", include("domains.urls")),
     path("bridge/", include("scim.urls")),
 ]
+
+if settings.SCIM_ASYNC_READS and sssd_async.is_available():
+    # Served before the django_scim views for the same URLs
+    urlpatterns[1:1] = [
+        re_path(
+            r"^scim/v2/Users/(?P<uuid>(?!\.search$)[^/]+)$",
+            views.user_detail,
+            name="users-async",
+        ),
+        re_path(
+            r"^scim/v2/Groups/(?P<uuid>(?!\.search$)[^/]+)$",
+            views.group_detail,
+            name="groups-async",
+        ),
+    ]
@@ -3,12 +3,17 @@
 #
 
 import logging
+from urllib.parse import urljoin
 
 from django.contrib.auth.models import BaseUserManager
 from django.db import transaction
-from django_scim import exceptions
+from django.urls import reverse
+from django_scim import constants, exceptions
 from django_scim.adapters import SCIMGroup, SCIMUser
+from django_scim.utils import get_base_scim_location_getter, get_user_adapter
 from scim.ipa import IPA
+from scim.records import UserRecord
+from scim.utils import JSONArray, Projection
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +28,9 @@ class SCIMUser(SCIMUser):
             "resourceType": self.resource_type,
             "location": self.location,
         }
+        last_modified = getattr(self.obj, "scim_last_modified", None)
+        if last_modified:
+            d["lastModified"] = last_modified
         return d
 
     def to_dict(self):
@@ -37,7 +45,13 @@ class SCIMUser(SCIMUser):
             }
         )
 
-        return d
+        return Projection.from_request(self.request).apply(d)
+
+    def to_stream(self):
+        """
+        Return the dict of the user for a JSONStream, the same as to_dict().
+        """
+        return self.to_dict()
 
     def from_dict(self, d):
         """
@@ -114,23 +128,32 @@ class SCIMUser(SCIMUser):
     def is_new_user(self):
         return not bool(self.obj.id)
 
+    def set_initial_password(self):
+        """
+        Set the password of a new user, a temporary one which must be
+        changed if none was passed.
+        """
+        password = getattr(self.obj, "_scim_cleartext_password", None)
+        # If temp password was not passed, create one.
+        if password is None:
+            self.obj.require_password_change = True
+            manager = BaseUserManager()
+            password = manager.make_random_password()
+        self.obj.set_password(password)
+
     def save(self):
         ipa_if = IPA()
-        temp_password = None
         if self.is_new_user:
-            password = getattr(self.obj, "_scim_cleartext_password", None)
-            # If temp password was not passed, create one.
-            if password is None:
-                self.obj.require_password_change = True
-                manager = BaseUserManager()
-                temp_password = manager.make_random_password()
-                password = temp_password
-            self.obj.set_password(password)
+            self.set_initial_password()
             ipa_if.user_add(self)
-
-        is_new_user = self.is_new_user
-        if not is_new_user:
+        else:
             ipa_if.user_mod(self)
+        self.save_local()
+
+    def save_local(self):
+        """
+        Save the user in the local database, once written to the backend.
+        """
         try:
             with transaction.atomic():
                 super().save()
@@ -145,16 +168,326 @@ class SCIMUser(SCIMUser):
             raise e
 
     def delete(self):
-        self.obj.is_active = False
         ipa_if = IPA()
         ipa_if.user_del(self)
+        self.delete_local()
+
+    def delete_local(self):
+        """
+        Delete the user from the local database, once deleted from the
+        backend.
+        """
+        self.obj.is_active = False
         self.obj.__class__.objects.filter(id=self.id).delete()
 
+    # Backend attribute and field of the user of the PATCH paths, by
+    # lower case (attribute, sub-attribute)
+    PATCH_ATTRS = {
+        ("name", "givenname"): ("givenname", "first_name"),
+        ("givenname", None): ("givenname", "first_name"),
+        ("name", "familyname"): ("sn", "last_name"),
+        ("familyname", None): ("sn", "last_name"),
+        ("emails", None): ("mail", "email"),
+        ("emails", "value"): ("mail", "email"),
+    }
+
+    def handle_operations(self, operations):
+        """
+        Apply the operations of a PATCH request (RFC 7644, section 3.5.2).
+
+        The operations are written to the backend as a single modification
+        of the attributes they target, the other attributes of the user
+        are neither compared nor written.
+        """
+        self._changes = []
+        super().handle_operations(operations)
+        IPA().user_patch(self, self._changes)
+        with transaction.atomic():
+            super().save()
+
+    def handle_add(self, path, value, operation):
+        self._patch("add", path, value)
+
+    def handle_remove(self, path, value, operation):
+        self._patch("remove", path, value)
+
+    def handle_replace(self, path, value, operation):
+        self._patch("replace", path, value)
+
+    def _patch(self, op, path, value):
+        if path.is_complex:
+            raise exceptions.BadRequestError(
+                "Filters in PATCH paths are not supported", scim_type="invalidPath"
+            )
+        attr_name, sub_attr, _ = path.first_path
+        key = (attr_name.lower(), sub_attr.lower() if sub_attr else None)
+        if key == ("name", None):
+            if op == "remove":
+                value = {"givenName": None, "familyName": None}
+            if not isinstance(value, dict):
+                raise exceptions.BadRequestError(
+                    "Invalid name value", scim_type="invalidValue"
+                )
+            for sub_attr, sub_value in value.items():
+                if sub_attr.lower() != "formatted":
+                    self._patch_attr(op, ("name", sub_attr.lower()), sub_value)
+        elif key == ("active", None):
+            # Not written to the backend, like with PUT
+            if op == "remove":
+                raise exceptions.BadRequestError(
+                    "active cannot be removed", scim_type="mutability"
+                )
+            self.parse_active(value)
+        else:
+            self._patch_attr(op, key, value)
+
+    def _patch_attr(self, op, key, value):
+        if key not in self.PATCH_ATTRS:
+            raise exceptions.NotImplementedError(
+                "PATCH of {} is not supported".format(".".join(filter(None, key)))
+            )
+        attr, field = self.PATCH_ATTRS[key]
+        if attr == "mail":
+            values = self._patch_emails(value)
+            current = getattr(self.obj, field)
+            if not isinstance(current, list):
+                current = [current] if current else []
+        else:
+            # Adding a single-valued attribute replaces it
+            if op == "add":
+                op = "replace"
+            values = [value] if value else []
+            current = []
+        self._changes.append((op, attr, values))
+
+        if op == "replace":
+            current = values
+        elif op == "add":
+            current = current + [v for v in values if v not in current]
+        elif values:
+            current = [v for v in current if v not in values]
+        else:
+            current = []
+        if attr == "mail" and len(current) > 1:
+            setattr(self.obj, field, current)
+        else:
+            setattr(self.obj, field, current[0] if current else "")
+
+    def _patch_emails(self, value):
+        """
+        Return the addresses of the emails value of a PATCH operation, the
+        primary ones first.
+        """
+        if value is None:
+            return []
+        if not isinstance(value, list):
+            value = [value]
+        emails = []
+        for email in sorted(
+            value, key=lambda e: not (isinstance(e, dict) and e.get("primary"))
+        ):
+            if isinstance(email, dict):
+                email = email.get("value") or ""
+            email = email.strip()
+            self.validate_email(email)
+            emails.append(email)
+        return emails
+
 
 class SCIMGroup(SCIMGroup):
+    @property
+    def meta(self):
+        """
+        Return the meta object of the group per the SCIM spec.
+        """
+        d = super().meta
+        last_modified = getattr(self.obj, "scim_last_modified", None)
+        if last_modified:
+            d["lastModified"] = last_modified
+        return d
+
+    # Return the members as a JSONArray
+    streaming = False
+
     @property
     def display_name(self):
         """
         Return the displayName of the group per the SCIM spec.
         """
         return self.obj.scim_display_name
+
+    @property
+    def members(self):
+        """
+        Return the members of the group, converted one at a time while
+        the JSONArray is written when streaming.
+        """
+        user_adapter = get_user_adapter()
+        members = self._members(
+            user_adapter(user, self.request) for user in self.obj.user_set.all()
+        )
+        if self.streaming:
+            return JSONArray(members)
+        return list(members)
+
+    @staticmethod
+    def _members(scim_users):
+        # The locations only differ by the id, reverse() is slow enough
+        # to dominate the cost of a large group
+        prefix = None
+        for scim_user in scim_users:
+            user_id = str(scim_user.id)
+            if prefix is None:
+                location = scim_user.location
+                if location.endswith("/" + user_id):
+                    prefix = location[: -len(user_id)]
+            else:
+                location = prefix + user_id
+            yield {
+                "value": scim_user.id,
+                "$ref": location,
+                "display": scim_user.display_name,
+            }
+
+    def to_dict(self):
+        """
+        Return a ``dict`` conforming to the SCIM Group Schema,
+        ready for conversion to a JSON object.
+        """
+        d = super().to_dict()
+        return Projection.from_request(self.request).apply(d)
+
+    def to_stream(self):
+        """
+        Return the dict of the group for a JSONStream, with the members as
+        a JSONArray.
+        """
+        self.streaming = True
+        try:
+            return self.to_dict()
+        finally:
+            self.streaming = False
+
+
+class RecordSerializer:
+    """
+    Serialize the UserRecord and GroupRecord objects to the SCIM JSON of
+    SCIMUser.to_dict() and SCIMGroup.to_dict(), without the adapters and
+    the models.
+
+    The locations of the resources only differ by the id, they are built
+    from a prefix computed once per resource type.
+    """
+
+    def __init__(self, request, streaming=False):
+        """
+        :param request: the request, for its projection and the locations
+        :param streaming: return the members of the groups as a JSONArray
+        """
+        self.request = request
+        self.projection = Projection.from_request(request)
+        self.streaming = streaming
+        self._prefixes = {}
+
+    def location(self, record):
+        """
+        Return the location of the resource of a record.
+        """
+        if isinstance(record, UserRecord):
+            url_name = SCIMUser.url_name
+        else:
+            url_name = SCIMGroup.url_name
+        record_id = str(record.id)
+        prefix = self._prefixes.get(url_name)
+        if prefix is not None:
+            return prefix + record_id
+        location = urljoin(
+            get_base_scim_location_getter()(self.request),
+            reverse(url_name, kwargs={"uuid": record_id}),
+        )
+        if location.endswith("/" + record_id):
+            self._prefixes[url_name] = location[: -len(record_id)]
+        return location
+
+    def to_dict(self, record):
+        """
+        Return the SCIM resource of a record, with the attributes requested.
+        """
+        if isinstance(record, UserRecord):
+            d = self._user(record)
+        else:
+            d = self._group(record)
+        return self.projection.apply(d)
+
+    def _display_name(self, user):
+        if user.first_name and user.last_name:
+            return "{} {}".format(user.first_name, user.last_name)
+        return user.name
+
+    def _meta(self, record, resource_type):
+        d = {
+            "resourceType": resource_type,
+            "location": self.location(record),
+        }
+        if record.modified:
+            d["lastModified"] = record.modified
+        return d
+
+    def _user(self, user):
+        display_name = self._display_name(user)
+        if isinstance(user.email, list):
+            emails = [
+                {"value": email, "primary": i == 0}
+                for i, email in enumerate(user.email)
+            ]
+        elif user.email:
+            emails = [{"value": user.email, "primary": True}]
+        else:
+            emails = []
+        groups = []
+        if self.projection.includes("groups"):
+            groups = [
+                {
+                    "value": str(group.id),
+                    "$ref": self.location(group),
+                    "display": group.name,
+                }
+                for group in user.groups
+            ]
+        return {
+            "id": str(user.id),
+            "externalId": None,
+            "schemas": [constants.SchemaURI.USER],
+            "userName": user.name,
+            "name": {
+                "givenName": user.first_name,
+                "familyName": user.last_name,
+                "formatted": display_name,
+            },
+            "displayName": display_name,
+            "emails": emails,
+            "active": user.active,
+            "groups": groups,
+            "meta": self._meta(user, SCIMUser.resource_type),
+        }
+
+    def _group(self, group):
+        members = []
+        if self.projection.includes("members"):
+            members = (
+                {
+                    "value": str(user.id),
+                    "$ref": self.location(user),
+                    "display": self._display_name(user),
+                }
+                for user in group.members
+            )
+            members = JSONArray(members) if self.streaming else list(members)
+        return {
+            "id": str(group.id),
+            "externalId": None,
+            "schemas": [constants.SchemaURI.GROUP],
+            "displayName": group.name,
+            "members": members,
+            "meta": self._meta(group, SCIMGroup.resource_type),
+        }
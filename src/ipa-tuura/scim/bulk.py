@@ -0,0 +1,335 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import json
+import logging
+import re
+
+from django import db
+from django.conf import settings
+from django.http import HttpRequest
+from django_scim import constants, exceptions
+from django_scim.settings import scim_settings
+from scim.ipa import (
+    IPA,
+    IPANotFoundException,
+    LDAPNotFoundException,
+    UserExistsException,
+)
+
+logger = logging.getLogger(__name__)
+
+
+BULK_REQUEST = "urn:ietf:params:scim:api:messages:2.0:BulkRequest"
+BULK_RESPONSE = "urn:ietf:params:scim:api:messages:2.0:BulkResponse"
+
+_path_re = re.compile(r"^/(?P<resource>Users|Groups)(?:/(?P<uuid>[^/]+))?$")
+_bulk_id_re = re.compile(r"^bulkId:(?P<bulk_id>.+)$")
+
+# Operation of IPA().user_batch() of the user operations written in
+# batches, by method
+BATCHED_METHODS = {
+    "POST": "add",
+    "PUT": "modify",
+    "DELETE": "delete",
+}
+
+
+class Operation:
+    """
+    Operation of a bulk request.
+    """
+
+    __slots__ = ("method", "bulk_id", "path", "data", "resource", "uuid")
+
+    def __init__(self, doc):
+        if not isinstance(doc, dict):
+            doc = {}
+        self.method = str(doc.get("method", "")).upper()
+        self.bulk_id = doc.get("bulkId")
+        self.path = doc.get("path", "")
+        self.data = doc.get("data")
+        match = _path_re.match(self.path) if isinstance(self.path, str) else None
+        self.resource = match.group("resource") if match else None
+        self.uuid = match.group("uuid") if match else None
+
+    def check(self):
+        """
+        :raises BadRequestError: if the operation is not valid
+        """
+        if self.method not in ("POST", "PUT", "PATCH", "DELETE"):
+            raise exceptions.BadRequestError(
+                "Invalid method {}".format(self.method), scim_type="invalidSyntax"
+            )
+        if self.resource is None:
+            raise exceptions.BadRequestError(
+                "Invalid path {}".format(self.path), scim_type="invalidPath"
+            )
+        if self.method == "POST":
+            if not self.bulk_id:
+                raise exceptions.BadRequestError(
+                    "POST operation without bulkId", scim_type="invalidSyntax"
+                )
+            if self.uuid is not None:
+                raise exceptions.BadRequestError(
+                    "Invalid path {}".format(self.path), scim_type="invalidPath"
+                )
+        elif self.uuid is None:
+            raise exceptions.BadRequestError(
+                "{} operation without resource id".format(self.method),
+                scim_type="invalidPath",
+            )
+        if self.method != "DELETE" and not isinstance(self.data, dict):
+            raise exceptions.BadRequestError(
+                "{} operation without data".format(self.method),
+                scim_type="invalidSyntax",
+            )
+
+    @property
+    def batch(self):
+        """
+        The operation of IPA().user_batch() writing the operation, None if
+        it is not written in a batch.
+        """
+        if self.resource != "Users":
+            return None
+        return BATCHED_METHODS.get(self.method)
+
+
+class Bulk:
+    """
+    Processes a bulk request (RFC 7644, section 3.7).
+
+    The consecutive POST, PUT or DELETE operations of users are grouped by
+    method and written with IPA().user_batch(): a batch command on the ipa
+    provider, pipelined operations on ldap and ad. The other operations, and
+    the invalid ones, are dispatched one at a time to the views of their
+    resources.
+
+    With failOnErrors, the batches are cut so that no operation is written
+    after the failOnErrors-th error.
+    """
+
+    def __init__(self, request, body, views):
+        """
+        :param request: the bulk request
+        :param body: its decoded body
+        :param views: dict of the view classes of the Users and Groups
+        :raises BadRequestError: if the request is not valid
+        :raises SCIMException: if it has more than SCIM_BULK_MAX_OPERATIONS
+            operations
+        """
+        if BULK_REQUEST not in body.get("schemas", []):
+            raise exceptions.BadRequestError("Invalid schema uri. Must be BulkRequest.")
+        operations = body.get("Operations")
+        if not isinstance(operations, list) or not operations:
+            raise exceptions.BadRequestError("Bulk request without operations")
+        max_operations = getattr(settings, "SCIM_BULK_MAX_OPERATIONS", 1000)
+        if len(operations) > max_operations:
+            raise exceptions.SCIMException(
+                "The bulk request exceeds the maximum number of operations "
+                "({})".format(max_operations),
+                status=413,
+            )
+        fail_on_errors = body.get("failOnErrors")
+        if fail_on_errors is not None and (
+            not isinstance(fail_on_errors, int) or fail_on_errors < 1
+        ):
+            raise exceptions.BadRequestError(
+                "Invalid failOnErrors {}".format(fail_on_errors),
+                scim_type="invalidValue",
+            )
+        self.request = request
+        self.operations = [Operation(doc) for doc in operations]
+        self.fail_on_errors = fail_on_errors
+        self._view_classes = views
+        self._views = {name: cls.as_view() for name, cls in views.items()}
+        # Ids of the resources created, by bulkId
+        self._bulk_ids = {}
+        # Path of the SCIM endpoints
+        self._prefix = request.path[: -len("/Bulk")]
+
+    def run(self):
+        """
+        :returns: the BulkResponse
+        """
+        results = []
+        errors = 0
+        i = 0
+        while i < len(self.operations):
+            if self.fail_on_errors and errors >= self.fail_on_errors:
+                break
+            op = self.operations[i]
+            batch = op.batch
+            j = i + 1
+            if batch is None:
+                batch_results = [self._run_single(op)]
+            else:
+                limit = len(self.operations)
+                if self.fail_on_errors:
+                    limit = min(limit, i + self.fail_on_errors - errors)
+                while j < limit and self.operations[j].batch == batch:
+                    j += 1
+                batch_results = self._run_batch(batch, self.operations[i:j])
+            for result in batch_results:
+                if int(result["status"]) >= 400:
+                    errors += 1
+                results.append(result)
+            i = j
+        return {"schemas": [BULK_RESPONSE], "Operations": results}
+
+    def _resolve_path(self, op):
+        """
+        Return the path of an operation, with the id of the resource
+        created by a previous operation in place of a bulkId reference.
+        """
+        if op.uuid is None:
+            return op.path
+        return "/{}/{}".format(op.resource, self._resolve(op.uuid))
+
+    def _resolve(self, value):
+        """
+        Replace the bulkId references of data with the ids of the resources
+        created by the previous operations.
+
+        :raises SCIMException: if a bulkId is not known
+        """
+        if isinstance(value, dict):
+            return {k: self._resolve(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self._resolve(v) for v in value]
+        if isinstance(value, str):
+            match = _bulk_id_re.match(value)
+            if match:
+                try:
+                    return self._bulk_ids[match.group("bulk_id")]
+                except KeyError:
+                    raise exceptions.SCIMException(
+                        "Unknown bulkId {}".format(match.group("bulk_id")),
+                        status=409,
+                        scim_type="invalidValue",
+                    )
+        return value
+
+    def _subrequest(self, op, path, data):
+        """
+        Return the request of an operation, with the user and headers of
+        the bulk request.
+        """
+        request = HttpRequest()
+        request.method = op.method
+        request.path = request.path_info = self._prefix + path
+        request.META = self.request.META.copy()
+        request.META["REQUEST_METHOD"] = op.method
+        request.META["CONTENT_TYPE"] = constants.SCIM_CONTENT_TYPE
+        request.user = self.request.user
+        request._body = json.dumps(data or {}).encode(constants.ENCODING)
+        return request
+
+    def _result(self, op, status, location=None, response=None):
+        result = {"method": op.method}
+        if op.bulk_id:
+            result["bulkId"] = op.bulk_id
+        if location:
+            result["location"] = location
+        result["status"] = str(status)
+        if response is not None:
+            result["response"] = response
+        return result
+
+    def _error(self, op, e):
+        e = scim_exception(e)
+        return self._result(op, e.status, response=e.to_dict())
+
+    def _run_single(self, op):
+        """
+        Dispatch an operation to the view of its resource.
+        """
+        try:
+            op.check()
+            path = self._resolve_path(op)
+            data = self._resolve(op.data)
+        except Exception as e:
+            return self._error(op, e)
+        uuid = _path_re.match(path).group("uuid")
+        response = self._views[op.resource](self._subrequest(op, path, data), uuid=uuid)
+        content = json.loads(response.content) if response.content else None
+        if response.status_code >= 400:
+            return self._result(op, response.status_code, response=content)
+        if op.method == "POST":
+            self._bulk_ids[op.bulk_id] = content["id"]
+        return self._result(op, response.status_code, response.get("Location"))
+
+    def _run_batch(self, batch, ops):
+        """
+        Write the users of operations with the same method with a single
+        IPA().user_batch().
+        """
+        view_cls = self._view_classes["Users"]
+        results = [None] * len(ops)
+        # (index, operation, adapter) of the operations to write
+        prepared = []
+        for i, op in enumerate(ops):
+            try:
+                op.check()
+                path = self._resolve_path(op)
+                data = self._resolve(op.data)
+                request = self._subrequest(op, path, data)
+                view = view_cls()
+                view.setup(request, uuid=_path_re.match(path).group("uuid"))
+                if op.method == "POST":
+                    obj = view.model_cls()
+                else:
+                    obj = view.get_object()
+                scim_obj = view.scim_adapter(obj, request=request)
+                if op.method != "DELETE":
+                    scim_obj.validate_dict(data)
+                    scim_obj.from_dict(data)
+                if op.method == "POST":
+                    scim_obj.set_initial_password()
+            except Exception as e:
+                results[i] = self._error(op, e)
+                continue
+            prepared.append((i, op, scim_obj))
+
+        errors = IPA().user_batch(batch, [scim_obj for _, _, scim_obj in prepared])
+        for (i, op, scim_obj), error in zip(prepared, errors):
+            try:
+                if error is not None:
+                    raise error
+                if op.method == "DELETE":
+                    scim_obj.delete_local()
+                    results[i] = self._result(op, 204)
+                    continue
+                try:
+                    scim_obj.save_local()
+                except db.utils.IntegrityError as e:
+                    raise exceptions.IntegrityError(str(e))
+            except Exception as e:
+                results[i] = self._error(op, e)
+                continue
+            if op.method == "POST":
+                self._bulk_ids[op.bulk_id] = scim_obj.id
+                results[i] = self._result(op, 201, scim_obj.location)
+            else:
+                results[i] = self._result(op, 200, scim_obj.location)
+        return results
+
+
+def scim_exception(e):
+    """
+    Return the SCIMException reported for the exception of a write.
+    """
+    if isinstance(e, exceptions.SCIMException):
+        return e
+    if isinstance(e, (IPANotFoundException, LDAPNotFoundException)):
+        return exceptions.SCIMException(str(e), status=404)
+    if isinstance(e, UserExistsException):
+        return exceptions.IntegrityError(str(e), scim_type="uniqueness")
+    logger.exception("Unable to complete SCIM operation.")
+    if scim_settings.EXPOSE_SCIM_EXCEPTIONS:
+        return exceptions.SCIMException(str(e))
+    return exceptions.SCIMException(
+        "Exception occurred while processing the SCIM request"
+    )
@@ -0,0 +1,1530 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import array
+import copy
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from scim2_filter_parser import ast
+from scim2_filter_parser.lexer import SCIMLexer
+from scim2_filter_parser.parser import SCIMParser
+from scim.models import DirectoryEntry, DirectoryMember, DirectorySyncState
+from scim.sssd import SSSD, SSSDGroup, SSSDNotFoundException, SSSDUser
+
+logger = logging.getLogger(__name__)
+
+# Default wildcard_limit of sssd.conf, the maximum number of users or groups
+# returned by an enumeration
+SSSD_WILDCARD_LIMIT = 1000
+
+
+class DirectoryIndexUnavailableException(Exception):
+    """
+    Exception returned when the directory index cannot be loaded, the
+    local mirror not being synchronized.
+    """
+
+    pass
+
+
+def _emails(index, user):
+    return [
+        {"value": mail, "primary": i == 0, "type": None}
+        for i, mail in enumerate(user.mail or [])
+    ]
+
+
+def _user_groups(index, user):
+    return [
+        {"value": str(gid), "display": index.groups[gid].name}
+        for gid in sorted(index.groups_by_user.get(user.id, ()))
+    ]
+
+
+def _group_members(index, group):
+    return [
+        {"value": str(uid), "display": index.users[uid].username}
+        for uid in sorted(index.members.members(group.id))
+    ]
+
+
+def _full_name(user):
+    return " ".join(n for n in (user.first_name, user.last_name) if n)
+
+
+# SCIM attributes of the users and groups, indexed by lower case name.
+# Each getter returns the list of values of the attribute, the values of
+# complex attributes are dicts indexed by lower case sub-attribute name.
+USER_ATTRIBUTES = {
+    "id": lambda index, user: [str(user.id)],
+    "username": lambda index, user: [user.username],
+    "name": lambda index, user: [
+        {
+            "givenname": user.first_name,
+            "familyname": user.last_name,
+            "formatted": _full_name(user),
+        }
+    ],
+    # Shortcuts for name.givenName and name.familyName, as in django_scim
+    "givenname": lambda index, user: [user.first_name],
+    "familyname": lambda index, user: [user.last_name],
+    "displayname": lambda index, user: [_full_name(user)],
+    "emails": _emails,
+    "active": lambda index, user: [user.active],
+    "groups": _user_groups,
+}
+
+GROUP_ATTRIBUTES = {
+    "id": lambda index, group: [str(group.id)],
+    "displayname": lambda index, group: [group.name],
+    "members": _group_members,
+}
+
+ATTRIBUTES = {"user": USER_ATTRIBUTES, "group": GROUP_ATTRIBUTES}
+
+# Attributes compared with case sensitivity (RFC 7643, caseExact)
+CASE_EXACT_ATTRIBUTES = {
+    ("id", None),
+    ("groups", "value"),
+    ("members", "value"),
+}
+
+# Attribute holding the group memberships, resolved by the MembershipIndex
+MEMBERSHIP_ATTRIBUTES = {"user": "groups", "group": "members"}
+
+# Filter attributes with the trigram index of another attribute
+SUBSTRING_ALIASES = {
+    "givenname": "name.givenname",
+    "familyname": "name.familyname",
+    "name.formatted": "displayname",
+}
+
+# Sort keys of the attributes accepted by sortBy, None for no value. The
+# strings are compared without case, except the ISO 8601 timestamps.
+SORT_ATTRIBUTES = {
+    "user": {
+        "username": lambda user: user.username.lower(),
+        "name.familyname": lambda user: _lower(user.last_name),
+        "name.givenname": lambda user: _lower(user.first_name),
+        "displayname": lambda user: _lower(_full_name(user)),
+        "meta.lastmodified": lambda user: user.modified,
+    },
+    "group": {
+        "displayname": lambda group: group.name.lower(),
+        "meta.lastmodified": lambda group: group.modified,
+    },
+}
+
+
+def _lower(value):
+    return value.lower() if value else None
+
+
+def _values(value):
+    return [value.lower()] if value else []
+
+
+def _timestamp(modified):
+    """
+    Convert a modifyTimestamp in LDAP generalized time, 20240131235959Z,
+    to ISO 8601.
+    """
+    if len(modified) < 14 or not modified[:14].isdigit():
+        return None
+    return "{}-{}-{}T{}:{}:{}Z".format(
+        modified[0:4],
+        modified[4:6],
+        modified[6:8],
+        modified[8:10],
+        modified[10:12],
+        modified[12:14],
+    )
+
+
+def _normalize(value, case_exact=False):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if value is None:
+        return None
+    value = str(value)
+    return value if case_exact else value.lower()
+
+
+def _compare(op, value, comp_value):
+    if op == "pr":
+        return value not in (None, "")
+    if value is None:
+        return False
+    if op == "eq":
+        return value == comp_value
+    if op == "ne":
+        return value != comp_value
+    if op == "co":
+        return comp_value in value
+    if op == "sw":
+        return value.startswith(comp_value)
+    if op == "ew":
+        return value.endswith(comp_value)
+    if op == "gt":
+        return value > comp_value
+    if op == "ge":
+        return value >= comp_value
+    if op == "lt":
+        return value < comp_value
+    if op == "le":
+        return value <= comp_value
+    raise ValueError("Unsupported filter operator {}".format(op))
+
+
+class Comparison:
+    """
+    Comparison of an attribute with a value, like userName eq "jdoe".
+    """
+
+    def __init__(self, attr, sub_attr, op, value):
+        self.attr = attr
+        self.sub_attr = sub_attr
+        self.op = op
+        self.case_exact = (attr, sub_attr) in CASE_EXACT_ATTRIBUTES
+        self.value = _normalize(value, self.case_exact)
+
+    def test(self, resolve):
+        """
+        :param resolve: callable returning the values of an attribute
+        :returns: True if one of the values matches
+        """
+        values = resolve(self.attr)
+        if self.op == "ne":
+            return not any(self._test("eq", v) for v in values)
+        return any(self._test(self.op, v) for v in values)
+
+    def _test(self, op, value):
+        if isinstance(value, dict):
+            # A complex attribute without sub-attribute compares its value
+            value = value.get(self.sub_attr or "value")
+        elif self.sub_attr is not None:
+            return False
+        return _compare(op, _normalize(value, self.case_exact), self.value)
+
+    def __repr__(self):
+        attr = self.attr if self.sub_attr is None else self.attr + "." + self.sub_attr
+        return "{} {} {!r}".format(attr, self.op, self.value)
+
+
+class ValuePath:
+    """
+    Filter on the values of a multi-valued attribute, like
+    emails[type eq "work" and value co "@ipa.test"].
+    """
+
+    def __init__(self, attr, expr):
+        self.attr = attr
+        self.expr = expr
+
+    def test(self, resolve):
+        for element in resolve(self.attr):
+            if isinstance(element, dict) and self.expr.test(
+                lambda attr, element=element: [element.get(attr)]
+            ):
+                return True
+        return False
+
+    def __repr__(self):
+        return "{}[{!r}]".format(self.attr, self.expr)
+
+
+class BooleanExpr:
+    """
+    and / or / not combination of comparisons, inside a value path.
+    """
+
+    def __init__(self, op, exprs):
+        self.op = op
+        self.exprs = exprs
+
+    def test(self, resolve):
+        if self.op == "and":
+            return all(e.test(resolve) for e in self.exprs)
+        if self.op == "or":
+            return any(e.test(resolve) for e in self.exprs)
+        return not self.exprs[0].test(resolve)
+
+    def __repr__(self):
+        return "({})".format(" {} ".format(self.op).join(map(repr, self.exprs)))
+
+
+class Plan:
+    """
+    Node of a query plan, returning the ids of the matching objects.
+
+    :param cost: estimation of the number of objects examined
+    """
+
+    cost = 0
+
+    def execute(self, index, kind, candidates=None):
+        """
+        :param index: the DirectoryIndex
+        :param kind: "user" or "group"
+        :param candidates: set of ids to select from, None for all
+        :returns: the set of ids of the matching objects
+        """
+        raise NotImplementedError
+
+    def bitmap(self, index, kind):
+        """
+        :returns: the MembershipIndex bitmap of the matching users, None
+                  if the plan cannot be evaluated on the bitmaps
+        """
+        return None
+
+
+class IndexLookup(Plan):
+    """
+    Equality on an attribute with a hash index.
+    """
+
+    cost = 1
+
+    def __init__(self, attr, value):
+        self.attr = attr
+        self.value = value
+
+    def execute(self, index, kind, candidates=None):
+        ids = index.lookup(kind, self.attr, self.value)
+        if candidates is not None:
+            ids = ids & candidates
+        return ids
+
+    def __repr__(self):
+        return "IndexLookup({} eq {!r})".format(self.attr, self.value)
+
+
+class SubstringLookup(Plan):
+    """
+    co, sw or ew comparison on an attribute with a trigram index. The
+    objects having all the trigrams of the value are then compared, as
+    the trigrams may be found at other positions or in other values.
+    """
+
+    cost = 10
+    # Below this number of candidates, comparing them is cheaper than
+    # intersecting the trigram postings
+    SCAN_LIMIT = 64
+
+    def __init__(self, attr, expr):
+        self.attr = attr
+        self.expr = expr
+
+    def execute(self, index, kind, candidates=None):
+        if candidates is None or len(candidates) > self.SCAN_LIMIT:
+            ids = index.substring_lookup(kind, self.attr, self.expr.op, self.expr.value)
+            candidates = ids if candidates is None else ids & candidates
+        return {id for id in candidates if self.expr.test(index.resolver(kind, id))}
+
+    def __repr__(self):
+        return "SubstringLookup({!r})".format(self.expr)
+
+
+class MembershipLookup(Plan):
+    """
+    Equality on the groups of a user or on the members of a group, like
+    groups.display eq "admins", resolved with the MembershipIndex.
+    """
+
+    cost = 2
+
+    def __init__(self, attr, sub_attr, value):
+        """
+        :param attr: "groups" or "members"
+        :param sub_attr: "value" or "display"
+        :param value: the normalized value
+        """
+        self.attr = attr
+        self.sub_attr = sub_attr
+        self.value = value
+
+    def _related(self, index):
+        """
+        Return the ids of the groups, or of the users, with the value.
+        """
+        if self.attr == "groups":
+            attr = "id" if self.sub_attr == "value" else "displayname"
+            return index.lookup("group", attr, self.value)
+        attr = "id" if self.sub_attr == "value" else "username"
+        return index.lookup("user", attr, self.value)
+
+    def bitmap(self, index, kind):
+        if self.attr != "groups":
+            return None
+        bitmap = 0
+        for gid in self._related(index):
+            bitmap |= index.members.bitmap(gid)
+        return bitmap
+
+    def execute(self, index, kind, candidates=None):
+        related = self._related(index)
+        if self.attr == "members":
+            ids = set()
+            for uid in related:
+                ids |= index.groups_by_user.get(uid, set())
+        elif candidates is not None:
+            # Cheaper than reading the members of large groups
+            return {
+                uid
+                for uid in candidates
+                if not related.isdisjoint(index.groups_by_user.get(uid, ()))
+            }
+        else:
+            ids = set()
+            for gid in related:
+                ids |= index.members.members(gid)
+        return ids if candidates is None else ids & candidates
+
+    def __repr__(self):
+        return "MembershipLookup({}.{} eq {!r})".format(
+            self.attr, self.sub_attr, self.value
+        )
+
+
+class Scan(Plan):
+    """
+    Evaluation of an expression on each candidate object.
+    """
+
+    cost = 1000
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def execute(self, index, kind, candidates=None):
+        if candidates is None:
+            candidates = index.objects(kind).keys()
+        return {id for id in candidates if self.expr.test(index.resolver(kind, id))}
+
+    def __repr__(self):
+        return "Scan({!r})".format(self.expr)
+
+
+class And(Plan):
+    def __init__(self, plans):
+        # The cheapest plans reduce the candidates of the next ones
+        self.plans = sorted(plans, key=lambda p: p.cost)
+        self.cost = self.plans[0].cost
+
+    def execute(self, index, kind, candidates=None):
+        for plan in self.plans:
+            candidates = plan.execute(index, kind, candidates)
+            if not candidates:
+                break
+        return candidates
+
+    def bitmap(self, index, kind):
+        bitmaps = [plan.bitmap(index, kind) for plan in self.plans]
+        if None in bitmaps:
+            return None
+        bitmap = bitmaps[0]
+        for other in bitmaps[1:]:
+            bitmap &= other
+        return bitmap
+
+    def __repr__(self):
+        return "And({})".format(", ".join(map(repr, self.plans)))
+
+
+class Or(Plan):
+    def __init__(self, plans):
+        self.plans = plans
+        self.cost = sum(p.cost for p in plans)
+
+    def execute(self, index, kind, candidates=None):
+        ids = set()
+        for plan in self.plans:
+            ids |= plan.execute(index, kind, candidates)
+        return ids
+
+    def bitmap(self, index, kind):
+        bitmaps = [plan.bitmap(index, kind) for plan in self.plans]
+        if None in bitmaps:
+            return None
+        bitmap = 0
+        for other in bitmaps:
+            bitmap |= other
+        return bitmap
+
+    def __repr__(self):
+        return "Or({})".format(", ".join(map(repr, self.plans)))
+
+
+class Not(Plan):
+    # The complement needs all the candidates
+    cost = Scan.cost
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def execute(self, index, kind, candidates=None):
+        if candidates is None:
+            candidates = set(index.objects(kind))
+        return candidates - self.plan.execute(index, kind, candidates)
+
+    def bitmap(self, index, kind):
+        bitmap = self.plan.bitmap(index, kind)
+        if bitmap is None:
+            return None
+        return index.members.everyone() & ~bitmap
+
+    def __repr__(self):
+        return "Not({!r})".format(self.plan)
+
+
+class QueryPlan:
+    """
+    SCIM filter compiled into a plan evaluated against the DirectoryIndex.
+
+    The equalities on an indexed attribute are resolved with the hash
+    indexes, the equalities on the groups or the members with the
+    membership index, and the co, sw and ew comparisons with the trigram
+    indexes when the value has at least one trigram. The other
+    comparisons only examine the objects selected by the indexed ones
+    when they are combined with "and".
+    """
+
+    def __init__(self, kind, filter_query):
+        """
+        :param kind: "user" or "group"
+        :param filter_query: the SCIM filter
+        :raises SCIMParserError: when the filter is invalid
+        :raises ValueError: when the filter uses an unknown attribute
+        """
+        self.kind = kind
+        self.filter_query = filter_query
+        # The (attribute, sub-attribute) used by the filter
+        self.attributes = set()
+        tree = SCIMParser().parse(SCIMLexer().tokenize(filter_query))
+        if tree is None:
+            raise ValueError("Invalid filter {}".format(filter_query))
+        self.root = self._compile(tree)
+
+    def __repr__(self):
+        return repr(self.root)
+
+    @property
+    def equality(self):
+        """
+        Return (attribute, value) if the filter is a single equality on the
+        id or the name, which SSSD can resolve directly, None otherwise.
+        """
+        if isinstance(self.root, IndexLookup) and self.root.attr in (
+            "id",
+            "username",
+            "displayname",
+        ):
+            return self.root.attr, self.root.value
+        return None
+
+    def execute(self, index):
+        """
+        :returns: the sorted ids of the matching objects
+        """
+        # The combinations of group memberships are computed on bitmaps,
+        # the members of a single group are read directly
+        if isinstance(self.root, (And, Or, Not)):
+            bitmap = self.root.bitmap(index, self.kind)
+            if bitmap is not None:
+                return sorted(index.members.ids(bitmap))
+        return sorted(self.root.execute(index, self.kind))
+
+    def _attribute(self, attr_path):
+        attr = attr_path.attr_name.lower()
+        sub_attr = attr_path.sub_attr.value.lower() if attr_path.sub_attr else None
+        if attr not in ATTRIBUTES[self.kind]:
+            raise ValueError("Unsupported filter attribute {}".format(attr))
+        self.attributes.add((attr, sub_attr))
+        return attr, sub_attr
+
+    def _compile(self, node):
+        if isinstance(node, ast.Filter):
+            if node.namespace is not None:
+                attr, _ = self._attribute(node.namespace)
+                plan = Scan(ValuePath(attr, self._compile_expr(node.expr)))
+            else:
+                plan = self._compile(node.expr)
+            return Not(plan) if node.negated else plan
+        if isinstance(node, ast.LogExpr):
+            plans = [self._compile(node.expr1), self._compile(node.expr2)]
+            cls = And if node.op.lower() == "and" else Or
+            # Flatten the nested and / or
+            flat = []
+            for plan in plans:
+                flat.extend(plan.plans if type(plan) is cls else [plan])
+            return cls(flat)
+        if isinstance(node, ast.AttrExpr):
+            attr, sub_attr = self._attribute(node.attr_path)
+            op = node.value.lower()
+            value = node.comp_value.value if node.comp_value is not None else None
+            path = attr if sub_attr is None else "{}.{}".format(attr, sub_attr)
+            indexes = _DirectoryIndex.INDEXED_ATTRIBUTES[self.kind]
+            if sub_attr is None and path + ".value" in indexes:
+                # A complex attribute without sub-attribute compares its value
+                path += ".value"
+            if op == "eq" and path in indexes:
+                case_exact = (attr, sub_attr) in CASE_EXACT_ATTRIBUTES
+                return IndexLookup(path, _normalize(value, case_exact))
+            if op == "eq" and attr == MEMBERSHIP_ATTRIBUTES[self.kind]:
+                sub_attr = sub_attr or "value"
+                if sub_attr in ("value", "display"):
+                    case_exact = (attr, sub_attr) in CASE_EXACT_ATTRIBUTES
+                    return MembershipLookup(
+                        attr, sub_attr, _normalize(value, case_exact)
+                    )
+            comparison = Comparison(attr, sub_attr, op, value)
+            path = SUBSTRING_ALIASES.get(path, path)
+            if path in _DirectoryIndex.SUBSTRING_ATTRIBUTES[self.kind] and (
+                TrigramIndex.query_trigrams(op, comparison.value)
+            ):
+                return SubstringLookup(path, comparison)
+            return Scan(comparison)
+        raise ValueError("Invalid filter {}".format(self.filter_query))
+
+    def _compile_expr(self, node):
+        """
+        Compile the filter of a value path into an expression evaluated on
+        each value of the attribute.
+        """
+        if isinstance(node, ast.Filter):
+            if node.namespace is not None:
+                raise ValueError("Nested value paths are not supported")
+            expr = self._compile_expr(node.expr)
+            return BooleanExpr("not", [expr]) if node.negated else expr
+        if isinstance(node, ast.LogExpr):
+            return BooleanExpr(
+                node.op.lower(),
+                [self._compile_expr(node.expr1), self._compile_expr(node.expr2)],
+            )
+        if isinstance(node, ast.AttrExpr):
+            attr = node.attr_path.attr_name.lower()
+            value = node.comp_value.value if node.comp_value is not None else None
+            return Comparison(attr, None, node.value.lower(), value)
+        raise ValueError("Invalid filter {}".format(self.filter_query))
+
+
+# Positions of the bits set in each byte value
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)]
+
+
+class MembershipIndex:
+    """
+    Members of the groups, by dense position of the users.
+
+    Each user gets the lowest free position, so that the positions stay
+    below the number of users. The members of a group are a set of
+    positions, which optimize() converts to a bitmap, a Python int with
+    the bit of each member set, when the bitmap is smaller. The bitmaps
+    of the groups are combined with the bitwise operators, in a few
+    milliseconds even with hundreds of thousands of users.
+    """
+
+    # A position costs about 32 bytes in a set, and 1 bit in a bitmap of
+    # all the users
+    DENSE_RATIO = 256
+
+    def __init__(self):
+        self._positions = {}
+        self._uids = []
+        # Heap of the free positions
+        self._free = []
+        self._members = {}
+        self._everyone = None
+
+    def add_user(self, uid):
+        """
+        :returns: the position of the user, a new one if it has none
+        """
+        position = self._positions.get(uid)
+        if position is None:
+            if self._free:
+                position = heapq.heappop(self._free)
+                self._uids[position] = uid
+            else:
+                position = len(self._uids)
+                self._uids.append(uid)
+            self._positions[uid] = position
+            self._everyone = None
+        return position
+
+    @staticmethod
+    def _to_bitmap(positions):
+        if not positions:
+            return 0
+        data = bytearray((max(positions) >> 3) + 1)
+        for position in positions:
+            data[position >> 3] |= 1 << (position & 7)
+        return int.from_bytes(data, "little")
+
+    @staticmethod
+    def _iter_bitmap(bitmap):
+        data = bitmap.to_bytes((bitmap.bit_length() + 7) >> 3, "little")
+        for i, byte in enumerate(data):
+            if byte:
+                base = i << 3
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def add_group(self, gid):
+        self._members.setdefault(gid, set())
+
+    def remove_group(self, gid):
+        """
+        :returns: the ids of the members of the removed group
+        """
+        uids = self.members(gid)
+        self._members.pop(gid, None)
+        return uids
+
+    def add(self, gid, uid):
+        position = self.add_user(uid)
+        members = self._members.get(gid)
+        if members is None:
+            self._members[gid] = {position}
+        elif isinstance(members, int):
+            self._members[gid] = members | (1 << position)
+        else:
+            members.add(position)
+
+    def remove_user(self, uid, gids):
+        """
+        Remove a user from its groups, and free its position.
+        """
+        position = self._positions.pop(uid, None)
+        if position is None:
+            return
+        for gid in gids:
+            members = self._members.get(gid)
+            if isinstance(members, int):
+                self._members[gid] = members & ~(1 << position)
+            elif members is not None:
+                members.discard(position)
+        self._uids[position] = None
+        heapq.heappush(self._free, position)
+        self._everyone = None
+
+    def members(self, gid):
+        """
+        :returns: the set of the ids of the members of the group
+        """
+        members = self._members.get(gid, ())
+        if isinstance(members, int):
+            members = self._iter_bitmap(members)
+        return {self._uids[position] for position in members}
+
+    def bitmap(self, gid):
+        members = self._members.get(gid, 0)
+        if isinstance(members, int):
+            return members
+        return self._to_bitmap(members)
+
+    def everyone(self):
+        """
+        :returns: the bitmap of all the users
+        """
+        if self._everyone is None:
+            free = self._to_bitmap(self._free)
+            self._everyone = ((1 << len(self._uids)) - 1) & ~free
+        return self._everyone
+
+    def ids(self, bitmap):
+        """
+        :returns: the set of the ids of the users of the bitmap
+        """
+        return {self._uids[position] for position in self._iter_bitmap(bitmap)}
+
+    def optimize(self):
+        """
+        Convert to bitmaps the sets of positions that take more memory.
+        The sets are not converted while they are filled, setting a bit
+        copies the whole bitmap.
+        """
+        size = len(self._uids)
+        for gid, members in self._members.items():
+            if isinstance(members, set) and len(members) * self.DENSE_RATIO > size:
+                self._members[gid] = self._to_bitmap(members)
+
+
+class TrigramIndex:
+    """
+    Ids of the objects by trigram of the values of an attribute.
+
+    The values are lowercase, and wrapped in start and end marks so that
+    the trigrams of a prefix or a suffix only match at the start or at
+    the end of a value.
+
+    The ids are stored in arrays of 32 bits integers, several times
+    smaller than sets. The ids are not removed from the arrays, as the
+    candidates are compared anyway, the DirectoryIndex rebuilds the index
+    once the removed entries are as many as the others.
+    """
+
+    START = "\x02"
+    END = "\x03"
+    # The postings larger than this ratio of the candidates are not
+    # intersected, comparing the candidates is cheaper
+    INTERSECT_RATIO = 16
+
+    def __init__(self):
+        self._postings = {}
+        # Number of entries, and of entries of the removed values
+        self.entries = 0
+        self.removed = 0
+
+    @classmethod
+    def trigrams(cls, value):
+        value = cls.START + value + cls.END
+        return {value[i : i + 3] for i in range(len(value) - 2)}
+
+    @classmethod
+    def query_trigrams(cls, op, value):
+        """
+        Return the trigrams an object must have to match the comparison,
+        an empty set when the value is too short to have one.
+        """
+        if not value:
+            return set()
+        if op == "sw":
+            value = cls.START + value
+        elif op == "ew":
+            value = value + cls.END
+        elif op != "co":
+            return set()
+        return {value[i : i + 3] for i in range(len(value) - 2)}
+
+    def add(self, id, values):
+        for value in values:
+            for trigram in self.trigrams(value):
+                ids = self._postings.get(trigram)
+                if ids is None:
+                    ids = self._postings[trigram] = array.array("I")
+                ids.append(id)
+                self.entries += 1
+
+    def remove(self, id, values):
+        for value in values:
+            self.removed += len(self.trigrams(value))
+
+    def lookup(self, op, value):
+        """
+        Return the ids of the objects that may match the comparison,
+        including removed objects.
+        """
+        postings = []
+        for trigram in self.query_trigrams(op, value):
+            ids = self._postings.get(trigram)
+            if ids is None:
+                return set()
+            postings.append(ids)
+        # Intersect from the most selective trigram
+        postings.sort(key=len)
+        ids = set(postings[0])
+        for other in postings[1:]:
+            if not ids or len(other) > len(ids) * self.INTERSECT_RATIO:
+                break
+            ids.intersection_update(other)
+        return ids
+
+    def __len__(self):
+        return len(self._postings)
+
+
+def _bisect(ids, key, sort_key):
+    """
+    Return the position of the sort key in the list of ids ordered by
+    sort_key, like bisect.bisect_left(ids, key, key=sort_key) in Python
+    3.10.
+    """
+    lo, hi = 0, len(ids)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if sort_key(ids[mid]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _range(ids, start, stop, descending=False):
+    """
+    Return the ids from position start to stop of the ordered list, or of
+    the list in reverse order.
+    """
+    if not descending:
+        return ids[start:stop]
+    size = len(ids)
+    return ids[max(size - stop, 0) : max(size - start, 0)][::-1]
+
+
+def _after(ids, key, count, sort_key, descending=False, selected=None):
+    """
+    Return the count ids following the sort key in the ordered list, or
+    preceding it in descending order.
+
+    :param key: the sort key of the last id of the previous page, None
+                for the first page
+    :param selected: the set of the ids to return, None for all
+    """
+    if key is None:
+        position = len(ids) if descending else 0
+    else:
+        position = _bisect(ids, key, sort_key)
+        if not descending and position < len(ids) and sort_key(ids[position]) == key:
+            position += 1
+    if selected is None:
+        if descending:
+            return ids[max(position - count, 0) : position][::-1]
+        return ids[position : position + count]
+    if descending:
+        positions = range(position - 1, -1, -1)
+    else:
+        positions = range(position, len(ids))
+    result = []
+    for i in positions:
+        if len(result) >= count:
+            break
+        if ids[i] in selected:
+            result.append(ids[i])
+    return result
+
+
+class SortIndex:
+    """
+    Ids of the objects ordered by the sort key of an attribute, then by id.
+    The objects without value come last.
+
+    Only the ids are stored, the keys are computed from the objects when
+    needed. The ids added are merged on the next read, sorting the whole
+    list once after a load is cheaper than inserting them one by one.
+    """
+
+    # Above this number of ids to merge, the list is sorted again
+    MERGE_THRESHOLD = 64
+
+    def __init__(self, objects, sort_key):
+        """
+        :param objects: the dict of the objects by id
+        :param sort_key: callable returning the sort key of an object
+        """
+        self._objects = objects
+        self._sort_key = sort_key
+        self._ids = []
+        self._pending = []
+
+    def key(self, id):
+        value = self._sort_key(self._objects[id])
+        return (value is None, value or "", id)
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def __contains__(self, id):
+        return id in self._objects
+
+    def add(self, id):
+        self._pending.append(id)
+
+    def remove(self, id):
+        """
+        Remove an id, before its object is removed from the objects.
+        """
+        if len(self._pending) > self.MERGE_THRESHOLD:
+            self.flush()
+        elif id in self._pending:
+            self._pending.remove(id)
+            return
+        i = _bisect(self._ids, self.key(id), self.key)
+        if i < len(self._ids) and self._ids[i] == id:
+            del self._ids[i]
+
+    def flush(self):
+        """
+        Merge the ids added since the last read.
+        """
+        if len(self._pending) > self.MERGE_THRESHOLD:
+            self._ids.extend(self._pending)
+            self._ids.sort(key=self.key)
+        else:
+            for id in self._pending:
+                self._ids.insert(_bisect(self._ids, self.key(id), self.key), id)
+        self._pending = []
+
+    def range(self, start, stop, descending=False):
+        """
+        Return the ids from position start to stop.
+        """
+        self.flush()
+        return _range(self._ids, start, stop, descending)
+
+    def after(self, key, count, descending=False, selected=None):
+        """
+        Return the count ids following the sort key, see _after().
+        """
+        self.flush()
+        return _after(self._ids, key, count, self.key, descending, selected)
+
+    def __iter__(self):
+        self.flush()
+        return iter(self._ids)
+
+    def __reversed__(self):
+        self.flush()
+        return reversed(self._ids)
+
+
+class SortedIds:
+    """
+    Sequence of the ids of the objects of a SortIndex, or of the results
+    of a filter, ordered by the SortIndex.
+
+    A slice of all the objects costs O(slice size). The results of a
+    filter are sorted when they are a small share of the objects, and
+    otherwise picked in the order of the SortIndex until the end of the
+    slice.
+
+    The pages of a cursor pagination start after the sort key of the last
+    id of the previous page, they cost the same at any depth and are not
+    shifted by the objects added or removed in the meantime.
+    """
+
+    # Share of the objects below which the filter results are sorted
+    SORT_RATIO = 16
+
+    def __init__(self, index, sort_index, descending=False, ids=None):
+        """
+        :param index: the DirectoryIndex, locked while reading
+        :param sort_index: the SortIndex ordering the ids
+        :param descending: reverse the order of the SortIndex
+        :param ids: the set of the ids of the filter results, None for all
+        """
+        self._index = index
+        self._sort_index = sort_index
+        self._descending = descending
+        self._ids = ids
+        self._sorted = None
+
+    def __len__(self):
+        if self._ids is None:
+            return len(self._sort_index)
+        return len(self._ids)
+
+    def __contains__(self, id):
+        if self._ids is None:
+            return id in self._sort_index
+        return id in self._ids
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            ids = self[index : index + 1]
+            if not ids:
+                raise IndexError("SortedIds index out of range")
+            return ids[0]
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("SortedIds slices do not support a step")
+        with self._index._lock:
+            if self._ids is None:
+                return self._sort_index.range(start, stop, self._descending)
+            if self._sort_results():
+                return _range(self._sorted, start, stop, self._descending)
+            return self._pick(start, stop)
+
+    def after(self, key, count):
+        """
+        Return the page of count ids following the sort key.
+
+        :param key: the sort key of the last id of the previous page, None
+                    for the first page
+        :returns: (list of ids, sort key of the last id or None if no page
+                  follows)
+        """
+        with self._index._lock:
+            # One more id tells if a page follows
+            if self._ids is None:
+                ids = self._sort_index.after(key, count + 1, self._descending)
+            elif self._sort_results():
+                ids = _after(
+                    self._sorted, key, count + 1, self._sort_key, self._descending
+                )
+            else:
+                ids = self._sort_index.after(
+                    key, count + 1, self._descending, self._ids
+                )
+            more = len(ids) > count
+            ids = ids[:count]
+            next_key = self._sort_key(ids[-1]) if more and ids else None
+        return ids, next_key
+
+    def _sort_results(self):
+        """
+        Sort the filter results when they are few, returns True if they
+        were sorted.
+        """
+        if self._sorted is None:
+            if len(self._ids) * self.SORT_RATIO < len(self._sort_index):
+                self._sorted = sorted(self._ids, key=self._sort_key)
+        return self._sorted is not None
+
+    def _sort_key(self, id):
+        return self._sort_index.key(id)
+
+    def _pick(self, start, stop):
+        ids = reversed(self._sort_index) if self._descending else self._sort_index
+        result = []
+        position = 0
+        for id in ids:
+            if position >= stop:
+                break
+            if id in self._ids:
+                if position >= start:
+                    result.append(id)
+                position += 1
+        return result
+
+
+class _DirectoryIndex:
+    """
+    In-memory copy of the users and groups, with hash, trigram, sort and
+    membership indexes.
+
+    The index is loaded with all the users and groups the first time a
+    filter needs it, from the DirectoryEntry mirror maintained by "manage.py
+    syncdirectory". The SSSD enumeration, limited to the wildcard_limit of
+    sssd.conf, is only used instead with DIRECTORY_INDEX_SSSD_ENUMERATION.
+    The index is then reloaded in a background thread every
+    DIRECTORY_INDEX_REFRESH_INTERVAL seconds, the queries using the previous
+    content in the meantime. The users added, modified or removed through
+    ipa-tuura are read again before the next query.
+    """
+
+    _instance = None
+
+    # Attributes with a hash index, as "attr" or "attr.sub_attr"
+    INDEXED_ATTRIBUTES = {
+        "user": {
+            "id": lambda index, user: [str(user.id)],
+            "username": lambda index, user: [user.username.lower()],
+            "emails.value": lambda index, user: [m.lower() for m in user.mail or []],
+        },
+        "group": {
+            "id": lambda index, group: [str(group.id)],
+            "displayname": lambda index, group: [group.name.lower()],
+        },
+    }
+
+    # Attributes with a trigram index for the co, sw and ew comparisons
+    SUBSTRING_ATTRIBUTES = {
+        "user": {
+            "username": lambda user: [user.username.lower()],
+            "emails.value": lambda user: [m.lower() for m in user.mail or []],
+            "name.givenname": lambda user: _values(user.first_name),
+            "name.familyname": lambda user: _values(user.last_name),
+            "displayname": lambda user: _values(_full_name(user)),
+        },
+        "group": {
+            "displayname": lambda group: [group.name.lower()],
+        },
+    }
+
+    def __init__(self):
+        self.refresh_interval = getattr(
+            settings, "DIRECTORY_INDEX_REFRESH_INTERVAL", 300
+        )
+        self._lock = threading.RLock()
+        self._loading = threading.Lock()
+        self._clear()
+        self.loaded = None
+        # Number of loads, identifies the snapshot used by a cursor
+        self.generation = 0
+        # Names of the users to read again from SSSD
+        self._pending = set()
+
+    def _clear(self):
+        self.users = {}
+        self.groups = {}
+        self.users_by_name = {}
+        self.groups_by_name = {}
+        self.groups_by_user = {}
+        self.members = MembershipIndex()
+        self._hashes = {
+            kind: {attr: {} for attr in attrs}
+            for kind, attrs in self.INDEXED_ATTRIBUTES.items()
+        }
+        self._trigrams = {
+            kind: {attr: TrigramIndex() for attr in attrs}
+            for kind, attrs in self.SUBSTRING_ATTRIBUTES.items()
+        }
+        self._sort_indexes = {
+            kind: {
+                attr: SortIndex(self.objects(kind), sort_key)
+                for attr, sort_key in attrs.items()
+            }
+            for kind, attrs in SORT_ATTRIBUTES.items()
+        }
+
+    def objects(self, kind):
+        return self.users if kind == "user" else self.groups
+
+    def lookup(self, kind, attr, value):
+        """
+        Return the ids of the objects whose attribute has the given
+        normalized value.
+        """
+        return set(self._hashes[kind][attr].get(value, ()))
+
+    def substring_lookup(self, kind, attr, op, value):
+        """
+        Return the ids of the objects whose attribute may match the co, sw
+        or ew comparison with the normalized value.
+        """
+        ids = self._trigrams[kind][attr].lookup(op, value)
+        # The removed objects are still in the trigram index
+        return ids & self.objects(kind).keys()
+
+    def resolver(self, kind, id):
+        """
+        Return a callable giving the values of an attribute of an object.
+        """
+        obj = self.objects(kind)[id]
+        attributes = ATTRIBUTES[kind]
+        return lambda attr: attributes[attr](self, obj)
+
+    def _index(self, kind, obj):
+        for attr, getter in self.INDEXED_ATTRIBUTES[kind].items():
+            for value in getter(self, obj):
+                self._hashes[kind][attr].setdefault(value, set()).add(obj.id)
+        for attr, getter in self.SUBSTRING_ATTRIBUTES[kind].items():
+            trigrams = self._trigrams[kind][attr]
+            if trigrams.removed > trigrams.entries // 2:
+                trigrams = self._rebuild_trigrams(kind, attr, exclude=obj.id)
+            trigrams.add(obj.id, getter(obj))
+        for sort_index in self._sort_indexes[kind].values():
+            sort_index.add(obj.id)
+
+    def _rebuild_trigrams(self, kind, attr, exclude=None):
+        getter = self.SUBSTRING_ATTRIBUTES[kind][attr]
+        trigrams = TrigramIndex()
+        for obj in self.objects(kind).values():
+            if obj.id != exclude:
+                trigrams.add(obj.id, getter(obj))
+        self._trigrams[kind][attr] = trigrams
+        return trigrams
+
+    def _unindex(self, kind, obj):
+        for attr, getter in self.INDEXED_ATTRIBUTES[kind].items():
+            hashes = self._hashes[kind][attr]
+            for value in getter(self, obj):
+                ids = hashes.get(value)
+                if ids is not None:
+                    ids.discard(obj.id)
+                    if not ids:
+                        del hashes[value]
+        for attr, getter in self.SUBSTRING_ATTRIBUTES[kind].items():
+            self._trigrams[kind][attr].remove(obj.id, getter(obj))
+        for sort_index in self._sort_indexes[kind].values():
+            sort_index.remove(obj.id)
+
+    def add_user(self, sssduser):
+        """
+        Add or replace a user, with the group memberships of
+        sssduser.groups when it was read with its groups.
+        """
+        with self._lock:
+            self.remove_user(sssduser.id)
+            user = copy.copy(sssduser)
+            user.groups = []
+            self.users[user.id] = user
+            self.users_by_name[user.username] = user.id
+            self._index("user", user)
+            self.groups_by_user[user.id] = set()
+            self.members.add_user(user.id)
+            for name in sssduser.groups or ():
+                gid = self.groups_by_name.get(name)
+                if gid is not None:
+                    self._add_member(gid, user.id)
+
+    def remove_user(self, id):
+        with self._lock:
+            user = self.users.get(id)
+            if user is None:
+                return
+            # The sort indexes read the user being removed
+            self._unindex("user", user)
+            del self.users[id]
+            self.users_by_name.pop(user.username, None)
+            self.members.remove_user(id, self.groups_by_user.pop(id, ()))
+
+    def add_group(self, sssdgroup):
+        """
+        Add or replace a group, with the members of sssdgroup.members.
+        """
+        with self._lock:
+            self.remove_group(sssdgroup.id)
+            group = copy.copy(sssdgroup)
+            group.members = []
+            self.groups[group.id] = group
+            self.groups_by_name[group.name] = group.id
+            self._index("group", group)
+            self.members.add_group(group.id)
+            for name in sssdgroup.members or ():
+                uid = self.users_by_name.get(name)
+                if uid is not None:
+                    self._add_member(group.id, uid)
+
+    def remove_group(self, id):
+        with self._lock:
+            group = self.groups.get(id)
+            if group is None:
+                return
+            self._unindex("group", group)
+            del self.groups[id]
+            self.groups_by_name.pop(group.name, None)
+            for uid in self.members.remove_group(id):
+                self.groups_by_user[uid].discard(id)
+
+    def _add_member(self, gid, uid):
+        self.members.add(gid, uid)
+        self.groups_by_user.setdefault(uid, set()).add(gid)
+
+    # SSSD client interface used by the model converters
+    def find_user_by_name(self, username, retrieve_groups=False):
+        with self._lock:
+            uid = self.users_by_name.get(username)
+            if uid is None:
+                raise SSSDNotFoundException("User {} not found".format(username))
+            user = copy.copy(self.users[uid])
+            if retrieve_groups:
+                user.groups = [
+                    self.groups[gid].name for gid in self.groups_by_user.get(uid, ())
+                ]
+            return user
+
+    def find_group_by_name(self, name, retrieve_members=False):
+        with self._lock:
+            gid = self.groups_by_name.get(name)
+            if gid is None:
+                raise SSSDNotFoundException("Group {} not found".format(name))
+            group = copy.copy(self.groups[gid])
+            if retrieve_members:
+                group.members = [
+                    self.users[uid].username
+                    for uid in sorted(self.members.members(gid))
+                ]
+            return group
+
+    def find_user_by_id(self, id, retrieve_groups=False):
+        with self._lock:
+            user = self.users.get(int(id))
+            if user is None:
+                raise SSSDNotFoundException("User {} not found".format(id))
+            return self.find_user_by_name(user.username, retrieve_groups)
+
+    def find_group_by_id(self, id, retrieve_members=False):
+        with self._lock:
+            group = self.groups.get(int(id))
+            if group is None:
+                raise SSSDNotFoundException("Group {} not found".format(id))
+            return self.find_group_by_name(group.name, retrieve_members)
+
+    # Loading
+    def load(self, sssd_if=None):
+        """
+        Load all the users and groups, replacing the current content. They
+        are read from the local mirror once "manage.py syncdirectory" has
+        loaded it, and enumerated by SSSD otherwise if
+        DIRECTORY_INDEX_SSSD_ENUMERATION is set.
+
+        :param sssd_if: SSSD interface obtained with sssd_if = SSSD()
+        :raises DirectoryIndexUnavailableException: if the mirror is not
+            complete and the SSSD enumeration is not allowed
+        """
+        start = time.monotonic()
+        loaded = _DirectoryIndex()
+        complete = DirectorySyncState.objects.filter(complete=True).count()
+        if complete == len(DirectoryEntry.Kind):
+            loaded._load_mirror()
+        elif getattr(settings, "DIRECTORY_INDEX_SSSD_ENUMERATION", False):
+            loaded._load_sssd(sssd_if or SSSD())
+        else:
+            raise DirectoryIndexUnavailableException(
+                'The directory is not synchronized, run "manage.py syncdirectory"'
+            )
+        for sort_indexes in loaded._sort_indexes.values():
+            for sort_index in sort_indexes.values():
+                sort_index.flush()
+        loaded.members.optimize()
+
+        with self._lock:
+            for attr in (
+                "users",
+                "groups",
+                "users_by_name",
+                "groups_by_name",
+                "groups_by_user",
+                "members",
+                "_hashes",
+                "_trigrams",
+                "_sort_indexes",
+            ):
+                setattr(self, attr, getattr(loaded, attr))
+            self.loaded = time.monotonic()
+            self.generation += 1
+        logger.info(
+            f"Directory index loaded with {len(self.users)} users and "
+            f"{len(self.groups)} groups in {self.loaded - start:.1f}s"
+        )
+
+    def _load_sssd(self, sssd_if):
+        limit = getattr(settings, "SSSD_LIST_LIMIT", 0)
+        uids = sssd_if.list_user_ids(limit)
+        gids = sssd_if.list_group_ids(limit)
+        for kind, ids in (("users", uids), ("groups", gids)):
+            if len(ids) >= (limit or SSSD_WILDCARD_LIMIT):
+                logger.warning(
+                    f"The SSSD enumeration of the {kind} returned {len(ids)} "
+                    f"entries, it may be truncated by the limit, the filters "
+                    f"and the sorted listings are incomplete"
+                )
+        for uid in uids:
+            try:
+                self.add_user(sssd_if.find_user_by_id(str(uid)))
+            except SSSDNotFoundException:
+                continue
+        for gid in gids:
+            try:
+                self.add_group(sssd_if.find_group_by_id(str(gid), True))
+            except SSSDNotFoundException:
+                continue
+
+    def _load_mirror(self):
+        # The entries without uid or gid number are unknown to SSSD
+        users = DirectoryEntry.objects.filter(kind="user", number__isnull=False)
+        for entry in users.iterator():
+            self.add_user(
+                SSSDUser(
+                    entry.number,
+                    entry.name,
+                    givenname=entry.attrs.get("givenname"),
+                    sn=entry.attrs.get("sn"),
+                    mail=entry.attrs.get("mail"),
+                    active=entry.attrs.get("active"),
+                    modified=_timestamp(entry.modified),
+                )
+            )
+        members = {}
+        for group_id, username in DirectoryMember.objects.values_list(
+            "group_id", "username"
+        ).iterator():
+            members.setdefault(group_id, []).append(username)
+        groups = DirectoryEntry.objects.filter(kind="group", number__isnull=False)
+        for entry in groups.iterator():
+            group = SSSDGroup(entry.number, entry.name, _timestamp(entry.modified))
+            group.set_members(members.get(entry.pk, []))
+            self.add_group(group)
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"Unable to reload the directory index {e}")
+        finally:
+            # The database connections of the thread are not reused
+            connections.close_all()
+            self._loading.release()
+
+    def ensure_loaded(self):
+        """
+        Load the index if it was never loaded, start a reload in the
+        background if it is older than the refresh interval, and read
+        again the users changed through ipa-tuura.
+        """
+        if self.loaded is None:
+            with self._loading:
+                if self.loaded is None:
+                    self.load()
+        elif time.monotonic() - self.loaded > self.refresh_interval:
+            if self._loading.acquire(blocking=False):
+                threading.Thread(target=self._reload, daemon=True).start()
+
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        if pending:
+            sssd_if = SSSD()
+            for username in pending:
+                self._refresh_user(sssd_if, username)
+
+    def _refresh_user(self, sssd_if, username):
+        with self._lock:
+            uid = self.users_by_name.get(username)
+            if uid is not None:
+                self.remove_user(uid)
+        try:
+            self.add_user(sssd_if.find_user_by_name(username, retrieve_groups=True))
+        except SSSDNotFoundException:
+            pass
+
+    def invalidate_user(self, username):
+        """
+        Read the user again before the next query, for instance when it was
+        added, modified or removed.
+        """
+        with self._lock:
+            self._pending.add(username)
+
+    def search(self, plan):
+        """
+        Return the sorted ids of the objects matching the QueryPlan.
+        """
+        self.ensure_loaded()
+        with self._lock:
+            return plan.execute(self)
+
+    def sorted(self, kind, sort_by, descending=False, plan=None):
+        """
+        Return the ids of the objects, or of the objects matching the
+        QueryPlan, ordered by an attribute of SORT_ATTRIBUTES.
+
+        :param kind: "user" or "group"
+        :param sort_by: the lowercase attribute, like "name.familyname"
+        :param descending: sort in descending order
+        :param plan: the QueryPlan of the filter, None for all the objects
+        :returns: a SortedIds sequence
+        :raises: ValueError if the attribute cannot be sorted
+        """
+        sort_index = self._sort_indexes[kind].get(sort_by)
+        if sort_index is None:
+            raise ValueError("Unsupported sortBy attribute {}".format(sort_by))
+        ids = None
+        if plan is not None:
+            ids = set(self.search(plan))
+        else:
+            self.ensure_loaded()
+        with self._lock:
+            # A reload replaces the sort indexes, keep the current one
+            sort_index = self._sort_indexes[kind][sort_by]
+        return SortedIds(self, sort_index, descending, ids)
+
+    def _reset_instance(self):
+        """
+        Drop the content, the index is loaded again by the next query
+        """
+        self.__init__()
+        logger.info("Reset directory index")
+
+
+def DirectoryIndex():
+    if _DirectoryIndex._instance is None:
+        _DirectoryIndex._instance = _DirectoryIndex()
+    return _DirectoryIndex._instance
@@ -5,18 +5,24 @@
 import datetime
 import logging
 import os
+import queue
+import threading
+import time
 import uuid
 from decimal import Decimal
+from urllib.parse import urlparse
 
 import domains
 import gssapi
 import ldap
+import ldap.filter
 import ldap.modlist as modlist
 import six
 from cryptography import x509 as crypto_x509
 from cryptography.hazmat.primitives import serialization as x509
+from django.conf import settings
 from ipalib import api
-from ipalib.errors import EmptyModlist
+from ipalib.errors import DuplicateEntry, EmptyModlist
 from ipalib.facts import is_ipa_client_configured
 from ipalib.install.kinit import kinit_keytab
 from ipalib.krb_utils import get_credentials_if_valid
@@ -24,6 +30,10 @@ from ipapython import admintool
 from ipapython.dn import DN
 from ipapython.dnsutil import DNSName
 from ipapython.kerberos import Principal
+from ldap.controls import LDAPControl, SimplePagedResultsControl
+from scim.directory import DirectoryIndex
+from scim.sssd import SSSD, IdentityCache, SSSDNotFoundException
+from scim.sync import DirectoryRecord, DirectorySource, mark_stale
 
 if six.PY3:
     unicode = str
@@ -34,6 +44,13 @@ logger = logging.getLogger(__name__)
 
 LDAP_GENERALIZED_TIME_FORMAT = "%Y%m%d%H%M%SZ"
 
+# Commands of the IPA batches, by operation of the writable interfaces
+IPA_BATCH_COMMANDS = {
+    "add": "user_add",
+    "modify": "user_mod",
+    "delete": "user_del",
+}
+
 
 class LDAPNotFoundException(Exception):
     """
@@ -51,6 +68,187 @@ class IPANotFoundException(Exception):
     pass
 
 
+class LDAPUnavailableException(Exception):
+    """
+    Exception returned when no LDAP connection is available.
+    """
+
+    pass
+
+
+class UserExistsException(Exception):
+    """
+    Exception returned when the user to add already exists.
+    """
+
+    pass
+
+
+class LDAPPool:
+    """
+    Pool of bound LDAP connections shared by the request threads.
+
+    At most LDAP_POOL_SIZE connections are opened, a thread waits up to
+    LDAP_POOL_TIMEOUT seconds for a connection to be returned to the pool
+    when they are all in use.
+
+    The servers close the connections idle for too long (nsslapd-idletimeout,
+    MaxConnIdleTime), so a connection idle for more than
+    LDAP_POOL_PROBE_INTERVAL seconds is probed with a WhoAmI operation
+    before it is used, and replaced if it was closed. An operation failing
+    with SERVER_DOWN is retried once on a new connection.
+    """
+
+    def __init__(self, connect):
+        """
+        :param connect: callable returning a new bound connection
+        """
+        self.connect = connect
+        self.size = getattr(settings, "LDAP_POOL_SIZE", 4)
+        self.timeout = getattr(settings, "LDAP_POOL_TIMEOUT", 30)
+        self.probe_interval = getattr(settings, "LDAP_POOL_PROBE_INTERVAL", 60)
+        # Idle connections, with the time they were returned
+        self._connections = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # Metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.probes = 0
+        self.reconnects = 0
+
+    def _open(self):
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _replace(self, conn):
+        """
+        Return a new connection in place of a closed one.
+        """
+        self._discard(conn)
+        with self._lock:
+            self.reconnects += 1
+        conn = self._open()
+        if conn is None:
+            # Taken by another thread in the meantime
+            conn = self._checkout()
+        return conn
+
+    def _alive(self, conn):
+        with self._lock:
+            self.probes += 1
+        try:
+            conn.whoami_s()
+        except ldap.LDAPError as e:
+            logger.info(f"Idle LDAP connection closed: {e}")
+            return False
+        return True
+
+    def _checkout(self):
+        try:
+            conn, returned = self._connections.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+            if conn is not None:
+                return conn
+            start = time.monotonic()
+            try:
+                conn, returned = self._connections.get(timeout=self.timeout)
+            except queue.Empty:
+                raise LDAPUnavailableException(
+                    "No LDAP connection available after {}s".format(self.timeout)
+                )
+            with self._lock:
+                self.waits += 1
+                self.wait_time += time.monotonic() - start
+
+        idle = time.monotonic() - returned
+        if idle > self.probe_interval and not self._alive(conn):
+            conn = self._replace(conn)
+        return conn
+
+    def fill(self):
+        """
+        Open a connection, so that the errors of the configuration of the
+        integration domain are raised now rather than by the first write.
+        """
+        conn = self._open()
+        if conn is not None:
+            self._connections.put((conn, time.monotonic()))
+
+    def run(self, operation):
+        """
+        Call operation with a connection of the pool.
+
+        :param operation: callable taking a bound connection
+        :returns: the result of the operation
+        :raises LDAPUnavailableException: if no connection is available in
+            time
+        """
+        conn = self._checkout()
+        with self._lock:
+            self.checkouts += 1
+        try:
+            try:
+                return operation(conn)
+            except ldap.SERVER_DOWN:
+                logger.info("LDAP connection lost, reconnecting")
+                stale, conn = conn, None
+                conn = self._replace(stale)
+                return operation(conn)
+        except ldap.SERVER_DOWN:
+            # Lost again, the server is down
+            if conn is not None:
+                stale, conn = conn, None
+                self._discard(stale)
+            raise
+        finally:
+            if conn is not None:
+                self._connections.put((conn, time.monotonic()))
+
+    def close(self):
+        """
+        Unbind the idle connections.
+        """
+        while True:
+            try:
+                conn, _ = self._connections.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(conn)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": self._connections.qsize(),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "probes": self.probes,
+                "reconnects": self.reconnects,
+            }
+
+
 class IPAAPI(admintool.AdminTool):
     """
     Initialization of the IPA API writable interface
@@ -93,7 +291,8 @@ class IPAAPI(admintool.AdminTool):
         if not self._backend.isconnected():
             self._backend.connect(ccache=os.environ.get("KRB5CCNAME", None))
 
-    def _valid_creds(self):
+    @staticmethod
+    def _valid_creds():
         # try GSSAPI first
         if "KRB5CCNAME" in os.environ:
             ccache = os.environ["KRB5CCNAME"]
@@ -140,31 +339,74 @@ class IPAAPI(admintool.AdminTool):
         Add a new user
 
         :param scim_user: user object conforming to the SCIM User Schema
+        :raises UserExistsException: if a user with the username exists
         """
         self._ipa_connect()
-        result = api.Command["user_add"](
-            uid=scim_user.obj.username,
-            givenname=scim_user.obj.first_name,
-            sn=scim_user.obj.last_name,
-            mail=scim_user.obj.email,
-        )
+        try:
+            result = api.Command["user_add"](
+                uid=scim_user.obj.username,
+                givenname=scim_user.obj.first_name,
+                sn=scim_user.obj.last_name,
+                mail=scim_user.obj.email,
+            )
+        except DuplicateEntry:
+            raise UserExistsException(
+                "User {} already exists".format(scim_user.obj.username)
+            )
         logger.info(f"ipa user_add result {result}")
 
-    def modify(self, scim_user):
+    def modify(self, scim_user, attrs=None):
         """
         Modify user
 
         :param scim_user: user object conforming to the SCIM User Schema
+        :param attrs: dict of the givenname, sn and mail to modify, all of
+            them by default
         :raises IPANotFoundException: if no user matching the username exists
         """
+        if attrs is None:
+            attrs = user_attrs(scim_user)
         self._ipa_connect()
         try:
-            result = api.Command["user_mod"](
-                scim_user.obj.username,
-                givenname=scim_user.obj.first_name,
-                sn=scim_user.obj.last_name,
-                mail=scim_user.obj.email,
+            result = api.Command["user_mod"](scim_user.obj.username, **attrs)
+        except EmptyModlist:
+            logger.debug("No modification for user {}".format(scim_user.obj.username))
+            return
+        except Exception:
+            raise IPANotFoundException(
+                "User {} not found".format(scim_user.obj.username)
             )
+        logger.info(f"ipa: user_mod result {result}")
+
+    def patch(self, scim_user, changes):
+        """
+        Modify the attributes of a user targeted by a PATCH request
+
+        The replaced attributes are passed as options of user_mod, the
+        values added and removed with addattr and delattr.
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        :param changes: list of (op, attr, values), see fold_changes()
+        :raises IPANotFoundException: if no user matching the username exists
+        """
+        options = {}
+        addattr = []
+        delattr = []
+        for op, attr, values in changes:
+            if op == "replace":
+                # None removes the attribute
+                options[attr] = values[0] if len(values) == 1 else values or None
+            elif op == "add":
+                addattr.extend("{}={}".format(attr, v) for v in values)
+            else:
+                delattr.extend("{}={}".format(attr, v) for v in values)
+        if addattr:
+            options["addattr"] = addattr
+        if delattr:
+            options["delattr"] = delattr
+        self._ipa_connect()
+        try:
+            result = api.Command["user_mod"](scim_user.obj.username, **options)
         except EmptyModlist:
             logger.debug("No modification for user {}".format(scim_user.obj.username))
             return
@@ -190,6 +432,54 @@ class IPAAPI(admintool.AdminTool):
             )
         logger.info(f"ipa: user_del result {result}")
 
+    def batch(self, op, items):
+        """
+        Add, modify or delete several users with a single batch command
+
+        :param op: "add", "modify" or "delete"
+        :param items: list of (scim_user, attrs), attrs being the dict of
+            the attributes to modify
+        :returns: the list of the errors of the users, None for the users
+            written
+        """
+        methods = []
+        for scim_user, attrs in items:
+            if op == "add":
+                options = user_attrs(scim_user)
+            elif op == "modify":
+                options = attrs
+            else:
+                options = {}
+            methods.append(
+                {
+                    "method": IPA_BATCH_COMMANDS[op],
+                    "params": [[scim_user.obj.username], options],
+                }
+            )
+        self._ipa_connect()
+        results = api.Command["batch"](*methods)["results"]
+        errors = []
+        for (scim_user, _), item in zip(items, results):
+            name = item.get("error_name")
+            if not item.get("error") or (op == "modify" and name == "EmptyModlist"):
+                errors.append(None)
+            elif name == "NotFound":
+                errors.append(
+                    IPANotFoundException(
+                        "User {} not found".format(scim_user.obj.username)
+                    )
+                )
+            elif name == "DuplicateEntry":
+                errors.append(
+                    UserExistsException(
+                        "User {} already exists".format(scim_user.obj.username)
+                    )
+                )
+            else:
+                errors.append(RuntimeError("ipa: {}".format(item["error"])))
+        logger.info(f"ipa: batch {op} of {len(items)} users")
+        return errors
+
 
 class LDAP:
     """
@@ -197,7 +487,7 @@ class LDAP:
     """
 
     def __init__(self):
-        self._conn = None
+        self._pool = None
         # The client_id is used as the 'Bind DN' object
         self._client_id = None
         self._client_secret = None
@@ -211,7 +501,14 @@ class LDAP:
         self._sasl_gssapi = ldap.sasl.sasl({}, "GSSAPI")
         # init and connect
         self._fetch_domain()
-        self._conn = self._bind()
+        self._connect()
+
+    def _connect(self):
+        """
+        Open the pool of connections of the writes
+        """
+        self._pool = LDAPPool(self._bind)
+        self._pool.fill()
 
     def _fetch_domain(self):
         """
@@ -236,23 +533,28 @@ class LDAP:
 
     def _bind(self):
         """
-        Bind to ldap server
+        Open a new connection bound to the ldap server
         """
-        self._fetch_domain()
         # TODO enable TLS support
-        # self._conn = ldap.initialize(self._ldap_uri)
-        # self._conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
-        # self._conn.sasl_interactive_bind_s('', self._sasl_gssapi)
-        self._conn = ldap.initialize(self._ldap_uri)
-        self._conn.protocol_version = 3
-        self._conn.set_option(ldap.OPT_REFERRALS, 0)
+        # conn = ldap.initialize(self._ldap_uri)
+        # conn.set_option(ldap.OPT_X_TLS_CACERTFILE, self._tls_cacert)
+        # conn.sasl_interactive_bind_s('', self._sasl_gssapi)
+        conn = ldap.initialize(self._ldap_uri)
+        conn.protocol_version = 3
+        conn.set_option(ldap.OPT_REFERRALS, 0)
         try:
-            self._conn.simple_bind_s(self._client_id, self._client_secret)
+            conn.simple_bind_s(self._client_id, self._client_secret)
         except Exception as e:
             logger.error(f"Unable to bind to LDAP server {e}")
             raise e
         else:
-            return self._conn
+            return conn
+
+    def close(self):
+        """
+        Unbind the idle connections of the pool
+        """
+        self._pool.close()
 
     def encode(self, val):
         """
@@ -292,17 +594,15 @@ class LDAP:
                 "value=%s type=%s" % (val, type(val))
             )
 
-    def add(self, scim_user):
-        """
-        Add a new user
+    def _user_dn(self, scim_user):
+        # AD: cn, LDAP: uid
+        return "{rdnattr}={rdnval},{usersdn}".format(
+            rdnattr=self._user_rdn_attr,
+            rdnval=scim_user.obj.username,
+            usersdn=self._users_dn,
+        )
 
-        :param scim_user: user object conforming to the SCIM User Schema
-        For a RHDS deployment:
-        dc=ipa,dc=com
-          cn=accounts
-            cn=users
-              uid=oneuser
-        """
+    def _add_modlist(self, scim_user):
         # TODO: implement dynamic list based on _ldap_user_extra_attrs
         attrs = {}
         attrs["cn"] = self.encode(scim_user.obj.username)
@@ -317,18 +617,34 @@ class LDAP:
         if self._user_rdn_attr == "cn":
             attrs["userAccountControl"] = self.encode("66048")
             attrs["sAMAccountName"] = self.encode(scim_user.obj.username)
-        ldif = modlist.addModlist(attrs)
+        return modlist.addModlist(attrs)
+
+    def _mod_attrs(self, attrs):
+        return [
+            (ldap.MOD_REPLACE, attr, self.encode(value))
+            for attr, value in attrs.items()
+        ]
+
+    def add(self, scim_user):
+        """
+        Add a new user
+
+        :param scim_user: user object conforming to the SCIM User Schema
+        For a RHDS deployment:
+        dc=ipa,dc=com
+          cn=accounts
+            cn=users
+              uid=oneuser
 
-        self._bind()
+        :raises UserExistsException: if a user with the username exists
+        """
+        dn = self._user_dn(scim_user)
+        ldif = self._add_modlist(scim_user)
         try:
-            # AD: cn, LDAP: uid
-            self._conn.add_s(
-                "{rdnattr}={rdnval},{usersdn}".format(
-                    rdnattr=self._user_rdn_attr,
-                    rdnval=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                ),
-                ldif,
+            self._pool.run(lambda conn: conn.add_s(dn, ldif))
+        except ldap.ALREADY_EXISTS:
+            raise UserExistsException(
+                "User {} already exists".format(scim_user.obj.username)
             )
         except ldap.LDAPError as e:
             desc = e.args[0]["desc"].strip()
@@ -336,33 +652,64 @@ class LDAP:
             logger.error(f"LDAP Error: {desc}: {info}")
             raise e
 
-    def modify(self, scim_user):
+    def modify(self, scim_user, attrs=None):
         """
         Modify user
 
         :param scim_user: user object conforming to the SCIM User Schema
+        :param attrs: dict of the givenname, sn and mail to modify, all of
+            them by default
         """
-        dn = "{rdnattr}={rdnval},{usersdn}".format(
-            rdnattr=self._user_rdn_attr,
-            rdnval=scim_user.obj.username,
-            usersdn=self._users_dn,
-        )
+        dn = self._user_dn(scim_user)
+        if attrs is None:
+            attrs = user_attrs(scim_user)
+        mod_attrs = self._mod_attrs(attrs)
+
+        try:
+            self._pool.run(lambda conn: conn.modify_ext_s(dn, mod_attrs))
+        except ldap.TYPE_OR_VALUE_EXISTS:
+            pass
+        except ldap.NO_SUCH_OBJECT:
+            raise LDAPNotFoundException(
+                "User {} not found".format(scim_user.obj.username)
+            )
 
-        sn = self.encode(scim_user.obj.last_name)
-        givenname = self.encode(scim_user.obj.first_name)
-        mail = self.encode(scim_user.obj.email)
+    def patch(self, scim_user, changes):
+        """
+        Modify the attributes of a user targeted by a PATCH request
 
+        :param scim_user: user object conforming to the SCIM User Schema
+        :param changes: list of (op, attr, values), see fold_changes()
+        """
+        dn = self._user_dn(scim_user)
+        ops = {
+            "replace": ldap.MOD_REPLACE,
+            "add": ldap.MOD_ADD,
+            "remove": ldap.MOD_DELETE,
+        }
         mod_attrs = [
-            (ldap.MOD_REPLACE, "sn", sn),
-            (ldap.MOD_REPLACE, "givenname", givenname),
-            (ldap.MOD_REPLACE, "mail", mail),
+            (ops[op], attr, self.encode(values) or None) for op, attr, values in changes
         ]
 
-        self._bind()
+        def modify(conn):
+            try:
+                conn.modify_ext_s(dn, mod_attrs)
+            except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+                # Adding a value which exists or removing one which does
+                # not is not an error, apply the other values one by one
+                for mod_op, attr, values in mod_attrs:
+                    if mod_op == ldap.MOD_REPLACE or not values:
+                        values = [values]
+                    else:
+                        values = [[value] for value in values]
+                    for value in values:
+                        try:
+                            conn.modify_ext_s(dn, [(mod_op, attr, value)])
+                        except (ldap.TYPE_OR_VALUE_EXISTS, ldap.NO_SUCH_ATTRIBUTE):
+                            pass
+
         try:
-            self._conn.modify_ext_s(dn, mod_attrs)
-        except ldap.TYPE_OR_VALUE_EXISTS:
-            pass
+            self._pool.run(modify)
         except ldap.NO_SUCH_OBJECT:
             raise LDAPNotFoundException(
                 "User {} not found".format(scim_user.obj.username)
@@ -374,21 +721,79 @@ class LDAP:
 
         :param scim_user: user object conforming to the SCIM User Schema
         """
-        self._bind()
+        dn = self._user_dn(scim_user)
         try:
-            self._conn.delete_s(
-                "{rdnattr}={rdnval},{usersdn}".format(
-                    rdnattr=self._user_rdn_attr,
-                    rdnval=scim_user.obj.username,
-                    usersdn=self._users_dn,
-                )
-            )
+            self._pool.run(lambda conn: conn.delete_s(dn))
         except ldap.LDAPError as e:
             desc = e.args[0]["desc"].strip()
             info = e.args[0].get("info", "").strip()
             logger.error(f"LDAP Error: {desc}: {info}")
             raise e
 
+    def batch(self, op, items):
+        """
+        Add, modify or delete several users with pipelined operations: the
+        requests are all sent on one connection of the pool before their
+        results are read, so that they cost a single round trip.
+
+        :param op: "add", "modify" or "delete"
+        :param items: list of (scim_user, attrs), attrs being the dict of
+            the attributes to modify
+        :returns: the list of the errors of the users, None for the users
+            written
+        """
+        requests = []
+        for scim_user, attrs in items:
+            dn = self._user_dn(scim_user)
+            if op == "add":
+                requests.append(("add_ext", (dn, self._add_modlist(scim_user))))
+            elif op == "modify":
+                requests.append(("modify_ext", (dn, self._mod_attrs(attrs))))
+            else:
+                requests.append(("delete_ext", (dn,)))
+
+        def pipeline(conn):
+            msgids = []
+            for method, args in requests:
+                try:
+                    msgids.append(getattr(conn, method)(*args))
+                except ldap.SERVER_DOWN as e:
+                    if not msgids:
+                        # Nothing was sent, retried on a new connection
+                        raise
+                    msgids.extend([e] * (len(requests) - len(msgids)))
+                    break
+            results = []
+            for msgid in msgids:
+                if isinstance(msgid, ldap.LDAPError):
+                    results.append(msgid)
+                    continue
+                try:
+                    conn.result3(msgid)
+                except ldap.LDAPError as e:
+                    results.append(e)
+                else:
+                    results.append(None)
+            return results
+
+        errors = []
+        for (scim_user, _), error in zip(items, self._pool.run(pipeline)):
+            username = scim_user.obj.username
+            if error is None or (
+                op == "modify" and isinstance(error, ldap.TYPE_OR_VALUE_EXISTS)
+            ):
+                errors.append(None)
+            elif op != "add" and isinstance(error, ldap.NO_SUCH_OBJECT):
+                errors.append(LDAPNotFoundException(f"User {username} not found"))
+            elif op == "add" and isinstance(error, ldap.ALREADY_EXISTS):
+                errors.append(UserExistsException(f"User {username} already exists"))
+            else:
+                desc = error.args[0]["desc"].strip()
+                info = error.args[0].get("info", "").strip()
+                logger.error(f"LDAP Error: {desc}: {info}")
+                errors.append(error)
+        return errors
+
 
 class AD(LDAP):
     """
@@ -400,6 +805,390 @@ class AD(LDAP):
         self._user_rdn_attr = "cn"
 
 
+def _first(values, default=None):
+    """
+    Return the first of the values of an attribute, decoded if needed
+    """
+    if not values:
+        return default
+    value = values[0] if isinstance(values, (list, tuple)) else values
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def _decode(values):
+    return [v.decode("utf-8") if isinstance(v, bytes) else v for v in values or []]
+
+
+class LDAPDirectorySource(LDAP, DirectorySource):
+    """
+    Reads the LDAP users and groups for the directory mirror.
+
+    The changes are found with paged searches on the modifyTimestamp of
+    the entries, and the removed entries by listing the names of all the
+    entries every DIRECTORY_SYNC_RECONCILE_INTERVAL seconds.
+    """
+
+    incremental = True
+
+    USER_FILTER = "(objectClass={user_object_class})"
+    GROUP_FILTER = (
+        "(|(objectClass=posixGroup)(objectClass=groupOfNames)"
+        "(objectClass=groupOfUniqueNames))"
+    )
+    USER_NAME_ATTR = "uid"
+    GROUP_NAME_ATTR = "cn"
+
+    def __init__(self):
+        self._conn = None
+        super().__init__()
+        self._page_size = getattr(settings, "DIRECTORY_SYNC_PAGE_SIZE", 500)
+        domain = domains.models.Domain.objects.last()
+        self._base_dn = ",".join("dc=" + dc for dc in domain.name.split("."))
+        # Names of the members, by lower case DN
+        self._member_names = {}
+
+    def _connect(self):
+        # The paged searches of a synchronization keep their connection,
+        # the source does not write
+        self._conn = self._bind()
+
+    def close(self):
+        """
+        Unbind the connection of the searches
+        """
+        if self._conn is not None:
+            self._conn.unbind_s()
+            self._conn = None
+
+    def _filter(self, kind):
+        if kind == "user":
+            return self.USER_FILTER.format(
+                user_object_class=self._user_object_classes[0]
+            )
+        return self.GROUP_FILTER
+
+    def _name_attr(self, kind):
+        return self.USER_NAME_ATTR if kind == "user" else self.GROUP_NAME_ATTR
+
+    def _base(self, kind):
+        return self._users_dn if kind == "user" else self._base_dn
+
+    def _search(self, base, filterstr, attrlist, serverctrls=()):
+        """
+        Paged search under the base DN.
+
+        :returns: an iterator of the pages of (dn, attrs)
+        """
+        control = SimplePagedResultsControl(True, size=self._page_size, cookie="")
+        while True:
+            msgid = self._conn.search_ext(
+                base,
+                ldap.SCOPE_SUBTREE,
+                filterstr,
+                attrlist,
+                serverctrls=[control, *serverctrls],
+            )
+            _, data, _, controls = self._conn.result3(msgid)
+            # Skip the search references, without DN
+            yield [
+                (dn, {k.lower(): v for k, v in attrs.items()})
+                for dn, attrs in data
+                if dn
+            ]
+            cookies = [
+                c.cookie
+                for c in controls
+                if c.controlType == SimplePagedResultsControl.controlType
+            ]
+            if not cookies or not cookies[0]:
+                break
+            control.cookie = cookies[0]
+
+    def _records(self, kind, filterstr):
+        # modifyTimestamp is an operational attribute, not returned by "*"
+        attrlist = ["*", "modifyTimestamp"]
+        for page in self._search(self._base(kind), filterstr, attrlist):
+            yield [self._record(kind, dn, attrs) for dn, attrs in page]
+
+    def _record(self, kind, dn, attrs):
+        name = _first(attrs.get(self._name_attr(kind).lower()))
+        modified = _first(attrs.get("modifytimestamp"), "")
+        if kind == "group":
+            gidnumber = _first(attrs.get("gidnumber"))
+            members = _decode(attrs.get("memberuid"))
+            for member_dn in _decode(attrs.get("member")) + _decode(
+                attrs.get("uniquemember")
+            ):
+                member = self._member_name(member_dn)
+                if member is not None:
+                    members.append(member)
+            return DirectoryRecord(
+                name,
+                int(gidnumber) if gidnumber else None,
+                members=members,
+                modified=modified,
+            )
+        self._member_names[dn.lower()] = name
+        uidnumber = _first(attrs.get("uidnumber"))
+        return DirectoryRecord(
+            name,
+            int(uidnumber) if uidnumber else None,
+            {
+                "givenname": _first(attrs.get("givenname")),
+                "sn": _first(attrs.get("sn")),
+                "mail": _decode(attrs.get("mail")),
+                "active": self._active(attrs),
+            },
+            modified=modified,
+        )
+
+    def _active(self, attrs):
+        return str(_first(attrs.get("nsaccountlock"), "")).lower() != "true"
+
+    def _member_name(self, dn):
+        """
+        Return the name of the user of a member DN, None if it is not a user.
+        """
+        key = dn.lower()
+        if key not in self._member_names:
+            try:
+                result = self._conn.search_s(
+                    dn,
+                    ldap.SCOPE_BASE,
+                    self._filter("user"),
+                    [self.USER_NAME_ATTR],
+                )
+            except ldap.NO_SUCH_OBJECT:
+                result = []
+            name = None
+            for _, attrs in result:
+                attrs = {k.lower(): v for k, v in attrs.items()}
+                name = _first(attrs.get(self.USER_NAME_ATTR.lower()))
+            self._member_names[key] = name
+        return self._member_names[key]
+
+    def _names_filter(self, kind, names):
+        attr = self._name_attr(kind)
+        return "(&{}(|{}))".format(
+            self._filter(kind),
+            "".join(
+                "({}={})".format(attr, ldap.filter.escape_filter_chars(name))
+                for name in names
+            ),
+        )
+
+    def pages(self, kind, position=""):
+        for records in self._records(kind, self._filter(kind)):
+            yield records, ""
+
+    def names(self, kind):
+        attr = self._name_attr(kind)
+        return {
+            _first(attrs.get(attr.lower()))
+            for page in self._search(self._base(kind), self._filter(kind), [attr])
+            for _, attrs in page
+        }
+
+    def fetch(self, kind, names):
+        records = []
+        for i in range(0, len(names), self._page_size):
+            filterstr = self._names_filter(kind, names[i : i + self._page_size])
+            for page in self._records(kind, filterstr):
+                records.extend(page)
+        return records
+
+    def changes(self, kind, cursor):
+        filterstr = self._filter(kind)
+        if cursor:
+            filterstr = "(&{}(modifyTimestamp>={}))".format(
+                filterstr, ldap.filter.escape_filter_chars(cursor)
+            )
+        records = []
+        for page in self._records(kind, filterstr):
+            records.extend(page)
+        removed, removed_cursor = self._removed(kind, cursor)
+        new_cursor = max([cursor, removed_cursor] + [r.modified for r in records])
+        return records, removed, new_cursor
+
+    def _removed(self, kind, cursor):
+        """
+        :returns: the names of the entries removed since the cursor, when
+                  the server keeps track of them, and their cursor
+        """
+        return [], ""
+
+
+class IPADirectorySource(LDAPDirectorySource):
+    """
+    Reads the IPA users and groups for the directory mirror.
+
+    The IPA API does not return the modifyTimestamp of the entries, they
+    are read from the LDAP server of IPA instead, bound with the Kerberos
+    credentials of the ipa writable interface, so that a refresh only
+    reads the entries changed since the cursor.
+    """
+
+    USER_FILTER = "(objectClass=posixAccount)"
+    GROUP_FILTER = "(objectClass=ipaUserGroup)"
+
+    def _fetch_domain(self):
+        super()._fetch_domain()
+        # The integration domain URL is the URL of the IPA server
+        url = urlparse(self._ldap_uri)
+        self._ldap_uri = "ldap://{}".format(url.hostname or url.path)
+
+    def _bind(self):
+        """
+        Open a new connection bound with GSSAPI to the LDAP server of IPA
+        """
+        IPAAPI._valid_creds()
+        conn = ldap.initialize(self._ldap_uri)
+        conn.protocol_version = 3
+        conn.set_option(ldap.OPT_REFERRALS, 0)
+        try:
+            conn.sasl_interactive_bind_s("", self._sasl_gssapi)
+        except Exception as e:
+            logger.error(f"Unable to bind to IPA LDAP server {e}")
+            raise e
+        else:
+            return conn
+
+    def _base(self, kind):
+        container = "users" if kind == "user" else "groups"
+        return "cn={},cn=accounts,{}".format(container, self._base_dn)
+
+
+class ADDirectorySource(LDAPDirectorySource):
+    """
+    Reads the Active Directory users and groups for the directory mirror.
+
+    The removed entries are the tombstones changed since the cursor.
+    """
+
+    USER_FILTER = "(&(objectClass=user)(objectCategory=person))"
+    GROUP_FILTER = "(objectClass=group)"
+    USER_NAME_ATTR = "sAMAccountName"
+    GROUP_NAME_ATTR = "sAMAccountName"
+
+    # LDAP_SERVER_SHOW_DELETED_OID
+    SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+    # ACCOUNTDISABLE flag of userAccountControl
+    ACCOUNTDISABLE = 0x2
+
+    def __init__(self):
+        super().__init__()
+        self._user_rdn_attr = "cn"
+
+    def _active(self, attrs):
+        flags = int(_first(attrs.get("useraccountcontrol"), 0))
+        return not flags & self.ACCOUNTDISABLE
+
+    def _removed(self, kind, cursor):
+        if not cursor:
+            return [], ""
+        filterstr = "(&(isDeleted=TRUE){}(modifyTimestamp>={}))".format(
+            "(objectClass=user)" if kind == "user" else self.GROUP_FILTER,
+            ldap.filter.escape_filter_chars(cursor),
+        )
+        attr = self._name_attr(kind)
+        removed, removed_cursor = [], ""
+        control = LDAPControl(self.SHOW_DELETED_OID, True)
+        # The tombstones are moved out of the users container
+        for page in self._search(
+            self._base_dn, filterstr, [attr, "modifyTimestamp"], [control]
+        ):
+            for _, attrs in page:
+                removed.append(_first(attrs.get(attr.lower())))
+                removed_cursor = max(
+                    removed_cursor, _first(attrs.get("modifytimestamp"), "")
+                )
+        return removed, removed_cursor
+
+
+def user_attrs(scim_user):
+    """
+    Return the attributes of a user written by the writable interfaces.
+
+    :param scim_user: user object conforming to the SCIM User Schema
+    :returns: dict of the givenname, sn and mail
+    """
+    return {
+        "givenname": scim_user.obj.first_name,
+        "sn": scim_user.obj.last_name,
+        "mail": scim_user.obj.email,
+    }
+
+
+def fold_changes(changes):
+    """
+    Fold the operations of a PATCH request into at most one replace, or
+    one add and one remove, per attribute, so that the backends do not
+    depend on their order.
+
+    :param changes: list of (op, attr, values), op being "add", "remove" or
+        "replace", values the list of values, all of them for a remove
+        without values
+    :returns: a list of (op, attr, values)
+    """
+    # attr: list of the values, or (values added, values removed)
+    folded = {}
+    for op, attr, values in changes:
+        state = folded.get(attr)
+        if op == "replace" or (op == "remove" and not values):
+            folded[attr] = list(values)
+        elif isinstance(state, list):
+            if op == "add":
+                state.extend(v for v in values if v not in state)
+            else:
+                folded[attr] = [v for v in state if v not in values]
+        else:
+            added, removed = state or ([], [])
+            if op == "add":
+                added = added + [v for v in values if v not in added]
+                removed = [v for v in removed if v not in values]
+            else:
+                removed = removed + [v for v in values if v not in removed]
+                added = [v for v in added if v not in values]
+            folded[attr] = (added, removed)
+
+    result = []
+    for attr, state in folded.items():
+        if isinstance(state, list):
+            result.append(("replace", attr, state))
+            continue
+        added, removed = state
+        if added:
+            result.append(("add", attr, added))
+        if removed:
+            result.append(("remove", attr, removed))
+    return result
+
+
+def _values(value):
+    """
+    Return the values of a single or multi-valued attribute as a tuple.
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(str(v) for v in value if v)
+    if value:
+        return (str(value),)
+    return ()
+
+
+def directory_source():
+    """
+    Return the DirectorySource of the integration domain.
+    """
+    sources = {
+        "ipa": IPADirectorySource,
+        "ldap": LDAPDirectorySource,
+        "ad": ADDirectorySource,
+    }
+    return sources[domains.models.Domain.objects.last().id_provider]()
+
+
 class _IPA:
     _instance = None
 
@@ -409,6 +1198,9 @@ class _IPA:
         """
         self._apiconn = self._write(domains.models.Domain.objects.last().id_provider)
         logger.info(f"Init writable interface {self._apiconn}")
+        # Modifications which did not change the user, and were not sent
+        self._lock = threading.Lock()
+        self.writes_avoided = 0
 
     def _reset_instance(self):
         """
@@ -416,6 +1208,9 @@ class _IPA:
         """
         self._instance = None
         logger.info("Reset writable interface")
+        close = getattr(self._apiconn, "close", None)
+        if close is not None:
+            close()
         self.__init__()
 
     def _write(self, iface="ipa"):
@@ -429,15 +1224,122 @@ class _IPA:
         }
         return ifaces[iface]()
 
+    def _written(self, op, scim_user):
+        """
+        Invalidate the cached entries of a user added, modified or deleted.
+        """
+        cache = IdentityCache()
+        cache.invalidate_user(scim_user.obj.username)
+        if op == "add":
+            # The new user may be a member of default groups, and must not
+            # be hidden by a cached not found result
+            cache.invalidate_missing_users()
+        if op != "modify":
+            cache.invalidate_groups()
+            cache.invalidate_listing("user")
+        DirectoryIndex().invalidate_user(scim_user.obj.username)
+        mark_stale("user", scim_user.obj.username)
+
     # CRUD Operations
     def user_add(self, scim_user):
         self._apiconn.add(scim_user)
+        self._written("add", scim_user)
+
+    def _changed_attrs(self, scim_user):
+        """
+        Return the attributes of a user which differ from its entry, read
+        from the identity cache or with one lookup, all of them if the
+        entry cannot be read.
+
+        The cached entry is only trusted if it was read less than
+        IPA_WRITE_COMPARE_MAX_AGE seconds ago, a user modified outside of
+        ipa-tuura would otherwise not be written back until it expires.
+        """
+        attrs = user_attrs(scim_user)
+        IdentityCache().expire_user(
+            scim_user.obj.username, getattr(settings, "IPA_WRITE_COMPARE_MAX_AGE", 5)
+        )
+        try:
+            sssduser = SSSD().find_user_by_name(scim_user.obj.username)
+        except SSSDNotFoundException:
+            return attrs
+        except Exception as e:
+            logger.info(f"Unable to read user {scim_user.obj.username}: {e}")
+            return attrs
+        current = {
+            "givenname": sssduser.first_name,
+            "sn": sssduser.last_name,
+            "mail": sssduser.mail,
+        }
+        return {
+            attr: value
+            for attr, value in attrs.items()
+            if _values(value) != _values(current[attr])
+        }
 
     def user_mod(self, scim_user):
-        self._apiconn.modify(scim_user)
+        attrs = self._changed_attrs(scim_user)
+        if not attrs:
+            with self._lock:
+                self.writes_avoided += 1
+            logger.debug(f"No modification for user {scim_user.obj.username}")
+            return
+        self._apiconn.modify(scim_user, attrs)
+        self._written("modify", scim_user)
+
+    def user_patch(self, scim_user, changes):
+        """
+        Write the attributes of a user targeted by a PATCH request, without
+        reading the user.
+
+        :param changes: list of (op, attr, values), see fold_changes()
+        """
+        changes = fold_changes(changes)
+        if not changes:
+            with self._lock:
+                self.writes_avoided += 1
+            return
+        self._apiconn.patch(scim_user, changes)
+        self._written("modify", scim_user)
 
     def user_del(self, scim_user):
         self._apiconn.delete(scim_user)
+        self._written("delete", scim_user)
+
+    def user_batch(self, op, scim_users):
+        """
+        Add, modify or delete several users with a single request to the
+        backend, an IPA batch command or pipelined LDAP operations.
+
+        As with user_mod, the modifications which change nothing are not
+        sent.
+
+        :param op: "add", "modify" or "delete"
+        :param scim_users: list of user objects conforming to the SCIM User
+            Schema
+        :returns: the list of the errors of the users, None for the users
+            written
+        """
+        errors = [None] * len(scim_users)
+        # (index, scim_user, attrs) of the users to write
+        items = []
+        for i, scim_user in enumerate(scim_users):
+            attrs = None
+            if op == "modify":
+                attrs = self._changed_attrs(scim_user)
+                if not attrs:
+                    with self._lock:
+                        self.writes_avoided += 1
+                    continue
+            items.append((i, scim_user, attrs))
+        if not items:
+            return errors
+        results = self._apiconn.batch(op, [(u, attrs) for _, u, attrs in items])
+        for (i, scim_user, _), error in zip(items, results):
+            errors[i] = error
+            if error is None:
+                self._written(op, scim_user)
+        return errors
 
 
 def IPA():
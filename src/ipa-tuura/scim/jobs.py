@@ -0,0 +1,359 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django import db
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import F, Q
+from django.utils import timezone
+from django_scim import exceptions
+from django_scim.utils import get_user_adapter
+from scim.bulk import scim_exception
+from scim.ipa import (
+    IPA,
+    IPANotFoundException,
+    LDAPNotFoundException,
+    UserExistsException,
+)
+from scim.models import ProvisioningJob, User
+
+logger = logging.getLogger(__name__)
+
+
+# Errors of the jobs which are not retried
+PERMANENT_ERRORS = (
+    exceptions.SCIMException,
+    IPANotFoundException,
+    LDAPNotFoundException,
+    UserExistsException,
+    db.utils.IntegrityError,
+)
+
+
+class _ProvisioningQueue:
+    """
+    Durable queue of the writes of the users, in the ProvisioningJob table.
+
+    The requests add jobs with enqueue(), the workers run them with claim()
+    and run(). A modification or a deletion of a user replaces the
+    modification of the same user still pending, so that repeated updates
+    are written once. The jobs of a user are run in order, one at a time.
+
+    A job failing with a backend error is retried up to
+    PROVISIONING_MAX_ATTEMPTS times, after PROVISIONING_RETRY_DELAY seconds
+    times the number of attempts.
+
+    A running job is leased to the process which claimed it for
+    PROVISIONING_LEASE_TIMEOUT seconds, recover() only queues again the
+    jobs whose lease expired, those of the other running processes are left
+    alone.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.max_attempts = getattr(settings, "PROVISIONING_MAX_ATTEMPTS", 3)
+        self.retry_delay = getattr(settings, "PROVISIONING_RETRY_DELAY", 30)
+        self.retention = getattr(settings, "PROVISIONING_JOB_RETENTION", 604800)
+        self.lease_timeout = getattr(settings, "PROVISIONING_LEASE_TIMEOUT", 300)
+        # Owner of the jobs claimed by this process
+        self.worker_id = "{}:{}".format(socket.gethostname(), os.getpid())
+        # Serializes the claims of the worker threads
+        self._lock = threading.Lock()
+        # Metrics
+        self.enqueued = 0
+        self.coalesced = 0
+        self.retried = 0
+
+    def _reset_instance(self):
+        """
+        Read the settings again and reset the metrics
+        """
+        self.__init__()
+
+    def enqueue(self, operation, scim_user, data, idempotency_key=None):
+        """
+        Queue the write of a user.
+
+        :param operation: "add", "modify" or "delete"
+        :param scim_user: user object of the request, with its data applied
+        :param data: the SCIM resource of the request
+        :param idempotency_key: the Idempotency-Key header of the request
+        :returns: the ProvisioningJob of the write: a new one, the one of a
+            previous request with the same idempotency key, or the pending
+            modification the write was merged into
+        :raises SCIMException: if the idempotency key was used by a request
+            with another operation or user
+        """
+        if idempotency_key:
+            job = ProvisioningJob.objects.filter(
+                idempotency_key=idempotency_key
+            ).first()
+            if job is not None:
+                return self._replayed(job, operation, scim_user)
+
+        fields = {
+            "operation": operation,
+            "payload": {k: v for k, v in data.items() if k != "password"},
+            # The hash of the password of the local user
+            "password": (
+                scim_user.obj.password
+                if operation == "add" or data.get("password")
+                else ""
+            ),
+        }
+        if operation != "add":
+            # Merged into a pending modification, unless a worker claimed
+            # it in the meantime. The idempotency key is not recorded, the
+            # PUT and DELETE requests being idempotent
+            job = (
+                ProvisioningJob.objects.filter(
+                    username=scim_user.obj.username,
+                    operation=ProvisioningJob.Operation.MODIFY,
+                    status=ProvisioningJob.Status.PENDING,
+                )
+                .order_by("id")
+                .first()
+            )
+            if job is not None and ProvisioningJob.objects.filter(
+                id=job.id, status=ProvisioningJob.Status.PENDING
+            ).update(coalesced=F("coalesced") + 1, **fields):
+                with self._lock:
+                    self.coalesced += 1
+                job.refresh_from_db()
+                return job
+
+        try:
+            job = ProvisioningJob.objects.create(
+                username=scim_user.obj.username,
+                resource_id="" if operation == "add" else scim_user.id,
+                idempotency_key=idempotency_key or None,
+                **fields,
+            )
+        except db.utils.IntegrityError:
+            # Concurrent request with the same idempotency key
+            job = ProvisioningJob.objects.get(idempotency_key=idempotency_key)
+            return self._replayed(job, operation, scim_user)
+        with self._lock:
+            self.enqueued += 1
+        return job
+
+    def _replayed(self, job, operation, scim_user):
+        """
+        Return the job of a previous request with the same idempotency key,
+        if it is the same operation on the same user.
+        """
+        if job.operation != operation or job.username != scim_user.obj.username:
+            raise exceptions.SCIMException(
+                "The Idempotency-Key was used by another request",
+                status=422,
+                scim_type="invalidValue",
+            )
+        return job
+
+    def claim(self):
+        """
+        Mark the next job to run as running, claimed by this process.
+
+        The jobs of a user wait for the running one, or for the one waiting
+        to be retried.
+
+        :returns: the ProvisioningJob, None if no job is ready
+        """
+        now = timezone.now()
+        busy = ProvisioningJob.objects.filter(
+            Q(status=ProvisioningJob.Status.RUNNING)
+            | Q(status=ProvisioningJob.Status.PENDING, run_after__gt=now)
+        ).values("username")
+        ready = (
+            ProvisioningJob.objects.filter(status=ProvisioningJob.Status.PENDING)
+            .exclude(username__in=busy)
+            .order_by("id")
+        )
+        with self._lock:
+            while True:
+                job = ready.first()
+                if job is None:
+                    return None
+                # Claimed by a worker of another process in the meantime
+                if ProvisioningJob.objects.filter(
+                    id=job.id, status=ProvisioningJob.Status.PENDING
+                ).update(
+                    status=ProvisioningJob.Status.RUNNING,
+                    attempts=F("attempts") + 1,
+                    claimed_by=self.worker_id,
+                    claimed_at=timezone.now(),
+                ):
+                    job.refresh_from_db()
+                    return job
+
+    def run(self, job):
+        """
+        Write the user of a running job, and record its result.
+        """
+        try:
+            self._write(job)
+        except Exception as e:
+            if not isinstance(e, PERMANENT_ERRORS) and job.attempts < self.max_attempts:
+                logger.info(f"Provisioning job {job.uuid} failed, retried: {e}")
+                with self._lock:
+                    self.retried += 1
+                job.status = ProvisioningJob.Status.PENDING
+                job.run_after = timezone.now() + timedelta(
+                    seconds=self.retry_delay * job.attempts
+                )
+            else:
+                job.status = ProvisioningJob.Status.FAILED
+                job.error = scim_exception(e).to_dict()
+        else:
+            job.status = ProvisioningJob.Status.DONE
+            job.error = None
+        job.save()
+        logger.info(f"Provisioning job {job.uuid}: {job}")
+
+    def _write(self, job):
+        """
+        Write the user of a job to the backend then to the local database,
+        like SCIMUser.save() and SCIMUser.delete().
+        """
+        adapter = get_user_adapter()
+        if job.operation == ProvisioningJob.Operation.ADD:
+            scim_user = adapter(User(), request=None)
+            scim_user.from_dict(job.payload)
+            IPA().user_add(scim_user)
+        else:
+            try:
+                obj = User.objects.get(scim_id=job.resource_id)
+            except ObjectDoesNotExist:
+                raise exceptions.NotFoundError(job.resource_id)
+            scim_user = adapter(obj, request=None)
+            if job.operation == ProvisioningJob.Operation.DELETE:
+                scim_user.delete()
+                return
+            scim_user.from_dict(job.payload)
+            IPA().user_mod(scim_user)
+        if job.password:
+            scim_user.obj.password = job.password
+        scim_user.save_local()
+        job.resource_id = scim_user.id
+
+    def recover(self):
+        """
+        Queue again the jobs left running by a stopped worker, claimed more
+        than PROVISIONING_LEASE_TIMEOUT seconds ago.
+
+        :returns: the number of jobs
+        """
+        expired = timezone.now() - timedelta(seconds=self.lease_timeout)
+        return (
+            ProvisioningJob.objects.filter(status=ProvisioningJob.Status.RUNNING)
+            .filter(Q(claimed_at__lt=expired) | Q(claimed_at__isnull=True))
+            .update(status=ProvisioningJob.Status.PENDING, claimed_by="")
+        )
+
+    def release(self, job):
+        """
+        Queue again a job claimed by this process, whose run was
+        interrupted by a database error.
+        """
+        ProvisioningJob.objects.filter(
+            id=job.id,
+            status=ProvisioningJob.Status.RUNNING,
+            claimed_by=self.worker_id,
+        ).update(status=ProvisioningJob.Status.PENDING, claimed_by="")
+
+    def purge(self):
+        """
+        Delete the jobs done or failed more than PROVISIONING_JOB_RETENTION
+        seconds ago.
+        """
+        ProvisioningJob.objects.filter(
+            status__in=(ProvisioningJob.Status.DONE, ProvisioningJob.Status.FAILED),
+            modified__lt=timezone.now() - timedelta(seconds=self.retention),
+        ).delete()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "retried": self.retried,
+            }
+
+
+def ProvisioningQueue():
+    if _ProvisioningQueue._instance is None:
+        _ProvisioningQueue._instance = _ProvisioningQueue()
+    return _ProvisioningQueue._instance
+
+
+class ProvisioningWorkers:
+    """
+    Threads running the jobs of the ProvisioningQueue, PROVISIONING_WORKERS
+    by default, so that the number of concurrent writes to the backend does
+    not depend on the number of SCIM requests.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or getattr(settings, "PROVISIONING_WORKERS", 4)
+        self.poll_interval = getattr(settings, "PROVISIONING_POLL_INTERVAL", 1)
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _work(self, drain):
+        queue = ProvisioningQueue()
+        job = None
+        try:
+            while not self._stop.is_set():
+                try:
+                    if job is not None:
+                        queue.release(job)
+                        job = None
+                    job = queue.claim()
+                    if job is not None:
+                        queue.run(job)
+                        job = None
+                        continue
+                    # Drained only once no job is ready, not on an error
+                    if drain:
+                        return
+                except db.Error as e:
+                    # Retried after the poll interval, a job whose run
+                    # failed is released first
+                    logger.error(f"Provisioning worker failed {e}")
+                self._stop.wait(self.poll_interval)
+        finally:
+            db.connection.close()
+
+    def start(self, drain=False):
+        """
+        :param drain: stop the threads once no job is ready
+        """
+        for i in range(self.size):
+            thread = threading.Thread(
+                target=self._work,
+                args=(drain,),
+                name="provisioning-{}".format(i),
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        """
+        :returns: True if the threads stopped
+        """
+        for thread in self._threads:
+            thread.join(timeout)
+        return not any(thread.is_alive() for thread in self._threads)
@@ -1,7 +1,3 @@
 #
 # Copyright (C) 2024  FreeIPA Contributors see COPYING for license
 #
-
-# from django.test import TestCase
-
-# Create your tests here.
@@ -0,0 +1,3 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
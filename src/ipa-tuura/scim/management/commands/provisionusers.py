@@ -0,0 +1,46 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+
+from django.core.management.base import BaseCommand
+from scim.jobs import ProvisioningQueue, ProvisioningWorkers
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Write the users queued by the SCIM requests to the integration domain"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help="Keep running, polling the queue every PROVISIONING_POLL_INTERVAL "
+            "seconds",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            help="Number of worker threads (default: PROVISIONING_WORKERS)",
+        )
+
+    def handle(self, *args, **options):
+        queue = ProvisioningQueue()
+        workers = ProvisioningWorkers(options["workers"])
+        workers.start(drain=not options["worker"])
+        try:
+            while True:
+                # Left running by a stopped worker, of this process or of
+                # another one sharing the database
+                recovered = queue.recover()
+                if recovered:
+                    logger.info(f"{recovered} provisioning jobs queued again")
+                queue.purge()
+                if workers.join(timeout=queue.lease_timeout):
+                    break
+        except KeyboardInterrupt:
+            workers.stop()
+            workers.join()
+        self.stdout.write(str(queue.stats))
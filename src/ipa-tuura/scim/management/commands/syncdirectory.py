@@ -0,0 +1,54 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from scim.ipa import directory_source
+from scim.sync import DirectorySync
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Synchronize the local mirror of the users and groups with the "
+        "integration domain"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--full",
+            action="store_true",
+            help="Reload all the users and groups",
+        )
+        parser.add_argument(
+            "--worker",
+            action="store_true",
+            help=(
+                "Keep running, refreshing the mirror every "
+                "DIRECTORY_SYNC_INTERVAL seconds"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        interval = getattr(settings, "DIRECTORY_SYNC_INTERVAL", 60)
+        sync = DirectorySync(directory_source())
+        full = options["full"]
+        while True:
+            try:
+                for stats in sync.run(full=full):
+                    self.stdout.write(str(stats))
+            except Exception as e:
+                if not options["worker"]:
+                    raise
+                # Retried on the next interval, from the last checkpoint
+                logger.error(f"Directory sync failed {e}")
+            else:
+                full = False
+            if not options["worker"]:
+                break
+            time.sleep(interval)
@@ -0,0 +1,50 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+from django_scim.middleware import SCIMAuthCheckMiddleware
+from scim.models import identity_map_scope
+
+
+@sync_and_async_middleware
+def IdentityMapMiddleware(get_response):
+    """
+    Share an IdentityMap between the model conversions of a request.
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            with identity_map_scope():
+                return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            with identity_map_scope():
+                return get_response(request)
+
+    return middleware
+
+
+class StreamingAuthCheckMiddleware(SCIMAuthCheckMiddleware):
+    """
+    SCIMAuthCheckMiddleware which does not read the body of the streamed
+    responses to log it, they would be consumed.
+    """
+
+    def get_loggable_response_message(self, request, response):
+        if not response.streaming:
+            return super().get_loggable_response_message(request, response)
+        parts = [
+            "PATH",
+            request.path,
+            "METHOD",
+            request.method,
+            "BODY",
+            "<streamed>",
+            "STATUS_CODE",
+            str(response.status_code),
+        ]
+        return "\n".join(parts)
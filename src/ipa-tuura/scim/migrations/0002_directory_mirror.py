@@ -0,0 +1,112 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scim", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DirectorySyncState",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("user", "User"), ("group", "Group")],
+                        max_length=5,
+                        unique=True,
+                    ),
+                ),
+                ("generation", models.PositiveIntegerField(default=0)),
+                ("loading", models.BooleanField(default=False)),
+                ("position", models.CharField(blank=True, max_length=255)),
+                ("complete", models.BooleanField(default=False)),
+                ("cursor", models.CharField(blank=True, max_length=255)),
+                ("reconciled", models.DateTimeField(blank=True, null=True)),
+                ("refreshed", models.DateTimeField(blank=True, null=True)),
+                ("fetched", models.PositiveIntegerField(default=0)),
+                ("written", models.PositiveIntegerField(default=0)),
+                ("deleted", models.PositiveIntegerField(default=0)),
+                ("duration", models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="DirectoryEntry",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("user", "User"), ("group", "Group")], max_length=5
+                    ),
+                ),
+                ("name", models.CharField(max_length=255)),
+                ("number", models.PositiveIntegerField(blank=True, null=True)),
+                ("attrs", models.JSONField(default=dict)),
+                ("digest", models.CharField(blank=True, max_length=40)),
+                ("modified", models.CharField(blank=True, max_length=32)),
+                ("generation", models.PositiveIntegerField(default=0)),
+                ("stale", models.BooleanField(default=False)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["kind", "number"], name="scim_direct_kind_7b138d_idx"
+                    ),
+                    models.Index(
+                        fields=["kind", "stale"], name="scim_direct_kind_c6853a_idx"
+                    ),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("kind", "name"), name="unique_directory_entry"
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="DirectoryMember",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("username", models.CharField(db_index=True, max_length=255)),
+                (
+                    "group",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="members",
+                        to="scim.directoryentry",
+                    ),
+                ),
+            ],
+        ),
+    ]
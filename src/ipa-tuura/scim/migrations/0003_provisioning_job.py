@@ -0,0 +1,83 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:06
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scim", "0002_directory_mirror"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ProvisioningJob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "uuid",
+                    models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+                ),
+                (
+                    "operation",
+                    models.CharField(
+                        choices=[
+                            ("add", "Add"),
+                            ("modify", "Modify"),
+                            ("delete", "Delete"),
+                        ],
+                        max_length=6,
+                    ),
+                ),
+                ("username", models.CharField(max_length=255)),
+                ("resource_id", models.CharField(blank=True, max_length=255)),
+                ("payload", models.JSONField(default=dict)),
+                ("password", models.CharField(blank=True, max_length=128)),
+                (
+                    "idempotency_key",
+                    models.CharField(
+                        blank=True, max_length=255, null=True, unique=True
+                    ),
+                ),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("pending", "Pending"),
+                            ("running", "Running"),
+                            ("done", "Done"),
+                            ("failed", "Failed"),
+                        ],
+                        default="pending",
+                        max_length=7,
+                    ),
+                ),
+                ("attempts", models.PositiveIntegerField(default=0)),
+                ("run_after", models.DateTimeField(blank=True, null=True)),
+                ("coalesced", models.PositiveIntegerField(default=0)),
+                ("error", models.JSONField(blank=True, null=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["status", "id"], name="scim_provis_status_c03486_idx"
+                    ),
+                    models.Index(
+                        fields=["username", "status"],
+                        name="scim_provis_usernam_825131_idx",
+                    ),
+                ],
+            },
+        ),
+    ]
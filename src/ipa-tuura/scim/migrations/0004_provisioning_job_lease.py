@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("scim", "0003_provisioning_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="provisioningjob",
+            name="claimed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="provisioningjob",
+            name="claimed_by",
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
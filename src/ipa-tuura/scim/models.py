@@ -2,9 +2,14 @@
 # Copyright (C) 2024  FreeIPA Contributors see COPYING for license
 #
 
+import contextvars
+import uuid
+from contextlib import contextmanager
 from urllib.parse import urljoin
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser, GroupManager, UserManager
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from django.db.utils import NotSupportedError
 from django.urls import reverse
@@ -17,22 +22,96 @@ from django_scim.models import (
 )
 from django_scim.settings import scim_settings
 from django_scim.utils import get_base_scim_location_getter
+from scim.records import Record, SSSDGroupToGroupRecord, SSSDUserToUserRecord
 from scim.sssd import SSSD, SSSDNotFoundException
 
 
-def SSSDUserToUserModel(sssd_if, sssduser):
+class IdentityMap:
+    """
+    Users and groups converted to models during a request.
+
+    The converters look up the groups of a user and the members of a group
+    here before asking SSSD, so that each user and group is fetched and
+    converted at most once per request. An entry is complete when the
+    model was built with the groups of the user, or the members of the
+    group.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, kind, attr, value, complete=False):
+        """
+        Return the model for the user or group, None if it was not built.
+
+        :param kind: "user" or "group"
+        :param attr: "name" or "id"
+        :param complete: if True, only return a complete model
+        """
+        entry = self._entries.get((kind, attr, str(value)))
+        if entry is None or (complete and not entry[1]):
+            return None
+        return entry[0]
+
+    def add(self, kind, model, complete=False):
+        """
+        Add the model of a user or group, a complete model is not replaced
+        by an incomplete one.
+        """
+        name = model.scim_username if kind == "user" else model.scim_display_name
+        existing = self._entries.get((kind, "name", str(name)))
+        if existing is not None and existing[1] and not complete:
+            return
+        entry = (model, complete)
+        self._entries[(kind, "name", str(name))] = entry
+        self._entries[(kind, "id", str(model.id))] = entry
+
+
+_identity_map = contextvars.ContextVar("identity_map", default=None)
+
+
+@contextmanager
+def identity_map_scope():
+    """
+    Share an IdentityMap between the conversions made in the block,
+    typically a request.
+    """
+    token = _identity_map.set(IdentityMap())
+    try:
+        yield _identity_map.get()
+    finally:
+        _identity_map.reset(token)
+
+
+def current_identity_map():
+    """
+    Return the IdentityMap of the current scope, a new one outside of
+    any scope.
+    """
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        identity_map = IdentityMap()
+    return identity_map
+
+
+def SSSDUserToUserModel(sssd_if, sssduser, identity_map=None):
     """
     Create a User from an SSSDUser object.
 
     If the SSSDUser contains groups (basically group names), the User
     is updated with the group list as an array of Group.
     This requires access to DBus through the provided SSSD interface
-    in order to fill the group gidNumber.
+    in order to fill the group gidNumber, unless the group is already
+    in the identity map.
 
     :param sssd_if: SSSD interface obtained with sssd_if = SSSD()
     :param sssduser: SSSDUser object
+    :param identity_map: IdentityMap shared by the conversions of the
+        request, a new one by default
     :returns: a User object
     """
+    if identity_map is None:
+        identity_map = IdentityMap()
     usermodel = User()
     usermodel.scim_username = sssduser.username
     usermodel.id = sssduser.id
@@ -41,49 +120,212 @@ def SSSDUserToUserModel(sssd_if, sssduser):
     usermodel.last_name = sssduser.last_name
     usermodel.email = sssduser.mail
     usermodel.is_active = sssduser.active
+    usermodel.scim_last_modified = sssduser.modified
+    identity_map.add("user", usermodel)
     groups = []
     for groupname in sssduser.groups:
-        try:
-            sssdgroup = sssd_if.find_group_by_name(groupname)
-            groupmodel = SSSDGroupToGroupModel(sssd_if, sssdgroup)
-            groups.append(groupmodel)
-        except SSSDNotFoundException:
-            # TBD add logging
-            pass
+        groupmodel = identity_map.get("group", "name", groupname)
+        if groupmodel is None:
+            try:
+                sssdgroup = sssd_if.find_group_by_name(groupname)
+            except SSSDNotFoundException:
+                # TBD add logging
+                continue
+            groupmodel = SSSDGroupToGroupModel(sssd_if, sssdgroup, identity_map)
+        groups.append(groupmodel)
     usermodel.scim_groups.set(groups)
     return usermodel
 
 
-def SSSDGroupToGroupModel(sssd_if, sssdgroup):
+class LazyUserList:
+    """
+    Users of the members of a group, converted one at a time when the list
+    is iterated and not kept, so that the responses streaming the members
+    of a large group do not hold all of them.
+    """
+
+    def __init__(self, sssd_if, usernames, identity_map):
+        """
+        :param sssd_if: SSSD interface resolving the users
+        :param usernames: the names of the members
+        :param identity_map: IdentityMap whose users are reused, the new
+            ones are not added to it
+        """
+        self._sssd_if = sssd_if
+        self._usernames = usernames
+        self._identity_map = identity_map
+
+    def __len__(self):
+        return len(self._usernames)
+
+    def __iter__(self):
+        for username in self._usernames:
+            usermodel = self._identity_map.get("user", "name", username)
+            if usermodel is None:
+                try:
+                    sssduser = self._sssd_if.find_user_by_name(username)
+                except SSSDNotFoundException:
+                    continue
+                usermodel = SSSDUserToUserModel(self._sssd_if, sssduser, IdentityMap())
+            yield usermodel
+
+
+def SSSDGroupToGroupModel(sssd_if, sssdgroup, identity_map=None):
     """
     Create a Group from an SSSDGroup object.
 
     If the SSSDGroup contains members (basically user names), the Group
     is updated with the user list as an array of User.
     This requires access to DBus through the provided SSSD interface
-    in order to fill the user uidNumber.
+    in order to fill the user uidNumber, unless the user is already
+    in the identity map.
+    With SCIM_STREAMING, the users are only converted when the list is
+    iterated, see LazyUserList.
 
     :param sssd_if: SSSD interface obtained with sssd_if = SSSD()
     :param sssdgroup: SSSDGroup object
+    :param identity_map: IdentityMap shared by the conversions of the
+        request, a new one by default
     :returns: a Group object
     """
+    if identity_map is None:
+        identity_map = IdentityMap()
     groupmodel = Group()
     groupmodel.scim_display_name = sssdgroup.name
     groupmodel.id = sssdgroup.id
     groupmodel.scim_id = str(groupmodel.id)
+    groupmodel.scim_last_modified = sssdgroup.modified
+    identity_map.add("group", groupmodel)
+    if getattr(settings, "SCIM_STREAMING", False):
+        # The members are converted while the response is written
+        groupmodel.user_set.set(LazyUserList(sssd_if, sssdgroup.members, identity_map))
+        return groupmodel
     users = []
     for username in sssdgroup.members:
-        try:
-            sssduser = sssd_if.find_user_by_name(username)
-            usermodel = SSSDUserToUserModel(sssd_if, sssduser)
-            users.append(usermodel)
-        except SSSDNotFoundException:
-            # TBD add logging
-            pass
+        usermodel = identity_map.get("user", "name", username)
+        if usermodel is None:
+            try:
+                sssduser = sssd_if.find_user_by_name(username)
+            except SSSDNotFoundException:
+                # TBD add logging
+                continue
+            usermodel = SSSDUserToUserModel(sssd_if, sssduser, identity_map)
+        users.append(usermodel)
     groupmodel.user_set.set(users)
     return groupmodel
 
 
+class DirectoryListing:
+    """
+    Sequence of the objects stored in the local database, followed by the
+    SSSD objects sorted by id.
+
+    Only the ids of the SSSD objects are enumerated up front, the objects
+    are read and converted when a slice of the listing is accessed, so
+    that a page only costs the lookups of its own objects.
+
+    A local object whose name is mirrored by scim.sync with one of the ids
+    takes the place of that SSSD object, so that it is counted once. The
+    SSSD objects with the id or the name of another local object are
+    skipped, as the lookups return the local object. The names are only
+    known once the objects are read, such a page is one object shorter,
+    which only happens before the mirror is synchronized.
+    """
+
+    def __init__(self, queryset, ids, find, name_field, kind=None):
+        """
+        :param queryset: the local objects, None for none
+        :param ids: the ordered ids of the SSSD objects
+        :param find: callable returning the model or the Record for an
+            SSSD id, raising ObjectDoesNotExist if it was removed since the
+            enumeration
+        :param name_field: the field holding the name of the local objects
+        :param kind: "user" or "group", to look up the names of the local
+            objects in the mirror, None to skip it
+        """
+        self._queryset = queryset
+        self._find = find
+        self._name_field = name_field
+        # Ids of the local objects mirrored among the ids, and their names
+        self._mirrored = {}
+        rows = []
+        if queryset is not None:
+            rows = list(queryset.values_list("scim_id", name_field))
+        if rows and kind is not None:
+            entries = DirectoryEntry.objects.filter(
+                kind=kind, name__in=queryset.values(name_field)
+            ).values_list("number", "name")
+            if entries:
+                selected = set(ids) if isinstance(ids, list) else ids
+                self._mirrored = {
+                    number: name for number, name in entries if number in selected
+                }
+        if self._mirrored:
+            mirrored_names = set(self._mirrored.values())
+            rows = [row for row in rows if row[1] not in mirrored_names]
+            queryset = queryset.exclude(**{name_field + "__in": list(mirrored_names)})
+        # The local objects listed first
+        self._local = queryset
+        local_ids = {scim_id for scim_id, _ in rows if scim_id}
+        self._names = {name for _, name in rows}
+        if local_ids:
+            self._ids = [id for id in ids if str(id) not in local_ids]
+        else:
+            # Not copied, a SortedIds is only read page by page
+            self._ids = ids
+        self._local_count = len(rows)
+
+    def __len__(self):
+        return self._local_count + len(self._ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            objects = self[index : index + 1]
+            if not objects:
+                raise IndexError("DirectoryListing index out of range")
+            return objects[0]
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("DirectoryListing slices do not support a step")
+
+        objects = []
+        if start < self._local_count:
+            objects.extend(self._local[start : min(stop, self._local_count)])
+        start = max(start - self._local_count, 0)
+        stop = max(stop - self._local_count, 0)
+        ids = self._ids[start:stop]
+        local = {}
+        names = [self._mirrored[id] for id in ids if id in self._mirrored]
+        if names:
+            local = {
+                getattr(obj, self._name_field): obj
+                for obj in self._queryset.filter(**{self._name_field + "__in": names})
+            }
+        for id in ids:
+            if id in self._mirrored:
+                # Removed from the local database since the enumeration
+                if self._mirrored[id] in local:
+                    objects.append(local[self._mirrored[id]])
+                continue
+            try:
+                obj = self._find(id)
+            except ObjectDoesNotExist:
+                continue
+            if isinstance(obj, Record):
+                name = obj.name
+            else:
+                name = getattr(obj, self._name_field)
+            if name not in self._names:
+                objects.append(obj)
+        return objects
+
+    def __iter__(self):
+        # Read the SSSD objects one page at a time
+        page_size = getattr(settings, "SCIM_MAX_RESULTS", 200)
+        for start in range(0, len(self), page_size):
+            yield from self[start : start + page_size]
+
+
 class CustomUserGroupRelationManager:
     """
     Manager allowing to access Groups linked to a User object.
@@ -138,7 +380,7 @@ class CustomUserManager(UserManager):
         user.save()
         return user
 
-    def get(self, *args, **kwargs):
+    def get(self, *args, projection=None, records=False, **kwargs):
         """
         Returns the User object matching the given lookup parameters.
 
@@ -147,6 +389,10 @@ class CustomUserManager(UserManager):
         and searches based on either the scim_id (mapped to uidNumber) or
         the scim_username (mapped to name).
 
+        :param projection: Projection of the request, the groups are only
+            retrieved from SSSD when they are returned
+        :param records: return a UserRecord for an SSSD user, for the
+            reads
         :returns: a User object
         :raises User.DoesNotExist: when no User matching the criteria is found
         :raises NotSupportedError: when the criteria are too complex
@@ -160,29 +406,69 @@ class CustomUserManager(UserManager):
             # Look in SSSD
             pass
 
+        return self._get_from_sssd(projection, records, **kwargs)
+
+    def _get_from_sssd(self, projection=None, records=False, **kwargs):
+        retrieve_groups = projection is None or projection.includes("groups")
+        identity_map = current_identity_map()
         # Support only search by scim_id
         if "scim_id" in kwargs.keys():
+            usermodel = identity_map.get(
+                "user", "id", kwargs["scim_id"], retrieve_groups
+            )
+            if usermodel is not None and not records:
+                return usermodel
             try:
                 sssd_if = SSSD()
                 sssduser = sssd_if.find_user_by_id(
-                    kwargs["scim_id"], retrieve_groups=True
+                    kwargs["scim_id"], retrieve_groups=retrieve_groups
                 )
             except SSSDNotFoundException:
                 raise User.DoesNotExist
-            return SSSDUserToUserModel(sssd_if, sssduser)
         elif "scim_username" in kwargs.keys():
+            usermodel = identity_map.get(
+                "user", "name", kwargs["scim_username"], retrieve_groups
+            )
+            if usermodel is not None and not records:
+                return usermodel
             try:
                 sssd_if = SSSD()
                 sssduser = sssd_if.find_user_by_name(
-                    kwargs["scim_username"], retrieve_groups=True
+                    kwargs["scim_username"], retrieve_groups=retrieve_groups
                 )
             except SSSDNotFoundException:
                 raise User.DoesNotExist
-            return SSSDUserToUserModel(sssd_if, sssduser)
         else:
             raise NotSupportedError(
                 "Support only exact search by scim_id or scim_username"
             )
+        if records:
+            return SSSDUserToUserRecord(sssd_if, sssduser)
+        usermodel = SSSDUserToUserModel(sssd_if, sssduser, identity_map)
+        identity_map.add("user", usermodel, complete=retrieve_groups)
+        return usermodel
+
+    def listing(self, queryset=None, projection=None, records=False):
+        """
+        Return all the users, the users of the local database first, then
+        the users enumerated by SSSD.
+
+        The number of SSSD users is limited by SSSD_LIST_LIMIT, or by the
+        wildcard_limit option of SSSD when it is 0.
+
+        :param queryset: the local users, all of them by default
+        :param projection: Projection of the request
+        :param records: list UserRecord objects for the SSSD users
+        :returns: a DirectoryListing of User objects
+        """
+        if queryset is None:
+            queryset = self.all()
+        ids = SSSD().list_user_ids(getattr(settings, "SSSD_LIST_LIMIT", 0))
+
+        def find(id):
+            return self._get_from_sssd(projection, records, scim_id=str(id))
+
+        return DirectoryListing(queryset, ids, find, "scim_username", "user")
 
 
 class User(AbstractSCIMUserMixin, AbstractBaseUser):
@@ -271,7 +557,7 @@ class CustomGroupManager(GroupManager):
     Manager specific to the Group objects.
     """
 
-    def get(self, *args, **kwargs):
+    def get(self, *args, projection=None, records=False, **kwargs):
         """
         Returns the Group object matching the given lookup parameters.
 
@@ -280,6 +566,10 @@ class CustomGroupManager(GroupManager):
         and searches based on either the scim_id (mapped to gidNumber) or
         the scim_display_name (mapped to name).
 
+        :param projection: Projection of the request, the members are only
+            retrieved from SSSD when they are returned
+        :param records: return a GroupRecord for an SSSD group, for the
+            reads
         :returns: a Group object
         :raises Group.DoesNotExist: when no Group matching the criteria is
         found
@@ -294,30 +584,69 @@ class CustomGroupManager(GroupManager):
             # Look in SSSD
             pass
 
+        return self._get_from_sssd(projection, records, **kwargs)
+
+    def _get_from_sssd(self, projection=None, records=False, **kwargs):
+        retrieve_members = projection is None or projection.includes("members")
+        identity_map = current_identity_map()
         # Support only search by scim_id or scim_display_name
         if "scim_id" in kwargs.keys():
+            groupmodel = identity_map.get(
+                "group", "id", kwargs["scim_id"], retrieve_members
+            )
+            if groupmodel is not None and not records:
+                return groupmodel
             try:
                 sssd_if = SSSD()
                 sssdgroup = sssd_if.find_group_by_id(
-                    kwargs["scim_id"], retrieve_members=True
+                    kwargs["scim_id"], retrieve_members=retrieve_members
                 )
             except SSSDNotFoundException:
                 raise Group.DoesNotExist
-
-            return SSSDGroupToGroupModel(sssd_if, sssdgroup)
         elif "scim_display_name" in kwargs.keys():
+            groupmodel = identity_map.get(
+                "group", "name", kwargs["scim_display_name"], retrieve_members
+            )
+            if groupmodel is not None and not records:
+                return groupmodel
             try:
                 sssd_if = SSSD()
                 sssdgroup = sssd_if.find_group_by_name(
-                    kwargs["scim_display_name"], retrieve_members=True
+                    kwargs["scim_display_name"], retrieve_members=retrieve_members
                 )
             except SSSDNotFoundException:
                 raise Group.DoesNotExist
-            return SSSDGroupToGroupModel(sssd_if, sssdgroup)
         else:
             raise NotSupportedError(
                 "Support only exact search by scim_id or scim_display_name"
             )
+        if records:
+            return SSSDGroupToGroupRecord(sssd_if, sssdgroup)
+        groupmodel = SSSDGroupToGroupModel(sssd_if, sssdgroup, identity_map)
+        identity_map.add("group", groupmodel, complete=retrieve_members)
+        return groupmodel
+
+    def listing(self, queryset=None, projection=None, records=False):
+        """
+        Return all the groups, the groups of the local database first, then
+        the groups enumerated by SSSD.
+
+        The number of SSSD groups is limited by SSSD_LIST_LIMIT, or by the
+        wildcard_limit option of SSSD when it is 0.
+
+        :param queryset: the local groups, all of them by default
+        :param projection: Projection of the request
+        :param records: list GroupRecord objects for the SSSD groups
+        :returns: a DirectoryListing of Group objects
+        """
+        if queryset is None:
+            queryset = self.all()
+        ids = SSSD().list_group_ids(getattr(settings, "SSSD_LIST_LIMIT", 0))
+
+        def find(id):
+            return self._get_from_sssd(projection, records, scim_id=str(id))
+
+        return DirectoryListing(queryset, ids, find, "scim_display_name", "group")
 
 
 class Group(AbstractSCIMGroupMixin):
@@ -340,6 +669,186 @@ class Group(AbstractSCIMGroupMixin):
             return self._user_set
 
 
+class DirectoryEntry(models.Model):
+    """
+    User or group of the integration domain, mirrored by scim.sync.
+
+    The number is the uidNumber or gidNumber, used as SCIM id like for
+    the entries read from SSSD.
+    """
+
+    class Kind(models.TextChoices):
+        USER = "user", _("User")
+        GROUP = "group", _("Group")
+
+    kind = models.CharField(max_length=5, choices=Kind.choices)
+    name = models.CharField(max_length=255)
+    number = models.PositiveIntegerField(null=True, blank=True)
+
+    # givenname, sn, mail and active of the users
+    attrs = models.JSONField(default=dict)
+
+    # Digest of the entry as read from the identity server, to skip the
+    # writes of the unchanged entries
+    digest = models.CharField(max_length=40, blank=True)
+
+    # modifyTimestamp of the entry on the identity server, if any
+    modified = models.CharField(max_length=32, blank=True)
+
+    # Full load of the DirectorySyncState that read the entry last
+    generation = models.PositiveIntegerField(default=0)
+
+    # Changed through ipa-tuura, read again by the next refresh
+    stale = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["kind", "name"], name="unique_directory_entry"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["kind", "number"]),
+            models.Index(fields=["kind", "stale"]),
+        ]
+
+    def __str__(self):
+        return "{} {}".format(self.kind, self.name)
+
+
+class DirectoryMember(models.Model):
+    """
+    Member of a mirrored group, by user name.
+    """
+
+    group = models.ForeignKey(
+        DirectoryEntry, on_delete=models.CASCADE, related_name="members"
+    )
+    username = models.CharField(max_length=255, db_index=True)
+
+
+class DirectorySyncState(models.Model):
+    """
+    Checkpoint of the synchronization of the users or the groups.
+
+    It is saved in the same transaction as the entries, so that an
+    interrupted synchronization resumes from the last saved page.
+    """
+
+    kind = models.CharField(
+        max_length=5, choices=DirectoryEntry.Kind.choices, unique=True
+    )
+
+    # Incremented by each full load
+    generation = models.PositiveIntegerField(default=0)
+
+    # A full load is in progress, resumed after the position (the last
+    # name read) when the identity server supports it
+    loading = models.BooleanField(default=False)
+    position = models.CharField(max_length=255, blank=True)
+
+    # A full load completed, the mirror can answer the queries
+    complete = models.BooleanField(default=False)
+
+    # Change cursor of the source: the highest modifyTimestamp read from
+    # LDAP, or the last name refreshed by the sweep of the IPA entries
+    cursor = models.CharField(max_length=255, blank=True)
+
+    # Last listing of all the names, to find the removed entries
+    reconciled = models.DateTimeField(null=True, blank=True)
+
+    # Cost of the last run
+    refreshed = models.DateTimeField(null=True, blank=True)
+    fetched = models.PositiveIntegerField(default=0)
+    written = models.PositiveIntegerField(default=0)
+    deleted = models.PositiveIntegerField(default=0)
+    duration = models.FloatField(default=0)
+
+    def __str__(self):
+        return "{} generation {}".format(self.kind, self.generation)
+
+
+class ProvisioningJob(models.Model):
+    """
+    Write of a user queued by a SCIM request, run by the workers of
+    scim.jobs.ProvisioningQueue.
+
+    The payload is the SCIM resource of the request, without the password,
+    whose hash is kept for the local user.
+    """
+
+    class Operation(models.TextChoices):
+        ADD = "add", _("Add")
+        MODIFY = "modify", _("Modify")
+        DELETE = "delete", _("Delete")
+
+    class Status(models.TextChoices):
+        PENDING = "pending", _("Pending")
+        RUNNING = "running", _("Running")
+        DONE = "done", _("Done")
+        FAILED = "failed", _("Failed")
+
+    # Id of the job in the URL of its status
+    uuid = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
+    operation = models.CharField(max_length=6, choices=Operation.choices)
+    username = models.CharField(max_length=255)
+    # SCIM id of the modified or deleted user, of the added user once done
+    resource_id = models.CharField(max_length=255, blank=True)
+    payload = models.JSONField(default=dict)
+    password = models.CharField(max_length=128, blank=True)
+
+    # Idempotency-Key header of the request which created the job
+    idempotency_key = models.CharField(
+        max_length=255, null=True, blank=True, unique=True
+    )
+
+    status = models.CharField(
+        max_length=7, choices=Status.choices, default=Status.PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    # Worker process ("host:pid") running the job, and time of its claim,
+    # the job is queued again by another process once the lease expired
+    claimed_by = models.CharField(max_length=255, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Not run before, after an attempt failing with a backend error
+    run_after = models.DateTimeField(null=True, blank=True)
+    # Requests merged into the job while it was pending
+    coalesced = models.PositiveIntegerField(default=0)
+
+    # SCIM error of the failed job
+    error = models.JSONField(null=True, blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+            models.Index(fields=["username", "status"]),
+        ]
+
+    def __str__(self):
+        return "{} {} {}".format(self.operation, self.username, self.status)
+
+    def to_dict(self):
+        """
+        Return the status of the job returned by the SCIM requests.
+        """
+        d = {
+            "id": str(self.uuid),
+            "operation": self.operation,
+            "userName": self.username,
+            "status": self.status,
+            "attempts": self.attempts,
+            "created": self.created.isoformat(),
+            "lastModified": self.modified.isoformat(),
+        }
+        if self.error:
+            d["response"] = self.error
+        return d
+
+
 class ServiceProviderConfig(SCIMServiceProviderConfig):
     """
     Service Provider Config model.
@@ -367,29 +876,37 @@ class ServiceProviderConfig(SCIMServiceProviderConfig):
         return {
             "schemas": [constants.SchemaURI.SERVICE_PROVIDER_CONFIG],
             "documentationUri": scim_settings.DOCUMENTATION_URI,
-            # In order to support the PATCH method both:
-            # - ScimUser.handle_add
-            # - ScimUser.handle_replace
-            # must be implemented.
+            # PATCH of the users, see scim.adapters.SCIMUser.handle_operations
             "patch": {
-                "supported": False,
+                "supported": True,
             },
+            # Users written in batches, see scim.bulk.Bulk
             "bulk": {
-                "supported": False,
-                "maxOperations": 1000,
-                "maxPayloadSize": 1048576,
+                "supported": True,
+                "maxOperations": getattr(settings, "SCIM_BULK_MAX_OPERATIONS", 1000),
+                "maxPayloadSize": getattr(
+                    settings, "SCIM_BULK_MAX_PAYLOAD_SIZE", 1048576
+                ),
             },
-            # Django-SCIM2 does not fully support the all the
-            # SCIM2.0 filtering options (Section 3.4.2.2 of [RFC7644])
+            # The filters are evaluated by scim.directory.QueryPlan
             "filter": {
-                "supported": False,
-                "maxResults": 50,
+                "supported": True,
+                "maxResults": getattr(settings, "SCIM_MAX_RESULTS", 200),
             },
             "changePassword": {
                 "supported": True,
             },
             "sort": {
-                "supported": False,
+                "supported": True,
+            },
+            # Cursor pagination (RFC 9865) on the sort indexes
+            "pagination": {
+                "cursor": True,
+                "index": True,
+                "defaultPaginationMethod": "index",
+                # Applied to the requests without count, see PaginationMixin
+                "defaultPageSize": getattr(settings, "SCIM_MAX_RESULTS", 200),
+                "maxPageSize": getattr(settings, "SCIM_MAX_RESULTS", 200),
             },
             "etag": {
                 "supported": False,
@@ -0,0 +1,137 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+from django.conf import settings
+from scim.sssd import SSSDNotFoundException
+
+
+class Record:
+    """
+    Read-only user or group of SSSD or of the DirectoryIndex.
+
+    The records are what the GET requests and the searches return instead
+    of the User and Group models, which are only built for the writes.
+    They are serialized by scim.adapters.RecordSerializer.
+
+    The name is the userName of a user, the displayName of a group.
+    """
+
+    __slots__ = ("id", "name", "modified")
+
+    def __init__(self, id, name, modified=None):
+        self.id = id
+        self.name = name
+        self.modified = modified
+
+    def __repr__(self):
+        return "{}({}, {})".format(self.__class__.__name__, self.id, self.name)
+
+
+class UserRecord(Record):
+    """
+    Read-only user, with a GroupRecord without members per group.
+    """
+
+    __slots__ = ("first_name", "last_name", "email", "active", "groups")
+
+    def __init__(
+        self,
+        id,
+        name,
+        first_name="",
+        last_name="",
+        email=None,
+        active=True,
+        modified=None,
+        groups=(),
+    ):
+        super().__init__(id, name, modified)
+        self.first_name = first_name
+        self.last_name = last_name
+        self.email = email
+        self.active = active
+        self.groups = groups
+
+
+class GroupRecord(Record):
+    """
+    Read-only group, with a UserRecord without groups per member.
+    """
+
+    __slots__ = ("members",)
+
+    def __init__(self, id, name, modified=None, members=()):
+        super().__init__(id, name, modified)
+        self.members = members
+
+
+class LazyMemberRecords:
+    """
+    Members of a group, converted one at a time when they are iterated and
+    not kept, like scim.models.LazyUserList.
+    """
+
+    def __init__(self, sssd_if, usernames):
+        self._sssd_if = sssd_if
+        self._usernames = usernames
+
+    def __len__(self):
+        return len(self._usernames)
+
+    def __iter__(self):
+        for username in self._usernames:
+            try:
+                sssduser = self._sssd_if.find_user_by_name(username)
+            except SSSDNotFoundException:
+                continue
+            yield SSSDUserToUserRecord(self._sssd_if, sssduser)
+
+
+def SSSDUserToUserRecord(sssd_if, sssduser):
+    """
+    Create a UserRecord from an SSSDUser object.
+
+    The groups of the SSSDUser, if any, are looked up by name through the
+    provided SSSD interface for their gidNumber.
+
+    :param sssd_if: SSSD interface obtained with sssd_if = SSSD()
+    :param sssduser: SSSDUser object
+    :returns: a UserRecord object
+    """
+    groups = []
+    for groupname in sssduser.groups:
+        try:
+            sssdgroup = sssd_if.find_group_by_name(groupname)
+        except SSSDNotFoundException:
+            continue
+        groups.append(GroupRecord(sssdgroup.id, sssdgroup.name, sssdgroup.modified))
+    return UserRecord(
+        sssduser.id,
+        sssduser.username,
+        sssduser.first_name,
+        sssduser.last_name,
+        sssduser.mail,
+        sssduser.active,
+        sssduser.modified,
+        tuple(groups),
+    )
+
+
+def SSSDGroupToGroupRecord(sssd_if, sssdgroup):
+    """
+    Create a GroupRecord from an SSSDGroup object.
+
+    The members of the SSSDGroup, if any, are looked up by name through the
+    provided SSSD interface for their uidNumber and names. With
+    SCIM_STREAMING, they are only looked up when the members are iterated,
+    see LazyMemberRecords.
+
+    :param sssd_if: SSSD interface obtained with sssd_if = SSSD()
+    :param sssdgroup: SSSDGroup object
+    :returns: a GroupRecord object
+    """
+    members = LazyMemberRecords(sssd_if, sssdgroup.members)
+    if not getattr(settings, "SCIM_STREAMING", False):
+        members = tuple(members)
+    return GroupRecord(sssdgroup.id, sssdgroup.name, sssdgroup.modified, members)
@@ -2,7 +2,22 @@
 # Copyright (C) 2024  FreeIPA Contributors see COPYING for license
 #
 
+import copy
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
 import dbus
+import SSSDConfig
+from django.conf import settings
+from domains.models import Domain
+
+logger = logging.getLogger(__name__)
 
 DBUS_SSSD_NAME = "org.freedesktop.sssd.infopipe"
 DBUS_SSSD_PATH = "/org/freedesktop/sssd/infopipe"
@@ -14,6 +29,25 @@ DBUS_SSSD_USER_IF = "org.freedesktop.sssd.infopipe.Users.User"
 DBUS_SSSD_GROUPS_PATH = "/org/freedesktop/sssd/infopipe/Groups"
 DBUS_SSSD_GROUPS_IF = "org.freedesktop.sssd.infopipe.Groups"
 DBUS_SSSD_GROUP_IF = "org.freedesktop.sssd.infopipe.Groups.Group"
+DBUS_SSSD_NOT_FOUND = "org.freedesktop.sssd.Error.NotFound"
+
+# Errors returned when the infopipe responder is not running, or when it
+# was restarted and the proxies point to its previous instance
+DBUS_DISCONNECTED_ERRORS = {
+    "org.freedesktop.DBus.Error.Disconnected",
+    "org.freedesktop.DBus.Error.NameHasNoOwner",
+    "org.freedesktop.DBus.Error.NoReply",
+    "org.freedesktop.DBus.Error.NoServer",
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.TimedOut",
+    "org.freedesktop.DBus.Error.Timeout",
+}
+
+# SSSD defaults for the entry_cache_timeout domain option and the
+# entry_negative_timeout nss option, in seconds
+DEFAULT_ENTRY_CACHE_TIMEOUT = 5400
+DEFAULT_ENTRY_NEGATIVE_TIMEOUT = 15
+DEFAULT_MEMBER_REFRESH_INTERVAL = 60
 
 
 class SSSDNotFoundException(Exception):
@@ -24,21 +58,42 @@ class SSSDNotFoundException(Exception):
     pass
 
 
+class SSSDUnavailableException(Exception):
+    """
+    Exception returned when no SSSD client is available.
+    """
+
+    pass
+
+
 class SSSDGroup:
     """
     Represents a SSSD Group.
 
     SSSD groups are defined by an id (gidNumber in LDAP) and a name.
+    The modification time, in ISO 8601, is only known for the groups read
+    from the local mirror.
     """
 
-    def __init__(self, id, name):
+    def __init__(self, id, name, modified=None):
         self.id = id
         self.name = name
+        self.modified = modified
         self.members = []
 
     def set_members(self, members):
         self.members = members
 
+    @classmethod
+    def from_properties(cls, props):
+        """
+        Create a SSSDGroup from the properties of a DBus Group.
+
+        :param props: a dict containing the properties of the DBus Group
+        :returns: a SSSDGroup object
+        """
+        return cls(int(props["gidNumber"]), str(props["name"]))
+
     def __repr__(self):
         members = ", ".join(self.members)
         msg = "Group {}({}): {}".format(self.id, self.name, members)
@@ -60,6 +115,44 @@ class SSSDUser:
         self.mail = kwargs.get("mail")
         self.groups = kwargs.get("groups") or []
         self.active = kwargs.get("active")
+        # ISO 8601, only known for the users read from the local mirror
+        self.modified = kwargs.get("modified")
+
+    @classmethod
+    def from_properties(cls, props, groups=None):
+        """
+        Create a SSSDUser from the properties of a DBus User.
+
+        :param props: a dict containing the properties of the DBus User
+        :param groups: optional list of the names of the user groups
+        :returns: a SSSDUser object
+        """
+        kwargs = dict()
+        extra_attrs = props.get("extraAttributes", {})
+
+        # Retrieve firstname
+        givenname = extra_attrs.get("givenname")
+        if givenname:
+            kwargs["givenname"] = str(givenname[0])
+        # Retrieve lastname
+        sn = extra_attrs.get("sn")
+        if sn:
+            kwargs["sn"] = str(sn[0])
+        # Retrieve email
+        mail = extra_attrs.get("mail")
+        if mail:
+            kwargs["mail"] = [str(x) for x in mail]
+        # Retrieve active state
+        locked = extra_attrs.get("lock")
+        if locked and str(locked[0]).lower() == "true":
+            kwargs["active"] = False
+        else:
+            kwargs["active"] = True
+
+        if groups:
+            kwargs["groups"] = {str(x) for x in groups}
+
+        return cls(props["uidNumber"], props["name"], **kwargs)
 
     def __repr__(self):
         groups = ", ".join(self.groups)
@@ -67,15 +160,413 @@ class SSSDUser:
         return msg
 
 
-class _SSSD:
+def get_entry_cache_timeout():
+    """
+    Read the entry_cache_timeout of the SSSD domains from sssd.conf.
+
+    :returns: the smallest entry_cache_timeout of the active domains, in
+    seconds, or the SSSD default if it cannot be read
+    """
+    try:
+        sssdconfig = SSSDConfig.SSSDConfig()
+        sssdconfig.import_config()
+        timeouts = []
+        for name in sssdconfig.list_active_domains():
+            domain = sssdconfig.get_domain(name)
+            try:
+                timeouts.append(int(domain.get_option("entry_cache_timeout")))
+            except SSSDConfig.NoOptionError:
+                timeouts.append(DEFAULT_ENTRY_CACHE_TIMEOUT)
+    except Exception as e:
+        logger.info(f"Unable to read entry_cache_timeout from SSSD config {e}")
+        return DEFAULT_ENTRY_CACHE_TIMEOUT
+    return min(timeouts, default=DEFAULT_ENTRY_CACHE_TIMEOUT)
+
+
+def get_entry_negative_timeout():
+    """
+    Read the entry_negative_timeout of the nss responder from sssd.conf.
+
+    :returns: the entry_negative_timeout, in seconds, or the SSSD default
+    if it cannot be read
+    """
+    try:
+        sssdconfig = SSSDConfig.SSSDConfig()
+        sssdconfig.import_config()
+        nss = sssdconfig.get_service("nss")
+        return int(nss.get_option("entry_negative_timeout"))
+    except Exception as e:
+        logger.info(f"Unable to read entry_negative_timeout from SSSD config {e}")
+        return DEFAULT_ENTRY_NEGATIVE_TIMEOUT
+
+
+def get_member_refresh_interval():
+    """
+    Read the minimum interval between two refreshes of a group member list
+    from the integration domain.
+
+    :returns: the interval in seconds, or the default if no integration
+    domain is configured
+    """
+    try:
+        domain = Domain.objects.last()
+    except Exception as e:
+        logger.info(f"Unable to read the integration domain {e}")
+        return DEFAULT_MEMBER_REFRESH_INTERVAL
+    if domain is None:
+        return DEFAULT_MEMBER_REFRESH_INTERVAL
+    return domain.member_refresh_interval
+
+
+class LRUCache:
+    """
+    Bounded mapping with LRU eviction and per-entry expiration.
+
+    The cache is safe to share between threads. It keeps hit, miss and
+    eviction counters, expired entries count as misses.
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        :param maxsize: maximum number of entries
+        :param ttl: default time to live of an entry, in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Return the value stored for key and mark it as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, _ = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store value for key, evicting the least recently used entries
+        if the cache is full.
+        """
+        now = time.monotonic()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def age(self, key):
+        """
+        Return the number of seconds since the value of key was stored,
+        None if the key is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else time.monotonic() - entry[2]
+
+    def discard_if(self, predicate):
+        """
+        Remove the entries for which predicate(key, value) is True.
+        """
+        with self._lock:
+            keys = [k for k, (v, *_) in self._entries.items() if predicate(k, v)]
+            for key in keys:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class _IdentityCache:
+    """
+    Cache of the SSSDUser and SSSDGroup objects read from SSSD.
+
+    The entries are indexed both by name and by id. An entry remembers
+    whether it was read with the groups (for users) or the members (for
+    groups), so that it is only returned to callers asking for at most
+    the same level of details.
+
+    Unknown names and ids are remembered in a separate, smaller cache with
+    a short time to live, so that repeated lookups of a missing user or
+    group do not trigger a backend search each time.
+
+    The time of the last refresh of each group member list from the
+    backend is also remembered, a member list is refreshed again after
+    the member_refresh_interval of the integration domain, or when it
+    may have been changed through ipa-tuura. The interval is read from the
+    database with the first refresh, which must not run in the thread of
+    an event loop, and again after _reset_instance().
+
+    The ids returned by the enumeration of all the users or groups are
+    kept for SSSD_LIST_CACHE_TIMEOUT seconds, so that the pages of a
+    listing do not each trigger a wildcard search.
+    """
+
     _instance = None
 
+    def __init__(self):
+        self._entries = LRUCache(
+            getattr(settings, "SSSD_CACHE_SIZE", 10000),
+            getattr(settings, "SSSD_CACHE_TIMEOUT", None) or get_entry_cache_timeout(),
+        )
+        self._missing = LRUCache(
+            getattr(settings, "SSSD_NEGATIVE_CACHE_SIZE", 1000),
+            getattr(settings, "SSSD_NEGATIVE_CACHE_TIMEOUT", None)
+            or get_entry_negative_timeout(),
+        )
+        # None until read from the integration domain
+        self._member_refresh_interval = getattr(
+            settings, "SSSD_MEMBER_REFRESH_INTERVAL", None
+        )
+        self._refreshed = LRUCache(
+            getattr(settings, "SSSD_CACHE_SIZE", 10000),
+            DEFAULT_MEMBER_REFRESH_INTERVAL,
+        )
+        self._listings = LRUCache(2, getattr(settings, "SSSD_LIST_CACHE_TIMEOUT", 60))
+
+    def _get(self, kind, attr, value, complete):
+        entry = self._entries.get((kind, attr, str(value)))
+        if entry is None:
+            return None
+        obj, entry_complete = entry
+        if complete and not entry_complete:
+            return None
+        if entry_complete and not complete:
+            # Return the object as the lookup would have read it, callers
+            # converting the groups of a user and the members of a group
+            # expect them to stop there
+            obj = copy.copy(obj)
+            if kind == "user":
+                obj.groups = []
+            else:
+                obj.members = []
+        return obj
+
+    def _add(self, kind, obj, name, complete):
+        entry = (obj, complete)
+        self._entries.set((kind, "name", str(name)), entry)
+        self._entries.set((kind, "id", str(obj.id)), entry)
+
+    def _invalidate(self, kind, attr, value):
+        entry = self._entries.pop((kind, attr, str(value)))
+        if entry is None:
+            return
+        obj = entry[0]
+        name = obj.username if kind == "user" else obj.name
+        self._entries.pop((kind, "name", str(name)))
+        self._entries.pop((kind, "id", str(obj.id)))
+
+    def is_missing(self, kind, attr, value):
+        """
+        Return True if the lookup of a "user" or "group" by "name" or "id"
+        recently returned not found.
+        """
+        return (kind, attr, str(value)) in self._missing
+
+    def add_missing(self, kind, attr, value):
+        self._missing.set((kind, attr, str(value)), True)
+
+    def get_user_by_name(self, name, retrieve_groups=False):
+        return self._get("user", "name", name, retrieve_groups)
+
+    def get_user_by_id(self, id, retrieve_groups=False):
+        return self._get("user", "id", id, retrieve_groups)
+
+    def add_user(self, sssduser, retrieve_groups=False):
+        self._add("user", sssduser, sssduser.username, retrieve_groups)
+
+    def get_group_by_name(self, name, retrieve_members=False):
+        return self._get("group", "name", name, retrieve_members)
+
+    def get_group_by_id(self, id, retrieve_members=False):
+        return self._get("group", "id", id, retrieve_members)
+
+    def add_group(self, sssdgroup, retrieve_members=False):
+        self._add("group", sssdgroup, sssdgroup.name, retrieve_members)
+
+    def needs_member_refresh(self, group_id):
+        """
+        Return True if the member list of the group must be refreshed from
+        the backend before being read.
+        """
+        return str(group_id) not in self._refreshed
+
+    @property
+    def member_refresh_interval(self):
+        if self._member_refresh_interval is None:
+            self._member_refresh_interval = get_member_refresh_interval()
+        return self._member_refresh_interval
+
+    def member_list_refreshed(self, group_id):
+        self._refreshed.set(str(group_id), True, self.member_refresh_interval)
+
+    def get_listing(self, kind):
+        return self._listings.get(kind)
+
+    def add_listing(self, kind, ids):
+        self._listings.set(kind, ids)
+
+    def invalidate_listing(self, kind):
+        """
+        Drop the enumeration of the "user" or "group" objects, for instance
+        when one is added or removed.
+        """
+        self._listings.pop(kind)
+
+    def invalidate_user(self, username):
+        """
+        Drop the cached entries for the user with the given name,
+        including a cached not found result.
+        """
+        self._invalidate("user", "name", username)
+        self._missing.pop(("user", "name", str(username)))
+
+    def expire_user(self, username, max_age):
+        """
+        Drop the cached entries for the user with the given name if they
+        were read more than max_age seconds ago.
+        """
+        age = self._entries.age(("user", "name", str(username)))
+        if age is not None and age > max_age:
+            self._invalidate("user", "name", username)
+
+    def invalidate_missing_users(self):
+        """
+        Drop the cached not found results for users, for instance when a
+        user is added with an id that is not known in advance.
+        """
+        self._missing.discard_if(lambda key, value: key[0] == "user")
+
+    def invalidate_group(self, name):
+        """
+        Drop the cached entries for the group with the given name.
+        """
+        entry = self._entries.get(("group", "name", str(name)))
+        if entry is not None:
+            self._refreshed.pop(str(entry[0].id))
+        self._invalidate("group", "name", name)
+
+    def invalidate_groups(self):
+        """
+        Drop all the cached groups, for instance when a user is added or
+        removed and the member lists may have changed.
+        """
+        self._entries.discard_if(lambda key, value: key[0] == "group")
+        self._refreshed.clear()
+
+    def _reset_instance(self):
+        """
+        Drop all the entries and read the timeouts from sssd.conf and
+        the integration domain again
+        """
+        self.__init__()
+        logger.info("Reset identity cache")
+
+    def clear(self):
+        self._entries.clear()
+        self._missing.clear()
+        self._refreshed.clear()
+        self._listings.clear()
+
+    @property
+    def stats(self):
+        return self._entries.stats
+
+    @property
+    def missing_stats(self):
+        return self._missing.stats
+
+
+def IdentityCache():
+    if _IdentityCache._instance is None:
+        _IdentityCache._instance = _IdentityCache()
+    return _IdentityCache._instance
+
+
+def _reconnect_on_failure(method):
+    """
+    Decorator retrying a _SSSD method once, after reconnecting to the
+    infopipe, when the call fails because the infopipe is not reachable.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() not in DBUS_DISCONNECTED_ERRORS:
+                raise
+            logger.info(f"Lost connection to the SSSD infopipe {e}")
+        self._reconnect()
+        try:
+            return method(self, *args, **kwargs)
+        except dbus.exceptions.DBusException as e:
+            raise SSSDUnavailableException(
+                "SSSD infopipe unavailable: {}".format(e.get_dbus_message())
+            )
+
+    return wrapper
+
+
+class _SSSD:
     def __init__(self):
         """
         Initialization of the DBus objects and interfaces.
+
+        Each client uses its own private connection to the system bus, so
+        that clients used by different threads do not share a connection.
+        """
+        self._owner = None
+        self._connect()
+
+    def _connect(self):
+        """
+        Connect to the system bus and create the infopipe proxies.
+
+        The proxies are bound to the current owner of the infopipe name,
+        which is remembered in order to detect a restart of sssd_ifp.
         """
         try:
-            self._bus = dbus.SystemBus()
+            self._bus = dbus.SystemBus(private=True)
+            self._owner = self._bus.activate_name_owner(DBUS_SSSD_NAME)
             self._sssd_obj = self._bus.get_object(DBUS_SSSD_NAME, DBUS_SSSD_PATH)
             self._sssd_iface = dbus.Interface(self._sssd_obj, DBUS_SSSD_IF)
             self._users_obj = self._bus.get_object(DBUS_SSSD_NAME, DBUS_SSSD_USERS_PATH)
@@ -84,21 +575,153 @@ class _SSSD:
                 DBUS_SSSD_NAME, DBUS_SSSD_GROUPS_PATH
             )
             self._groups_iface = dbus.Interface(self._groups_obj, DBUS_SSSD_GROUPS_IF)
-        except dbus.DBusException:
-            # TBD: add some logging
-            raise SSSDNotFoundException
+        except dbus.DBusException as e:
+            logger.info(f"Unable to connect to the SSSD infopipe {e}")
+            raise SSSDNotFoundException("SSSD infopipe not found")
+
+        # Proxies for the user and group objects, indexed by object path,
+        # object paths indexed by user or group name and id, and user
+        # names indexed by object path
+        size = getattr(settings, "SSSD_PROXY_CACHE_SIZE", 10000)
+        self._proxies = LRUCache(size, float("inf"))
+        self._paths = LRUCache(size, float("inf"))
+        self._names = LRUCache(size, float("inf"))
 
-    def _get_user_name(self, user_path):
+    def _reconnect(self):
         """
-        Retrieve the user name for a given DBus user_path.
+        Drop the connection and reconnect to the infopipe.
 
-        :param user_path: the object_path for a Dbus User
-        :returns: a str containing the user name
+        While the infopipe is restarting the connection is retried with an
+        exponential backoff, for at most SSSD_RECONNECT_TIMEOUT seconds.
+        When the infopipe has a new owner, the identity cache is flushed.
+
+        :raises SSSDUnavailableException: if the infopipe is not back in time
+        """
+        owner = self._owner
+        try:
+            self._bus.close()
+        except Exception as e:
+            logger.debug(f"Unable to close the DBus connection {e}")
+
+        timeout = getattr(settings, "SSSD_RECONNECT_TIMEOUT", 5)
+        deadline = time.monotonic() + timeout
+        delay = 0.1
+        while True:
+            try:
+                self._connect()
+                break
+            except SSSDNotFoundException:
+                if time.monotonic() + delay > deadline:
+                    raise SSSDUnavailableException(
+                        "SSSD infopipe unavailable after {}s".format(timeout)
+                    )
+                time.sleep(delay)
+                delay = min(delay * 2, 1)
+
+        if self._owner != owner:
+            logger.info(f"SSSD infopipe restarted, new owner {self._owner}")
+            IdentityCache().clear()
+        else:
+            logger.info("Reconnected to the SSSD infopipe")
+
+    def _get_proxy(self, object_path):
+        """
+        Return the proxy object and its DBus Properties interface for the
+        given object path, reusing the proxy when it is already known.
+
+        :param object_path: the object_path for a Dbus User or Group
+        :returns: a tuple (proxy object, properties interface)
+        """
+        proxy = self._proxies.get(object_path)
+        if proxy is None:
+            obj = self._bus.get_object(DBUS_SSSD_NAME, object_path)
+            proxy = (obj, dbus.Interface(obj, DBUS_PROPERTY_IF))
+            self._proxies.set(object_path, proxy)
+        return proxy
+
+    def _resolve(self, key, find, read, *args):
+        """
+        Find the object path for key and read the object at this path.
+
+        The object path found for key is remembered so that a later lookup
+        does not need to call the Find method again. If the remembered path
+        does not exist anymore, the object is looked up again.
+
+        :param key: a tuple ("user" or "group", "name" or "id", value)
+        :param find: the DBus method resolving the value to an object path
+        :param read: the method reading the object from its object path
+        :returns: the object returned by read
+        """
+        object_path = self._paths.get(key)
+        if object_path is not None:
+            try:
+                return read(object_path, *args)
+            except dbus.exceptions.DBusException as e:
+                if e.get_dbus_name() != DBUS_SSSD_NOT_FOUND:
+                    raise
+                self._paths.pop(key)
+                self._proxies.pop(object_path)
+                self._names.pop(object_path)
+        object_path = find(key[2])
+        obj = read(object_path, *args)
+        self._paths.set(key, object_path)
+        if key[0] == "user":
+            self._names.set(object_path, obj.username)
+        return obj
+
+    @_reconnect_on_failure
+    def _read_members(self, user_paths, deadline):
+        """
+        Read the users at the given DBus user_paths and add them to the
+        identity cache.
+
+        :param user_paths: a list of object_path for Dbus Users
+        :param deadline: time.monotonic() value after which to give up
+        :returns: a list of (object_path, user name) for the users found
+        :raises SSSDUnavailableException: if the deadline is exceeded
+        """
+        cache = IdentityCache()
+        members = []
+        for user_path in user_paths:
+            if time.monotonic() > deadline:
+                raise SSSDUnavailableException("Timeout reading the group members")
+            try:
+                sssduser = self._get_user_from_path(user_path)
+            except dbus.exceptions.DBusException as e:
+                if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                    raise
+                # The user was removed since the member list was read
+                logger.debug(f"Group member {user_path} not found {e}")
+                continue
+            cache.add_user(sssduser)
+            members.append((user_path, sssduser.username))
+        return members
+
+    def _get_member_names(self, user_paths):
         """
-        user_obj = self._bus.get_object(DBUS_SSSD_NAME, user_path)
-        user_iface = dbus.Interface(user_obj, DBUS_PROPERTY_IF)
-        name = user_iface.Get(DBUS_SSSD_USER_IF, "name")
-        return str(name)
+        Retrieve the user names for the given DBus user_paths.
+
+        The users already in the identity cache are not read again, the
+        others are read by the member resolver.
+
+        :param user_paths: a list of object_path for Dbus Users
+        :returns: a list of str containing the user names
+        """
+        cache = IdentityCache()
+        names = {}
+        unknown = []
+        for user_path in dict.fromkeys(user_paths):
+            name = self._names.get(user_path)
+            if name is not None and cache.get_user_by_name(name) is not None:
+                names[user_path] = name
+            else:
+                unknown.append(user_path)
+
+        for user_path, name in MemberResolver().resolve(self, unknown):
+            self._paths.set(("user", "name", name), user_path)
+            self._names.set(user_path, name)
+            names[user_path] = name
+        return [names[p] for p in user_paths if p in names]
 
     def _get_group_from_path(self, group_path, retrieve_members=False):
         """
@@ -108,22 +731,24 @@ class _SSSD:
         :param retrieve_members: if True, also fill in the members of the group
         :returns: a SSSDGroup object
         """
-        group_obj = self._bus.get_object(DBUS_SSSD_NAME, group_path)
-        group_props = dbus.Interface(group_obj, DBUS_PROPERTY_IF)
-        name = group_props.Get(DBUS_SSSD_GROUP_IF, "name")
-        id = group_props.Get(DBUS_SSSD_GROUP_IF, "gidNumber")
-
-        sssdgroup = SSSDGroup(int(id), str(name))
+        group_obj, group_props = self._get_proxy(group_path)
+        # Read all the properties in a single round trip
+        props = group_props.GetAll(DBUS_SSSD_GROUP_IF)
+        sssdgroup = SSSDGroup.from_properties(props)
 
         if retrieve_members:
-            group_iface = dbus.Interface(group_obj, DBUS_SSSD_GROUP_IF)
-            group_iface.UpdateMemberList(id)
+            cache = IdentityCache()
+            if cache.needs_member_refresh(sssdgroup.id):
+                group_iface = dbus.Interface(group_obj, DBUS_SSSD_GROUP_IF)
+                group_iface.UpdateMemberList(props["gidNumber"])
+                cache.member_list_refreshed(sssdgroup.id)
+            # The member list may have changed with the update
             members = group_props.Get(DBUS_SSSD_GROUP_IF, "users")
             # Transform the users (object path) into names
-            users = [self._get_user_name(user) for user in members]
-            sssdgroup.set_members(users)
+            sssdgroup.set_members(self._get_member_names(members))
         return sssdgroup
 
+    @_reconnect_on_failure
     def find_group_by_name(self, name, retrieve_members=False):
         """
         Find the group with the specified name.
@@ -133,12 +758,30 @@ class _SSSD:
         :returns: a SSSDGroup object
         :raises SSSDNotFoundException: if no group matching the name exists
         """
+        cache = IdentityCache()
+        sssdgroup = cache.get_group_by_name(name, retrieve_members)
+        if sssdgroup is not None:
+            return sssdgroup
+        if cache.is_missing("group", "name", name):
+            raise SSSDNotFoundException("Group {} not found".format(name))
+
         try:
-            group_path = self._groups_iface.FindByName(name)
-            return self._get_group_from_path(group_path, retrieve_members)
-        except dbus.exceptions.DBusException:
+            sssdgroup = self._resolve(
+                ("group", "name", name),
+                self._groups_iface.FindByName,
+                self._get_group_from_path,
+                retrieve_members,
+            )
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                raise
+            if e.get_dbus_name() == DBUS_SSSD_NOT_FOUND:
+                cache.add_missing("group", "name", name)
             raise SSSDNotFoundException("Group {} not found".format(name))
+        cache.add_group(sssdgroup, retrieve_members)
+        return sssdgroup
 
+    @_reconnect_on_failure
     def find_group_by_id(self, id, retrieve_members=False):
         """
         Find the group with the specified id.
@@ -148,11 +791,28 @@ class _SSSD:
         :returns: a SSSDGroup object
         :raises SSSDNotFoundException: if no group matching the id exists
         """
+        cache = IdentityCache()
+        sssdgroup = cache.get_group_by_id(id, retrieve_members)
+        if sssdgroup is not None:
+            return sssdgroup
+        if cache.is_missing("group", "id", id):
+            raise SSSDNotFoundException("Group {} not found".format(id))
+
         try:
-            group_path = self._groups_iface.FindByID(id)
-            return self._get_group_from_path(group_path, retrieve_members)
-        except dbus.exceptions.DBusException:
+            sssdgroup = self._resolve(
+                ("group", "id", id),
+                self._groups_iface.FindByID,
+                self._get_group_from_path,
+                retrieve_members,
+            )
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                raise
+            if e.get_dbus_name() == DBUS_SSSD_NOT_FOUND:
+                cache.add_missing("group", "id", id)
             raise SSSDNotFoundException("Group {} not found".format(id))
+        cache.add_group(sssdgroup, retrieve_members)
+        return sssdgroup
 
     def _get_user_from_path(self, user_path, retrieve_groups=False):
         """
@@ -162,41 +822,17 @@ class _SSSD:
         :param retrieve_groups: if True, also fill in the groups of the user
         :returns: a SSSDUser object
         """
-        user_obj = self._bus.get_object(DBUS_SSSD_NAME, user_path)
-        user_iface = dbus.Interface(user_obj, DBUS_PROPERTY_IF)
-        name = user_iface.Get(DBUS_SSSD_USER_IF, "name")
-        id = user_iface.Get(DBUS_SSSD_USER_IF, "uidNumber")
-
-        kwargs = dict()
-        extra_attrs = user_iface.Get(DBUS_SSSD_USER_IF, "extraAttributes")
-
-        # Retrieve firstname
-        givenname = extra_attrs.get("givenname")
-        if givenname:
-            kwargs["givenname"] = str(givenname[0])
-        # Retrieve lastname
-        sn = extra_attrs.get("sn")
-        if sn:
-            kwargs["sn"] = str(sn[0])
-        # Retrieve email
-        mail = extra_attrs.get("mail")
-        if mail:
-            kwargs["mail"] = [str(x) for x in mail]
-        # Retrieve active state
-        locked = extra_attrs.get("lock")
-        if locked and str(locked[0]).lower() == "true":
-            kwargs["active"] = False
-        else:
-            kwargs["active"] = True
+        user_obj, user_iface = self._get_proxy(user_path)
+        # Read all the properties in a single round trip
+        props = user_iface.GetAll(DBUS_SSSD_USER_IF)
 
+        groups = None
         if retrieve_groups:
-            groups = self._sssd_iface.GetUserGroups(name)
-            if groups:
-                kwargs["groups"] = {str(x) for x in groups}
+            groups = self._sssd_iface.GetUserGroups(props["name"])
 
-        sssduser = SSSDUser(id, name, **kwargs)
-        return sssduser
+        return SSSDUser.from_properties(props, groups)
 
+    @_reconnect_on_failure
     def find_user_by_name(self, username, retrieve_groups=False):
         """
         Find the user with the specified name.
@@ -206,12 +842,30 @@ class _SSSD:
         :returns: a SSSDUser object
         :raises SSSDNotFoundException: if no user matching the name exists
         """
+        cache = IdentityCache()
+        sssduser = cache.get_user_by_name(username, retrieve_groups)
+        if sssduser is not None:
+            return sssduser
+        if cache.is_missing("user", "name", username):
+            raise SSSDNotFoundException("User {} not found".format(username))
+
         try:
-            user_path = self._users_iface.FindByName(username)
-            return self._get_user_from_path(user_path, retrieve_groups)
-        except dbus.exceptions.DBusException:
+            sssduser = self._resolve(
+                ("user", "name", username),
+                self._users_iface.FindByName,
+                self._get_user_from_path,
+                retrieve_groups,
+            )
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                raise
+            if e.get_dbus_name() == DBUS_SSSD_NOT_FOUND:
+                cache.add_missing("user", "name", username)
             raise SSSDNotFoundException("User {} not found".format(username))
+        cache.add_user(sssduser, retrieve_groups)
+        return sssduser
 
+    @_reconnect_on_failure
     def find_user_by_id(self, id, retrieve_groups=False):
         """
         Find the user with the specified id.
@@ -221,12 +875,88 @@ class _SSSD:
         :returns: a SSSDUser object
         :raises SSSDNotFoundException: if no user matching the id exists
         """
+        cache = IdentityCache()
+        sssduser = cache.get_user_by_id(id, retrieve_groups)
+        if sssduser is not None:
+            return sssduser
+        if cache.is_missing("user", "id", id):
+            raise SSSDNotFoundException("User {} not found".format(id))
+
         try:
-            user_path = self._users_iface.FindByID(id)
-            return self._get_user_from_path(user_path, retrieve_groups)
-        except dbus.exceptions.DBusException:
+            sssduser = self._resolve(
+                ("user", "id", id),
+                self._users_iface.FindByID,
+                self._get_user_from_path,
+                retrieve_groups,
+            )
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                raise
+            if e.get_dbus_name() == DBUS_SSSD_NOT_FOUND:
+                cache.add_missing("user", "id", id)
             raise SSSDNotFoundException("User {} not found".format(id))
+        cache.add_user(sssduser, retrieve_groups)
+        return sssduser
+
+    def _list_ids(self, kind, list_by_name, limit):
+        """
+        Enumerate the users or groups with a wildcard search.
+
+        The object paths end with the id of the user or group, they are
+        remembered so that reading an object by id afterwards skips the
+        FindByID call.
+
+        :param kind: "user" or "group"
+        :param list_by_name: the ListByName DBus method of the interface
+        :param limit: the maximum number of objects, 0 for the SSSD
+            wildcard_limit
+        :returns: a sorted list of int
+        """
+        cache = IdentityCache()
+        ids = cache.get_listing(kind)
+        if ids is not None:
+            return ids
+
+        try:
+            object_paths = list_by_name("*", dbus.UInt32(limit))
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() != DBUS_SSSD_NOT_FOUND:
+                raise
+            object_paths = []
+        ids = []
+        for object_path in object_paths:
+            id = str(object_path).rsplit("/", 1)[-1]
+            if not id.isdigit():
+                continue
+            self._paths.set((kind, "id", id), str(object_path))
+            ids.append(int(id))
+        ids.sort()
+        cache.add_listing(kind, ids)
+        return ids
+
+    @_reconnect_on_failure
+    def list_user_ids(self, limit=0):
+        """
+        List the ids of the users known by SSSD.
+
+        :param limit: the maximum number of users, 0 for the SSSD
+            wildcard_limit
+        :returns: a sorted list of int
+        """
+        return self._list_ids("user", self._users_iface.ListByName, limit)
+
+    @_reconnect_on_failure
+    def list_group_ids(self, limit=0):
+        """
+        List the ids of the groups known by SSSD.
+
+        :param limit: the maximum number of groups, 0 for the SSSD
+            wildcard_limit
+        :returns: a sorted list of int
+        """
+        return self._list_ids("group", self._groups_iface.ListByName, limit)
 
+    @_reconnect_on_failure
     def find_user_groups(self, username):
         """
         Find the groups for the specified user.
@@ -244,11 +974,209 @@ class _SSSD:
                 sssdgroup = self.find_group_by_name(grp)
                 sssdgroups.append(sssdgroup)
             return sssdgroups
-        except dbus.exceptions.DBusException:
+        except dbus.exceptions.DBusException as e:
+            if e.get_dbus_name() in DBUS_DISCONNECTED_ERRORS:
+                raise
             raise SSSDNotFoundException("User {} not found".format(username))
 
 
+class _SSSDPool:
+    """
+    Pool of SSSD clients shared by the request threads.
+
+    A client is checked out for the duration of each call, a thread
+    already holding a client reuses it. At most SSSD_POOL_SIZE clients
+    are created, a thread waits up to SSSD_POOL_TIMEOUT seconds for a
+    client to be returned to the pool when they are all in use.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.size = getattr(settings, "SSSD_POOL_SIZE", 4)
+        self.timeout = getattr(settings, "SSSD_POOL_TIMEOUT", 30)
+        self._clients = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Wait time metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _checkout(self):
+        try:
+            return self._clients.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return _SSSD()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        start = time.monotonic()
+        try:
+            client = self._clients.get(timeout=self.timeout)
+        except queue.Empty:
+            raise SSSDUnavailableException(
+                "No SSSD client available after {}s".format(self.timeout)
+            )
+        waited = time.monotonic() - start
+        with self._lock:
+            self.waits += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        return client
+
+    @contextmanager
+    def client(self):
+        """
+        Check out a SSSD client for the current thread.
+
+        :returns: a context manager returning a _SSSD object
+        :raises SSSDUnavailableException: if no client is available in time
+        """
+        client = getattr(self._local, "client", None)
+        if client is not None:
+            yield client
+            return
+
+        client = self._checkout()
+        with self._lock:
+            self.checkouts += 1
+        self._local.client = client
+        try:
+            yield client
+        finally:
+            self._local.client = None
+            self._clients.put(client)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.size,
+                "created": self._created,
+                "idle": self._clients.qsize(),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+                "max_wait_time": self.max_wait_time,
+            }
+
+    def find_group_by_name(self, name, retrieve_members=False):
+        with self.client() as client:
+            return client.find_group_by_name(name, retrieve_members)
+
+    def find_group_by_id(self, id, retrieve_members=False):
+        with self.client() as client:
+            return client.find_group_by_id(id, retrieve_members)
+
+    def find_user_by_name(self, username, retrieve_groups=False):
+        with self.client() as client:
+            return client.find_user_by_name(username, retrieve_groups)
+
+    def find_user_by_id(self, id, retrieve_groups=False):
+        with self.client() as client:
+            return client.find_user_by_id(id, retrieve_groups)
+
+    def find_user_groups(self, username):
+        with self.client() as client:
+            return client.find_user_groups(username)
+
+    def list_user_ids(self, limit=0):
+        with self.client() as client:
+            return client.list_user_ids(limit)
+
+    def list_group_ids(self, limit=0):
+        with self.client() as client:
+            return client.list_group_ids(limit)
+
+
+class _MemberResolver:
+    """
+    Resolve the members of large groups with a bounded pool of threads.
+
+    The member object paths are split in batches of SSSD_MEMBER_BATCH_SIZE
+    users, which are read concurrently by at most SSSD_MEMBER_WORKERS
+    threads. Each thread uses its own SSSD client, outside of the pool
+    used by the request threads. The whole resolution is given up after
+    SSSD_MEMBER_TIMEOUT seconds.
+    """
+
+    _instance = None
+
+    def __init__(self):
+        self.workers = getattr(settings, "SSSD_MEMBER_WORKERS", 8)
+        self.batch_size = getattr(settings, "SSSD_MEMBER_BATCH_SIZE", 500)
+        self.timeout = getattr(settings, "SSSD_MEMBER_TIMEOUT", 60)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="sssd-members"
+        )
+        self._local = threading.local()
+
+    def _read_batch(self, user_paths, deadline):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = _SSSD()
+        return client._read_members(user_paths, deadline)
+
+    def resolve(self, client, user_paths):
+        """
+        Read the users at the given DBus user_paths.
+
+        A single batch is read by the calling thread with its own client.
+
+        :param client: the _SSSD client of the calling thread
+        :param user_paths: a list of object_path for Dbus Users
+        :returns: a list of (object_path, user name) for the users found
+        :raises SSSDUnavailableException: if the members are not read in time
+        """
+        deadline = time.monotonic() + self.timeout
+        batches = [
+            user_paths[i : i + self.batch_size]
+            for i in range(0, len(user_paths), self.batch_size)
+        ]
+        if len(batches) <= 1 or self.workers <= 1:
+            return client._read_members(user_paths, deadline)
+
+        futures = [
+            self._executor.submit(self._read_batch, batch, deadline)
+            for batch in batches
+        ]
+        done, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        if pending:
+            for future in pending:
+                future.cancel()
+            raise SSSDUnavailableException(
+                "Group members not resolved after {}s".format(self.timeout)
+            )
+        members = []
+        for future in futures:
+            members.extend(future.result())
+        return members
+
+    def _reset_instance(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.__init__()
+
+
+def MemberResolver():
+    if _MemberResolver._instance is None:
+        _MemberResolver._instance = _MemberResolver()
+    return _MemberResolver._instance
+
+
 def SSSD():
-    if _SSSD._instance is None:
-        _SSSD._instance = _SSSD()
-    return _SSSD._instance
+    if _SSSDPool._instance is None:
+        _SSSDPool._instance = _SSSDPool()
+    return _SSSDPool._instance
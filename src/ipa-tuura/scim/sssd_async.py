@@ -0,0 +1,499 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import asyncio
+import logging
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from scim.sssd import (
+    DBUS_DISCONNECTED_ERRORS,
+    DBUS_PROPERTY_IF,
+    DBUS_SSSD_GROUP_IF,
+    DBUS_SSSD_GROUPS_IF,
+    DBUS_SSSD_GROUPS_PATH,
+    DBUS_SSSD_IF,
+    DBUS_SSSD_NAME,
+    DBUS_SSSD_NOT_FOUND,
+    DBUS_SSSD_PATH,
+    DBUS_SSSD_USER_IF,
+    DBUS_SSSD_USERS_IF,
+    DBUS_SSSD_USERS_PATH,
+    IdentityCache,
+    LRUCache,
+    SSSDGroup,
+    SSSDNotFoundException,
+    SSSDUnavailableException,
+    SSSDUser,
+)
+
+try:
+    from dbus_next import BusType, Message, MessageType, Variant
+    from dbus_next.aio import MessageBus
+    from dbus_next.errors import DBusError
+except ImportError:
+    MessageBus = None
+
+logger = logging.getLogger(__name__)
+
+DBUS_NAME = "org.freedesktop.DBus"
+DBUS_PATH = "/org/freedesktop/DBus"
+DBUS_IF = "org.freedesktop.DBus"
+
+
+def is_available():
+    """
+    Return True when the asyncio D-Bus library (dbus-next) is installed.
+    """
+    return MessageBus is not None
+
+
+def _unwrap(value):
+    """
+    Convert the dbus-next Variants contained in value to plain values.
+    """
+    if MessageBus is not None and isinstance(value, Variant):
+        value = value.value
+    if isinstance(value, dict):
+        return {k: _unwrap(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_unwrap(v) for v in value]
+    return value
+
+
+class _AsyncSSSD:
+    """
+    asyncio client of the SSSD infopipe.
+
+    It offers the same lookups as the _SSSD client, as coroutines. All the
+    calls share a single connection to the system bus and are pipelined:
+    up to SSSD_ASYNC_MAX_CALLS calls can wait for their reply at the same
+    time, which lets one event loop overlap many lookups. The identity
+    cache is shared with the _SSSD clients.
+    """
+
+    def __init__(self):
+        self._bus = None
+        self._owner = None
+        self._connecting = asyncio.Lock()
+        self._calls = asyncio.Semaphore(getattr(settings, "SSSD_ASYNC_MAX_CALLS", 256))
+        # Object paths indexed by user or group name and id, and user names
+        # indexed by object path
+        size = getattr(settings, "SSSD_PROXY_CACHE_SIZE", 10000)
+        self._paths = LRUCache(size, float("inf"))
+        self._names = LRUCache(size, float("inf"))
+
+    async def _connect(self):
+        """
+        Connect to the system bus and activate the infopipe.
+
+        The owner of the infopipe name is remembered in order to detect a
+        restart of sssd_ifp.
+        """
+        try:
+            self._bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            await self._send(
+                DBUS_NAME,
+                DBUS_PATH,
+                DBUS_IF,
+                "StartServiceByName",
+                "su",
+                [DBUS_SSSD_NAME, 0],
+            )
+            self._owner = await self._send(
+                DBUS_NAME, DBUS_PATH, DBUS_IF, "GetNameOwner", "s", [DBUS_SSSD_NAME]
+            )
+        except (DBusError, OSError) as e:
+            logger.debug(f"Unable to connect to the SSSD infopipe {e}")
+            self._bus = None
+            raise SSSDNotFoundException
+
+    async def _reconnect(self, bus):
+        """
+        Drop the connection bus and reconnect to the infopipe.
+
+        Concurrent calls failing on the same connection reconnect only once.
+        While the infopipe is restarting the connection is retried with an
+        exponential backoff, for at most SSSD_RECONNECT_TIMEOUT seconds.
+        When the infopipe has a new owner, the identity cache is flushed.
+
+        :param bus: the connection on which the call failed
+        :raises SSSDUnavailableException: if the infopipe is not back in time
+        """
+        async with self._connecting:
+            if self._bus is not bus and self._bus is not None:
+                # Another call already reconnected
+                return
+            owner = self._owner
+            if bus is not None:
+                bus.disconnect()
+                self._bus = None
+
+            timeout = getattr(settings, "SSSD_RECONNECT_TIMEOUT", 5)
+            deadline = time.monotonic() + timeout
+            delay = 0.1
+            while True:
+                try:
+                    await self._connect()
+                    break
+                except SSSDNotFoundException:
+                    if time.monotonic() + delay > deadline:
+                        raise SSSDUnavailableException(
+                            "SSSD infopipe unavailable after {}s".format(timeout)
+                        )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 1)
+
+            if owner is not None and self._owner != owner:
+                logger.info(f"SSSD infopipe restarted, new owner {self._owner}")
+                IdentityCache().clear()
+                self._paths.clear()
+                self._names.clear()
+
+    async def _send(self, destination, path, interface, member, signature="", body=()):
+        """
+        Send a method call on the current connection and wait for its reply.
+
+        :returns: the first value of the reply, None if the reply is empty
+        :raises DBusError: if the reply is an error
+        """
+        async with self._calls:
+            reply = await self._bus.call(
+                Message(
+                    destination=destination,
+                    path=path,
+                    interface=interface,
+                    member=member,
+                    signature=signature,
+                    body=list(body),
+                )
+            )
+        if reply.message_type == MessageType.ERROR:
+            text = reply.body[0] if reply.body else reply.error_name
+            raise DBusError(reply.error_name, text)
+        if not reply.body:
+            return None
+        return _unwrap(reply.body[0])
+
+    async def _call(self, path, interface, member, signature="", *args):
+        """
+        Call a method of the infopipe.
+
+        The call is retried once, after reconnecting, when the infopipe is
+        not reachable.
+
+        :raises DBusError: if the infopipe replies with an error
+        :raises SSSDUnavailableException: if the infopipe is not reachable
+        """
+        if self._bus is None:
+            await self._reconnect(None)
+        bus = self._bus
+        try:
+            return await self._send(
+                DBUS_SSSD_NAME, path, interface, member, signature, args
+            )
+        except DBusError as e:
+            if e.type not in DBUS_DISCONNECTED_ERRORS:
+                raise
+            logger.info(f"Lost connection to the SSSD infopipe {e}")
+        except (EOFError, OSError) as e:
+            logger.info(f"Lost connection to the SSSD infopipe {e}")
+        await self._reconnect(bus)
+        try:
+            return await self._send(
+                DBUS_SSSD_NAME, path, interface, member, signature, args
+            )
+        except DBusError as e:
+            if e.type not in DBUS_DISCONNECTED_ERRORS:
+                raise
+            raise SSSDUnavailableException("SSSD infopipe unavailable: {}".format(e))
+        except (EOFError, OSError) as e:
+            raise SSSDUnavailableException("SSSD infopipe unavailable: {}".format(e))
+
+    async def _resolve(self, key, find, read, *args):
+        """
+        Find the object path for key and read the object at this path.
+
+        Same as _SSSD._resolve, with coroutines.
+        """
+        object_path = self._paths.get(key)
+        if object_path is not None:
+            try:
+                return await read(object_path, *args)
+            except DBusError as e:
+                if e.type != DBUS_SSSD_NOT_FOUND:
+                    raise
+                self._paths.pop(key)
+                self._names.pop(object_path)
+        object_path = await find(key[2])
+        obj = await read(object_path, *args)
+        self._paths.set(key, object_path)
+        if key[0] == "user":
+            self._names.set(object_path, obj.username)
+        return obj
+
+    async def _lookup(self, kind, attr, value, flag, find, read):
+        """
+        Look up a user or group, using the identity cache.
+
+        :param kind: "user" or "group"
+        :param attr: "name" or "id"
+        :param flag: retrieve_groups for users, retrieve_members for groups
+        :param find: the coroutine resolving the value to an object path
+        :param read: the coroutine reading the object from its object path
+        :raises SSSDNotFoundException: if no object matching the value exists
+        """
+        cache = IdentityCache()
+        obj = getattr(cache, f"get_{kind}_by_{attr}")(value, flag)
+        if obj is not None:
+            return obj
+        if cache.is_missing(kind, attr, value):
+            raise SSSDNotFoundException("{} {} not found".format(kind.title(), value))
+
+        try:
+            obj = await self._resolve((kind, attr, value), find, read, flag)
+        except DBusError as e:
+            if e.type == DBUS_SSSD_NOT_FOUND:
+                cache.add_missing(kind, attr, value)
+            raise SSSDNotFoundException("{} {} not found".format(kind.title(), value))
+        getattr(cache, f"add_{kind}")(obj, flag)
+        return obj
+
+    async def _find_user_path_by_name(self, name):
+        return await self._call(
+            DBUS_SSSD_USERS_PATH, DBUS_SSSD_USERS_IF, "FindByName", "s", name
+        )
+
+    async def _find_user_path_by_id(self, id):
+        return await self._call(
+            DBUS_SSSD_USERS_PATH, DBUS_SSSD_USERS_IF, "FindByID", "u", int(id)
+        )
+
+    async def _find_group_path_by_name(self, name):
+        return await self._call(
+            DBUS_SSSD_GROUPS_PATH, DBUS_SSSD_GROUPS_IF, "FindByName", "s", name
+        )
+
+    async def _find_group_path_by_id(self, id):
+        return await self._call(
+            DBUS_SSSD_GROUPS_PATH, DBUS_SSSD_GROUPS_IF, "FindByID", "u", int(id)
+        )
+
+    async def _read_member(self, user_path):
+        """
+        Read the user at the given DBus user_path and add it to the
+        identity cache.
+
+        :param user_path: the object_path for a Dbus User
+        :returns: a str containing the user name, None if the user is gone
+        """
+        try:
+            sssduser = await self._get_user_from_path(user_path)
+        except DBusError as e:
+            if e.type in DBUS_DISCONNECTED_ERRORS:
+                raise
+            # The user was removed since the member list was read
+            logger.debug(f"Group member {user_path} not found {e}")
+            return None
+        IdentityCache().add_user(sssduser)
+        self._paths.set(("user", "name", sssduser.username), user_path)
+        self._names.set(user_path, sssduser.username)
+        return sssduser.username
+
+    async def _read_members(self, user_paths):
+        batch_size = getattr(settings, "SSSD_MEMBER_BATCH_SIZE", 500)
+        names = {}
+        for i in range(0, len(user_paths), batch_size):
+            batch = user_paths[i : i + batch_size]
+            results = await asyncio.gather(*(self._read_member(p) for p in batch))
+            names.update(zip(batch, results))
+        return names
+
+    async def _get_member_names(self, user_paths):
+        """
+        Retrieve the user names for the given DBus user_paths.
+
+        The users already in the identity cache are not read again, the
+        others are read concurrently, in batches of SSSD_MEMBER_BATCH_SIZE.
+
+        :param user_paths: a list of object_path for Dbus Users
+        :returns: a list of str containing the user names
+        :raises SSSDUnavailableException: if the members are not read in
+            SSSD_MEMBER_TIMEOUT seconds
+        """
+        cache = IdentityCache()
+        names = {}
+        unknown = []
+        for user_path in dict.fromkeys(user_paths):
+            name = self._names.get(user_path)
+            if name is not None and cache.get_user_by_name(name) is not None:
+                names[user_path] = name
+            else:
+                unknown.append(user_path)
+
+        timeout = getattr(settings, "SSSD_MEMBER_TIMEOUT", 60)
+        try:
+            names.update(await asyncio.wait_for(self._read_members(unknown), timeout))
+        except asyncio.TimeoutError:
+            raise SSSDUnavailableException(
+                "Group members not resolved after {}s".format(timeout)
+            )
+        return [names[p] for p in user_paths if names.get(p) is not None]
+
+    async def _get_user_from_path(self, user_path, retrieve_groups=False):
+        """
+        Retrieve the user for a given DBus user_path.
+
+        :param user_path: the object_path for a Dbus User
+        :param retrieve_groups: if True, also fill in the groups of the user
+        :returns: a SSSDUser object
+        """
+        props = await self._call(
+            user_path, DBUS_PROPERTY_IF, "GetAll", "s", DBUS_SSSD_USER_IF
+        )
+        groups = None
+        if retrieve_groups:
+            groups = await self._call(
+                DBUS_SSSD_PATH, DBUS_SSSD_IF, "GetUserGroups", "s", props["name"]
+            )
+        return SSSDUser.from_properties(props, groups)
+
+    async def _get_group_from_path(self, group_path, retrieve_members=False):
+        """
+        Retrieve the group for a given DBus group_path.
+
+        :param group_path: the object_path for a Dbus Group
+        :param retrieve_members: if True, also fill in the members of the group
+        :returns: a SSSDGroup object
+        """
+        props = await self._call(
+            group_path, DBUS_PROPERTY_IF, "GetAll", "s", DBUS_SSSD_GROUP_IF
+        )
+        sssdgroup = SSSDGroup.from_properties(props)
+
+        if retrieve_members:
+            cache = IdentityCache()
+            if cache.needs_member_refresh(sssdgroup.id):
+                await self._call(group_path, DBUS_SSSD_GROUP_IF, "UpdateMemberList")
+                # Reads the interval from the database the first time
+                await sync_to_async(cache.member_list_refreshed)(sssdgroup.id)
+            # The member list may have changed with the update
+            members = await self._call(
+                group_path, DBUS_PROPERTY_IF, "Get", "ss", DBUS_SSSD_GROUP_IF, "users"
+            )
+            sssdgroup.set_members(await self._get_member_names(members))
+        return sssdgroup
+
+    async def find_group_by_name(self, name, retrieve_members=False):
+        """
+        Find the group with the specified name.
+
+        :param name: a str containing the group name
+        :param retrieve_members: if True, also fill in the members of the group
+        :returns: a SSSDGroup object
+        :raises SSSDNotFoundException: if no group matching the name exists
+        """
+        return await self._lookup(
+            "group",
+            "name",
+            name,
+            retrieve_members,
+            self._find_group_path_by_name,
+            self._get_group_from_path,
+        )
+
+    async def find_group_by_id(self, id, retrieve_members=False):
+        """
+        Find the group with the specified id.
+
+        :param id: an int containing the group id
+        :param retrieve_members: if True, also fill in the members of the group
+        :returns: a SSSDGroup object
+        :raises SSSDNotFoundException: if no group matching the id exists
+        """
+        return await self._lookup(
+            "group",
+            "id",
+            id,
+            retrieve_members,
+            self._find_group_path_by_id,
+            self._get_group_from_path,
+        )
+
+    async def find_user_by_name(self, username, retrieve_groups=False):
+        """
+        Find the user with the specified name.
+
+        :param username: a str containing the user name
+        :param retrieve_groups: if True, also fill in the groups of the user
+        :returns: a SSSDUser object
+        :raises SSSDNotFoundException: if no user matching the name exists
+        """
+        return await self._lookup(
+            "user",
+            "name",
+            username,
+            retrieve_groups,
+            self._find_user_path_by_name,
+            self._get_user_from_path,
+        )
+
+    async def find_user_by_id(self, id, retrieve_groups=False):
+        """
+        Find the user with the specified id.
+
+        :param id: an int containing the user id
+        :param retrieve_groups: if True, also fill in the groups of the user
+        :returns: a SSSDUser object
+        :raises SSSDNotFoundException: if no user matching the id exists
+        """
+        return await self._lookup(
+            "user",
+            "id",
+            id,
+            retrieve_groups,
+            self._find_user_path_by_id,
+            self._get_user_from_path,
+        )
+
+    async def find_user_groups(self, username):
+        """
+        Find the groups for the specified user.
+
+        The groups are looked up concurrently.
+
+        :param username: a str containing the user name
+        :returns: an array of SSSDGroup objects, can be empty
+        :raises SSSDNotFoundException: if no user matching the name exists
+        """
+        try:
+            groups = await self._call(
+                DBUS_SSSD_PATH, DBUS_SSSD_IF, "GetUserGroups", "s", username
+            )
+        except DBusError:
+            raise SSSDNotFoundException("User {} not found".format(username))
+        return list(
+            await asyncio.gather(
+                *(self.find_group_by_name(str(grp)) for grp in set(groups))
+            )
+        )
+
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def AsyncSSSD():
+    """
+    Return the asyncio SSSD client of the running event loop.
+
+    A connection is bound to the event loop which created it, so each event
+    loop gets its own client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = _AsyncSSSD()
+    return client
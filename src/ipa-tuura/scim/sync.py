@@ -0,0 +1,403 @@
+#
+# Copyright (C) 2024  FreeIPA Contributors see COPYING for license
+#
+
+import bisect
+import hashlib
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from scim.models import DirectoryEntry, DirectoryMember, DirectorySyncState
+from scim.sssd import SSSD, SSSDNotFoundException
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryRecord:
+    """
+    User or group read from the identity server.
+
+    :param name: the user or group name
+    :param number: the uidNumber or gidNumber, None if the identity server
+                   does not have one and SSSD maps it
+    :param attrs: dict with the givenname, sn, mail and active of a user
+    :param members: list of the names of the members of a group
+    :param modified: the modifyTimestamp of the entry, if any
+    """
+
+    def __init__(self, name, number=None, attrs=None, members=None, modified=""):
+        self.name = name
+        self.number = number
+        self.attrs = attrs or {}
+        self.members = members
+        self.modified = modified
+
+    def digest(self):
+        members = sorted(self.members) if self.members is not None else None
+        data = json.dumps([self.number, self.attrs, members], sort_keys=True)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    def __repr__(self):
+        return "DirectoryRecord({})".format(self.name)
+
+
+class DirectorySource:
+    """
+    Reads the users and groups of the integration domain for DirectorySync.
+
+    The kind of the entries is "user" or "group".
+    """
+
+    # changes() returns the entries changed since a cursor
+    incremental = False
+    # pages() can resume a full load after the last name read
+    resumable = False
+
+    def pages(self, kind, position=""):
+        """
+        Read all the entries, by pages.
+
+        :param position: the position returned with the last page read
+        :returns: an iterator of (list of DirectoryRecord, position)
+        """
+        raise NotImplementedError
+
+    def names(self, kind):
+        """
+        :returns: the set of the names of all the entries
+        """
+        raise NotImplementedError
+
+    def fetch(self, kind, names):
+        """
+        :returns: the list of DirectoryRecord of the entries that exist
+        """
+        raise NotImplementedError
+
+    def changes(self, kind, cursor):
+        """
+        Read the entries changed since the cursor.
+
+        :returns: (list of DirectoryRecord, names of the removed entries,
+                   new cursor)
+        """
+        raise NotImplementedError
+
+
+class SyncStats:
+    """
+    Cost of a synchronization of the users or the groups.
+    """
+
+    def __init__(self, kind, full=False):
+        self.kind = kind
+        self.full = full
+        # Entries read from the identity server
+        self.fetched = 0
+        # Entries created or updated in the mirror
+        self.written = 0
+        self.deleted = 0
+        self.duration = 0.0
+
+    def __str__(self):
+        return "{} {}: {} fetched, {} written, {} deleted in {:.2f}s".format(
+            self.kind,
+            "load" if self.full else "refresh",
+            self.fetched,
+            self.written,
+            self.deleted,
+            self.duration,
+        )
+
+
+class DirectorySync:
+    """
+    Maintains the DirectoryEntry mirror of the users and groups of the
+    integration domain.
+
+    The first run loads all the entries, page by page. The next runs
+    only read the entries changed since the cursor of the previous run
+    when the source supports it. Otherwise they read the new entries, the
+    entries changed through ipa-tuura and one page of the other entries,
+    so that their cost depends on the volume of changes rather than on
+    the size of the directory.
+
+    The entries and the DirectorySyncState are saved in the same
+    transaction, an interrupted run is resumed from the last saved page.
+    """
+
+    KINDS = ("user", "group")
+
+    def __init__(self, source, sssd_if=None):
+        """
+        :param source: the DirectorySource of the integration domain
+        :param sssd_if: SSSD interface mapping the missing uid and gid
+                        numbers, obtained with SSSD() when needed
+        """
+        self.source = source
+        self._sssd_if = sssd_if
+        self.page_size = getattr(settings, "DIRECTORY_SYNC_PAGE_SIZE", 500)
+        self.reconcile_interval = getattr(
+            settings, "DIRECTORY_SYNC_RECONCILE_INTERVAL", 3600
+        )
+
+    def run(self, full=False):
+        """
+        Load or refresh the users, then the groups.
+
+        :param full: reload all the entries even if the mirror is complete
+        :returns: the list of SyncStats
+        """
+        stats = []
+        for kind in self.KINDS:
+            state, _ = DirectorySyncState.objects.get_or_create(kind=kind)
+            if full or state.loading or not state.complete:
+                stats.append(self.load(state, restart=full))
+            else:
+                stats.append(self.refresh(state))
+            logger.info(f"Directory sync: {stats[-1]}")
+        return stats
+
+    def load(self, state, restart=False):
+        """
+        Read all the entries, and remove the ones that were not read.
+
+        :param state: the DirectorySyncState of the kind of entries
+        :param restart: start a new load even if one was interrupted
+        """
+        stats = SyncStats(state.kind, full=True)
+        start = time.monotonic()
+        if restart or not state.loading:
+            state.generation += 1
+            state.loading = True
+            state.position = ""
+            state.cursor = ""
+            state.save()
+        elif not self.source.resumable:
+            state.position = ""
+
+        for records, position in self.source.pages(state.kind, state.position):
+            with transaction.atomic():
+                self._store(state, records, stats)
+                state.position = position or ""
+                state.cursor = max([state.cursor] + [r.modified for r in records])
+                state.save()
+
+        with transaction.atomic():
+            removed = DirectoryEntry.objects.filter(
+                kind=state.kind, generation__lt=state.generation
+            )
+            stats.deleted += removed.delete()[1].get(DirectoryEntry._meta.label, 0)
+            state.loading = False
+            state.complete = True
+            state.position = ""
+            state.reconciled = timezone.now()
+            self._save_stats(state, stats, start)
+        return stats
+
+    def refresh(self, state):
+        """
+        Read the entries changed since the last run.
+
+        :param state: the DirectorySyncState of the kind of entries
+        """
+        kind = state.kind
+        stats = SyncStats(kind)
+        start = time.monotonic()
+        stale = set(
+            DirectoryEntry.objects.filter(kind=kind, stale=True).values_list(
+                "name", flat=True
+            )
+        )
+
+        if self.source.incremental:
+            records, removed, cursor = self.source.changes(kind, state.cursor)
+            removed = set(removed)
+            if self._reconcile_due(state):
+                removed |= self._known(kind) - self.source.names(kind)
+                state.reconciled = timezone.now()
+            wanted = stale - {r.name for r in records} - removed
+        else:
+            # Without change cursor, the new entries are found in the list
+            # of all the names, and the cursor sweeps the other ones page
+            # by page to find their changes
+            records = []
+            names = self.source.names(kind)
+            known = self._known(kind)
+            removed = known - names
+            existing = sorted(names & known)
+            first = bisect.bisect_right(existing, state.cursor)
+            sweep = existing[first : first + self.page_size]
+            cursor = sweep[-1] if first + self.page_size < len(existing) else ""
+            wanted = (names - known) | (stale & names) | set(sweep)
+            state.reconciled = timezone.now()
+
+        if wanted:
+            fetched = self.source.fetch(kind, sorted(wanted))
+            # The entries that no longer exist were removed
+            removed |= wanted - {r.name for r in fetched}
+            records = records + fetched
+        # An entry removed then added again is kept
+        removed -= {r.name for r in records}
+
+        with transaction.atomic():
+            self._store(state, records, stats)
+            stats.deleted += self._delete(kind, removed)
+            state.cursor = cursor
+            self._save_stats(state, stats, start)
+        return stats
+
+    def _reconcile_due(self, state):
+        if state.reconciled is None:
+            return True
+        elapsed = (timezone.now() - state.reconciled).total_seconds()
+        return elapsed >= self.reconcile_interval
+
+    def _known(self, kind):
+        return set(
+            DirectoryEntry.objects.filter(kind=kind).values_list("name", flat=True)
+        )
+
+    def _chunks(self, items):
+        items = list(items)
+        for i in range(0, len(items), self.page_size):
+            yield items[i : i + self.page_size]
+
+    def _store(self, state, records, stats):
+        """
+        Create or update the entries of the records that changed.
+        """
+        stats.fetched += len(records)
+        for chunk in self._chunks(records):
+            self._store_chunk(state, chunk, stats)
+
+    def _store_chunk(self, state, records, stats):
+        kind = state.kind
+        existing = {
+            entry.name: entry
+            for entry in DirectoryEntry.objects.filter(
+                kind=kind, name__in=[r.name for r in records]
+            )
+        }
+        created, updated, unchanged = [], [], []
+        for record in records:
+            entry = existing.get(record.name)
+            digest = record.digest()
+            if entry is not None and entry.digest == digest and not entry.stale:
+                unchanged.append(entry.pk)
+                continue
+            if entry is None:
+                entry = DirectoryEntry(kind=kind, name=record.name)
+                created.append((entry, record))
+            else:
+                updated.append((entry, record))
+            if record.number is not None:
+                entry.number = record.number
+            elif entry.number is None:
+                entry.number = self._map_number(kind, record.name)
+            entry.attrs = record.attrs
+            entry.digest = digest
+            entry.modified = record.modified
+            entry.generation = state.generation
+            entry.stale = False
+
+        # A single upsert, bulk_update() builds a CASE expression per field
+        # and row that costs more than the query itself
+        DirectoryEntry.objects.bulk_create(
+            [entry for entry, _ in created + updated],
+            update_conflicts=True,
+            unique_fields=["kind", "name"],
+            update_fields=[
+                "number",
+                "attrs",
+                "digest",
+                "modified",
+                "generation",
+                "stale",
+            ],
+        )
+        if unchanged:
+            DirectoryEntry.objects.filter(
+                pk__in=unchanged, generation__lt=state.generation
+            ).update(generation=state.generation)
+        stats.written += len(created) + len(updated)
+
+        if kind == "group":
+            self._store_members(created, updated)
+
+    def _store_members(self, created, updated):
+        if any(entry.pk is None for entry, _ in created):
+            # The database did not return the primary keys of the new rows
+            pks = dict(
+                DirectoryEntry.objects.filter(
+                    kind="group", name__in=[entry.name for entry, _ in created]
+                ).values_list("name", "pk")
+            )
+            for entry, _ in created:
+                entry.pk = pks[entry.name]
+        DirectoryMember.objects.filter(
+            group__in=[entry.pk for entry, _ in updated]
+        ).delete()
+        DirectoryMember.objects.bulk_create(
+            [
+                DirectoryMember(group_id=entry.pk, username=username)
+                for entry, record in created + updated
+                for username in set(record.members or ())
+            ],
+            batch_size=self.page_size,
+        )
+
+    def _delete(self, kind, names):
+        deleted = 0
+        for chunk in self._chunks(names):
+            removed = DirectoryEntry.objects.filter(kind=kind, name__in=chunk)
+            deleted += removed.delete()[1].get(DirectoryEntry._meta.label, 0)
+        return deleted
+
+    def _map_number(self, kind, name):
+        """
+        Ask SSSD the id it mapped to an entry without uidNumber or gidNumber.
+        """
+        if self._sssd_if is None:
+            self._sssd_if = SSSD()
+        if kind == "user":
+            find = self._sssd_if.find_user_by_name
+        else:
+            find = self._sssd_if.find_group_by_name
+        try:
+            return find(name).id
+        except SSSDNotFoundException:
+            return None
+
+    def _save_stats(self, state, stats, start):
+        stats.duration = time.monotonic() - start
+        state.refreshed = timezone.now()
+        state.fetched = stats.fetched
+        state.written = stats.written
+        state.deleted = stats.deleted
+        state.duration = stats.duration
+        state.save()
+
+
+def mark_stale(kind, name):
+    """
+    Read the entry again on the next refresh of the mirror, for instance
+    when it was added, modified or removed through ipa-tuura.
+
+    :param kind: "user" or "group"
+    :param name: the user or group name
+    """
+    state = DirectorySyncState.objects.filter(kind=kind, complete=True).first()
+    if state is None:
+        # The mirror is not used
+        return
+    if not DirectoryEntry.objects.filter(kind=kind, name=name).update(stale=True):
+        DirectoryEntry.objects.get_or_create(
+            kind=kind,
+            name=name,
+            defaults={"stale": True, "generation": state.generation},
+        )
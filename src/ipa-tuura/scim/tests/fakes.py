@@ -0,0 +1,725 @@
+import asyncio
+import copy
+import fnmatch
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import dbus
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from scim.sssd import (
+    DBUS_PROPERTY_IF,
+    DBUS_SSSD_GROUP_IF,
+    DBUS_SSSD_GROUPS_IF,
+    DBUS_SSSD_GROUPS_PATH,
+    DBUS_SSSD_IF,
+    DBUS_SSSD_USER_IF,
+    DBUS_SSSD_USERS_IF,
+    DBUS_SSSD_USERS_PATH,
+)
+from scim.sync import DirectoryRecord, DirectorySource
+
+SSSD_NOT_FOUND = "org.freedesktop.sssd.Error.NotFound"
+
+
+class FakeInfopipe:
+    """
+    In-process stand-in for the sssd_ifp D-Bus responder.
+
+    It behaves like a dbus.SystemBus() connected to sssd_ifp: get_object()
+    returns proxies that can be wrapped in dbus.Interface. Every method
+    call is recorded in ``messages`` as an (interface, member) tuple so
+    that tests can count the D-Bus round trips.
+    """
+
+    def __init__(self, domain="ipa.test", latency=0):
+        self.domain = domain.replace(".", "_2e")
+        # Simulated round trip time of a message, in seconds
+        self.latency = latency
+        self.users = {}
+        self.groups = {}
+        self.messages = []
+        self.proxies = 0
+        # Unique bus name of the running sssd_ifp, None when stopped
+        self.owner = ":1.1"
+        self._restarts = 1
+
+    def add_user(self, name, uid, givenname=None, sn=None, mail=None, lock=None):
+        extra_attrs = {}
+        if givenname:
+            extra_attrs["givenname"] = [givenname]
+        if sn:
+            extra_attrs["sn"] = [sn]
+        if mail:
+            extra_attrs["mail"] = [mail]
+        if lock:
+            extra_attrs["lock"] = [lock]
+        self.users[uid] = {
+            "name": name,
+            "uidNumber": uid,
+            "gidNumber": uid,
+            "extraAttributes": extra_attrs,
+        }
+
+    def add_group(self, name, gid, members=()):
+        self.groups[gid] = {
+            "name": name,
+            "gidNumber": gid,
+            "users": [self.user_path(uid) for uid in members],
+        }
+
+    def user_path(self, uid):
+        return "{}/{}/{}".format(DBUS_SSSD_USERS_PATH, self.domain, uid)
+
+    def group_path(self, gid):
+        return "{}/{}/{}".format(DBUS_SSSD_GROUPS_PATH, self.domain, gid)
+
+    def count(self, interface=None, member=None):
+        """
+        Return the number of recorded messages matching the filters.
+        """
+        return sum(
+            1
+            for iface, name in self.messages
+            if interface in (None, iface) and member in (None, name)
+        )
+
+    def reset(self):
+        self.messages = []
+        self.proxies = 0
+
+    def remove_user(self, uid):
+        del self.users[uid]
+
+    def stop(self):
+        self.owner = None
+
+    def restart(self):
+        """
+        Simulate a restart of sssd_ifp, which gets a new unique bus name.
+        """
+        self._restarts += 1
+        self.owner = ":1.{}".format(self._restarts)
+
+    # dbus.SystemBus() API
+    def get_object(self, bus_name, object_path):
+        self.proxies += 1
+        return FakeProxy(self, object_path, self.owner)
+
+    def activate_name_owner(self, bus_name):
+        if self.owner is None:
+            raise dbus.exceptions.DBusException(
+                "sssd_ifp is not running",
+                name="org.freedesktop.DBus.Error.ServiceUnknown",
+            )
+        return self.owner
+
+    def close(self):
+        pass
+
+    # Message handlers
+    def _not_found(self, what):
+        raise dbus.exceptions.DBusException(
+            "{} not found".format(what), name=SSSD_NOT_FOUND
+        )
+
+    def _lookup(self, path):
+        for base, entries in (
+            (DBUS_SSSD_USERS_PATH, self.users),
+            (DBUS_SSSD_GROUPS_PATH, self.groups),
+        ):
+            if path.startswith(base + "/"):
+                key = int(path.rsplit("/", 1)[1])
+                if key in entries:
+                    return entries[key]
+        self._not_found(path)
+
+    def _user_by_name(self, name):
+        for uid, user in self.users.items():
+            if user["name"] == name:
+                return uid
+        self._not_found(name)
+
+    def _group_by_name(self, name):
+        for gid, group in self.groups.items():
+            if group["name"] == name:
+                return gid
+        self._not_found(name)
+
+    def _list_by_name(self, interface, name_filter, limit):
+        if interface == DBUS_SSSD_USERS_IF:
+            entries, object_path = self.users, self.user_path
+        else:
+            entries, object_path = self.groups, self.group_path
+        paths = [
+            object_path(key)
+            for key, entry in entries.items()
+            if fnmatch.fnmatchcase(entry["name"], name_filter)
+        ]
+        return paths[:limit] if limit else paths
+
+    def call(self, path, owner, interface, member, *args):
+        self.messages.append((interface, member))
+        if owner is None or owner != self.owner:
+            raise dbus.exceptions.DBusException(
+                "The name {} was not provided by any .service files".format(owner),
+                name="org.freedesktop.DBus.Error.ServiceUnknown",
+            )
+        if self.latency:
+            time.sleep(self.latency)
+        if member == "ListByName" and interface in (
+            DBUS_SSSD_USERS_IF,
+            DBUS_SSSD_GROUPS_IF,
+        ):
+            return self._list_by_name(interface, *args)
+        if interface == DBUS_SSSD_USERS_IF:
+            if member == "FindByName":
+                return self.user_path(self._user_by_name(args[0]))
+            if member == "FindByID":
+                if int(args[0]) not in self.users:
+                    self._not_found(args[0])
+                return self.user_path(int(args[0]))
+        elif interface == DBUS_SSSD_GROUPS_IF:
+            if member == "FindByName":
+                return self.group_path(self._group_by_name(args[0]))
+            if member == "FindByID":
+                if int(args[0]) not in self.groups:
+                    self._not_found(args[0])
+                return self.group_path(int(args[0]))
+        elif interface == DBUS_SSSD_IF and member == "GetUserGroups":
+            uid = self._user_by_name(args[0])
+            path = self.user_path(uid)
+            return [g["name"] for g in self.groups.values() if path in g["users"]]
+        elif interface == DBUS_SSSD_GROUP_IF and member == "UpdateMemberList":
+            self._lookup(path)
+            return None
+        elif interface == DBUS_PROPERTY_IF:
+            entry = self._lookup(path)
+            if args[0] not in (DBUS_SSSD_USER_IF, DBUS_SSSD_GROUP_IF):
+                raise dbus.exceptions.DBusException("Unknown interface")
+            if member == "GetAll":
+                return dict(entry)
+            if member == "Get":
+                return entry[args[1]]
+        raise dbus.exceptions.DBusException(
+            "Unknown method {}.{}".format(interface, member)
+        )
+
+
+class DBusCallsMixin:
+    """
+    TestCase mixin counting the D-Bus calls received by self.infopipe.
+    """
+
+    @contextmanager
+    def assertNumDBusCalls(self, num, interface=None, member=None):
+        """
+        Assert that the block sends num messages to self.infopipe, like
+        assertNumQueries does for the SQL queries.
+        """
+        start = len(self.infopipe.messages)
+        yield
+        calls = [
+            (iface, name)
+            for iface, name in self.infopipe.messages[start:]
+            if interface in (None, iface) and member in (None, name)
+        ]
+        self.assertEqual(
+            len(calls),
+            num,
+            "{} D-Bus calls sent, {} expected:\n{}".format(
+                len(calls), num, "\n".join(".".join(call) for call in calls)
+            ),
+        )
+
+
+class FakeProxy:
+    """
+    Proxy object returned by FakeInfopipe.get_object().
+    """
+
+    def __init__(self, infopipe, object_path, owner):
+        self._infopipe = infopipe
+        self.object_path = object_path
+        # Like dbus-python proxies, bound to the owner at creation time
+        self._owner = owner
+
+    def get_dbus_method(self, member, dbus_interface=None):
+        def method(*args, **kwargs):
+            return self._infopipe.call(
+                self.object_path, self._owner, dbus_interface, member, *args
+            )
+
+        return method
+
+
+# Signatures of the properties returned by Get and GetAll
+PROPERTY_SIGNATURES = {
+    "name": "s",
+    "uidNumber": "u",
+    "gidNumber": "u",
+    "extraAttributes": "a{sas}",
+    "users": "ao",
+}
+
+
+class FakeAsyncBus:
+    """
+    Stand-in for a dbus_next.aio.MessageBus connected to a FakeInfopipe.
+
+    Like a real connection, it is bound to the owner of the infopipe at
+    connection time.
+    """
+
+    def __init__(self, infopipe):
+        self._infopipe = infopipe
+        self._owner = infopipe.owner
+        self._serial = 0
+        self.connected = False
+
+    async def connect(self):
+        self._owner = self._infopipe.owner
+        self.connected = True
+        return self
+
+    def disconnect(self):
+        self.connected = False
+
+    def _reply(self, msg, value):
+        from dbus_next import Message, Variant
+
+        if msg.member == "GetAll":
+            value = {
+                k: Variant(PROPERTY_SIGNATURES[k], v)
+                for k, v in value.items()
+                if k in PROPERTY_SIGNATURES
+            }
+            return Message.new_method_return(msg, "a{sv}", [value])
+        if msg.member == "Get":
+            signature = PROPERTY_SIGNATURES[msg.body[1]]
+            return Message.new_method_return(msg, "v", [Variant(signature, value)])
+        if msg.member in ("FindByName", "FindByID"):
+            return Message.new_method_return(msg, "o", [value])
+        if msg.member == "ListByName":
+            return Message.new_method_return(msg, "ao", [value])
+        if msg.member == "GetUserGroups":
+            return Message.new_method_return(msg, "as", [value])
+        if msg.member == "GetNameOwner":
+            return Message.new_method_return(msg, "s", [value])
+        if msg.member == "StartServiceByName":
+            return Message.new_method_return(msg, "u", [2])
+        return Message.new_method_return(msg)
+
+    async def call(self, msg):
+        from dbus_next import Message
+
+        self._serial += 1
+        msg.serial = self._serial
+        if self._infopipe.latency:
+            await asyncio.sleep(self._infopipe.latency)
+        try:
+            if msg.destination == "org.freedesktop.DBus":
+                self._infopipe.activate_name_owner(msg.body[0])
+                value = self._infopipe.owner
+            else:
+                # The latency is simulated above without blocking the loop
+                latency, self._infopipe.latency = self._infopipe.latency, 0
+                try:
+                    value = self._infopipe.call(
+                        msg.path, self._owner, msg.interface, msg.member, *msg.body
+                    )
+                finally:
+                    self._infopipe.latency = latency
+        except dbus.exceptions.DBusException as e:
+            return Message.new_error(msg, e.get_dbus_name(), e.get_dbus_message())
+        return self._reply(msg, value)
+
+
+class FakeDirectorySource(DirectorySource):
+    """
+    In-process identity server read by DirectorySync.
+
+    The entries are DirectoryRecords stamped with a modifyTimestamp
+    incremented by each change. With incremental=False, it behaves like
+    a server without change cursor. Every record read is counted in
+    ``fetched``, and the names listings in ``listings``.
+    """
+
+    def __init__(self, incremental=True, page_size=100):
+        self.incremental = incremental
+        self.resumable = not incremental
+        self.page_size = page_size
+        self.entries = {"user": {}, "group": {}}
+        # Timestamps of the removed entries
+        self.tombstones = {"user": {}, "group": {}}
+        self.clock = 0
+        self.fetched = 0
+        self.listings = 0
+        # Number of pages served before failing, None to never fail
+        self.fail_after = None
+
+    def _tick(self):
+        self.clock += 1
+        return "{:014d}Z".format(self.clock)
+
+    def add_user(self, name, number, givenname=None, sn=None, mail=(), active=True):
+        self.entries["user"][name] = DirectoryRecord(
+            name,
+            number,
+            {"givenname": givenname, "sn": sn, "mail": list(mail), "active": active},
+            modified=self._tick(),
+        )
+        self.tombstones["user"].pop(name, None)
+
+    def add_group(self, name, number, members=()):
+        self.entries["group"][name] = DirectoryRecord(
+            name, number, members=list(members), modified=self._tick()
+        )
+        self.tombstones["group"].pop(name, None)
+
+    def remove(self, kind, name):
+        del self.entries[kind][name]
+        self.tombstones[kind][name] = self._tick()
+
+    def _read(self, records):
+        self.fetched += len(records)
+        return [copy.deepcopy(r) for r in records]
+
+    # DirectorySource API
+    def pages(self, kind, position=""):
+        names = sorted(n for n in self.entries[kind] if n > position)
+        for i in range(0, len(names), self.page_size):
+            if self.fail_after is not None:
+                if self.fail_after == 0:
+                    raise RuntimeError("Connection lost")
+                self.fail_after -= 1
+            page = names[i : i + self.page_size]
+            yield self._read([self.entries[kind][n] for n in page]), page[-1]
+
+    def names(self, kind):
+        self.listings += 1
+        return set(self.entries[kind])
+
+    def fetch(self, kind, names):
+        entries = self.entries[kind]
+        return self._read([entries[n] for n in names if n in entries])
+
+    def changes(self, kind, cursor):
+        records = self._read(
+            [r for r in self.entries[kind].values() if r.modified >= cursor]
+        )
+        removed = [n for n, t in self.tombstones[kind].items() if t >= cursor]
+        new_cursor = max(
+            [cursor]
+            + [r.modified for r in records]
+            + list(self.tombstones[kind].values())
+        )
+        return records, removed, new_cursor
+
+
+class FakeLDAPServer:
+    """
+    In-process stand-in for the LDAP server of the ldap and ad writable
+    interfaces.
+
+    Patch ldap.initialize with initialize(). Every bind is counted in
+    ``binds``, every add, modify or delete in ``operations``, and every
+    entry returned by a search in ``returned``. A round trip takes
+    ``latency`` seconds, a new connection two of them (TCP and bind), and
+    the asynchronous operations sent together a single one. close_idle()
+    closes the open connections, like the idle timeout of a server.
+
+    The entries added or modified through a connection, or with
+    add_entry(), are stamped with a modifyTimestamp incremented by each
+    change.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.entries = {}
+        # modifyTimestamp of the entries, by DN
+        self.modified = {}
+        self.clock = 0
+        self.binds = 0
+        self.operations = 0
+        self.returned = 0
+        self.connections = []
+        self._lock = threading.Lock()
+
+    def stamp(self, dn):
+        self.clock += 1
+        self.modified[dn] = "{:014d}Z".format(self.clock)
+
+    def add_entry(self, dn, **attrs):
+        """
+        Add or replace an entry, the values are str or lists of str.
+        """
+        self.entries[dn] = {
+            attr: [v.encode("utf-8") for v in (v if isinstance(v, list) else [v])]
+            for attr, v in attrs.items()
+        }
+        self.stamp(dn)
+
+    def search(self, base, scope, filterstr, attrlist=None):
+        """
+        :returns: the list of (dn, attrs) of the entries matching the filter
+        """
+        match = _ldap_filter(filterstr)
+        results = []
+        for dn in sorted(self.entries):
+            if scope == ldap.SCOPE_BASE:
+                in_scope = dn.lower() == base.lower()
+            else:
+                in_scope = dn.lower().endswith(base.lower())
+            attrs = dict(self.entries[dn])
+            attrs["modifyTimestamp"] = [
+                self.modified.get(dn, "00000000000000Z").encode("utf-8")
+            ]
+            if in_scope and match(attrs):
+                results.append((dn, _ldap_attrs(attrs, attrlist)))
+        if scope == ldap.SCOPE_BASE and base not in self.entries:
+            raise ldap.NO_SUCH_OBJECT({"desc": "No such object"})
+        return results
+
+    def _returned(self, results):
+        with self._lock:
+            self.returned += len(results)
+        return results
+
+    def initialize(self, uri):
+        conn = FakeLDAPConnection(self)
+        with self._lock:
+            self.connections.append(conn)
+        return conn
+
+    def close_idle(self):
+        for conn in self.connections:
+            conn.closed = True
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeLDAPConnection:
+    def __init__(self, server):
+        self._server = server
+        self._who = None
+        self.closed = False
+        self.protocol_version = None
+        self._msgid = 0
+        self._pending = {}
+        self._unanswered = False
+
+    def _call(self):
+        if self.closed:
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        self._server.round_trip()
+
+    def _operation(self):
+        self._call()
+        with self._server._lock:
+            self._server.operations += 1
+
+    def set_option(self, option, invalue):
+        pass
+
+    def simple_bind_s(self, who="", cred=""):
+        self._server.round_trip()
+        self._call()
+        self._who = who
+        with self._server._lock:
+            self._server.binds += 1
+
+    def sasl_interactive_bind_s(self, who, auth):
+        self.simple_bind_s(who)
+
+    def whoami_s(self):
+        self._call()
+        return "dn:{}".format(self._who)
+
+    def _add(self, dn, modlist):
+        if dn in self._server.entries:
+            raise ldap.ALREADY_EXISTS({"desc": "Already exists"})
+        self._server.entries[dn] = dict(modlist)
+        self._server.stamp(dn)
+
+    def _modify(self, dn, modlist):
+        if dn not in self._server.entries:
+            raise ldap.NO_SUCH_OBJECT({"desc": "No such object"})
+        entry = self._server.entries[dn]
+        for op, attr, value in modlist:
+            if isinstance(value, bytes):
+                value = [value]
+            current = entry.get(attr, [])
+            if op == ldap.MOD_ADD:
+                if any(v in current for v in value):
+                    raise ldap.TYPE_OR_VALUE_EXISTS({"desc": "Type or value exists"})
+                entry[attr] = current + value
+            elif op == ldap.MOD_DELETE and value:
+                if any(v not in current for v in value):
+                    raise ldap.NO_SUCH_ATTRIBUTE({"desc": "No such attribute"})
+                entry[attr] = [v for v in current if v not in value]
+            else:
+                entry[attr] = value
+            if not entry[attr]:
+                del entry[attr]
+        self._server.stamp(dn)
+
+    def _delete(self, dn):
+        if self._server.entries.pop(dn, None) is None:
+            raise ldap.NO_SUCH_OBJECT({"desc": "No such object"})
+        self._server.modified.pop(dn, None)
+
+    def add_s(self, dn, modlist):
+        self._operation()
+        self._add(dn, modlist)
+
+    def modify_ext_s(self, dn, modlist):
+        self._operation()
+        self._modify(dn, modlist)
+
+    def delete_s(self, dn):
+        self._operation()
+        self._delete(dn)
+
+    # Asynchronous operations: the requests sent before a result3() are
+    # answered after a single round trip, like pipelined requests
+
+    def _send(self, apply, *args):
+        if self.closed:
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        with self._server._lock:
+            self._server.operations += 1
+        self._msgid += 1
+        self._pending[self._msgid] = (apply, args)
+        self._unanswered = True
+        return self._msgid
+
+    def add_ext(self, dn, modlist):
+        return self._send(self._add, dn, modlist)
+
+    def modify_ext(self, dn, modlist):
+        return self._send(self._modify, dn, modlist)
+
+    def delete_ext(self, dn):
+        return self._send(self._delete, dn)
+
+    def search_s(self, base, scope, filterstr="(objectClass=*)", attrlist=None):
+        self._call()
+        return self._server._returned(
+            self._server.search(base, scope, filterstr, attrlist)
+        )
+
+    def search_ext(
+        self, base, scope, filterstr="(objectClass=*)", attrlist=None, serverctrls=()
+    ):
+        """
+        Search with the paged results control of the serverctrls, the
+        cookie being the index of the first entry of the page.
+        """
+        if self.closed:
+            raise ldap.SERVER_DOWN({"desc": "Can't contact LDAP server"})
+        self._msgid += 1
+        self._pending[self._msgid] = (
+            self._search_page,
+            (base, scope, filterstr, attrlist, serverctrls),
+        )
+        self._unanswered = True
+        return self._msgid
+
+    def _search_page(self, base, scope, filterstr, attrlist, serverctrls):
+        paging = [
+            c
+            for c in serverctrls or ()
+            if c.controlType == SimplePagedResultsControl.controlType
+        ]
+        results = self._server.search(base, scope, filterstr, attrlist)
+        if not paging:
+            return self._server._returned(results), []
+        first = int(paging[0].cookie or 0)
+        last = first + paging[0].size
+        cookie = str(last).encode("ascii") if last < len(results) else b""
+        control = SimplePagedResultsControl(True, size=paging[0].size, cookie=cookie)
+        return self._server._returned(results[first:last]), [control]
+
+    def result3(self, msgid):
+        if self._unanswered:
+            self._call()
+            self._unanswered = False
+        apply, args = self._pending.pop(msgid)
+        result = apply(*args)
+        if result is None:
+            return None, [], msgid, []
+        data, controls = result
+        return ldap.RES_SEARCH_RESULT, data, msgid, controls
+
+    def unbind_s(self):
+        self.closed = True
+
+
+def _ldap_unescape(value):
+    return re.sub(r"\\([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _ldap_filter(filterstr):
+    """
+    Compile an LDAP filter with the &, |, ! operators and the =, >=, <=
+    and presence comparisons into a predicate on a dict of attributes.
+    """
+
+    def parse(i):
+        # filterstr[i] is the opening parenthesis of a filter
+        op = filterstr[i + 1]
+        if op in "&|!":
+            i += 2
+            operands = []
+            while filterstr[i] == "(":
+                operand, i = parse(i)
+                operands.append(operand)
+            if op == "&":
+                return (lambda attrs: all(f(attrs) for f in operands)), i + 1
+            if op == "|":
+                return (lambda attrs: any(f(attrs) for f in operands)), i + 1
+            return (lambda attrs: not operands[0](attrs)), i + 1
+        end = filterstr.index(")", i)
+        attr, cmp, value = re.match(
+            r"([^=<>]+)(>=|<=|=)(.*)", filterstr[i + 1 : end]
+        ).groups()
+        attr = attr.lower()
+        value = _ldap_unescape(value).lower()
+
+        def match(attrs):
+            values = [
+                v.decode("utf-8").lower() if isinstance(v, bytes) else str(v).lower()
+                for a, vs in attrs.items()
+                if a.lower() == attr
+                for v in vs
+            ]
+            if cmp == ">=":
+                return any(v >= value for v in values)
+            if cmp == "<=":
+                return any(v <= value for v in values)
+            if value == "*":
+                return bool(values)
+            return value in values
+
+        return match, end + 1
+
+    predicate, _ = parse(0)
+    return predicate
+
+
+def _ldap_attrs(attrs, attrlist):
+    """
+    Return the attributes requested by the attrlist of a search, all the
+    user attributes with "*", and modifyTimestamp only if it is requested.
+    """
+    requested = {a.lower() for a in attrlist or ["*"]}
+    return {
+        attr: values
+        for attr, values in attrs.items()
+        if attr.lower() in requested or ("*" in requested and attr != "modifyTimestamp")
+    }
@@ -0,0 +1,1019 @@
+"""
+Micro-benchmarks for the SCIM read and write paths.
+
+They run against in-process fakes and are skipped by default, set
+IPATUURA_BENCHMARK=1 to run them:
+
+    IPATUURA_BENCHMARK=1 python manage.py test scim.tests.test_benchmarks -v 2
+"""
+
+import asyncio
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
+
+import dbus
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.text import compress_sequence
+from domains.tests.factories import DomainFactory
+from scim import sssd_async
+from scim.adapters import RecordSerializer, SCIMGroup, SCIMUser
+from scim.directory import Comparison, QueryPlan, Scan, TrigramIndex, _DirectoryIndex
+from scim.ipa import _IPA, IPAAPI, LDAP, IPADirectorySource
+from scim.jobs import _ProvisioningQueue
+from scim.models import SSSDGroupToGroupModel, SSSDUserToUserModel
+from scim.records import SSSDUserToUserRecord
+from scim.sssd import (
+    _SSSD,
+    IdentityCache,
+    MemberResolver,
+    SSSDGroup,
+    SSSDUser,
+    _IdentityCache,
+    _SSSDPool,
+)
+from scim.sssd_async import _AsyncSSSD
+from scim.sync import DirectorySync
+from scim.tests.fakes import (
+    FakeAsyncBus,
+    FakeDirectorySource,
+    FakeInfopipe,
+    FakeLDAPServer,
+)
+from scim.utils import JSONStream
+
+BENCHMARK = os.environ.get("IPATUURA_BENCHMARK")
+
+
+def report(name, **results):
+    values = ", ".join("{}={}".format(k, v) for k, v in results.items())
+    print("\n[benchmark] {}: {}".format(name, values))
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class SSSDLookupBenchmark(SimpleTestCase):
+    lookups = 1000
+
+    def setUp(self):
+        _IdentityCache._instance = None
+        self.infopipe = FakeInfopipe()
+        for uid in range(1000, 1000 + self.lookups):
+            self.infopipe.add_user("user{}".format(uid), uid, "First", "Last")
+        self.infopipe.add_group("staff", 5000, members=range(1000, 1100))
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sssd = _SSSD()
+
+    def test_dbus_messages_per_user_lookup(self):
+        self.infopipe.reset()
+        start = time.perf_counter()
+        for uid in range(1000, 1000 + self.lookups):
+            self.sssd.find_user_by_name("user{}".format(uid))
+        elapsed = time.perf_counter() - start
+        report(
+            "user lookup",
+            messages_per_lookup=len(self.infopipe.messages) / self.lookups,
+            usec_per_lookup=round(elapsed / self.lookups * 1e6, 1),
+        )
+
+    def test_dbus_messages_per_group_lookup(self):
+        self.infopipe.reset()
+        self.sssd.find_group_by_name("staff")
+        report("group lookup", messages=len(self.infopipe.messages))
+
+    def test_repeated_polling(self):
+        """Keycloak-like polling of the same users, served by the cache."""
+        for _ in range(2):
+            self.infopipe.reset()
+            start = time.perf_counter()
+            for uid in range(1000, 1000 + self.lookups):
+                self.sssd.find_user_by_id(uid)
+            elapsed = time.perf_counter() - start
+        report(
+            "repeated polling",
+            messages=len(self.infopipe.messages),
+            usec_per_lookup=round(elapsed / self.lookups * 1e6, 1),
+            **_IdentityCache._instance.stats,
+        )
+
+    def _measure_lookups(self):
+        sssd = _SSSD()
+        names = ["user{}".format(uid) for uid in range(1000, 1100)]
+        IdentityCache().clear()
+        for name in names:
+            sssd.find_user_by_name(name)
+        self.infopipe.reset()
+        with mock.patch("scim.sssd.dbus.Interface", wraps=dbus.Interface) as iface:
+            tracemalloc.start()
+            for name in names:
+                IdentityCache().clear()
+                sssd.find_user_by_name(name)
+            size, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        return {
+            "proxies_per_lookup": self.infopipe.proxies / len(names),
+            "interfaces_per_lookup": iface.call_count / len(names),
+            "find_per_lookup": self.infopipe.count(member="FindByName") / len(names),
+            "peak_bytes": peak,
+        }
+
+    def test_proxy_reuse(self):
+        """Per-lookup proxy and interface creations, with and without reuse."""
+        with override_settings(SSSD_PROXY_CACHE_SIZE=0):
+            report("lookup without proxy reuse", **self._measure_lookups())
+        report("lookup with proxy reuse", **self._measure_lookups())
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class SSSDPoolBenchmark(SimpleTestCase):
+    lookups = 200
+
+    def setUp(self):
+        # 2ms per message, the typical cost of a sssd_ifp round trip
+        self.infopipe = FakeInfopipe(latency=0.002)
+        for uid in range(1000, 1000 + self.lookups):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_parallel_lookups(self):
+        """Lookup throughput as a function of the pool and thread count."""
+        for threads in (1, 2, 4, 8):
+            _IdentityCache._instance = None
+            with override_settings(SSSD_POOL_SIZE=threads):
+                pool = _SSSDPool()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                uids = range(1000, 1000 + self.lookups)
+                list(executor.map(pool.find_user_by_id, uids))
+            elapsed = time.perf_counter() - start
+            report(
+                "parallel lookups",
+                threads=threads,
+                lookups_per_sec=round(self.lookups / elapsed),
+                max_wait_time=round(pool.stats["max_wait_time"], 4),
+            )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+@override_settings(SSSD_CACHE_SIZE=200000, SSSD_PROXY_CACHE_SIZE=100000)
+class LargeGroupBenchmark(SimpleTestCase):
+    members = 50000
+
+    def setUp(self):
+        _IdentityCache._instance = None
+        # 0.2ms per message, sssd_ifp answering from its memory cache
+        self.infopipe = FakeInfopipe(latency=0.0002)
+        for uid in range(10000, 10000 + self.members):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        self.infopipe.add_group(
+            "everyone", 5000, members=range(10000, 10000 + self.members)
+        )
+        for patcher in (
+            mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe),
+            mock.patch(
+                "scim.sssd_async.MessageBus",
+                side_effect=lambda **kwargs: FakeAsyncBus(self.infopipe),
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(MemberResolver()._reset_instance)
+
+    def _measure(self, resolve):
+        IdentityCache().clear()
+        self.infopipe.reset()
+        start = time.perf_counter()
+        group = resolve()
+        elapsed = time.perf_counter() - start
+        self.assertEqual(len(group.members), self.members)
+        return round(elapsed, 2)
+
+    def test_group_members(self):
+        """Resolution of the members of a 50k members group."""
+        for workers in (1, 8):
+            with override_settings(SSSD_MEMBER_WORKERS=workers):
+                MemberResolver()._reset_instance()
+                sssd = _SSSD()
+                elapsed = self._measure(
+                    lambda: sssd.find_group_by_name("everyone", retrieve_members=True)
+                )
+            report("50k members group", workers=workers, sec=elapsed)
+
+        # A second read only needs the member list
+        IdentityCache().invalidate_groups()
+        self.infopipe.reset()
+        start = time.perf_counter()
+        sssd.find_group_by_id(5000, retrieve_members=True)
+        report(
+            "50k members group, cached members",
+            messages=len(self.infopipe.messages),
+            sec=round(time.perf_counter() - start, 2),
+        )
+
+        if sssd_async.is_available():
+            elapsed = self._measure(
+                lambda: asyncio.run(
+                    _AsyncSSSD().find_group_by_name("everyone", retrieve_members=True)
+                )
+            )
+            report("50k members group", client="asyncio", sec=elapsed)
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+@skipUnless(sssd_async.is_available(), "dbus-next is not installed")
+class AsyncSSSDBenchmark(SimpleTestCase):
+    lookups = 200
+
+    def setUp(self):
+        _IdentityCache._instance = None
+        self.infopipe = FakeInfopipe(latency=0.002)
+        for uid in range(1000, 1000 + self.lookups):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        self.infopipe.add_group("staff", 5000, members=range(1000, 1000 + self.lookups))
+        for patcher in (
+            mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe),
+            mock.patch(
+                "scim.sssd_async.MessageBus",
+                side_effect=lambda **kwargs: FakeAsyncBus(self.infopipe),
+            ),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_concurrent_lookups(self):
+        """Lookup throughput of a single event loop."""
+
+        async def lookups():
+            sssd = _AsyncSSSD()
+            await asyncio.gather(
+                *(sssd.find_user_by_id(uid) for uid in range(1000, 1000 + self.lookups))
+            )
+
+        start = time.perf_counter()
+        asyncio.run(lookups())
+        elapsed = time.perf_counter() - start
+        report("async lookups", lookups_per_sec=round(self.lookups / elapsed))
+
+    def test_group_members(self):
+        """Resolution of the members of a group, sequential and concurrent."""
+        self.infopipe.latency = 0.001
+        start = time.perf_counter()
+        _SSSD().find_group_by_name("staff", retrieve_members=True)
+        sequential = time.perf_counter() - start
+
+        IdentityCache().clear()
+        start = time.perf_counter()
+        asyncio.run(_AsyncSSSD().find_group_by_name("staff", retrieve_members=True))
+        concurrent = time.perf_counter() - start
+        report(
+            "group members",
+            members=self.lookups,
+            sequential_sec=round(sequential, 3),
+            concurrent_sec=round(concurrent, 3),
+        )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class FilterBenchmark(SimpleTestCase):
+    users = 100000
+    groups = 100
+    repeat = 5
+
+    filters = {
+        "equality": 'userName eq "user50000"',
+        "equality and scan": 'userName eq "user50000" and emails co "ipa.test"',
+        "prefix": 'userName sw "user999"',
+        "substring": 'emails co "@sales."',
+        "or": 'userName eq "user10" or emails eq "user20@ipa.test"',
+        "not": "not (active eq true)",
+        "value path": 'emails[value ew ".test" and primary eq true]',
+        "membership": 'groups.value eq "5007"',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index = _DirectoryIndex()
+        cls.index.loaded = float("inf")
+        for gid in range(5000, 5000 + cls.groups):
+            cls.index.add_group(SSSDGroup(gid, "group{}".format(gid)))
+        tracemalloc.start()
+        start = time.perf_counter()
+        for uid in range(cls.users):
+            domain = "sales.ipa.test" if uid % 10 == 0 else "ipa.test"
+            cls.index.add_user(
+                SSSDUser(
+                    uid,
+                    "user{}".format(uid),
+                    givenname="First{}".format(uid),
+                    sn="Last",
+                    mail=["user{}@{}".format(uid, domain)],
+                    active=uid % 100 != 0,
+                    groups=["group{}".format(5000 + uid % cls.groups)],
+                )
+            )
+        cls.build_time = time.perf_counter() - start
+        cls.memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    def test_filter_latency(self):
+        report(
+            "directory index",
+            users=self.users,
+            build_sec=round(self.build_time, 2),
+            memory_mb=round(self.memory / 1e6, 1),
+        )
+        for name, filter_query in self.filters.items():
+            plan = QueryPlan("user", filter_query)
+            start = time.perf_counter()
+            for _ in range(self.repeat):
+                ids = self.index.search(plan)
+            elapsed = (time.perf_counter() - start) / self.repeat
+            report(
+                "filter, 100k users",
+                filter=name,
+                results=len(ids),
+                msec=round(elapsed * 1000, 2),
+            )
+
+    def test_substring_latency(self):
+        # Memory of trigram indexes built apart from the directory index
+        tracemalloc.start()
+        trigrams = {
+            attr: TrigramIndex()
+            for attr in _DirectoryIndex.SUBSTRING_ATTRIBUTES["user"]
+        }
+        start = time.perf_counter()
+        for user in self.index.users.values():
+            for attr, getter in _DirectoryIndex.SUBSTRING_ATTRIBUTES["user"].items():
+                trigrams[attr].add(user.id, getter(user))
+        build_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report(
+            "trigram indexes",
+            users=self.users,
+            trigrams=sum(len(t) for t in trigrams.values()),
+            build_sec=round(build_time, 2),
+            memory_mb=round(memory / 1e6, 1),
+        )
+        del trigrams
+
+        for filter_query in (
+            'userName sw "user999"',
+            'userName co "9999"',
+            'emails co "@sales."',
+            'emails ew "99@ipa.test"',
+            'name.givenName sw "first12"',
+        ):
+            plan = QueryPlan("user", filter_query)
+            for name, root in (("trigram", plan.root), ("scan", Scan(plan.root.expr))):
+                start = time.perf_counter()
+                for _ in range(self.repeat):
+                    ids = root.execute(self.index, "user")
+                elapsed = (time.perf_counter() - start) / self.repeat
+                report(
+                    "substring filter, 100k users",
+                    filter=filter_query,
+                    path=name,
+                    results=len(ids),
+                    msec=round(elapsed * 1000, 2),
+                )
+
+        user = self.index.users[50000]
+        start = time.perf_counter()
+        for _ in range(1000):
+            self.index.add_user(user)
+        report(
+            "user update with the indexes",
+            usec=round((time.perf_counter() - start) * 1000, 1),
+        )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class MembershipBenchmark(SimpleTestCase):
+    users = 100000
+    small_groups = 1000
+    repeat = 5
+
+    filters = {
+        "large group": 'groups.display eq "everyone"',
+        "small group": 'groups.value eq "5007"',
+        "large and not large": (
+            'groups.display eq "everyone" and not (groups.display eq "even")'
+        ),
+        "large or small": 'groups.display eq "even" or groups.value eq "5007"',
+        "group and attribute": 'groups.display eq "even" and userName sw "user99"',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.index = _DirectoryIndex()
+        cls.index.loaded = float("inf")
+        for uid in range(cls.users):
+            cls.index.add_user(SSSDUser(uid, "user{}".format(uid)))
+        tracemalloc.start()
+        start = time.perf_counter()
+        group = SSSDGroup(1, "everyone")
+        group.set_members(["user{}".format(uid) for uid in range(cls.users)])
+        cls.index.add_group(group)
+        group = SSSDGroup(2, "even")
+        group.set_members(["user{}".format(uid) for uid in range(0, cls.users, 2)])
+        cls.index.add_group(group)
+        for gid in range(5000, 5000 + cls.small_groups):
+            group = SSSDGroup(gid, "group{}".format(gid))
+            group.set_members(
+                [
+                    "user{}".format(uid)
+                    for uid in range(gid - 5000, cls.users, cls.small_groups)
+                ]
+            )
+            cls.index.add_group(group)
+        cls.index.members.optimize()
+        cls.build_time = time.perf_counter() - start
+        # With the groups_by_user sets of the users
+        cls.memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    def test_membership_latency(self):
+        report(
+            "membership index",
+            users=self.users,
+            groups=self.small_groups + 2,
+            build_sec=round(self.build_time, 2),
+            memory_mb=round(self.memory / 1e6, 1),
+        )
+        for name, filter_query in self.filters.items():
+            plan = QueryPlan("user", filter_query)
+            start = time.perf_counter()
+            for _ in range(self.repeat):
+                ids = self.index.search(plan)
+            elapsed = (time.perf_counter() - start) / self.repeat
+            report(
+                "membership filter, 100k users",
+                filter=name,
+                results=len(ids),
+                msec=round(elapsed * 1000, 2),
+            )
+        # The walk of the groups of each user it replaces
+        plan = Scan(Comparison("groups", "display", "eq", "even"))
+        start = time.perf_counter()
+        ids = plan.execute(self.index, "user")
+        report(
+            "membership filter, 100k users",
+            filter="large group, scanned",
+            results=len(ids),
+            msec=round((time.perf_counter() - start) * 1000, 2),
+        )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class SyncBenchmark(TestCase):
+    users = 20000
+
+    def test_refresh_cost(self):
+        source = FakeDirectorySource(page_size=500)
+        for uid in range(self.users):
+            source.add_user("user{}".format(uid), uid, "First", "Last")
+        sync = DirectorySync(source)
+        start = time.perf_counter()
+        users, _ = sync.run()
+        report(
+            "directory sync load",
+            users=self.users,
+            written=users.written,
+            sec=round(time.perf_counter() - start, 2),
+        )
+        for changes in (0, 10, 100, 1000):
+            for uid in range(changes):
+                source.add_user("user{}".format(uid), uid, "Changed{}".format(changes))
+            start = time.perf_counter()
+            users, _ = sync.run()
+            report(
+                "directory sync refresh",
+                users=self.users,
+                changes=changes,
+                fetched=users.fetched,
+                written=users.written,
+                msec=round((time.perf_counter() - start) * 1000, 1),
+            )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class IPASyncBenchmark(TestCase):
+    """
+    Refresh of the mirror of an ipa integration domain, read from the LDAP
+    server of IPA.
+    """
+
+    users = 20000
+    users_dn = "cn=users,cn=accounts,dc=ipa,dc=test"
+
+    def setUp(self):
+        DomainFactory()
+        self.server = FakeLDAPServer()
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(IPAAPI, "_valid_creds")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_user(self, uid, sn="Last"):
+        self.server.add_entry(
+            "uid=user{},{}".format(uid, self.users_dn),
+            objectClass=["person", "posixAccount"],
+            uid="user{}".format(uid),
+            uidNumber=str(uid),
+            givenName="First",
+            sn=sn,
+        )
+
+    def test_refresh_cost(self):
+        for uid in range(self.users):
+            self.add_user(uid)
+        sync = DirectorySync(IPADirectorySource())
+        start = time.perf_counter()
+        users, _ = sync.run()
+        report(
+            "ipa directory sync load",
+            users=self.users,
+            written=users.written,
+            sec=round(time.perf_counter() - start, 2),
+        )
+        for changes in (0, 10, 100, 1000):
+            for uid in range(changes):
+                self.add_user(uid, "Changed{}".format(changes))
+            self.server.returned = 0
+            start = time.perf_counter()
+            users, _ = sync.run()
+            report(
+                "ipa directory sync refresh",
+                users=self.users,
+                changes=changes,
+                returned=self.server.returned,
+                written=users.written,
+                msec=round((time.perf_counter() - start) * 1000, 1),
+            )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class SortBenchmark(SimpleTestCase):
+    sizes = (10000, 100000, 500000)
+    page_size = 100
+    repeat = 5
+
+    def build(self, users):
+        index = _DirectoryIndex()
+        index.loaded = float("inf")
+        start = time.perf_counter()
+        for uid in range(users):
+            index.add_user(
+                SSSDUser(
+                    uid,
+                    "user{}".format(uid),
+                    givenname="First{}".format(uid % 1000),
+                    sn="Last{}".format(uid * 7919 % users),
+                    mail=["user{}@ipa.test".format(uid)],
+                    modified="2024-01-01T00:00:{:02}Z".format(uid % 60),
+                )
+            )
+        sort_start = time.perf_counter()
+        # Sort all the ids added, like a load does
+        for sort_index in index._sort_indexes["user"].values():
+            sort_index.flush()
+        sort_time = time.perf_counter() - sort_start
+        build_time = time.perf_counter() - start
+        # Only the lists of ids, the keys are read from the users
+        memory = sum(
+            sys.getsizeof(sort_index._ids)
+            for sort_index in index._sort_indexes["user"].values()
+        )
+        return index, build_time, sort_time, memory
+
+    def measure(self, read):
+        start = time.perf_counter()
+        for _ in range(self.repeat):
+            read()
+        return round((time.perf_counter() - start) / self.repeat * 1000, 3)
+
+    def test_sorted_page_latency(self):
+        for users in self.sizes:
+            index, build_time, sort_time, memory = self.build(users)
+            report(
+                "sort indexes",
+                users=users,
+                index_build_sec=round(build_time, 2),
+                sort_sec=round(sort_time, 2),
+                memory_mb=round(memory / 1e6, 1),
+            )
+            ids = index.sorted("user", "name.familyname")
+            last = users - self.page_size
+            plan = QueryPlan("user", 'name.givenName eq "First7"')
+            filtered = index.sorted("user", "username", plan=plan)
+            pages = {
+                "first page": lambda: ids[0 : self.page_size],
+                "last page": lambda: ids[last:users],
+                "descending": lambda: index.sorted(
+                    "user", "name.familyname", descending=True
+                )[0 : self.page_size],
+                "filter 0.1%": lambda: filtered[0 : self.page_size],
+                # The sort of all the objects on each request it replaces
+                "full sort": lambda: sorted(
+                    index.users.values(), key=lambda user: user.last_name
+                )[0 : self.page_size],
+            }
+            for name, read in pages.items():
+                report(
+                    "sorted page",
+                    users=users,
+                    page=name,
+                    msec=self.measure(read),
+                )
+
+            def update():
+                index.add_user(SSSDUser(users, "new", sn="Last0"))
+                ids[0 : self.page_size]
+                index.remove_user(users)
+
+            report("sorted page after update", users=users, msec=self.measure(update))
+
+    def test_cursor_page_latency(self):
+        users = 300000
+        index, _, _, _ = self.build(users)
+        # 11% of the users, picked in the order of the sort index
+        plan = QueryPlan("user", 'name.givenName sw "First1"')
+        filtered = index.sorted("user", "username", plan=plan)
+        total = len(filtered)
+        keys = {}
+        key = None
+        for page in range(total // self.page_size):
+            ids, key = filtered.after(key, self.page_size)
+            keys[page] = key
+        for depth in (0.0, 0.5, 0.99):
+            page = int(total * depth) // self.page_size
+            start = page * self.page_size
+            cursor = keys.get(page - 1)
+            report(
+                "filtered page",
+                users=users,
+                depth=depth,
+                cursor_msec=self.measure(
+                    lambda: filtered.after(cursor, self.page_size)
+                ),
+                start_index_msec=self.measure(
+                    lambda: filtered[start : start + self.page_size]
+                ),
+            )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class StreamingBenchmark(SimpleTestCase):
+    sizes = (10000, 50000)
+
+    def build(self, members):
+        index = _DirectoryIndex()
+        index.loaded = float("inf")
+        for uid in range(10000, 10000 + members):
+            index.add_user(
+                SSSDUser(uid, "user{}".format(uid), givenname="First", sn="Last")
+            )
+        group = SSSDGroup(5000, "everyone")
+        group.set_members(
+            ["user{}".format(uid) for uid in range(10000, 10000 + members)]
+        )
+        index.add_group(group)
+        return index
+
+    def respond(self, index, respond):
+        request = RequestFactory().get("/scim/v2/Groups/5000")
+        start = time.perf_counter()
+        sssdgroup = index.find_group_by_id(5000, retrieve_members=True)
+        chunks = respond(SCIMGroup(SSSDGroupToGroupModel(index, sssdgroup), request))
+        first = None
+        size = 0
+        for chunk in chunks:
+            if first is None:
+                first = time.perf_counter() - start
+            size += len(chunk)
+        return first, time.perf_counter() - start, size
+
+    def measure(self, index, respond):
+        first, elapsed, size = self.respond(index, respond)
+        # Separately, tracemalloc slows the conversions down
+        tracemalloc.start()
+        self.respond(index, respond)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {
+            "first_byte_msec": round(first * 1000, 1),
+            "total_msec": round(elapsed * 1000, 1),
+            "peak_mb": round(peak / 1e6, 1),
+            "kb": size // 1000,
+        }
+
+    def test_group_members(self):
+        for members in self.sizes:
+            index = self.build(members)
+            report(
+                "group response",
+                members=members,
+                mode="json.dumps",
+                **self.measure(
+                    index, lambda g: [json.dumps(g.to_dict()).encode("utf-8")]
+                ),
+            )
+            with override_settings(SCIM_STREAMING=True):
+                report(
+                    "group response",
+                    members=members,
+                    mode="stream",
+                    **self.measure(index, lambda g: JSONStream(g.to_stream())),
+                )
+                report(
+                    "group response",
+                    members=members,
+                    mode="stream+gzip",
+                    **self.measure(
+                        index, lambda g: compress_sequence(JSONStream(g.to_stream()))
+                    ),
+                )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class RecordBenchmark(SimpleTestCase):
+    """
+    Serialize a page of users from models and adapters, then from records.
+    """
+
+    users = 10000
+
+    def setUp(self):
+        self.index = _DirectoryIndex()
+        self.index.loaded = float("inf")
+        group = SSSDGroup(5000, "everyone")
+        self.index.add_group(group)
+        self.sssdusers = []
+        for uid in range(10000, 10000 + self.users):
+            sssduser = SSSDUser(
+                uid,
+                "user{}".format(uid),
+                givenname="First",
+                sn="Last",
+                mail="user{}@ipa.test".format(uid),
+                groups=["everyone"],
+            )
+            self.index.add_user(sssduser)
+            self.sssdusers.append(sssduser)
+        self.request = RequestFactory().get("/scim/v2/Users")
+
+    def models(self):
+        return [
+            SCIMUser(SSSDUserToUserModel(self.index, u), request=self.request).to_dict()
+            for u in self.sssdusers
+        ]
+
+    def records(self):
+        serializer = RecordSerializer(self.request)
+        return [
+            serializer.to_dict(SSSDUserToUserRecord(self.index, u))
+            for u in self.sssdusers
+        ]
+
+    def test_serialize(self):
+        self.assertEqual(self.models()[:10], self.records()[:10])
+        for name, serialize in (("model", self.models), ("record", self.records)):
+            start = time.perf_counter()
+            serialize()
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            objects = [
+                (
+                    SSSDUserToUserModel(self.index, u)
+                    if name == "model"
+                    else SSSDUserToUserRecord(self.index, u)
+                )
+                for u in self.sssdusers
+            ]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del objects
+            report(
+                "user serialization",
+                path=name,
+                users=self.users,
+                objects_per_sec=int(self.users / elapsed),
+                bytes_per_object=size // self.users,
+            )
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+class ProvisioningBenchmark(TestCase):
+    """
+    Provision users through the ldap writable interface, against a server
+    with a round trip time of 0.5ms.
+    """
+
+    users = 500
+
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer(latency=0.0005)
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ldap_if = LDAP()
+
+    def scim_user(self, uid):
+        scim_user = mock.Mock()
+        scim_user.obj.username = "user{}".format(uid)
+        scim_user.obj.first_name = "First"
+        scim_user.obj.last_name = "Last"
+        scim_user.obj.email = "user{}@ldap.test".format(uid)
+        return scim_user
+
+    def bind_per_write(self, scim_user):
+        # A write before the pool: domain query, connection, bind and add
+        self.ldap_if._fetch_domain()
+        conn = self.ldap_if._bind()
+        dn = "uid={},{}".format(scim_user.obj.username, self.ldap_if._users_dn)
+        conn.add_s(dn, [])
+
+    def measure(self, name, provision, workers=1):
+        self.server.entries.clear()
+        binds = self.server.binds
+        users = [self.scim_user(uid) for uid in range(10000, 10000 + self.users)]
+        start = time.perf_counter()
+        if workers == 1:
+            for scim_user in users:
+                provision(scim_user)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(provision, users))
+        elapsed = time.perf_counter() - start
+        report(
+            "user provisioning",
+            mode=name,
+            workers=workers,
+            users_per_sec=int(self.users / elapsed),
+            binds=self.server.binds - binds,
+        )
+
+    def test_provisioning(self):
+        self.measure("bind per write", self.bind_per_write)
+        self.measure("pool", self.ldap_if.add)
+        self.measure("pool", self.ldap_if.add, workers=8)
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class BulkBenchmark(TestCase):
+    """
+    Provision users with individual POST requests and with bulk requests,
+    through the ldap writable interface, against a server with a round trip
+    time of 0.5ms.
+    """
+
+    users = 500
+
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer(latency=0.0005)
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _IPA._instance = None
+        self.addCleanup(setattr, _IPA, "_instance", None)
+        admin = get_user_model().objects.create_superuser("admin", "a@ldap.test", "x")
+        self.client.force_login(admin)
+
+    def user(self, uid):
+        username = "user{}".format(uid)
+        return {
+            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+            "userName": username,
+            "password": "Secret123",
+            "name": {"givenName": "First", "familyName": "Last"},
+            "emails": [{"value": "{}@ldap.test".format(username), "primary": True}],
+        }
+
+    def individual(self, uids):
+        for uid in uids:
+            response = self.client.post(
+                "/scim/v2/Users",
+                json.dumps(self.user(uid)),
+                content_type="application/scim+json",
+            )
+            self.assertEqual(response.status_code, 201)
+
+    def bulk(self, uids, size=1000):
+        uids = list(uids)
+        for i in range(0, len(uids), size):
+            body = {
+                "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkRequest"],
+                "Operations": [
+                    {
+                        "method": "POST",
+                        "path": "/Users",
+                        "bulkId": str(uid),
+                        "data": self.user(uid),
+                    }
+                    for uid in uids[i : i + size]
+                ],
+            }
+            response = self.client.post(
+                "/scim/v2/Bulk", json.dumps(body), content_type="application/scim+json"
+            )
+            statuses = {op["status"] for op in response.json()["Operations"]}
+            self.assertEqual(statuses, {"201"})
+
+    def measure(self, name, provision, first_uid):
+        uids = range(first_uid, first_uid + self.users)
+        start = time.perf_counter()
+        provision(uids)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(self.server.operations, self.users)
+        self.server.operations = 0
+        report(
+            "bulk provisioning",
+            mode=name,
+            users_per_sec=int(self.users / elapsed),
+        )
+
+    def test_bulk(self):
+        self.measure("individual requests", self.individual, 10000)
+        self.measure("bulk, 100 operations", lambda u: self.bulk(u, 100), 20000)
+        self.measure("bulk, 1000 operations", self.bulk, 30000)
+
+
+@skipUnless(BENCHMARK, "set IPATUURA_BENCHMARK=1 to run the benchmarks")
+@override_settings(
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+    SCIM_ASYNC_WRITES=True,
+)
+class AsyncWriteBenchmark(TestCase):
+    """
+    Latency of the POST requests of users, written synchronously and
+    queued with Prefer: respond-async, against a slow ldap server with a
+    round trip time of 20ms.
+    """
+
+    users = 50
+
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer(latency=0.02)
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cls in (_IPA, _ProvisioningQueue):
+            cls._instance = None
+            self.addCleanup(setattr, cls, "_instance", None)
+        admin = get_user_model().objects.create_superuser("admin", "a@ldap.test", "x")
+        self.client.force_login(admin)
+
+    def post(self, uid, **headers):
+        username = "user{}".format(uid)
+        user = {
+            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+            "userName": username,
+            "password": "Secret123",
+            "name": {"givenName": "First", "familyName": "Last"},
+            "emails": [{"value": "{}@ldap.test".format(username), "primary": True}],
+        }
+        return self.client.post(
+            "/scim/v2/Users",
+            json.dumps(user),
+            content_type="application/scim+json",
+            **headers,
+        )
+
+    def measure(self, name, uids, status, **headers):
+        start = time.perf_counter()
+        for uid in uids:
+            self.assertEqual(self.post(uid, **headers).status_code, status)
+        elapsed = time.perf_counter() - start
+        report(
+            "user write acknowledgement",
+            mode=name,
+            latency_ms=round(elapsed * 1000 / len(uids), 2),
+        )
+
+    def test_acknowledgement_latency(self):
+        self.measure("synchronous", range(self.users), 201)
+        self.measure(
+            "respond-async",
+            range(1000, 1000 + self.users),
+            202,
+            HTTP_PREFER="respond-async",
+        )
+        self.assertEqual(self.server.operations, self.users)
@@ -0,0 +1,361 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from scim2_filter_parser.parser import SCIMParserError
+from scim.directory import (
+    DirectoryIndex,
+    DirectoryIndexUnavailableException,
+    MembershipIndex,
+    QueryPlan,
+    SortIndex,
+    _DirectoryIndex,
+)
+from scim.sssd import SSSDGroup, SSSDUser, _IdentityCache, _SSSDPool
+from scim.tests.fakes import DBusCallsMixin, FakeInfopipe
+
+
+def make_user(uid, username, givenname, sn, mail, active=True, groups=()):
+    return SSSDUser(
+        uid,
+        username,
+        givenname=givenname,
+        sn=sn,
+        mail=mail,
+        active=active,
+        groups=groups,
+    )
+
+
+class QueryPlanTestCase(SimpleTestCase):
+    def setUp(self):
+        self.index = _DirectoryIndex()
+        self.index.loaded = float("inf")
+        admins = SSSDGroup(2001, "admins")
+        self.index.add_group(admins)
+        self.index.add_group(SSSDGroup(2002, "editors"))
+        for user in (
+            make_user(
+                1001, "jdoe", "John", "Doe", ["jdoe@ipa.test"], groups=["admins"]
+            ),
+            make_user(1002, "asmith", "Alice", "Smith", ["asmith@sales.ipa.test"]),
+            make_user(
+                1003,
+                "bwayne",
+                "Bruce",
+                "Wayne",
+                ["bwayne@ipa.test", "batman@example.org"],
+                active=False,
+                groups=["admins", "editors"],
+            ),
+            make_user(1004, "nomail", "No", "Mail", []),
+        ):
+            self.index.add_user(user)
+
+    def search(self, filter_query, kind="user"):
+        return self.index.search(QueryPlan(kind, filter_query))
+
+    def test_equality(self):
+        self.assertEqual(self.search('userName eq "JDOE"'), [1001])
+        self.assertEqual(self.search('id eq "1002"'), [1002])
+        self.assertEqual(self.search('emails eq "batman@example.org"'), [1003])
+        self.assertEqual(self.search('displayName eq "admins"', "group"), [2001])
+
+    def test_index_lookup_plan(self):
+        plan = QueryPlan("user", 'name.familyName co "a" and userName eq "asmith"')
+        self.assertEqual(
+            repr(plan),
+            "And(IndexLookup(username eq 'asmith'), Scan(name.familyname co 'a'))",
+        )
+        self.assertEqual(plan.equality, None)
+        self.assertEqual(
+            QueryPlan("user", 'userName eq "jdoe"').equality, ("username", "jdoe")
+        )
+        self.assertEqual(
+            repr(QueryPlan("user", 'emails eq "jdoe@ipa.test"')),
+            "IndexLookup(emails.value eq 'jdoe@ipa.test')",
+        )
+
+    def test_operators(self):
+        self.assertEqual(self.search('userName ne "jdoe"'), [1002, 1003, 1004])
+        self.assertEqual(self.search('emails co "@sales."'), [1002])
+        self.assertEqual(self.search('userName sw "B"'), [1003])
+        self.assertEqual(self.search('emails.value ew ".org"'), [1003])
+        self.assertEqual(self.search("emails pr"), [1001, 1002, 1003])
+        self.assertEqual(self.search('name.givenName gt "C"'), [1001, 1004])
+        self.assertEqual(self.search("active eq false"), [1003])
+
+    def test_logical_operators(self):
+        self.assertEqual(
+            self.search('userName eq "jdoe" or userName eq "asmith"'), [1001, 1002]
+        )
+        self.assertEqual(
+            self.search('emails co "ipa.test" and not (active eq false)'),
+            [1001, 1002],
+        )
+        self.assertEqual(
+            self.search('(userName sw "j" or userName sw "a") and emails co "sales"'),
+            [1002],
+        )
+
+    def test_value_path(self):
+        self.assertEqual(
+            self.search('emails[value ew ".org" and not (primary eq true)]'), [1003]
+        )
+        self.assertEqual(self.search('emails[type eq "work"]'), [])
+
+    def test_membership(self):
+        self.assertEqual(self.search('groups.value eq "2001"'), [1001, 1003])
+        self.assertEqual(self.search('groups.display eq "editors"'), [1003])
+        self.assertEqual(self.search('members.display eq "jdoe"', "group"), [2001])
+
+    def test_membership_plan(self):
+        self.assertEqual(
+            repr(QueryPlan("user", 'groups eq "2001"')),
+            "MembershipLookup(groups.value eq '2001')",
+        )
+        self.assertEqual(
+            self.search('groups.value eq "2001" and not (groups.display eq "EDITORS")'),
+            [1001],
+        )
+        self.assertEqual(
+            self.search('groups eq "2002" or groups.display eq "admins"'), [1001, 1003]
+        )
+        self.assertEqual(self.search('not (groups.value eq "2001")'), [1002, 1004])
+        self.assertEqual(
+            self.search('groups.value eq "2001" and userName sw "bwa"'), [1003]
+        )
+        self.assertEqual(self.search('members eq "1003"', "group"), [2001, 2002])
+        self.assertEqual(self.search('groups.value eq "9999"'), [])
+
+    def test_urn_prefix(self):
+        self.assertEqual(
+            self.search(
+                'urn:ietf:params:scim:schemas:core:2.0:User:userName eq "jdoe"'
+            ),
+            [1001],
+        )
+
+    def test_invalid_filters(self):
+        with self.assertRaises(ValueError):
+            QueryPlan("user", 'title eq "boss"')
+        with self.assertRaises(SCIMParserError):
+            QueryPlan("user", "userName eq")
+
+    def test_substring_plan(self):
+        self.assertEqual(
+            repr(QueryPlan("user", 'emails co "@sales."')),
+            "SubstringLookup(emails co '@sales.')",
+        )
+        self.assertEqual(
+            repr(QueryPlan("user", 'givenName sw "Al"')),
+            "SubstringLookup(givenname sw 'al')",
+        )
+        # Too short to have a trigram
+        self.assertEqual(
+            repr(QueryPlan("user", 'userName ew "e"')), "Scan(username ew 'e')"
+        )
+        self.assertEqual(self.search('name.formatted co "CE WA"'), [1003])
+        self.assertEqual(self.search('displayName sw "edi"', "group"), [2002])
+        # The trigrams are found in the value, but not in sequence
+        self.index.add_user(make_user(1005, "abaxbab", None, None, []))
+        self.assertEqual(self.search('userName co "abab"'), [])
+        self.assertEqual(self.search('userName sw "aba" and userName ew "bab"'), [1005])
+
+    def test_substring_updates(self):
+        self.index.add_user(make_user(1002, "asmith", "Alice", "Smyth", []))
+        self.assertEqual(self.search('name.familyName sw "smi"'), [])
+        self.assertEqual(self.search('name.familyName ew "yth"'), [1002])
+        self.assertEqual(self.search('emails co "sales"'), [])
+        self.index.remove_user(1003)
+        self.assertEqual(self.search('emails ew ".org"'), [])
+        # The index is rebuilt once half of its entries were removed
+        for _ in range(10):
+            self.index.add_user(make_user(1002, "asmith", "Alice", "Smyth", []))
+        trigrams = self.index._trigrams["user"]["username"]
+        self.assertLessEqual(trigrams.removed, trigrams.entries // 2)
+        self.assertEqual(self.search('userName co "smit"'), [1002])
+
+    def test_remove_user(self):
+        self.index.remove_user(1003)
+        self.assertEqual(self.search('groups.value eq "2001"'), [1001])
+        self.assertEqual(self.search('emails co "example"'), [])
+
+    def test_sorted(self):
+        ids = self.index.sorted("user", "name.familyname")
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(ids[0:4], [1001, 1004, 1002, 1003])
+        self.assertEqual(ids[1:3], [1004, 1002])
+        ids = self.index.sorted("user", "username", descending=True)
+        self.assertEqual(ids[0:2], [1004, 1001])
+        self.assertEqual(ids[3], 1002)
+        ids = self.index.sorted("group", "displayname", descending=True)
+        self.assertEqual(ids[0:5], [2002, 2001])
+        with self.assertRaises(ValueError):
+            self.index.sorted("user", "emails")
+
+    def test_sorted_missing_values(self):
+        self.index.add_user(make_user(1005, "noname", None, None, []))
+        ids = self.index.sorted("user", "name.givenname")
+        self.assertEqual(ids[0:5], [1002, 1003, 1001, 1004, 1005])
+        ids = self.index.sorted("user", "name.givenname", descending=True)
+        self.assertEqual(ids[0:2], [1005, 1004])
+
+    def test_sorted_filter(self):
+        plan = QueryPlan("user", 'emails co "ipa.test"')
+        # Picked in the order of the sort index, the results are many
+        ids = self.index.sorted("user", "username", plan=plan)
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(ids[0:3], [1002, 1003, 1001])
+        self.assertEqual(ids[1:3], [1003, 1001])
+        # Sorted when they are few
+        with mock.patch("scim.directory.SortedIds.SORT_RATIO", 1):
+            ids = self.index.sorted("user", "username", True, plan)
+            self.assertEqual(ids[1:3], [1003, 1002])
+
+    def test_sorted_updates(self):
+        ids = self.index.sorted("user", "name.familyname")
+        self.assertEqual(ids[0:4], [1001, 1004, 1002, 1003])
+        self.index.add_user(make_user(1001, "jdoe", "John", "Zorro", []))
+        self.index.add_user(make_user(1006, "aaron", "Aaron", "Aaron", []))
+        self.index.remove_user(1002)
+        ids = self.index.sorted("user", "name.familyname")
+        self.assertEqual(ids[0:5], [1006, 1004, 1003, 1001])
+
+    def test_sorted_after(self):
+        ids = self.index.sorted("user", "username")
+        page, key = ids.after(None, 2)
+        self.assertEqual(page, [1002, 1003])
+        # Not shifted by the users added or removed before the position
+        self.index.remove_user(1002)
+        self.index.add_user(make_user(1005, "aaron", "Aaron", "Aaron", []))
+        ids = self.index.sorted("user", "username")
+        page, key = ids.after(key, 2)
+        self.assertEqual(page, [1001, 1004])
+        self.assertIsNone(key)
+
+        ids = self.index.sorted("user", "username", descending=True)
+        page, key = ids.after(None, 3)
+        self.assertEqual(page, [1004, 1001, 1003])
+        self.assertEqual(ids.after(key, 3), ([1005], None))
+
+    def test_sorted_after_filter(self):
+        plan = QueryPlan("user", 'emails co "ipa.test"')
+        for ratio in (16, 1):
+            with mock.patch("scim.directory.SortedIds.SORT_RATIO", ratio):
+                ids = self.index.sorted("user", "username", plan=plan)
+                page, key = ids.after(None, 2)
+                self.assertEqual(page, [1002, 1003])
+                self.assertEqual(ids.after(key, 2), ([1001], None))
+
+
+class MembershipIndexTestCase(SimpleTestCase):
+    def test_bitmaps(self):
+        members = MembershipIndex()
+        for uid in range(1000, 1600):
+            members.add(1, uid)
+            if uid % 2:
+                members.add(2, uid)
+        members.add(3, 1000)
+        members.optimize()
+        # Only the large groups are converted to bitmaps
+        self.assertIsInstance(members._members[1], int)
+        self.assertIsInstance(members._members[3], set)
+        self.assertEqual(members.members(3), {1000})
+        even = members.bitmap(1) & ~members.bitmap(2)
+        self.assertEqual(len(members.ids(even)), 300)
+
+        members.remove_user(1001, [1, 2])
+        self.assertNotIn(1001, members.members(1))
+        self.assertEqual(len(members.ids(members.everyone())), 599)
+        # The free position is reused
+        members.add(2, 2000)
+        self.assertEqual(members._positions[2000], 1)
+        self.assertIn(2000, members.members(2))
+        self.assertNotIn(2000, members.members(1))
+        self.assertEqual(members.remove_group(3), {1000})
+        self.assertEqual(members.members(3), set())
+
+
+class SortIndexTestCase(SimpleTestCase):
+    def test_merge(self):
+        objects = {id: "{:03}".format(100 - id) for id in range(100)}
+        sort_index = SortIndex(objects, lambda value: value)
+        for id in objects:
+            sort_index.add(id)
+        self.assertEqual(len(sort_index), 100)
+        # Sorted at once, above the merge threshold
+        self.assertEqual(sort_index.range(0, 3), [99, 98, 97])
+        self.assertEqual(sort_index.range(0, 2, descending=True), [0, 1])
+        # Same value as 97, ordered by id
+        objects[100] = "003"
+        sort_index.add(100)
+        sort_index.remove(98)
+        del objects[98]
+        self.assertEqual(sort_index.range(0, 3), [99, 97, 100])
+        self.assertEqual(list(sort_index)[3:5], [96, 95])
+
+
+@override_settings(
+    DIRECTORY_INDEX_SSSD_ENUMERATION=True,
+    SSSD_CACHE_TIMEOUT=60,
+    SSSD_NEGATIVE_CACHE_TIMEOUT=60,
+    SSSD_MEMBER_REFRESH_INTERVAL=60,
+)
+class DirectoryIndexTestCase(DBusCallsMixin, TransactionTestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        _SSSDPool._instance = None
+        _DirectoryIndex._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ipa.test")
+        self.infopipe.add_user("asmith", 1002, "Alice", "Smith")
+        self.infopipe.add_group("admins", 2001, members=[1001, 1002])
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load(self):
+        index = DirectoryIndex()
+        plan = QueryPlan("user", 'groups.display eq "admins" and name.givenName sw "a"')
+        self.assertEqual(index.search(plan), [1002])
+        # The next queries do not call SSSD
+        with self.assertNumDBusCalls(0):
+            self.assertEqual(index.search(plan), [1002])
+
+    @override_settings(SSSD_LIST_LIMIT=2)
+    def test_truncated_enumeration(self):
+        with self.assertLogs("scim.directory", "WARNING") as logs:
+            DirectoryIndex().load()
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("enumeration of the users returned 2", logs.output[0])
+
+    @override_settings(DIRECTORY_INDEX_SSSD_ENUMERATION=False)
+    def test_unsynchronized_directory(self):
+        index = DirectoryIndex()
+        with self.assertRaises(DirectoryIndexUnavailableException):
+            index.search(QueryPlan("user", 'userName sw "j"'))
+        self.assertIsNone(index.loaded)
+
+    def test_invalidate_user(self):
+        index = DirectoryIndex()
+        plan = QueryPlan("user", 'name.familyName eq "Smith"')
+        self.assertEqual(index.search(plan), [1002])
+        self.infopipe.users[1001]["extraAttributes"]["sn"] = ["Smith"]
+        _IdentityCache._instance = None
+        index.invalidate_user("jdoe")
+        self.assertEqual(index.search(plan), [1001, 1002])
+        self.assertEqual(
+            index.search(QueryPlan("user", 'groups.value eq "2001"')), [1001, 1002]
+        )
+
+    @override_settings(DIRECTORY_INDEX_REFRESH_INTERVAL=0)
+    def test_reload(self):
+        index = DirectoryIndex()
+        plan = QueryPlan("user", 'userName sw "b"')
+        self.assertEqual(index.search(plan), [])
+        self.infopipe.add_user("bwayne", 1003)
+        _IdentityCache._instance = None
+        index.search(plan)
+        # The reload runs in the background
+        with index._loading:
+            self.assertEqual(index.search(plan), [1003])
@@ -0,0 +1,605 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import ldap
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django_scim import exceptions
+from domains.tests.factories import DomainFactory
+from scim.adapters import SCIMUser
+from scim.ipa import (
+    _IPA,
+    IPA,
+    IPAAPI,
+    LDAP,
+    IPADirectorySource,
+    IPANotFoundException,
+    LDAPNotFoundException,
+    LDAPPool,
+    LDAPUnavailableException,
+    UserExistsException,
+    fold_changes,
+)
+from scim.models import DirectoryEntry, DirectoryMember, User
+from scim.sssd import SSSD, _IdentityCache, _SSSDPool
+from scim.sync import DirectorySync
+from scim.tests.fakes import FakeInfopipe, FakeLDAPServer
+
+
+def add(conn):
+    conn.add_s("uid=jdoe,ou=people,dc=ldap,dc=test", [])
+
+
+@override_settings(LDAP_POOL_SIZE=2, LDAP_POOL_TIMEOUT=30, LDAP_POOL_PROBE_INTERVAL=60)
+class LDAPPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = FakeLDAPServer()
+        self.pool = LDAPPool(self.connect)
+
+    def connect(self):
+        conn = self.server.initialize("ldap://ldap.test")
+        conn.simple_bind_s("cn=Directory Manager", "Secret123")
+        return conn
+
+    def test_reuse(self):
+        """The connections are bound once."""
+        for _ in range(10):
+            self.pool.run(lambda conn: conn.whoami_s())
+        self.assertEqual(self.server.binds, 1)
+        self.assertEqual(self.pool.stats["checkouts"], 10)
+
+    def test_parallel_operations(self):
+        """Parallel operations share at most LDAP_POOL_SIZE connections."""
+        self.server.latency = 0.001
+
+        def whoami(i):
+            return self.pool.run(lambda conn: conn.whoami_s())
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(whoami, range(50)))
+        stats = self.pool.stats
+        self.assertEqual(self.server.binds, 2)
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["idle"], 2)
+        self.assertGreater(stats["waits"], 0)
+
+    def test_operation_error(self):
+        """The connection is returned to the pool after an LDAP error."""
+        self.pool.run(add)
+        with self.assertRaises(ldap.ALREADY_EXISTS):
+            self.pool.run(add)
+        self.assertEqual(self.pool.stats["idle"], 1)
+        self.assertEqual(self.server.binds, 1)
+
+    @override_settings(LDAP_POOL_PROBE_INTERVAL=0)
+    def test_idle_timeout_probe(self):
+        """An idle connection closed by the server is replaced."""
+        pool = LDAPPool(self.connect)
+        pool.run(lambda conn: conn.whoami_s())
+        self.server.close_idle()
+        pool.run(add)
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(pool.stats["probes"], 1)
+        self.assertEqual(pool.stats["reconnects"], 1)
+        self.assertEqual(pool.stats["created"], 1)
+
+    def test_server_down_retry(self):
+        """An operation on a connection closed since the probe is retried."""
+        self.pool.run(lambda conn: conn.whoami_s())
+        self.server.close_idle()
+        self.pool.run(add)
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(self.pool.stats["probes"], 0)
+        self.assertEqual(self.pool.stats["reconnects"], 1)
+        self.assertEqual(self.server.binds, 2)
+
+    def test_server_down(self):
+        """The connections are not kept when the server is down."""
+        self.pool.run(lambda conn: conn.whoami_s())
+        self.server.close_idle()
+        self.pool.connect = mock.Mock(side_effect=ldap.SERVER_DOWN({}))
+        with self.assertRaises(ldap.SERVER_DOWN):
+            self.pool.run(add)
+        self.assertEqual(self.pool.stats["created"], 0)
+        self.assertEqual(self.pool.stats["idle"], 0)
+
+    def test_checkout_timeout(self):
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold(conn):
+            held.set()
+            release.wait()
+
+        threads = [
+            threading.Thread(target=self.pool.run, args=(hold,)) for _ in range(2)
+        ]
+        for thread in threads:
+            held.clear()
+            thread.start()
+            held.wait()
+        self.pool.timeout = 0.01
+        try:
+            with self.assertRaises(LDAPUnavailableException):
+                self.pool.run(add)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
+
+    def test_close(self):
+        self.pool.run(lambda conn: conn.whoami_s())
+        self.pool.close()
+        self.assertEqual(self.pool.stats["created"], 0)
+        self.assertTrue(all(conn.closed for conn in self.server.connections))
+
+
+class LDAPTestCase(TestCase):
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer()
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def scim_user(self, username):
+        scim_user = mock.Mock()
+        scim_user.obj.username = username
+        scim_user.obj.first_name = "John"
+        scim_user.obj.last_name = "Doe"
+        scim_user.obj.email = "{}@ldap.test".format(username)
+        return scim_user
+
+    def test_writes(self):
+        """The writes do not read the domain and reuse the connection."""
+        ldap_if = LDAP()
+        self.assertEqual(self.server.binds, 1)
+        with self.assertNumQueries(0):
+            for i in range(5):
+                scim_user = self.scim_user("user{}".format(i))
+                ldap_if.add(scim_user)
+                ldap_if.modify(scim_user)
+                ldap_if.delete(scim_user)
+        self.assertEqual(self.server.operations, 15)
+        self.assertEqual(self.server.binds, 1)
+        self.assertEqual(self.server.entries, {})
+
+    def test_batch(self):
+        """The operations of a batch are sent before their results are read."""
+        self.server.latency = 0.001
+        ldap_if = LDAP()
+        scim_users = [self.scim_user("user{}".format(i)) for i in range(3)]
+        items = [(scim_user, None) for scim_user in scim_users]
+        self.assertEqual(ldap_if.batch("add", items), [None, None, None])
+        start = time.monotonic()
+        errors = ldap_if.batch("add", items[:1])
+        self.assertIsInstance(errors[0], UserExistsException)
+        attrs = {"sn": "Smith"}
+        errors = ldap_if.batch("modify", [(u, attrs) for u in scim_users])
+        self.assertEqual(errors, [None, None, None])
+        dn = "uid=user0,ou=people,dc=ldap,dc=test"
+        self.assertEqual(self.server.entries[dn]["sn"], [b"Smith"])
+        ldap_if.delete(scim_users[1])
+        errors = ldap_if.batch("delete", items)
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], LDAPNotFoundException)
+        self.assertEqual(self.server.entries, {})
+        self.assertEqual(ldap_if._pool.stats["checkouts"], 5)
+        self.assertEqual(self.server.binds, 1)
+
+
+@override_settings(DIRECTORY_SYNC_PAGE_SIZE=2, DIRECTORY_SYNC_RECONCILE_INTERVAL=3600)
+class IPADirectorySourceTestCase(TestCase):
+    users_dn = "cn=users,cn=accounts,dc=ipa,dc=test"
+    groups_dn = "cn=groups,cn=accounts,dc=ipa,dc=test"
+
+    def setUp(self):
+        DomainFactory()
+        self.server = FakeLDAPServer()
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(IPAAPI, "_valid_creds")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for uid, name in enumerate(("jdoe", "asmith", "bwayne"), 1001):
+            self.add_user(name, uid)
+        self.server.add_entry(
+            "cn=admins," + self.groups_dn,
+            objectClass=["groupOfNames", "ipaUserGroup", "posixGroup"],
+            cn="admins",
+            gidNumber="2001",
+            member=["uid=jdoe," + self.users_dn, "cn=editors," + self.groups_dn],
+        )
+        self.server.add_entry(
+            "cn=editors," + self.groups_dn,
+            objectClass=["groupOfNames", "ipaUserGroup"],
+            cn="editors",
+        )
+        self.sssd_if = mock.Mock()
+        self.sssd_if.find_group_by_name.return_value = mock.Mock(id=2002)
+
+    def add_user(self, name, uid, sn="Doe"):
+        self.server.add_entry(
+            "uid={},{}".format(name, self.users_dn),
+            objectClass=["person", "posixAccount"],
+            uid=name,
+            uidNumber=str(uid),
+            givenName="John",
+            sn=sn,
+            mail="{}@ipa.test".format(name),
+        )
+
+    def test_refresh(self):
+        """The refresh only reads the entries changed since the cursor."""
+        sync = DirectorySync(IPADirectorySource(), self.sssd_if)
+        users, groups = sync.run()
+        self.assertEqual((users.written, groups.written), (3, 2))
+        self.assertEqual(DirectoryEntry.objects.get(name="jdoe").number, 1001)
+        # The non-POSIX groups are mapped by SSSD, the nested groups are
+        # not members
+        self.assertEqual(DirectoryEntry.objects.get(name="editors").number, 2002)
+        members = DirectoryMember.objects.values_list("group__name", "username")
+        self.assertEqual(list(members), [("admins", "jdoe")])
+
+        # Changed directly in IPA
+        for uid in range(2000, 2100):
+            self.add_user("user{}".format(uid), uid)
+        users, _ = sync.run()
+        self.server.entries["uid=jdoe," + self.users_dn]["sn"] = [b"Smith"]
+        self.server.stamp("uid=jdoe," + self.users_dn)
+        self.server.returned = 0
+        users, groups = sync.run()
+        # The entries of the cursor itself are read again
+        self.assertEqual(users.fetched, 2)
+        self.assertEqual((users.written, groups.fetched), (1, 1))
+        self.assertEqual(self.server.returned, 3)
+        self.assertEqual(DirectoryEntry.objects.get(name="jdoe").attrs["sn"], "Smith")
+        # A single connection for the whole synchronization
+        self.assertEqual(self.server.binds, 1)
+
+
+class IPABatchTestCase(SimpleTestCase):
+    def setUp(self):
+        for target in ("is_ipa_client_configured", "IPAAPI._ipa_connect"):
+            patcher = mock.patch("scim.ipa.{}".format(target))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch("scim.ipa.api")
+        self.api = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.batch = self.api.Command.__getitem__.return_value
+
+    def scim_user(self, username):
+        scim_user = mock.Mock()
+        scim_user.obj.username = username
+        scim_user.obj.first_name = "John"
+        scim_user.obj.last_name = "Doe"
+        scim_user.obj.email = "{}@ipa.test".format(username)
+        return scim_user
+
+    def test_batch(self):
+        """The users are written with a single batch command."""
+        self.batch.return_value = {
+            "results": [
+                {"error": None, "result": {}},
+                {
+                    "error": "user with name jdoe already exists",
+                    "error_name": "DuplicateEntry",
+                },
+                {"error": "Insufficient access", "error_name": "ACIError"},
+            ]
+        }
+        items = [(self.scim_user(name), None) for name in ("asmith", "jdoe", "bsmith")]
+        errors = IPAAPI().batch("add", items)
+        self.api.Command.__getitem__.assert_called_once_with("batch")
+        methods = self.batch.call_args.args
+        self.assertEqual(
+            methods[0],
+            {
+                "method": "user_add",
+                "params": [
+                    ["asmith"],
+                    {"givenname": "John", "sn": "Doe", "mail": "asmith@ipa.test"},
+                ],
+            },
+        )
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], UserExistsException)
+        self.assertIsInstance(errors[2], RuntimeError)
+
+    def test_batch_modify(self):
+        self.batch.return_value = {
+            "results": [
+                {
+                    "error": "no modifications to be performed",
+                    "error_name": "EmptyModlist",
+                },
+                {"error": "jdoe: user not found", "error_name": "NotFound"},
+            ]
+        }
+        items = [(self.scim_user(name), {"sn": "Smith"}) for name in ("asmith", "jdoe")]
+        errors = IPAAPI().batch("modify", items)
+        self.assertEqual(
+            self.batch.call_args.args[1],
+            {"method": "user_mod", "params": [["jdoe"], {"sn": "Smith"}]},
+        )
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], IPANotFoundException)
+
+
+@override_settings(SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60)
+class IPAModifyTestCase(TestCase):
+    dn = "uid=jdoe,ou=people,dc=ldap,dc=test"
+
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer()
+        self.server.entries[self.dn] = {}
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _IdentityCache._instance = None
+        _SSSDPool._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ldap.test")
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _IPA._instance = None
+        self.addCleanup(setattr, _IPA, "_instance", None)
+        self.ipa = IPA()
+
+    def scim_user(self, username="jdoe", first_name="John", last_name="Doe"):
+        scim_user = mock.Mock()
+        scim_user.obj.username = username
+        scim_user.obj.first_name = first_name
+        scim_user.obj.last_name = last_name
+        scim_user.obj.email = "{}@ldap.test".format(username)
+        return scim_user
+
+    def test_unchanged(self):
+        """A modification which changes nothing is not sent."""
+        self.ipa.user_mod(self.scim_user())
+        self.assertEqual(self.server.operations, 0)
+        self.assertEqual(self.ipa.writes_avoided, 1)
+
+    def test_changed_attrs(self):
+        """Only the attributes which changed are sent."""
+        self.ipa.user_mod(self.scim_user(last_name="Smith"))
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(self.server.entries[self.dn], {"sn": [b"Smith"]})
+        self.assertEqual(self.ipa.writes_avoided, 0)
+
+    def test_unknown_user(self):
+        """All the attributes are sent when the entry cannot be read."""
+        dn = "uid=asmith,ou=people,dc=ldap,dc=test"
+        self.server.entries[dn] = {}
+        self.ipa.user_mod(self.scim_user("asmith"))
+        self.assertEqual(sorted(self.server.entries[dn]), ["givenname", "mail", "sn"])
+
+    def test_stale_cached_user(self):
+        """A user cached before a change outside of ipa-tuura is read again."""
+        with mock.patch("scim.sssd.time.monotonic", return_value=1000):
+            SSSD().find_user_by_name("jdoe")
+        self.infopipe.add_user("jdoe", 1001, "John", "Smith", "jdoe@ldap.test")
+        with mock.patch("scim.sssd.time.monotonic", return_value=1010):
+            self.ipa.user_mod(self.scim_user())
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(self.server.entries[self.dn], {"sn": [b"Doe"]})
+        self.assertEqual(self.ipa.writes_avoided, 0)
+
+
+class FoldChangesTestCase(SimpleTestCase):
+    def test_fold(self):
+        changes = [
+            ("add", "mail", ["a@ldap.test"]),
+            ("remove", "mail", ["b@ldap.test"]),
+            ("add", "mail", ["b@ldap.test", "c@ldap.test"]),
+            ("replace", "sn", ["Doe"]),
+            ("remove", "sn", []),
+            ("add", "sn", ["Smith"]),
+        ]
+        self.assertEqual(
+            fold_changes(changes),
+            [
+                ("add", "mail", ["a@ldap.test", "b@ldap.test", "c@ldap.test"]),
+                ("replace", "sn", ["Smith"]),
+            ],
+        )
+
+    def test_fold_add_remove(self):
+        changes = [
+            ("add", "mail", ["a@ldap.test"]),
+            ("remove", "mail", ["a@ldap.test"]),
+        ]
+        self.assertEqual(fold_changes(changes), [("remove", "mail", ["a@ldap.test"])])
+
+
+@override_settings(SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60)
+class SCIMUserPatchTestCase(IPAModifyTestCase):
+    def patch(self, *operations):
+        request = RequestFactory().patch("/scim/v2/Users/1001")
+        scim_user = SCIMUser(User.objects.get(scim_id="1001"), request=request)
+        scim_user.handle_operations(list(operations))
+        return scim_user
+
+    def test_replace(self):
+        """Only the attributes of the operations are written."""
+        self.server.entries[self.dn] = {"givenname": [b"John"], "sn": [b"Doe"]}
+        scim_user = self.patch(
+            {"op": "replace", "path": "name.familyName", "value": "Smith"}
+        )
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(
+            self.server.entries[self.dn], {"givenname": [b"John"], "sn": [b"Smith"]}
+        )
+        self.assertEqual(scim_user.to_dict()["name"]["familyName"], "Smith")
+
+    def test_emails(self):
+        self.server.entries[self.dn] = {"mail": [b"jdoe@ldap.test"]}
+        scim_user = self.patch(
+            {
+                "op": "add",
+                "path": "emails",
+                "value": [{"value": "john@ldap.test"}],
+            },
+            {"op": "remove", "path": "emails", "value": [{"value": "jdoe@ldap.test"}]},
+        )
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(self.server.entries[self.dn], {"mail": [b"john@ldap.test"]})
+        self.assertEqual(
+            [e["value"] for e in scim_user.to_dict()["emails"]], ["john@ldap.test"]
+        )
+
+    def test_existing_values(self):
+        """Adding existing values and removing missing ones are ignored."""
+        self.server.entries[self.dn] = {"mail": [b"jdoe@ldap.test"]}
+        self.patch(
+            {
+                "op": "add",
+                "path": "emails",
+                "value": [{"value": "jdoe@ldap.test"}, {"value": "john@ldap.test"}],
+            },
+            {"op": "remove", "path": "emails", "value": {"value": "doe@ldap.test"}},
+        )
+        self.assertEqual(
+            self.server.entries[self.dn],
+            {"mail": [b"jdoe@ldap.test", b"john@ldap.test"]},
+        )
+
+    def test_without_path(self):
+        self.patch(
+            {
+                "op": "replace",
+                "value": {"name": {"givenName": "Johnny"}, "active": True},
+            }
+        )
+        self.assertEqual(self.server.entries[self.dn], {"givenname": [b"Johnny"]})
+
+    def test_unsupported_path(self):
+        with self.assertRaises(exceptions.BadRequestError):
+            self.patch(
+                {"op": "replace", "path": 'emails[type eq "work"].value', "value": ""}
+            )
+        with self.assertRaises(exceptions.NotImplementedError):
+            self.patch({"op": "replace", "path": "title", "value": "Engineer"})
+        self.assertEqual(self.server.operations, 0)
+
+
+@override_settings(SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60)
+class BulkTestCase(IPAModifyTestCase):
+    def setUp(self):
+        super().setUp()
+        admin = get_user_model().objects.create_superuser("admin", "a@ldap.test", "x")
+        self.client.force_login(admin)
+
+    def bulk(self, *operations, **kwargs):
+        body = {
+            "schemas": ["urn:ietf:params:scim:api:messages:2.0:BulkRequest"],
+            "Operations": list(operations),
+            **kwargs,
+        }
+        return self.client.post(
+            "/scim/v2/Bulk", json.dumps(body), content_type="application/scim+json"
+        )
+
+    def user(self, username, last_name="Doe"):
+        return {
+            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+            "userName": username,
+            "password": "Secret123",
+            "name": {"givenName": "John", "familyName": last_name},
+            "emails": [{"value": "{}@ldap.test".format(username), "primary": True}],
+        }
+
+    def post(self, username):
+        return {
+            "method": "POST",
+            "path": "/Users",
+            "bulkId": username,
+            "data": self.user(username),
+        }
+
+    def test_batches(self):
+        """The consecutive operations with the same method are batched."""
+        response = self.bulk(
+            self.post("asmith"),
+            self.post("bsmith"),
+            {"method": "PUT", "path": "/Users/1001", "data": self.user("jdoe", "Doe")},
+            {"method": "DELETE", "path": "/Users/1001"},
+        )
+        self.assertEqual(response.status_code, 200)
+        operations = response.json()["Operations"]
+        self.assertEqual(
+            [op["status"] for op in operations], ["201", "201", "200", "204"]
+        )
+        self.assertEqual(operations[0]["bulkId"], "asmith")
+        self.assertIn("/scim/v2/Users/", operations[0]["location"])
+        self.assertEqual(
+            sorted(self.server.entries),
+            [
+                "uid=asmith,ou=people,dc=ldap,dc=test",
+                "uid=bsmith,ou=people,dc=ldap,dc=test",
+            ],
+        )
+        # The unchanged user is not written
+        self.assertEqual(self.ipa.writes_avoided, 1)
+        self.assertEqual(self.ipa._apiconn._pool.stats["checkouts"], 2)
+
+    def test_errors(self):
+        response = self.bulk(
+            self.post("jdoe"),
+            {"method": "DELETE", "path": "/Users/9999"},
+            {"method": "GET", "path": "/Users/1001"},
+            {"method": "PUT", "path": "/Users/bulkId:unknown", "data": {}},
+            self.post("asmith"),
+        )
+        operations = response.json()["Operations"]
+        self.assertEqual(
+            [op["status"] for op in operations], ["409", "404", "400", "409", "201"]
+        )
+        self.assertEqual(operations[0]["response"]["scimType"], "uniqueness")
+
+    def test_fail_on_errors(self):
+        """No operation is written after failOnErrors errors."""
+        response = self.bulk(
+            self.post("jdoe"),
+            self.post("asmith"),
+            self.post("jdoe"),
+            self.post("bsmith"),
+            failOnErrors=2,
+        )
+        operations = response.json()["Operations"]
+        self.assertEqual([op["status"] for op in operations], ["409", "201", "409"])
+        self.assertNotIn("uid=bsmith,ou=people,dc=ldap,dc=test", self.server.entries)
+
+    def test_bulk_id_reference(self):
+        response = self.bulk(
+            self.post("asmith"),
+            {
+                "method": "PATCH",
+                "path": "/Users/bulkId:asmith",
+                "data": {
+                    "schemas": ["urn:ietf:params:scim:api:messages:2.0:PatchOp"],
+                    "Operations": [
+                        {"op": "replace", "path": "name.familyName", "value": "Smith"}
+                    ],
+                },
+            },
+        )
+        operations = response.json()["Operations"]
+        self.assertEqual([op["status"] for op in operations], ["201", "200"])
+        self.assertEqual(
+            self.server.entries["uid=asmith,ou=people,dc=ldap,dc=test"]["sn"],
+            [b"Smith"],
+        )
+
+    @override_settings(SCIM_BULK_MAX_OPERATIONS=1)
+    def test_max_operations(self):
+        response = self.bulk(self.post("asmith"), self.post("bsmith"))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.server.entries, {self.dn: {}})
@@ -0,0 +1,262 @@
+import json
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, TransactionTestCase, override_settings
+from domains.tests.factories import DomainFactory
+from scim.ipa import _IPA
+from scim.jobs import ProvisioningQueue, _ProvisioningQueue
+from scim.models import ProvisioningJob, User
+from scim.sssd import _IdentityCache, _SSSDPool
+from scim.tests.fakes import FakeInfopipe, FakeLDAPServer
+
+
+class ProvisioningMixin:
+    dn = "uid=jdoe,ou=people,dc=ldap,dc=test"
+
+    def setUp(self):
+        DomainFactory(id_provider="ldap", integration_domain_url="ldap://ldap.test")
+        self.server = FakeLDAPServer()
+        self.server.entries[self.dn] = {}
+        patcher = mock.patch("scim.ipa.ldap.initialize", self.server.initialize)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        _IdentityCache._instance = None
+        _SSSDPool._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ldap.test")
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cls in (_IPA, _ProvisioningQueue):
+            cls._instance = None
+            self.addCleanup(setattr, cls, "_instance", None)
+        self.queue = ProvisioningQueue()
+        admin = get_user_model().objects.create_superuser("admin", "a@ldap.test", "x")
+        self.client.force_login(admin)
+
+    def user(self, username, last_name="Doe"):
+        return {
+            "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+            "userName": username,
+            "password": "Secret123",
+            "name": {"givenName": "John", "familyName": last_name},
+            "emails": [{"value": "{}@ldap.test".format(username), "primary": True}],
+        }
+
+    def request(self, method, path, data=None, **headers):
+        return getattr(self.client, method)(
+            path,
+            json.dumps(data) if data is not None else "",
+            content_type="application/scim+json",
+            HTTP_PREFER="respond-async",
+            **headers,
+        )
+
+    def drain(self):
+        while True:
+            job = self.queue.claim()
+            if job is None:
+                return
+            self.queue.run(job)
+
+
+@override_settings(
+    SCIM_ASYNC_WRITES=True, SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60
+)
+class ProvisioningQueueTestCase(ProvisioningMixin, TestCase):
+    def test_add(self):
+        """The write is acknowledged before it is sent."""
+        response = self.request("post", "/scim/v2/Users", self.user("asmith"))
+        self.assertEqual(response.status_code, 202)
+        job = response.json()
+        self.assertEqual(job["status"], "pending")
+        self.assertTrue(response["Location"].endswith("/scim/v2/Jobs/" + job["id"]))
+        self.assertEqual(self.server.operations, 0)
+        self.assertNotIn("password", ProvisioningJob.objects.get().payload)
+
+        self.drain()
+        self.assertIn("uid=asmith,ou=people,dc=ldap,dc=test", self.server.entries)
+        user = User.objects.filter(scim_username="asmith").first()
+        self.assertTrue(user.check_password("Secret123"))
+        job = self.client.get("/scim/v2/Jobs/" + job["id"]).json()
+        self.assertEqual(job["status"], "done")
+        self.assertIn("/scim/v2/Users/", job["location"])
+
+    def test_synchronous(self):
+        """The writes are synchronous without the Prefer header."""
+        response = self.client.post(
+            "/scim/v2/Users",
+            json.dumps(self.user("asmith")),
+            content_type="application/scim+json",
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.server.operations, 1)
+        self.assertFalse(ProvisioningJob.objects.exists())
+
+    def test_prefer_parameters(self):
+        """The respond-async preference is recognized with parameters."""
+        response = self.client.post(
+            "/scim/v2/Users",
+            json.dumps(self.user("asmith")),
+            content_type="application/scim+json",
+            HTTP_PREFER="return=minimal, respond-async; wait=10",
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(self.server.operations, 0)
+
+    def test_validation(self):
+        """The invalid requests are rejected before they are queued."""
+        response = self.request("put", "/scim/v2/Users/9999", self.user("asmith"))
+        self.assertEqual(response.status_code, 404)
+        response = self.request("post", "/scim/v2/Users", {"userName": "asmith"})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ProvisioningJob.objects.exists())
+
+    def test_idempotency_key(self):
+        for _ in range(2):
+            response = self.request(
+                "post",
+                "/scim/v2/Users",
+                self.user("asmith"),
+                HTTP_IDEMPOTENCY_KEY="8e03978e",
+            )
+        self.assertEqual(ProvisioningJob.objects.count(), 1)
+        self.assertEqual(response.json()["id"], str(ProvisioningJob.objects.get().uuid))
+
+    def test_idempotency_key_reused(self):
+        """A key used by another request is rejected."""
+        self.request(
+            "post",
+            "/scim/v2/Users",
+            self.user("asmith"),
+            HTTP_IDEMPOTENCY_KEY="8e03978e",
+        )
+        response = self.request(
+            "post",
+            "/scim/v2/Users",
+            self.user("bjones"),
+            HTTP_IDEMPOTENCY_KEY="8e03978e",
+        )
+        self.assertEqual(response.status_code, 422)
+        response = self.request(
+            "put",
+            "/scim/v2/Users/1001",
+            self.user("jdoe", "Smith"),
+            HTTP_IDEMPOTENCY_KEY="8e03978e",
+        )
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(ProvisioningJob.objects.count(), 1)
+
+    def test_coalescing(self):
+        """Repeated updates of a user are written once."""
+        for last_name in ("Smith", "Jones"):
+            response = self.request(
+                "put", "/scim/v2/Users/1001", self.user("jdoe", last_name)
+            )
+        self.assertEqual(ProvisioningJob.objects.count(), 1)
+        self.assertEqual(ProvisioningJob.objects.get().coalesced, 1)
+        self.drain()
+        self.assertEqual(self.server.operations, 1)
+        self.assertEqual(self.server.entries[self.dn]["sn"], [b"Jones"])
+
+    def test_delete_coalescing(self):
+        """A deletion replaces the pending modification."""
+        job = self.request("put", "/scim/v2/Users/1001", self.user("jdoe", "Smith"))
+        response = self.request("delete", "/scim/v2/Users/1001")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["id"], job.json()["id"])
+        self.assertEqual(response.json()["operation"], "delete")
+        self.drain()
+        self.assertEqual(self.server.operations, 1)
+        self.assertNotIn(self.dn, self.server.entries)
+
+    def test_user_order(self):
+        """The jobs of a user are run one at a time."""
+        self.request("put", "/scim/v2/Users/1001", self.user("jdoe", "Smith"))
+        running = self.queue.claim()
+        self.request("put", "/scim/v2/Users/1001", self.user("jdoe", "Jones"))
+        self.request("post", "/scim/v2/Users", self.user("asmith"))
+        self.assertEqual(self.queue.claim().username, "asmith")
+        self.assertIsNone(self.queue.claim())
+        self.queue.run(running)
+        self.assertEqual(self.queue.claim().username, "jdoe")
+
+    @override_settings(PROVISIONING_MAX_ATTEMPTS=2)
+    def test_retry(self):
+        """The jobs failing with a backend error are retried."""
+        self.queue._reset_instance()
+        self.request("post", "/scim/v2/Users", self.user("asmith"))
+        with mock.patch.object(_IPA, "user_add", side_effect=RuntimeError("down")):
+            self.queue.run(self.queue.claim())
+            job = ProvisioningJob.objects.get()
+            self.assertEqual(job.status, "pending")
+            self.assertIsNone(self.queue.claim())
+            ProvisioningJob.objects.update(run_after=None)
+            self.queue.run(self.queue.claim())
+        job = ProvisioningJob.objects.get()
+        self.assertEqual(job.status, "failed")
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(job.error["status"], 500)
+
+    def test_permanent_error(self):
+        """The jobs failing with an error of the request are not retried."""
+        self.request("post", "/scim/v2/Users", self.user("jdoe"))
+        self.drain()
+        job = self.client.get(
+            "/scim/v2/Jobs/" + str(ProvisioningJob.objects.get().uuid)
+        ).json()
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["attempts"], 1)
+        self.assertEqual(job["response"]["status"], 409)
+
+    def test_unknown_job(self):
+        response = self.client.get("/scim/v2/Jobs/{}".format(uuid.uuid4()))
+        self.assertEqual(response.status_code, 404)
+
+    def test_recover(self):
+        """Only the jobs whose lease expired are queued again."""
+        self.request("post", "/scim/v2/Users", self.user("asmith"))
+        job = self.queue.claim()
+        self.assertEqual(job.claimed_by, self.queue.worker_id)
+        self.assertEqual(self.queue.recover(), 0)
+        self.assertIsNone(self.queue.claim())
+        ProvisioningJob.objects.update(
+            claimed_at=job.claimed_at - timedelta(seconds=self.queue.lease_timeout + 1)
+        )
+        self.assertEqual(self.queue.recover(), 1)
+        self.assertEqual(self.queue.claim().username, "asmith")
+
+
+@override_settings(
+    SCIM_ASYNC_WRITES=True, SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60
+)
+class ProvisionUsersCommandTestCase(ProvisioningMixin, TransactionTestCase):
+    def test_drain(self):
+        for i in range(10):
+            self.request("post", "/scim/v2/Users", self.user("user{}".format(i)))
+        call_command("provisionusers", workers=1, stdout=mock.Mock())
+        self.assertEqual(
+            set(ProvisioningJob.objects.values_list("status", flat=True)), {"done"}
+        )
+        self.assertEqual(len(self.server.entries), 11)
+
+    @override_settings(PROVISIONING_POLL_INTERVAL=0)
+    def test_drain_database_error(self):
+        """A database error does not stop the draining of the queue."""
+        self.request("post", "/scim/v2/Users", self.user("asmith"))
+        claim = _ProvisioningQueue.claim
+        errors = [OperationalError("database table is locked")] * 2
+
+        def failing_claim(queue):
+            if errors:
+                raise errors.pop()
+            return claim(queue)
+
+        with mock.patch.object(_ProvisioningQueue, "claim", failing_claim):
+            call_command("provisionusers", workers=1, stdout=mock.Mock())
+        self.assertEqual(ProvisioningJob.objects.get().status, "done")
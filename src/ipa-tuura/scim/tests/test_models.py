@@ -0,0 +1,206 @@
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from scim.adapters import RecordSerializer, SCIMGroup, SCIMUser
+from scim.models import (
+    DirectoryEntry,
+    Group,
+    LazyUserList,
+    ServiceProviderConfig,
+    User,
+    identity_map_scope,
+)
+from scim.records import GroupRecord, UserRecord
+from scim.sssd import IdentityCache, MemberResolver, _IdentityCache, _SSSDPool
+from scim.tests.fakes import DBusCallsMixin, FakeInfopipe
+from scim.utils import Projection
+from scim.views import UsersView
+
+
+@override_settings(SSSD_CACHE_TIMEOUT=60, SSSD_NEGATIVE_CACHE_TIMEOUT=60)
+class SSSDModelTestCase(DBusCallsMixin, TestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        _SSSDPool._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ipa.test")
+        self.infopipe.add_user("asmith", 1002, "Alice", "Smith")
+        self.infopipe.add_group("admins", 2001, members=[1001, 1002])
+        self.infopipe.add_group("editors", 2002, members=[1001])
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(MemberResolver()._reset_instance)
+
+    def test_get_user(self):
+        # FindByID, GetAll, GetUserGroups, then FindByName and GetAll per group
+        with self.assertNumDBusCalls(7):
+            user = User.objects.get(scim_id="1001")
+        self.assertEqual(user.scim_username, "jdoe")
+        self.assertEqual(
+            sorted(g.scim_display_name for g in user.scim_groups.all()),
+            ["admins", "editors"],
+        )
+
+    def test_get_group(self):
+        # FindByID, GetAll, UpdateMemberList, Get, then GetAll per member
+        with self.assertNumDBusCalls(6):
+            group = Group.objects.get(scim_id="2001")
+        self.assertEqual(
+            sorted(u.scim_username for u in group.user_set.all()), ["asmith", "jdoe"]
+        )
+
+    @override_settings(SCIM_STREAMING=True)
+    def test_get_group_streaming(self):
+        """The members are converted when they are iterated."""
+        with self.assertNumDBusCalls(6):
+            group = Group.objects.get(scim_id="2001")
+        self.assertIsInstance(group.user_set.all(), LazyUserList)
+        self.assertEqual(len(group.user_set.all()), 2)
+        # The users read with the members are cached
+        with self.assertNumDBusCalls(0):
+            members = [u.scim_username for u in group.user_set.all()]
+        self.assertEqual(sorted(members), ["asmith", "jdoe"])
+
+    def test_identity_map(self):
+        """A user or group is fetched once per request."""
+        with identity_map_scope():
+            User.objects.get(scim_id="1001")
+            IdentityCache().clear()
+            with self.assertNumDBusCalls(0):
+                user = User.objects.get(scim_username="jdoe")
+            self.assertEqual(user.scim_id, "1001")
+            # jdoe and the admins group are reused from the identity map
+            with self.assertNumDBusCalls(0, member="FindByName"):
+                group = Group.objects.get(scim_id="2001")
+        self.assertIn(user, group.user_set.all())
+
+    def test_identity_map_scope(self):
+        with identity_map_scope():
+            User.objects.get(scim_id="1001")
+        IdentityCache().clear()
+        with identity_map_scope():
+            # the object paths are known, no FindByID and FindByName
+            with self.assertNumDBusCalls(4):
+                User.objects.get(scim_id="1001")
+
+    def test_get_user_without_groups(self):
+        """The groups are not retrieved when they are not returned."""
+        projection = Projection(excluded_attributes="groups")
+        # FindByID and GetAll
+        with self.assertNumDBusCalls(2):
+            user = User.objects.get(scim_id="1001", projection=projection)
+        self.assertEqual(user.scim_username, "jdoe")
+        self.assertEqual(user.scim_groups.all(), [])
+
+    def test_get_group_without_members(self):
+        """The members are not retrieved when they are not returned."""
+        projection = Projection(attributes="displayName")
+        # FindByID and GetAll
+        with self.assertNumDBusCalls(2):
+            group = Group.objects.get(scim_id="2001", projection=projection)
+        self.assertEqual(group.scim_display_name, "admins")
+        self.assertEqual(group.user_set.all(), [])
+
+    def test_identity_map_projection(self):
+        """A user fetched without its groups is fetched again with them."""
+        with identity_map_scope():
+            User.objects.get(scim_id="1001", projection=Projection(attributes="id"))
+            user = User.objects.get(scim_id="1001")
+        self.assertEqual(len(user.scim_groups.all()), 2)
+
+    def test_user_listing(self):
+        """Only the users of the requested page are read from SSSD."""
+        for uid in range(3010, 3000, -1):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        projection = Projection(excluded_attributes="groups")
+        with self.assertNumDBusCalls(1, member="ListByName"):
+            listing = User.objects.listing(projection=projection)
+        self.assertEqual(len(listing), 12)
+        # GetAll per user, the object paths are known from the enumeration
+        with self.assertNumDBusCalls(2):
+            users = listing[2:4]
+        self.assertEqual([u.scim_username for u in users], ["user3001", "user3002"])
+        self.assertEqual(len(list(listing)), 12)
+        # The enumeration is reused by the next pages
+        with self.assertNumDBusCalls(0):
+            User.objects.listing(projection=projection)
+
+    def test_user_listing_local_first(self):
+        User.objects.create_user("admin", "admin@ipa.test")
+        User.objects.create_user("jdoe", "jdoe@ipa.test")
+        listing = User.objects.listing()
+        self.assertEqual(len(listing), 4)
+        # The SSSD user with the name of a local user is skipped
+        self.assertEqual([u.scim_username for u in listing[:3]], ["admin", "jdoe"])
+        self.assertEqual([u.scim_username for u in listing[3:]], ["asmith"])
+
+    def test_user_listing_mirrored_local(self):
+        """A local user mirrored from SSSD is listed once, in its place."""
+        User.objects.create_user("admin", "admin@ipa.test")
+        User.objects.create_user("jdoe", "jdoe@ipa.test")
+        DirectoryEntry.objects.create(kind="user", name="jdoe", number=1001)
+        listing = User.objects.listing()
+        self.assertEqual(len(listing), 3)
+        users = listing[:3]
+        self.assertEqual([u.scim_username for u in users], ["admin", "jdoe", "asmith"])
+        self.assertIsNotNone(users[1].pk)
+        self.assertEqual(len(list(listing)), 3)
+
+    def test_group_listing(self):
+        listing = Group.objects.listing()
+        self.assertEqual(len(listing), 2)
+        self.assertEqual(
+            [g.scim_display_name for g in listing[1:]],
+            ["editors"],
+        )
+        self.assertEqual(len(listing[1].user_set.all()), 1)
+
+    def test_get_user_record(self):
+        # Same lookups as the model
+        with self.assertNumDBusCalls(7):
+            user = User.objects.get(scim_id="1001", records=True)
+        self.assertIsInstance(user, UserRecord)
+        self.assertEqual(user.name, "jdoe")
+        self.assertEqual(sorted(g.name for g in user.groups), ["admins", "editors"])
+
+    def test_group_listing_records(self):
+        listing = Group.objects.listing(records=True)
+        groups = listing[:]
+        self.assertTrue(all(isinstance(g, GroupRecord) for g in groups))
+        self.assertEqual([g.name for g in groups], ["admins", "editors"])
+        self.assertEqual(sorted(u.name for u in groups[0].members), ["asmith", "jdoe"])
+
+    def test_record_serializer(self):
+        """The records are serialized like the models by their adapters."""
+        for query in ("", "?attributes=userName,groups", "?excludedAttributes=name"):
+            request = RequestFactory().get("/scim/v2/Users/1001" + query)
+            model = User.objects.get(scim_id="1001")
+            record = User.objects.get(scim_id="1001", records=True)
+            serializer = RecordSerializer(request)
+            self.assertEqual(
+                serializer.to_dict(record),
+                SCIMUser(model, request=request).to_dict(),
+            )
+            self.assertEqual(
+                serializer.location(record), SCIMUser(model, request=request).location
+            )
+        for query in ("", "?attributes=members.display"):
+            request = RequestFactory().get("/scim/v2/Groups/2001" + query)
+            model = Group.objects.get(scim_id="2001")
+            record = Group.objects.get(scim_id="2001", records=True)
+            self.assertEqual(
+                RecordSerializer(request).to_dict(record),
+                SCIMGroup(model, request=request).to_dict(),
+            )
+
+
+class ServiceProviderConfigTestCase(SimpleTestCase):
+    @override_settings(SCIM_MAX_RESULTS=100)
+    def test_page_size(self):
+        """The page size advertised is the one applied without count."""
+        request = RequestFactory().get("/scim/v2/Users")
+        self.assertEqual(UsersView()._page(request), (1, 100))
+        pagination = ServiceProviderConfig(request).to_dict()["pagination"]
+        self.assertEqual(pagination["defaultPageSize"], 100)
+        self.assertEqual(pagination["maxPageSize"], 100)
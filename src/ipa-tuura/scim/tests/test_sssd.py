@@ -0,0 +1,315 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from scim.sssd import (
+    _SSSD,
+    DBUS_PROPERTY_IF,
+    IdentityCache,
+    LRUCache,
+    MemberResolver,
+    SSSDNotFoundException,
+    SSSDUnavailableException,
+    _IdentityCache,
+    _SSSDPool,
+)
+from scim.tests.fakes import FakeInfopipe
+
+
+@override_settings(
+    SSSD_CACHE_TIMEOUT=60,
+    SSSD_NEGATIVE_CACHE_TIMEOUT=60,
+    SSSD_MEMBER_REFRESH_INTERVAL=60,
+)
+class SSSDTestCase(SimpleTestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ipa.test")
+        self.infopipe.add_user("asmith", 1002, "Alice", "Smith", lock="TRUE")
+        self.infopipe.add_group("admins", 2001, members=[1001, 1002])
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(MemberResolver()._reset_instance)
+        self.sssd = _SSSD()
+        self.infopipe.reset()
+
+    def test_find_user_by_name(self):
+        user = self.sssd.find_user_by_name("jdoe", retrieve_groups=True)
+        self.assertEqual(user.id, 1001)
+        self.assertEqual(user.username, "jdoe")
+        self.assertEqual(user.first_name, "John")
+        self.assertEqual(user.last_name, "Doe")
+        self.assertEqual(user.mail, ["jdoe@ipa.test"])
+        self.assertTrue(user.active)
+        self.assertEqual(user.groups, {"admins"})
+
+    def test_find_user_locked(self):
+        user = self.sssd.find_user_by_id(1002)
+        self.assertFalse(user.active)
+
+    def test_find_user_not_found(self):
+        with self.assertRaises(SSSDNotFoundException):
+            self.sssd.find_user_by_name("unknown")
+
+    def test_find_group_with_members(self):
+        group = self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(group.id, 2001)
+        self.assertEqual(sorted(group.members), ["asmith", "jdoe"])
+
+    def test_group_members_cached(self):
+        """The members already in the identity cache are not read again."""
+        self.sssd.find_user_by_name("jdoe")
+        self.infopipe.reset()
+        group = self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(sorted(group.members), ["asmith", "jdoe"])
+        # the group itself and asmith
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF, "GetAll"), 2)
+        self.infopipe.reset()
+        self.sssd.find_user_by_name("asmith")
+        self.assertEqual(self.infopipe.messages, [])
+
+    @override_settings(SSSD_MEMBER_WORKERS=2, SSSD_MEMBER_BATCH_SIZE=10)
+    def test_group_members_in_batches(self):
+        MemberResolver()._reset_instance()
+        for uid in range(3000, 3095):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        self.infopipe.add_group("staff", 4000, members=range(3000, 3095))
+        group = self.sssd.find_group_by_name("staff", retrieve_members=True)
+        self.assertEqual(
+            group.members, ["user{}".format(uid) for uid in range(3000, 3095)]
+        )
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF, "GetAll"), 96)
+
+    @override_settings(SSSD_MEMBER_TIMEOUT=0)
+    def test_group_members_timeout(self):
+        MemberResolver()._reset_instance()
+        with self.assertRaises(SSSDUnavailableException):
+            self.sssd.find_group_by_name("admins", retrieve_members=True)
+
+    @override_settings(SSSD_MEMBER_REFRESH_INTERVAL=60)
+    def test_member_refresh_throttled(self):
+        """A member list refreshed recently is not refreshed again."""
+        _IdentityCache._instance = None
+        self.sssd.find_group_by_name("admins", retrieve_members=True)
+        IdentityCache()._entries.clear()
+        self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(self.infopipe.count(member="UpdateMemberList"), 1)
+        # ipa-tuura changed the members
+        IdentityCache().invalidate_groups()
+        self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(self.infopipe.count(member="UpdateMemberList"), 2)
+
+    @override_settings(SSSD_MEMBER_REFRESH_INTERVAL=0)
+    def test_member_refresh_always(self):
+        _IdentityCache._instance = None
+        for _ in range(2):
+            self.sssd.find_group_by_name("admins", retrieve_members=True)
+            IdentityCache()._entries.clear()
+        self.assertEqual(self.infopipe.count(member="UpdateMemberList"), 2)
+
+    def test_user_properties_single_round_trip(self):
+        """A user lookup reads all its properties with one message."""
+        self.sssd.find_user_by_name("jdoe")
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF), 1)
+        self.assertEqual(len(self.infopipe.messages), 2)
+
+    def test_group_properties_single_round_trip(self):
+        """A group lookup reads all its properties with one message."""
+        self.sssd.find_group_by_id(2001)
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF), 1)
+        self.assertEqual(len(self.infopipe.messages), 2)
+
+    def test_cached_user_lookup(self):
+        """A repeated lookup is served by the identity cache."""
+        self.sssd.find_user_by_name("jdoe")
+        self.infopipe.reset()
+        self.assertEqual(self.sssd.find_user_by_name("jdoe").id, 1001)
+        self.assertEqual(self.sssd.find_user_by_id(1001).username, "jdoe")
+        self.assertEqual(self.infopipe.messages, [])
+        self.assertEqual(IdentityCache().stats["hits"], 2)
+
+    def test_cached_user_without_groups(self):
+        """A user cached without its groups is read again with the groups."""
+        self.sssd.find_user_by_name("jdoe")
+        user = self.sssd.find_user_by_name("jdoe", retrieve_groups=True)
+        self.assertEqual(user.groups, {"admins"})
+        self.infopipe.reset()
+        self.sssd.find_user_by_name("jdoe")
+        self.assertEqual(self.infopipe.messages, [])
+
+    def test_invalidate_user(self):
+        self.sssd.find_user_by_name("jdoe")
+        IdentityCache().invalidate_user("jdoe")
+        self.infopipe.reset()
+        self.sssd.find_user_by_id(1001)
+        self.assertEqual(len(self.infopipe.messages), 2)
+
+    def test_invalidate_groups(self):
+        self.sssd.find_group_by_name("admins", retrieve_members=True)
+        IdentityCache().invalidate_groups()
+        self.infopipe.reset()
+        self.sssd.find_group_by_id(2001, retrieve_members=True)
+        self.assertNotEqual(self.infopipe.messages, [])
+
+    def test_missing_user_lookup(self):
+        """A repeated lookup of an unknown user is not sent to SSSD."""
+        for _ in range(3):
+            with self.assertRaises(SSSDNotFoundException):
+                self.sssd.find_user_by_name("newuser")
+        self.assertEqual(len(self.infopipe.messages), 1)
+
+    def test_missing_user_added(self):
+        """A user added after a not found lookup is visible immediately."""
+        with self.assertRaises(SSSDNotFoundException):
+            self.sssd.find_user_by_name("newuser")
+        self.infopipe.add_user("newuser", 1003)
+        IdentityCache().invalidate_user("newuser")
+        self.assertEqual(self.sssd.find_user_by_name("newuser").id, 1003)
+
+    def test_missing_user_by_id_added(self):
+        with self.assertRaises(SSSDNotFoundException):
+            self.sssd.find_user_by_id(1003)
+        self.infopipe.add_user("newuser", 1003)
+        IdentityCache().invalidate_missing_users()
+        self.assertEqual(self.sssd.find_user_by_id(1003).username, "newuser")
+
+    def test_object_path_index(self):
+        """A lookup by a known name skips FindByName and proxy creation."""
+        self.sssd.find_group_by_name("admins", retrieve_members=True)
+        IdentityCache().clear()
+        self.infopipe.reset()
+        self.sssd.find_user_by_name("jdoe")
+        self.assertEqual(self.infopipe.count(member="FindByName"), 0)
+        self.assertEqual(self.infopipe.proxies, 0)
+
+    def test_object_path_index_stale(self):
+        """A user re-created with another id is looked up again."""
+        self.sssd.find_user_by_name("jdoe")
+        IdentityCache().clear()
+        self.infopipe.remove_user(1001)
+        self.infopipe.add_user("jdoe", 1005)
+        self.assertEqual(self.sssd.find_user_by_name("jdoe").id, 1005)
+
+    def test_list_user_ids(self):
+        self.infopipe.add_user("bwayne", 1000)
+        self.assertEqual(self.sssd.list_user_ids(), [1000, 1001, 1002])
+        self.assertEqual(len(self.sssd.list_user_ids(limit=1)), 3)
+        IdentityCache().invalidate_listing("user")
+        self.assertEqual(self.sssd.list_user_ids(limit=1), [1001])
+        # The object paths of the users are known
+        self.infopipe.reset()
+        self.sssd.find_user_by_id("1001")
+        self.assertEqual(self.infopipe.count(member="FindByID"), 0)
+
+    def test_list_group_ids(self):
+        self.assertEqual(self.sssd.list_group_ids(), [2001])
+
+    def test_reconnect_after_restart(self):
+        """A restart of sssd_ifp is detected and the caches are flushed."""
+        self.sssd.find_user_by_name("jdoe")
+        self.infopipe.restart()
+        self.infopipe.users[1001]["extraAttributes"]["sn"] = ["Smith"]
+        with self.assertLogs("scim.sssd", "INFO") as logs:
+            self.assertEqual(self.sssd.find_user_by_name("asmith").id, 1002)
+        self.assertIn("SSSD infopipe restarted", logs.output[-1])
+        self.assertEqual(self.sssd.find_user_by_name("jdoe").last_name, "Smith")
+
+    @override_settings(SSSD_RECONNECT_TIMEOUT=0.2)
+    def test_reconnect_unavailable(self):
+        """A stopped sssd_ifp is reported as unavailable, not as not found."""
+        self.infopipe.stop()
+        with self.assertRaises(SSSDUnavailableException):
+            self.sssd.find_user_by_name("jdoe")
+        self.assertFalse(IdentityCache().is_missing("user", "name", "jdoe"))
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_eviction(self):
+        cache = LRUCache(2, 60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    def test_expiration(self):
+        cache = LRUCache(2, 60)
+        with mock.patch("scim.sssd.time.monotonic", return_value=1000):
+            cache.set("a", 1)
+        with mock.patch("scim.sssd.time.monotonic", return_value=1061):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats["misses"], 1)
+
+    def test_age(self):
+        cache = LRUCache(2, 60)
+        with mock.patch("scim.sssd.time.monotonic", return_value=1000):
+            cache.set("a", 1)
+        with mock.patch("scim.sssd.time.monotonic", return_value=1010):
+            self.assertEqual(cache.age("a"), 10)
+        self.assertIsNone(cache.age("b"))
+
+
+@override_settings(SSSD_POOL_SIZE=2)
+class SSSDPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        self.infopipe = FakeInfopipe(latency=0.001)
+        for uid in range(1000, 1050):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Read the cache settings before the threads hold the clients
+        IdentityCache()
+        self.pool = _SSSDPool()
+
+    def test_parallel_lookups(self):
+        """Parallel lookups share at most SSSD_POOL_SIZE clients."""
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            users = list(executor.map(self.pool.find_user_by_id, range(1000, 1050)))
+        self.assertEqual(
+            [u.username for u in users],
+            ["user{}".format(uid) for uid in range(1000, 1050)],
+        )
+        stats = self.pool.stats
+        self.assertEqual(stats["created"], 2)
+        self.assertEqual(stats["idle"], 2)
+        self.assertEqual(stats["checkouts"], 50)
+        self.assertGreater(stats["waits"], 0)
+
+    def test_nested_checkout(self):
+        """A thread holding a client reuses it."""
+        with self.pool.client() as client:
+            with self.pool.client() as nested:
+                self.assertIs(client, nested)
+            self.pool.find_user_by_id(1000)
+        self.assertEqual(self.pool.stats["created"], 1)
+
+    @override_settings(SSSD_POOL_TIMEOUT=0.1)
+    def test_checkout_timeout(self):
+        self.pool = _SSSDPool()
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with self.pool.client():
+                held.set()
+                release.wait()
+
+        threads = [threading.Thread(target=hold) for _ in range(2)]
+        for thread in threads:
+            held.clear()
+            thread.start()
+            held.wait()
+        try:
+            with self.assertRaises(SSSDUnavailableException):
+                self.pool.find_user_by_id(1000)
+        finally:
+            release.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,127 @@
+import asyncio
+from unittest import mock, skipUnless
+
+from django.test import SimpleTestCase, override_settings
+from scim import sssd_async
+from scim.sssd import (
+    DBUS_PROPERTY_IF,
+    IdentityCache,
+    SSSDNotFoundException,
+    SSSDUnavailableException,
+    _IdentityCache,
+)
+from scim.sssd_async import _AsyncSSSD
+from scim.tests.fakes import FakeAsyncBus, FakeInfopipe
+
+
+@skipUnless(sssd_async.is_available(), "dbus-next is not installed")
+@override_settings(
+    SSSD_CACHE_TIMEOUT=60,
+    SSSD_NEGATIVE_CACHE_TIMEOUT=60,
+    SSSD_MEMBER_REFRESH_INTERVAL=60,
+)
+class AsyncSSSDTestCase(SimpleTestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ipa.test")
+        self.infopipe.add_user("asmith", 1002, "Alice", "Smith", lock="TRUE")
+        self.infopipe.add_group("admins", 2001, members=[1001, 1002])
+        patcher = mock.patch(
+            "scim.sssd_async.MessageBus",
+            side_effect=lambda **kwargs: FakeAsyncBus(self.infopipe),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sssd = _AsyncSSSD()
+
+    async def test_find_user_by_name(self):
+        user = await self.sssd.find_user_by_name("jdoe", retrieve_groups=True)
+        self.assertEqual(user.id, 1001)
+        self.assertEqual(user.username, "jdoe")
+        self.assertEqual(user.first_name, "John")
+        self.assertEqual(user.last_name, "Doe")
+        self.assertEqual(user.mail, ["jdoe@ipa.test"])
+        self.assertTrue(user.active)
+        self.assertEqual(user.groups, {"admins"})
+
+    async def test_find_user_locked(self):
+        user = await self.sssd.find_user_by_id("1002")
+        self.assertFalse(user.active)
+
+    async def test_find_user_not_found(self):
+        with self.assertRaises(SSSDNotFoundException):
+            await self.sssd.find_user_by_name("unknown")
+        self.assertTrue(IdentityCache().is_missing("user", "name", "unknown"))
+
+    async def test_find_group_with_members(self):
+        group = await self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(group.id, 2001)
+        self.assertEqual(sorted(group.members), ["asmith", "jdoe"])
+
+    async def test_group_members_cached(self):
+        """The members already in the identity cache are not read again."""
+        await self.sssd.find_user_by_name("jdoe")
+        self.infopipe.reset()
+        group = await self.sssd.find_group_by_name("admins", retrieve_members=True)
+        self.assertEqual(sorted(group.members), ["asmith", "jdoe"])
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF, "GetAll"), 2)
+
+    @override_settings(SSSD_MEMBER_TIMEOUT=0.05)
+    async def test_group_members_timeout(self):
+        self.infopipe.latency = 0.1
+        with self.assertRaises(SSSDUnavailableException):
+            await self.sssd.find_group_by_name("admins", retrieve_members=True)
+
+    async def test_find_user_groups(self):
+        groups = await self.sssd.find_user_groups("jdoe")
+        self.assertEqual([g.name for g in groups], ["admins"])
+
+    async def test_shared_identity_cache(self):
+        """The asyncio and the threaded clients share the identity cache."""
+        await self.sssd.find_user_by_name("jdoe")
+        self.infopipe.reset()
+        self.assertEqual(IdentityCache().get_user_by_id(1001).username, "jdoe")
+        await self.sssd.find_user_by_id(1001)
+        self.assertEqual(self.infopipe.messages, [])
+
+    async def test_concurrent_lookups(self):
+        """Lookups issued together wait for their replies at the same time."""
+        for uid in range(1100, 1200):
+            self.infopipe.add_user("user{}".format(uid), uid)
+        self.infopipe.latency = 0.01
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        users = await asyncio.gather(
+            *(self.sssd.find_user_by_id(uid) for uid in range(1100, 1200))
+        )
+        self.assertEqual(users[-1].username, "user1199")
+        # 100 sequential lookups would take at least 100 * 2 * 10ms
+        self.assertLess(loop.time() - start, 1)
+        self.assertEqual(self.infopipe.count(DBUS_PROPERTY_IF), 100)
+
+    @override_settings(SSSD_ASYNC_MAX_CALLS=1)
+    async def test_max_calls(self):
+        sssd = _AsyncSSSD()
+        users = await asyncio.gather(
+            sssd.find_user_by_id(1001), sssd.find_user_by_id(1002)
+        )
+        self.assertEqual([u.username for u in users], ["jdoe", "asmith"])
+
+    async def test_reconnect_after_restart(self):
+        """A restart of sssd_ifp is detected and the caches are flushed."""
+        await self.sssd.find_user_by_name("jdoe")
+        self.infopipe.restart()
+        self.infopipe.users[1001]["extraAttributes"]["sn"] = ["Smith"]
+        self.assertEqual((await self.sssd.find_user_by_name("asmith")).id, 1002)
+        user = await self.sssd.find_user_by_name("jdoe")
+        self.assertEqual(user.last_name, "Smith")
+
+    @override_settings(SSSD_RECONNECT_TIMEOUT=0.2)
+    async def test_reconnect_unavailable(self):
+        """A stopped sssd_ifp is reported as unavailable, not as not found."""
+        await self.sssd.find_user_by_name("asmith")
+        self.infopipe.stop()
+        with self.assertRaises(SSSDUnavailableException):
+            await self.sssd.find_user_by_name("jdoe")
+        self.assertFalse(IdentityCache().is_missing("user", "name", "jdoe"))
@@ -0,0 +1,185 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from scim.directory import QueryPlan, _DirectoryIndex
+from scim.models import DirectoryEntry, DirectoryMember, DirectorySyncState
+from scim.sssd import SSSDNotFoundException
+from scim.sync import DirectorySync, mark_stale
+from scim.tests.fakes import FakeDirectorySource
+
+
+@override_settings(DIRECTORY_SYNC_PAGE_SIZE=2, DIRECTORY_SYNC_RECONCILE_INTERVAL=3600)
+class DirectorySyncTestCase(TestCase):
+    def setUp(self):
+        self.source = FakeDirectorySource(page_size=2)
+        self.populate(self.source)
+        self.sync = DirectorySync(self.source)
+
+    def populate(self, source):
+        source.add_user("jdoe", 1001, "John", "Doe", ["jdoe@ipa.test"])
+        source.add_user("asmith", 1002, "Alice", "Smith", ["asmith@ipa.test"])
+        source.add_user("bwayne", 1003, "Bruce", "Wayne", active=False)
+        source.add_group("admins", 2001, ["jdoe"])
+        source.add_group("staff", 2002, ["jdoe", "asmith"])
+
+    def entry(self, kind, name):
+        return DirectoryEntry.objects.get(kind=kind, name=name)
+
+    def members(self, name):
+        return sorted(
+            DirectoryMember.objects.filter(group__name=name).values_list(
+                "username", flat=True
+            )
+        )
+
+    def test_full_load(self):
+        users, groups = self.sync.run()
+        self.assertEqual((users.fetched, users.written, users.deleted), (3, 3, 0))
+        self.assertEqual((groups.fetched, groups.written), (2, 2))
+
+        jdoe = self.entry("user", "jdoe")
+        self.assertEqual(jdoe.number, 1001)
+        self.assertEqual(jdoe.attrs["mail"], ["jdoe@ipa.test"])
+        self.assertFalse(self.entry("user", "bwayne").attrs["active"])
+        self.assertEqual(self.members("staff"), ["asmith", "jdoe"])
+
+        state = DirectorySyncState.objects.get(kind="user")
+        self.assertTrue(state.complete)
+        self.assertFalse(state.loading)
+        self.assertEqual(state.generation, 1)
+        self.assertEqual(state.cursor, "00000000000003Z")
+
+    def test_refresh_reads_the_changes(self):
+        self.sync.run()
+        self.source.add_user("jdoe", 1001, "Johnny", "Doe", ["jdoe@ipa.test"])
+        self.source.add_user("ckent", 1004, "Clark", "Kent")
+        self.source.remove("user", "asmith")
+        self.source.add_group("staff", 2002, ["jdoe", "ckent"])
+
+        self.source.fetched = 0
+        users, groups = self.sync.run()
+        # The changed entries, and the last entry of the previous run
+        self.assertEqual(users.fetched, 3)
+        self.assertEqual((users.written, users.deleted), (2, 1))
+        self.assertEqual((groups.fetched, groups.written), (1, 1))
+        self.assertEqual(self.entry("user", "jdoe").attrs["givenname"], "Johnny")
+        self.assertEqual(self.entry("user", "ckent").number, 1004)
+        self.assertFalse(DirectoryEntry.objects.filter(name="asmith").exists())
+        self.assertEqual(self.members("staff"), ["ckent", "jdoe"])
+        # The names are not listed before the reconciliation interval
+        self.assertEqual(self.source.listings, 0)
+
+    def test_refresh_without_changes(self):
+        self.sync.run()
+        users, groups = self.sync.run()
+        self.assertEqual((users.written, users.deleted), (0, 0))
+        self.assertEqual((groups.written, groups.deleted), (0, 0))
+
+    @override_settings(DIRECTORY_SYNC_RECONCILE_INTERVAL=0)
+    def test_reconcile_finds_the_removed_entries(self):
+        sync = DirectorySync(self.source)
+        sync.run()
+        # Removed without tombstone, like from an LDAP server
+        del self.source.entries["user"]["bwayne"]
+        users, _ = sync.run()
+        self.assertEqual(users.deleted, 1)
+        self.assertFalse(DirectoryEntry.objects.filter(name="bwayne").exists())
+
+    def test_interrupted_load_is_resumed(self):
+        source = FakeDirectorySource(incremental=False, page_size=2)
+        self.populate(source)
+        sync = DirectorySync(source)
+        source.fail_after = 1
+        with self.assertRaises(RuntimeError):
+            sync.run()
+        state = DirectorySyncState.objects.get(kind="user")
+        self.assertTrue(state.loading)
+        self.assertEqual(state.position, "bwayne")
+        self.assertEqual(DirectoryEntry.objects.count(), 2)
+
+        source.fail_after = None
+        source.fetched = 0
+        users, _ = sync.run()
+        # Only the last page is read again
+        self.assertEqual(users.fetched, 1)
+        self.assertEqual(DirectoryEntry.objects.filter(kind="user").count(), 3)
+        state.refresh_from_db()
+        self.assertTrue(state.complete)
+        self.assertEqual(state.generation, 1)
+
+    def test_full_load_removes_the_missing_entries(self):
+        self.sync.run()
+        del self.source.entries["group"]["admins"]
+        _, groups = self.sync.run(full=True)
+        self.assertEqual(groups.deleted, 1)
+        self.assertEqual(DirectorySyncState.objects.get(kind="group").generation, 2)
+        self.assertFalse(DirectoryMember.objects.filter(group__name="admins").exists())
+
+    def test_sweep_without_change_cursor(self):
+        source = FakeDirectorySource(incremental=False, page_size=2)
+        self.populate(source)
+        sync = DirectorySync(source)
+        sync.run()
+        source.add_user("ckent", 1004, "Clark", "Kent")
+        source.add_user("jdoe", 1001, "Johnny", "Doe", ["jdoe@ipa.test"])
+
+        source.fetched = 0
+        users, _ = sync.run()
+        # The new user, and the first page of the sweep
+        self.assertEqual(users.fetched, 3)
+        self.assertEqual(users.written, 1)
+        self.assertEqual(DirectorySyncState.objects.get(kind="user").cursor, "bwayne")
+
+        users, _ = sync.run()
+        # jdoe is reached by the second page, and the sweep starts again
+        self.assertEqual(users.written, 1)
+        self.assertEqual(self.entry("user", "jdoe").attrs["givenname"], "Johnny")
+        self.assertEqual(DirectorySyncState.objects.get(kind="user").cursor, "")
+
+    def test_mark_stale(self):
+        # The mirror is not used yet
+        mark_stale("user", "jdoe")
+        self.assertFalse(DirectoryEntry.objects.exists())
+
+        source = FakeDirectorySource(incremental=False, page_size=2)
+        self.populate(source)
+        sync = DirectorySync(source)
+        sync.run()
+        source.add_user("ckent", 1004, "Clark", "Kent")
+        source.add_user("asmith", 1002, "Alicia", "Smith")
+        source.remove("user", "jdoe")
+        for name in ("ckent", "asmith", "jdoe"):
+            mark_stale("user", name)
+
+        with override_settings(DIRECTORY_SYNC_PAGE_SIZE=1):
+            users, _ = DirectorySync(source).run()
+        self.assertEqual((users.written, users.deleted), (2, 1))
+        self.assertEqual(self.entry("user", "asmith").attrs["givenname"], "Alicia")
+        self.assertEqual(self.entry("user", "ckent").number, 1004)
+        self.assertFalse(DirectoryEntry.objects.filter(stale=True).exists())
+
+    def test_missing_number_mapped_by_sssd(self):
+        self.source.add_user("aduser", None, "AD", "User")
+        sssd_if = mock.Mock()
+        sssd_if.find_user_by_name.return_value = mock.Mock(id=1234567)
+        DirectorySync(self.source, sssd_if).run()
+        self.assertEqual(self.entry("user", "aduser").number, 1234567)
+        sssd_if.find_user_by_name.assert_called_once_with("aduser")
+
+        # Not mapped by SSSD
+        self.source.add_user("unknown", None)
+        sssd_if.find_user_by_name.side_effect = SSSDNotFoundException()
+        DirectorySync(self.source, sssd_if).run()
+        self.assertIsNone(self.entry("user", "unknown").number)
+
+    def test_directory_index_loads_the_mirror(self):
+        self.sync.run()
+        sssd_if = mock.Mock()
+        index = _DirectoryIndex()
+        index.load(sssd_if)
+        sssd_if.list_user_ids.assert_not_called()
+        self.assertEqual(
+            index.search(QueryPlan("user", 'groups.display eq "staff"')),
+            [1001, 1002],
+        )
+        self.assertEqual(index.search(QueryPlan("user", "active eq false")), [1003])
@@ -0,0 +1,265 @@
+import json
+from unittest import mock
+
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from scim.directory import (
+    DirectoryIndex,
+    DirectoryIndexUnavailableException,
+    QueryPlan,
+    _DirectoryIndex,
+)
+from scim.models import DirectoryEntry, User
+from scim.sssd import _IdentityCache, _SSSDPool
+from scim.tests.fakes import DBusCallsMixin, FakeInfopipe
+from scim.utils import (
+    Cursor,
+    CursorError,
+    JSONArray,
+    JSONStream,
+    Projection,
+    SCIMGroupFilterQuery,
+    SCIMUserFilterQuery,
+    Sorting,
+)
+
+USER = {
+    "schemas": ["urn:ietf:params:scim:schemas:core:2.0:User"],
+    "id": "1001",
+    "userName": "jdoe",
+    "name": {"givenName": "John", "familyName": "Doe"},
+    "emails": [{"value": "jdoe@ipa.test", "primary": True}],
+    "groups": [{"value": "2001", "display": "admins"}],
+}
+
+
+class ProjectionTestCase(SimpleTestCase):
+    def test_no_projection(self):
+        projection = Projection()
+        self.assertTrue(projection.includes("groups"))
+        self.assertEqual(projection.apply(USER), USER)
+
+    def test_attributes(self):
+        projection = Projection("userName,name.givenName")
+        self.assertFalse(projection.includes("groups"))
+        self.assertTrue(projection.includes("name"))
+        self.assertEqual(
+            projection.apply(USER),
+            {
+                "schemas": USER["schemas"],
+                "id": "1001",
+                "userName": "jdoe",
+                "name": {"givenName": "John"},
+            },
+        )
+
+    def test_excluded_attributes(self):
+        projection = Projection(excluded_attributes="Groups,emails.primary")
+        self.assertFalse(projection.includes("groups"))
+        self.assertTrue(projection.includes("emails"))
+        d = projection.apply(USER)
+        self.assertNotIn("groups", d)
+        self.assertEqual(d["emails"], [{"value": "jdoe@ipa.test"}])
+
+    def test_always_returned(self):
+        projection = Projection(excluded_attributes="id,schemas")
+        self.assertEqual(projection.apply(USER), USER)
+
+    def test_schema_urn(self):
+        projection = Projection("urn:ietf:params:scim:schemas:core:2.0:User:userName")
+        self.assertEqual(set(projection.apply(USER)), {"schemas", "id", "userName"})
+
+    def test_from_request(self):
+        request = RequestFactory().get("/scim/v2/Users/1001?attributes=userName")
+        self.assertFalse(Projection.from_request(request).includes("groups"))
+        self.assertTrue(Projection.from_request(None).includes("groups"))
+
+    def test_from_search_request(self):
+        request = RequestFactory().post(
+            "/scim/v2/Users/.search",
+            data='{"excludedAttributes": ["groups"]}',
+            content_type="application/scim+json",
+        )
+        self.assertFalse(Projection.from_request(request).includes("groups"))
+
+
+class JSONStreamTestCase(SimpleTestCase):
+    def read(self, doc):
+        return b"".join(JSONStream(doc)).decode("utf-8")
+
+    def test_document(self):
+        members = JSONArray({"value": str(uid)} for uid in range(3))
+        doc = {
+            "id": "2001",
+            "meta": {"resourceType": "Group"},
+            "members": members,
+            "count": lambda: members.count,
+        }
+        expected = dict(doc, members=[{"value": "0"}, {"value": "1"}, {"value": "2"}])
+        expected["count"] = 3
+        self.assertEqual(self.read(doc), json.dumps(expected))
+        self.assertEqual(self.read({"Resources": JSONArray([])}), '{"Resources": []}')
+
+    def test_chunks(self):
+        doc = {"members": JSONArray("x" * 100 for _ in range(1000))}
+        with mock.patch.object(JSONStream, "CHUNK_SIZE", 1000):
+            chunks = list(JSONStream(doc))
+        self.assertEqual(len(chunks), 101)
+        self.assertTrue(all(len(chunk) < 1200 for chunk in chunks))
+        self.assertEqual(len(json.loads(b"".join(chunks))["members"]), 1000)
+
+    def test_projection(self):
+        projection = Projection(attributes="members.value")
+        doc = {"id": "2001", "members": JSONArray([{"value": "1", "display": "a"}])}
+        self.assertEqual(
+            self.read(projection.apply(doc)),
+            '{"id": "2001", "members": [{"value": "1"}]}',
+        )
+
+
+class SortingTestCase(SimpleTestCase):
+    def test_from_request(self):
+        request = RequestFactory().get(
+            "/scim/v2/Users?sortBy=urn:ietf:params:scim:schemas:core:2.0:User:"
+            "name.familyName&sortOrder=Descending"
+        )
+        sorting = Sorting.from_request(request)
+        self.assertEqual(sorting.sort_by, "name.familyname")
+        self.assertTrue(sorting.descending)
+        self.assertIsNone(Sorting.from_request(None).sort_by)
+
+    def test_from_search_request(self):
+        request = RequestFactory().post(
+            "/scim/v2/Groups/.search",
+            data='{"sortBy": "displayName"}',
+            content_type="application/scim+json",
+        )
+        sorting = Sorting.from_request(request)
+        self.assertEqual(sorting.sort_by, "displayname")
+        self.assertFalse(sorting.descending)
+
+    def test_invalid_sort_order(self):
+        with self.assertRaises(ValueError):
+            Sorting("userName", "random")
+
+
+class CursorTestCase(SimpleTestCase):
+    def test_encode_decode(self):
+        token = Cursor("username", True, 'emails co "x"', (False, "jdoe", 1001), 3)
+        cursor = Cursor.decode(token.encode(), "username", True, 'emails co "x"')
+        self.assertEqual(cursor.key, (False, "jdoe", 1001))
+        self.assertEqual(cursor.generation, 3)
+        self.assertIsNone(Cursor.decode("", "username", False).key)
+
+    def test_invalid_cursor(self):
+        token = Cursor("username", False, None, (False, "jdoe", 1001)).encode()
+        for token in ("random", "WzEsMV0", token[:-2]):
+            with self.assertRaises(CursorError):
+                Cursor.decode(token, "username", False)
+
+    def test_other_listing(self):
+        token = Cursor("username", False, None, (False, "jdoe", 1001)).encode()
+        with self.assertRaises(CursorError):
+            Cursor.decode(token, "username", True)
+        with self.assertRaises(CursorError):
+            Cursor.decode(token, "username", False, 'userName sw "j"')
+
+
+@override_settings(
+    DIRECTORY_INDEX_SSSD_ENUMERATION=True,
+    SSSD_CACHE_TIMEOUT=60,
+    SSSD_NEGATIVE_CACHE_TIMEOUT=60,
+)
+class SCIMFilterQueryTestCase(DBusCallsMixin, TestCase):
+    def setUp(self):
+        _IdentityCache._instance = None
+        _SSSDPool._instance = None
+        _DirectoryIndex._instance = None
+        self.infopipe = FakeInfopipe()
+        self.infopipe.add_user("jdoe", 1001, "John", "Doe", "jdoe@ipa.test")
+        self.infopipe.add_user("asmith", 1002, "Alice", "Smith", "asmith@sales.test")
+        self.infopipe.add_group("admins", 2001, members=[1001, 1002])
+        patcher = mock.patch("scim.sssd.dbus.SystemBus", return_value=self.infopipe)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_equality_search(self):
+        """A single equality is resolved by SSSD, without the index."""
+        users = SCIMUserFilterQuery.search('userName eq "jdoe"')
+        self.assertEqual([u.scim_id for u in users], ["1001"])
+        groups = SCIMGroupFilterQuery.search('id eq "2001"')
+        self.assertEqual([g.scim_display_name for g in groups], ["admins"])
+        self.assertIsNone(DirectoryIndex().loaded)
+
+    @override_settings(DIRECTORY_INDEX_SSSD_ENUMERATION=False)
+    def test_unsynchronized_directory(self):
+        """Without the mirror, only a single equality can be resolved."""
+        request = RequestFactory().get("/scim/v2/Users?sortBy=userName")
+        users = SCIMUserFilterQuery.search('userName eq "jdoe"', request)
+        self.assertEqual([u.scim_id for u in users], ["1001"])
+        with self.assertRaises(DirectoryIndexUnavailableException):
+            SCIMUserFilterQuery.search('userName sw "j"')
+        with self.assertRaises(DirectoryIndexUnavailableException):
+            SCIMUserFilterQuery.index_listing(None, request)
+        self.assertIsNone(DirectoryIndex().loaded)
+
+    def test_index_search(self):
+        users = SCIMUserFilterQuery.search(
+            'emails co "ipa.test" or name.givenName sw "A"'
+        )
+        self.assertEqual(len(users), 2)
+        # The results are converted from the index
+        with self.assertNumDBusCalls(0):
+            self.assertEqual([u.scim_username for u in users[0:2]], ["jdoe", "asmith"])
+        groups = SCIMGroupFilterQuery.search('members.value eq "1002"')
+        self.assertEqual(len(groups[0].user_set.all()), 2)
+
+    def test_search_local_and_mirrored(self):
+        """The local users are merged with the users of the index."""
+        self.infopipe.add_user("jsmith", 1003, "Jane", "Smith", "jsmith@ipa.test")
+        User.objects.create_user("jbrown", "jbrown@ipa.test")
+        User.objects.create_user("jdoe", "jdoe@ipa.test")
+        DirectoryEntry.objects.create(kind="user", name="jdoe", number=1001)
+        users = SCIMUserFilterQuery.search('userName sw "j"')
+        self.assertEqual(len(users), 3)
+        self.assertEqual(
+            [u.scim_username for u in users[0:3]], ["jbrown", "jdoe", "jsmith"]
+        )
+        self.assertIsNotNone(users[1].pk)
+        request = RequestFactory().get("/scim/v2/Users?sortBy=userName")
+        users = SCIMUserFilterQuery.search('userName sw "j"', request)
+        self.assertEqual(len(users), 3)
+        self.assertEqual(
+            [u.scim_username for u in users[0:3]], ["jbrown", "jdoe", "jsmith"]
+        )
+
+    def test_sorted_search(self):
+        request = RequestFactory().get(
+            "/scim/v2/Users?sortBy=name.familyName&sortOrder=descending"
+        )
+        users = SCIMUserFilterQuery.search('emails co "test"', request)
+        self.assertEqual([u.scim_username for u in users[0:2]], ["asmith", "jdoe"])
+        users = SCIMUserFilterQuery.search('userName eq "jdoe"', request)
+        self.assertEqual([u.scim_username for u in users[0:2]], ["jdoe"])
+
+        request = RequestFactory().get("/scim/v2/Users?sortBy=userName")
+        users = SCIMUserFilterQuery.index_listing(None, request)
+        self.assertEqual([u.scim_username for u in users[0:2]], ["asmith", "jdoe"])
+        request = RequestFactory().get("/scim/v2/Users?sortBy=emails")
+        with self.assertRaises(ValueError):
+            SCIMUserFilterQuery.index_listing(None, request)
+
+    def test_index_page(self):
+        self.infopipe.add_user("bwayne", 1003, "Bruce", "Wayne", "bwayne@ipa.test")
+        users, total, token = SCIMUserFilterQuery.index_page("", 2)
+        self.assertEqual(total, 3)
+        self.assertEqual([u.scim_username for u in users], ["asmith", "bwayne"])
+        users, total, token = SCIMUserFilterQuery.index_page(token, 2)
+        self.assertEqual([u.scim_username for u in users], ["jdoe"])
+        self.assertIsNone(token)
+
+        request = RequestFactory().get("/scim/v2/Users?sortBy=userName")
+        plan = QueryPlan("user", 'emails co "ipa.test"')
+        users, total, token = SCIMUserFilterQuery.index_page("", 1, plan, request)
+        self.assertEqual((users[0].scim_username, total), ("bwayne", 2))
+        with self.assertRaises(CursorError):
+            SCIMUserFilterQuery.index_page(token, 1, None, request)
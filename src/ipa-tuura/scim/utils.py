@@ -2,19 +2,465 @@
 # Copyright (C) 2024  FreeIPA Contributors see COPYING for license
 #
 
-from base64 import b64decode, b64encode
+import hashlib
+import json
+import logging
+from base64 import b64decode, b64encode, urlsafe_b64decode, urlsafe_b64encode
 
 import gssapi
-from django.db import NotSupportedError
+from django_scim import constants
 from django_scim.filters import GroupFilterQuery, UserFilterQuery
 from requests.auth import AuthBase
-from scim.models import SSSDGroupToGroupModel, SSSDUserToUserModel
+from scim.directory import DirectoryIndex, QueryPlan
+from scim.models import (
+    DirectoryListing,
+    SSSDGroupToGroupModel,
+    SSSDUserToUserModel,
+    current_identity_map,
+)
+from scim.records import SSSDGroupToGroupRecord, SSSDUserToUserRecord
 from scim.sssd import SSSD, SSSDNotFoundException
 
+logger = logging.getLogger(__name__)
 
-class SCIMUserFilterQuery(UserFilterQuery):
+
+def _request_parameters(request, *names):
+    """
+    Return the values of the query parameters, or of the body of a POST
+    /.search request, None for the missing ones.
+    """
+    params = {name: request.GET.get(name) for name in names}
+    if request.method == "POST" and request.path.endswith("/.search"):
+        try:
+            body = json.loads(request.body.decode(constants.ENCODING))
+            for name in names:
+                params[name] = body.get(name, params[name])
+        except (ValueError, AttributeError):
+            pass
+    return params
+
+
+class Projection:
+    """
+    Attributes requested with the attributes or excludedAttributes
+    parameters (RFC 7644, section 3.4.2.5).
+
+    The attribute names are case insensitive and may be prefixed with the
+    schema URN, or refer to a sub-attribute, like name.givenName.
+    """
+
+    # Attributes returned regardless of the parameters
+    ALWAYS_RETURNED = {"id", "schemas"}
+
+    def __init__(self, attributes=None, excluded_attributes=None):
+        self.attributes = self._parse(attributes)
+        self.excluded_attributes = self._parse(excluded_attributes)
+
+    @staticmethod
+    def _parse(names):
+        if not names:
+            return None
+        if isinstance(names, str):
+            names = names.split(",")
+        paths = set()
+        for name in names:
+            name = name.strip()
+            if name.lower().startswith("urn:"):
+                # Strip the schema URN, the attribute follows the last colon
+                name = name.rsplit(":", 1)[-1]
+            if name:
+                paths.add(tuple(name.lower().split(".", 1)))
+        return paths or None
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Return the projection requested with the query parameters, or the
+        body of a POST /.search request.
+        """
+        if request is None:
+            return cls()
+        projection = getattr(request, "_scim_projection", None)
+        if projection is not None:
+            return projection
+        params = _request_parameters(request, "attributes", "excludedAttributes")
+        projection = cls(params["attributes"], params["excludedAttributes"])
+        request._scim_projection = projection
+        return projection
+
+    def includes(self, name):
+        """
+        Return True if the attribute name, or one of its sub-attributes,
+        is returned.
+        """
+        name = name.lower()
+        if name in self.ALWAYS_RETURNED:
+            return True
+        if self.attributes is not None:
+            return any(path[0] == name for path in self.attributes)
+        if self.excluded_attributes is not None:
+            return (name,) not in self.excluded_attributes
+        return True
+
+    def _sub_attributes(self, name, paths):
+        return {path[1] for path in paths if path[0] == name and len(path) == 2}
+
+    def _project(self, value, keep=None, drop=None):
+        if isinstance(value, JSONArray):
+            return value.map(lambda v: self._project(v, keep, drop))
+        if isinstance(value, list):
+            return [self._project(v, keep, drop) for v in value]
+        if not isinstance(value, dict):
+            return value
+        return {
+            k: v
+            for k, v in value.items()
+            if (keep is None or k.lower() in keep)
+            and (drop is None or k.lower() not in drop)
+        }
+
+    def apply(self, d):
+        """
+        Return the SCIM resource d with only the requested attributes.
+        """
+        if self.attributes is None and self.excluded_attributes is None:
+            return d
+        result = {}
+        for key, value in d.items():
+            name = key.lower()
+            if name in self.ALWAYS_RETURNED:
+                result[key] = value
+            elif self.attributes is not None:
+                if (name,) in self.attributes:
+                    result[key] = value
+                elif self.includes(name):
+                    keep = self._sub_attributes(name, self.attributes)
+                    result[key] = self._project(value, keep=keep)
+            elif (name,) not in self.excluded_attributes:
+                drop = self._sub_attributes(name, self.excluded_attributes)
+                result[key] = self._project(value, drop=drop) if drop else value
+        return result
+
+
+class JSONArray:
+    """
+    Array of a JSONStream, whose items are produced and serialized one at
+    a time while the document is written.
+    """
+
+    def __init__(self, items):
+        """
+        :param items: iterable of the items, read once
+        """
+        self._items = items
+        # Number of items written so far
+        self.count = 0
+
+    def map(self, function):
+        """
+        Return the JSONArray of the items transformed by function.
+        """
+        return JSONArray(function(item) for item in self._items)
+
+    def __iter__(self):
+        for item in self._items:
+            self.count += 1
+            yield item
+
+
+class JSONStream:
+    """
+    JSON document written incrementally, as an iterator of bytes.
+
+    The JSONArray values are written one item at a time, and the callable
+    values are called when they are reached, for instance to write the
+    number of items of an array that precedes them. The other values are
+    serialized with json.dumps(). The chunks are about CHUNK_SIZE bytes,
+    so that the memory used does not depend on the size of the document.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, doc):
+        """
+        :param doc: the dict of the document
+        """
+        self.doc = doc
+
+    def __iter__(self):
+        parts = []
+        size = 0
+        for part in self._parts(self.doc):
+            parts.append(part)
+            size += len(part)
+            if size >= self.CHUNK_SIZE:
+                yield "".join(parts).encode("utf-8")
+                parts = []
+                size = 0
+        if parts:
+            yield "".join(parts).encode("utf-8")
+
+    def _parts(self, value):
+        if callable(value):
+            value = value()
+        if isinstance(value, JSONArray):
+            yield "["
+            for i, item in enumerate(value):
+                if i:
+                    yield ", "
+                yield from self._parts(item)
+            yield "]"
+        elif isinstance(value, dict) and any(
+            callable(v) or isinstance(v, (JSONArray, dict)) for v in value.values()
+        ):
+            yield "{"
+            for i, (key, item) in enumerate(value.items()):
+                yield (", " if i else "") + json.dumps(key) + ": "
+                yield from self._parts(item)
+            yield "}"
+        else:
+            yield json.dumps(value)
+
+
+class Sorting:
+    """
+    Order requested with the sortBy and sortOrder parameters (RFC 7644,
+    section 3.4.2.3).
+
+    The attribute name is case insensitive and may be prefixed with the
+    schema URN. The attributes that can be sorted are listed in
+    scim.directory.SORT_ATTRIBUTES.
+    """
+
+    def __init__(self, sort_by=None, sort_order=None):
+        """
+        :raises: ValueError if sortOrder is neither ascending nor descending
+        """
+        self.sort_by = None
+        if sort_by:
+            sort_by = sort_by.strip()
+            if sort_by.lower().startswith("urn:"):
+                sort_by = sort_by.rsplit(":", 1)[-1]
+            self.sort_by = sort_by.lower() or None
+        sort_order = (sort_order or "ascending").lower()
+        if sort_order not in ("ascending", "descending"):
+            raise ValueError("Invalid sortOrder {}".format(sort_order))
+        self.descending = sort_order == "descending"
+
+    @classmethod
+    def from_request(cls, request):
+        """
+        Return the order requested with the query parameters, or the body
+        of a POST /.search request.
+        """
+        if request is None:
+            return cls()
+        sorting = getattr(request, "_scim_sorting", None)
+        if sorting is not None:
+            return sorting
+        params = _request_parameters(request, "sortBy", "sortOrder")
+        sorting = cls(params["sortBy"], params["sortOrder"])
+        request._scim_sorting = sorting
+        return sorting
+
+
+class LocalFilterMixin:
+    """
+    Search the objects of the local database, with the SQL query built by
+    django_scim from attr_map.
+    """
+
+    @classmethod
+    def search_local(cls, plan, request=None):
+        """
+        Return the local objects matching the QueryPlan, none when the
+        filter uses attributes missing from attr_map, which the SQL query
+        would silently ignore.
+        """
+        mapped = {
+            (attr.lower(), sub_attr.lower() if sub_attr else None)
+            for attr, sub_attr, _ in cls.attr_map
+        }
+        if not plan.attributes <= mapped:
+            return []
+        return super().search(plan.filter_query, request)
+
+
+class CursorError(ValueError):
+    """
+    Exception raised for a cursor which is invalid, or which belongs to
+    another listing.
+    """
+
+
+class Cursor:
+    """
+    Position in a listing with cursor pagination (RFC 9865).
+
+    The opaque token encodes the sort key of the last object of the
+    previous page, a digest of the order and the filter of the listing,
+    and the generation of the DirectoryIndex the page was read from. The
+    next page starts after that sort key in the current content of the
+    index, so that the objects added or removed between two pages do not
+    shift the other ones, even when the index was reloaded.
+    """
+
+    VERSION = 1
+
+    def __init__(self, sort_by, descending, filter_query=None, key=None, generation=0):
+        """
+        :param sort_by: the lowercase sortBy attribute
+        :param descending: True for the descending order
+        :param filter_query: the filter of the listing, if any
+        :param key: the sort key of the last object of the previous page,
+                    None for the first page
+        :param generation: the generation of the DirectoryIndex
+        """
+        self.sort_by = sort_by
+        self.descending = descending
+        self.filter_query = filter_query
+        self.key = key
+        self.generation = generation
+
+    def _listing(self):
+        listing = json.dumps([self.sort_by, self.descending, self.filter_query])
+        return hashlib.sha1(listing.encode("utf-8")).hexdigest()[:16]
+
+    def encode(self):
+        data = [self.VERSION, self.generation, self._listing(), list(self.key)]
+        token = urlsafe_b64encode(json.dumps(data, separators=(",", ":")).encode())
+        return token.decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, token, sort_by, descending, filter_query=None):
+        """
+        Return the cursor of a token, the cursor of the first page for an
+        empty token.
+
+        :raises: CursorError if the token is invalid, or was returned by
+                 a listing with another order or filter
+        """
+        cursor = cls(sort_by, descending, filter_query)
+        if not token:
+            return cursor
+        try:
+            data = urlsafe_b64decode(token + "=" * (-len(token) % 4))
+            version, generation, listing, key = json.loads(data)
+            is_none, value, id = key
+            valid = (
+                version == cls.VERSION
+                and isinstance(generation, int)
+                and isinstance(is_none, bool)
+                and isinstance(value, str)
+                and isinstance(id, int)
+            )
+        except (ValueError, TypeError):
+            valid = False
+        if not valid:
+            raise CursorError("Invalid cursor {}".format(token))
+        if listing != cursor._listing():
+            raise CursorError("Cursor of a listing with another order or filter")
+        cursor.key = (is_none, value, id)
+        cursor.generation = generation
+        return cursor
+
+
+class IndexListingMixin:
+    """
+    Listings of the objects of the DirectoryIndex, in the order requested
+    by sortBy.
+
+    The classes define kind, name_field, the sortBy attribute of the
+    cursor pagination without sortBy, and _index_find() returning the
+    callable that converts an id of the index to a model, or to a Record
+    for the reads.
+    """
+
+    kind = None
+    name_field = None
+    default_sort_by = None
+
+    @classmethod
+    def _index_find(cls, index, request, records=False):
+        raise NotImplementedError
+
+    @classmethod
+    def index_listing(cls, plan=None, request=None, records=False, local=None):
+        """
+        Return the objects of the DirectoryIndex matching the QueryPlan,
+        all of them without plan, in the order requested by sortBy.
+
+        The local objects are merged by name with the objects of the index
+        mirrored from the directory, those missing from it come first.
+
+        :param records: return Record objects instead of models
+        :param local: the local objects matching the QueryPlan, if any
+        :raises: ValueError if the sortBy attribute cannot be sorted
+        """
+        queryset = None
+        if local:
+            queryset = cls.model_getter().objects.filter(
+                pk__in=[obj.pk for obj in local]
+            )
+        sorting = Sorting.from_request(request)
+        index = DirectoryIndex()
+        find = cls._index_find(index, request, records)
+        if sorting.sort_by:
+            ids = index.sorted(cls.kind, sorting.sort_by, sorting.descending, plan)
+        else:
+            ids = index.search(plan)
+        return DirectoryListing(queryset, ids, find, cls.name_field, cls.kind)
+
+    @classmethod
+    def index_page(cls, token, count, plan=None, request=None, records=False):
+        """
+        Return a page of the cursor pagination of the objects of the
+        DirectoryIndex matching the QueryPlan.
+
+        :param token: the cursor parameter, empty for the first page
+        :param count: the maximum number of objects
+        :param records: return Record objects instead of models
+        :returns: (list of objects, total number of objects, nextCursor
+                  or None for the last page)
+        :raises: CursorError if the cursor is invalid, ValueError if the
+                 sortBy attribute cannot be sorted
+        """
+        sorting = Sorting.from_request(request)
+        sort_by = sorting.sort_by or cls.default_sort_by
+        filter_query = plan.filter_query if plan is not None else None
+        cursor = Cursor.decode(token, sort_by, sorting.descending, filter_query)
+        index = DirectoryIndex()
+        ids = index.sorted(cls.kind, sort_by, sorting.descending, plan)
+        if cursor.generation and cursor.generation != index.generation:
+            logger.debug(
+                f"Cursor of generation {cursor.generation} of the directory "
+                f"index, continued in generation {index.generation}"
+            )
+        page, next_key = ids.after(cursor.key, count)
+
+        find = cls._index_find(index, request, records)
+        objects = []
+        for id in page:
+            try:
+                objects.append(find(id))
+            except SSSDNotFoundException:
+                # Removed since the page was read
+                continue
+        next_cursor = None
+        if next_key is not None:
+            next_cursor = Cursor(
+                sort_by, sorting.descending, filter_query, next_key, index.generation
+            ).encode()
+        return objects, len(ids), next_cursor
+
+
+class SCIMUserFilterQuery(LocalFilterMixin, IndexListingMixin, UserFilterQuery):
     """
-    Custom UserFilterQuery allowing to search using SSSD DBus interface.
+    Custom UserFilterQuery allowing to search the SSSD users.
+
+    The filters are evaluated against the DirectoryIndex and merged with
+    the local users, except a single equality on the id or the userName,
+    which is resolved from the local users or by SSSD, sorted or not.
     """
 
     attr_map = {
@@ -27,66 +473,123 @@ class SCIMUserFilterQuery(UserFilterQuery):
         ("active", None, None): "is_active",
     }
 
+    kind = "user"
+    name_field = "scim_username"
+    default_sort_by = "username"
+
     @classmethod
-    def search(cls, filter_query, request=None):
-        localresult = super(SCIMUserFilterQuery, cls).search(filter_query, request)
+    def search(cls, filter_query, request=None, records=False):
+        """
+        Return the users matching the filter.
+
+        :param records: return UserRecord objects for the SSSD users, for the
+            reads
+        """
+        plan = QueryPlan("user", filter_query)
+        localresult = cls.search_local(plan, request)
+        if plan.equality is None:
+            return cls.index_listing(plan, request, records, localresult)
         if len(localresult) > 0:
             return localresult
 
-        # The only supported search filters are equality filters
-        items = filter_query.split(" ")
-        if len(items) != 3:
-            raise NotSupportedError("Support only exact search by username")
-
-        (attr, op, value) = (items[0], items[1], items[2].strip('"'))
-        if attr.lower() != "username":
-            raise NotSupportedError("Support only search by username")
-        if op.lower() != "eq":
-            raise NotSupportedError("Support only exact search")
-
+        # A single equality is resolved by SSSD directly
+        retrieve_groups = Projection.from_request(request).includes("groups")
+        identity_map = current_identity_map()
+        attr, value = plan.equality
         try:
             sssd_if = SSSD()
-            sssduser = sssd_if.find_user_by_name(value, retrieve_groups=True)
+            if attr == "id":
+                sssduser = sssd_if.find_user_by_id(value, retrieve_groups)
+            else:
+                sssduser = sssd_if.find_user_by_name(value, retrieve_groups)
         except SSSDNotFoundException:
             return localresult
 
-        user = SSSDUserToUserModel(sssd_if, sssduser)
+        if records:
+            return [SSSDUserToUserRecord(sssd_if, sssduser)]
+        user = SSSDUserToUserModel(sssd_if, sssduser, identity_map)
+        identity_map.add("user", user, complete=retrieve_groups)
         return [user]
 
+    @classmethod
+    def _index_find(cls, index, request, records=False):
+        # The groups are only resolved when they are returned
+        retrieve_groups = Projection.from_request(request).includes("groups")
+        identity_map = current_identity_map()
+
+        def find(id):
+            sssduser = index.find_user_by_id(id, retrieve_groups)
+            if records:
+                return SSSDUserToUserRecord(index, sssduser)
+            return SSSDUserToUserModel(index, sssduser, identity_map)
+
+        return find
+
 
-class SCIMGroupFilterQuery(GroupFilterQuery):
+class SCIMGroupFilterQuery(LocalFilterMixin, IndexListingMixin, GroupFilterQuery):
     """
-    Custom GroupFilterQuery allowing to search using SSSD DBus interface.
+    Custom GroupFilterQuery allowing to search the SSSD groups.
+
+    The filters are evaluated against the DirectoryIndex and merged with
+    the local groups, except a single equality on the id or the
+    displayName, which is resolved from the local groups or by SSSD,
+    sorted or not.
     """
 
     attr_map = {("displayName", None, None): "scim_display_name"}
 
+    kind = "group"
+    name_field = "scim_display_name"
+    default_sort_by = "displayname"
+
     @classmethod
-    def search(cls, filter_query, request=None):
-        localresult = super(SCIMGroupFilterQuery, cls).search(filter_query, request)
+    def search(cls, filter_query, request=None, records=False):
+        """
+        Return the groups matching the filter.
+
+        :param records: return GroupRecord objects for the SSSD groups, for the
+            reads
+        """
+        plan = QueryPlan("group", filter_query)
+        localresult = cls.search_local(plan, request)
+        if plan.equality is None:
+            return cls.index_listing(plan, request, records, localresult)
         if len(localresult) > 0:
             return localresult
 
-        # The only supported search filters are equality filters
-        items = filter_query.split(" ")
-        if len(items) != 3:
-            raise NotSupportedError("Support only exact search by displayname")
-
-        (attr, op, value) = (items[0], items[1], items[2].strip('"'))
-        if attr.lower() != "displayname":
-            raise NotSupportedError("Support only search by displayname")
-        if op.lower() != "eq":
-            raise NotSupportedError("Support only exact search")
-
+        # A single equality is resolved by SSSD directly
+        retrieve_members = Projection.from_request(request).includes("members")
+        identity_map = current_identity_map()
+        attr, value = plan.equality
         try:
             sssd_if = SSSD()
-            sssdgroup = sssd_if.find_group_by_name(value, retrieve_members=True)
+            if attr == "id":
+                sssdgroup = sssd_if.find_group_by_id(value, retrieve_members)
+            else:
+                sssdgroup = sssd_if.find_group_by_name(value, retrieve_members)
         except SSSDNotFoundException:
             return localresult
 
-        group = SSSDGroupToGroupModel(sssd_if, sssdgroup)
+        if records:
+            return [SSSDGroupToGroupRecord(sssd_if, sssdgroup)]
+        group = SSSDGroupToGroupModel(sssd_if, sssdgroup, identity_map)
+        identity_map.add("group", group, complete=retrieve_members)
         return [group]
 
+    @classmethod
+    def _index_find(cls, index, request, records=False):
+        # The members are only resolved when they are returned
+        retrieve_members = Projection.from_request(request).includes("members")
+        identity_map = current_identity_map()
+
+        def find(id):
+            sssdgroup = index.find_group_by_id(id, retrieve_members)
+            if records:
+                return SSSDGroupToGroupRecord(index, sssdgroup)
+            return SSSDGroupToGroupModel(index, sssdgroup, identity_map)
+
+        return find
+
 
 class NegotiateAuth(AuthBase):
     """Negotiate Auth using python GSSAPI"""
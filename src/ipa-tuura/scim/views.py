@@ -2,12 +2,39 @@
 # Copyright (C) 2024  FreeIPA Contributors see COPYING for license
 #
 
+import asyncio
+import json
+import re
 import socket
+from urllib.parse import urljoin
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MultipleObjectsReturned, ObjectDoesNotExist
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+from django.views.decorators.csrf import csrf_exempt
+from django_scim import constants, exceptions
+from django_scim.settings import scim_settings
+from django_scim.utils import (
+    get_base_scim_location_getter,
+    get_extra_model_filter_kwargs_getter,
+    get_user_adapter,
+)
+from django_scim.views import (
+    GroupSearchView,
+    GroupsView,
+    SCIMView,
+    UserSearchView,
+    UsersView,
+)
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.viewsets import GenericViewSet
+from scim2_filter_parser.parser import SCIMParserError
 
 try:
     from ipalib.install.kinit import kinit_password
@@ -20,7 +47,22 @@ import tempfile
 
 import requests
 import SSSDConfig
-from scim.utils import NegotiateAuth
+from scim.adapters import RecordSerializer
+from scim.bulk import Bulk
+from scim.directory import DirectoryIndexUnavailableException, QueryPlan
+from scim.jobs import ProvisioningQueue
+from scim.models import Group, ProvisioningJob, User
+from scim.records import Record, SSSDGroupToGroupRecord, SSSDUserToUserRecord
+from scim.sssd import SSSDNotFoundException
+from scim.sssd_async import AsyncSSSD
+from scim.utils import (
+    CursorError,
+    JSONArray,
+    JSONStream,
+    NegotiateAuth,
+    Projection,
+    Sorting,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -63,3 +105,546 @@ class BridgeViewSet(GenericViewSet):
         session_cookie = r.cookies.get("session")
 
         return Response({"session": session_cookie})
+
+
+class ProjectionMixin:
+    """
+    Pass the projection of the request to the model managers, so that the
+    attributes which are not returned are not retrieved from SSSD.
+
+    The GET requests read the SSSD objects as records, the other methods
+    need the models to modify them.
+    """
+
+    def get_object(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg not in self.kwargs:
+            raise exceptions.BadRequestError(
+                "Expected view {} to be called with a URL keyword argument "
+                'named "{}"'.format(self.__class__.__name__, lookup_url_kwarg)
+            )
+        uuid = self.kwargs[lookup_url_kwarg]
+
+        extra_filter_kwargs = self.get_extra_filter_kwargs(self.request, uuid)
+        extra_filter_kwargs[self.lookup_field] = uuid
+        projection = Projection.from_request(self.request)
+        try:
+            obj = self.model_cls.objects.get(
+                projection=projection,
+                records=self.request.method == "GET",
+                **extra_filter_kwargs,
+            )
+            return self.get_object_post_processor(self.request, obj)
+        except ObjectDoesNotExist:
+            raise exceptions.NotFoundError(uuid)
+        except MultipleObjectsReturned:
+            raise exceptions.BadRequestError(
+                "Multiple objects returned by lookup of {} with value {}".format(
+                    lookup_url_kwarg, uuid
+                )
+            )
+
+
+class StreamingMixin:
+    """
+    Write the single resources with _json_response(), so that the members
+    of a large group are streamed.
+    """
+
+    def get_single(self, request):
+        obj = self.get_object()
+        serializer = RecordSerializer(request, _streaming())
+        if isinstance(obj, Record):
+            location = serializer.location(obj)
+        else:
+            location = self.scim_adapter(obj, request=request).location
+        response = _json_response(
+            request, _resource(self.scim_adapter, serializer, obj)
+        )
+        response["Location"] = location
+        return response
+
+
+class PaginationMixin:
+    """
+    Return the listings and the search results one page at a time.
+
+    The page size is SCIM_MAX_RESULTS without count, as advertised by the
+    ServiceProviderConfig, and capped to it. Only the objects of the
+    requested page are read from SSSD. The listings with a cursor
+    parameter are paginated with cursors instead of startIndex.
+
+    With SCIM_STREAMING, the resources are read STREAMING_CHUNK at a time
+    and written one at a time.
+    """
+
+    STREAMING_CHUNK = 50
+
+    def _page(self, request):
+        start, count = super()._page(request)
+        max_results = getattr(settings, "SCIM_MAX_RESULTS", 200)
+        if "count" not in request.GET or count is None or count > max_results:
+            count = max_results
+        # A negative count is interpreted as 0 (RFC 7644, section 3.4.2.4)
+        return start, max(count, 0)
+
+    def get_many(self, request):
+        token = request.GET.get("cursor")
+        if token is not None:
+            return self._cursor_page(request, token)
+        query = request.GET.get("filter")
+        if query:
+            return self._search(request, query, *self._page(request))
+        try:
+            sorting = Sorting.from_request(request)
+            if sorting.sort_by:
+                # The sort indexes only hold the directory objects
+                listing = self.__class__.parser_getter().index_listing(
+                    None, request, records=True
+                )
+        except ValueError as e:
+            raise exceptions.BadRequestError("Invalid sort query: " + str(e))
+        except DirectoryIndexUnavailableException as e:
+            raise _index_unavailable(e)
+        if sorting.sort_by:
+            return self._build_response(request, listing, *self._page(request))
+
+        extra_filter_kwargs = self.get_extra_filter_kwargs(request)
+        extra_exclude_kwargs = self.get_extra_exclude_kwargs(request)
+        qs = self.model_cls.objects.filter(**extra_filter_kwargs).exclude(
+            **extra_exclude_kwargs
+        )
+        qs = qs.order_by(self.lookup_field)
+        qs = self.get_queryset_post_processor(request, qs)
+        listing = self.model_cls.objects.listing(
+            qs, Projection.from_request(request), records=True
+        )
+        return self._build_response(request, listing, *self._page(request))
+
+    def _search(self, request, query, start, count):
+        # The extra filters are matched against the attributes of the models
+        extra_filter_kwargs = self.get_extra_filter_kwargs(request)
+        extra_exclude_kwargs = self.get_extra_exclude_kwargs(request)
+        records = not (extra_filter_kwargs or extra_exclude_kwargs)
+        try:
+            qs = self.__class__.parser_getter().search(query, request, records=records)
+        except (ValueError, SCIMParserError) as e:
+            raise exceptions.BadRequestError("Invalid filter/search query: " + str(e))
+        except DirectoryIndexUnavailableException as e:
+            raise _index_unavailable(e)
+
+        # Filtering the results reads all of them, only do it when needed
+        if extra_filter_kwargs:
+            qs = self._filter_raw_queryset_with_extra_filter_kwargs(
+                qs, extra_filter_kwargs
+            )
+        if extra_exclude_kwargs:
+            qs = self._filter_raw_queryset_with_extra_exclude_kwargs(
+                qs, extra_exclude_kwargs
+            )
+        return self._build_response(request, qs, start, count)
+
+    def _cursor_page(self, request, token):
+        """
+        Return a page of the cursor pagination (RFC 9865), read from the
+        sort indexes of the DirectoryIndex.
+        """
+        if "startIndex" in request.GET:
+            raise exceptions.BadRequestError(
+                "startIndex and cursor cannot be used together",
+                scim_type="invalidValue",
+            )
+        _, count = self._page(request)
+        parser = self.__class__.parser_getter()
+        query = request.GET.get("filter")
+        try:
+            plan = QueryPlan(parser.kind, query) if query else None
+            objects, total_count, next_cursor = parser.index_page(
+                token, count, plan, request, records=True
+            )
+        except CursorError as e:
+            raise exceptions.BadRequestError(str(e), scim_type="invalidCursor")
+        except (ValueError, SCIMParserError) as e:
+            raise exceptions.BadRequestError("Invalid filter/sort query: " + str(e))
+        except DirectoryIndexUnavailableException as e:
+            raise _index_unavailable(e)
+        extra = {}
+        if next_cursor is not None:
+            extra["nextCursor"] = next_cursor
+        return self._list_response(request, objects, total_count, **extra)
+
+    def _build_response(self, request, qs, start, count):
+        # len() does not read the objects of a DirectoryListing
+        total_count = len(qs)
+        if _streaming():
+            objects = self._chunks(qs, start - 1, start - 1 + count)
+        else:
+            objects = qs[start - 1 : start - 1 + count]
+        return self._list_response(request, objects, total_count, startIndex=start)
+
+    def _chunks(self, qs, start, stop):
+        for chunk in range(start, stop, self.STREAMING_CHUNK):
+            yield from qs[chunk : min(chunk + self.STREAMING_CHUNK, stop)]
+
+    def _list_response(self, request, objects, total_count, **extra):
+        serializer = RecordSerializer(request, _streaming())
+        if _streaming():
+            # itemsPerPage is only known once the resources are written
+            resources = JSONArray(
+                _resource(self.scim_adapter, serializer, o) for o in objects
+            )
+            doc = {
+                "schemas": [constants.SchemaURI.LIST_RESPONSE],
+                "totalResults": total_count,
+                **extra,
+                "Resources": resources,
+                "itemsPerPage": lambda: resources.count,
+            }
+            return _json_response(request, doc)
+        try:
+            resources = [_resource(self.scim_adapter, serializer, o) for o in objects]
+        except ValueError as e:
+            raise exceptions.BadRequestError(str(e))
+        doc = {
+            "schemas": [constants.SchemaURI.LIST_RESPONSE],
+            "totalResults": total_count,
+            "itemsPerPage": len(resources),
+            **extra,
+            "Resources": resources,
+        }
+        return _json_response(request, doc)
+
+
+class AsyncWriteMixin:
+    """
+    Queue the writes of the users requested with a "Prefer: respond-async"
+    header when SCIM_ASYNC_WRITES is set, see scim.jobs.ProvisioningQueue.
+
+    The request is validated, then answered with 202 Accepted and the
+    status of its job, at the Location of the job.
+    """
+
+    def _respond_async(self, request):
+        if not getattr(settings, "SCIM_ASYNC_WRITES", False):
+            return False
+        prefer = request.META.get("HTTP_PREFER", "")
+        # Preferences with parameters, "respond-async; wait=10"
+        return "respond-async" in [
+            p.split(";")[0].strip().lower() for p in prefer.split(",")
+        ]
+
+    def _enqueue(self, request, operation, scim_obj, body):
+        job = ProvisioningQueue().enqueue(
+            operation,
+            scim_obj,
+            body,
+            idempotency_key=request.META.get("HTTP_IDEMPOTENCY_KEY"),
+        )
+        response = HttpResponse(
+            content=json.dumps(_job_dict(request, job)),
+            content_type=constants.SCIM_CONTENT_TYPE,
+            status=202,
+        )
+        response["Location"] = _job_location(request, job)
+        return response
+
+    def _load(self, request, obj):
+        scim_obj = self.scim_adapter(obj, request=request)
+        body = self.load_body(request.body)
+        if not body:
+            raise exceptions.BadRequestError(
+                "{} call made with empty body".format(request.method)
+            )
+        scim_obj.validate_dict(body)
+        scim_obj.from_dict(body)
+        return scim_obj, body
+
+    def post(self, request, *args, **kwargs):
+        if not self._respond_async(request):
+            return super().post(request, *args, **kwargs)
+        scim_obj, body = self._load(request, self.model_cls())
+        scim_obj.set_initial_password()
+        return self._enqueue(request, "add", scim_obj, body)
+
+    def put(self, request, *args, **kwargs):
+        if not self._respond_async(request):
+            return super().put(request, *args, **kwargs)
+        scim_obj, body = self._load(request, self.get_object())
+        return self._enqueue(request, "modify", scim_obj, body)
+
+    def delete(self, request, *args, **kwargs):
+        if not self._respond_async(request):
+            return super().delete(request, *args, **kwargs)
+        scim_obj = self.scim_adapter(self.get_object(), request=request)
+        return self._enqueue(request, "delete", scim_obj, {})
+
+
+class UsersView(
+    AsyncWriteMixin, ProjectionMixin, StreamingMixin, PaginationMixin, UsersView
+):
+    pass
+
+
+class GroupsView(ProjectionMixin, StreamingMixin, PaginationMixin, GroupsView):
+    pass
+
+
+class UserSearchView(PaginationMixin, UserSearchView):
+    pass
+
+
+class GroupSearchView(PaginationMixin, GroupSearchView):
+    pass
+
+
+class JobView(SCIMView):
+    """
+    Serve the status of the queued writes, see AsyncWriteMixin.
+    """
+
+    http_method_names = ["get"]
+
+    def get(self, request, uuid, *args, **kwargs):
+        job = ProvisioningJob.objects.filter(uuid=uuid).first()
+        if job is None:
+            raise exceptions.NotFoundError(uuid)
+        response = HttpResponse(
+            content=json.dumps(_job_dict(request, job)),
+            content_type=constants.SCIM_CONTENT_TYPE,
+        )
+        response["Location"] = _job_location(request, job)
+        return response
+
+
+class BulkView(SCIMView):
+    """
+    Serve the bulk requests, see scim.bulk.Bulk.
+    """
+
+    http_method_names = ["post"]
+
+    def post(self, request, *args, **kwargs):
+        max_payload_size = getattr(settings, "SCIM_BULK_MAX_PAYLOAD_SIZE", 1048576)
+        if len(request.body) > max_payload_size:
+            raise exceptions.SCIMException(
+                "The bulk request exceeds the maximum payload size "
+                "({} bytes)".format(max_payload_size),
+                status=413,
+            )
+        body = self.load_body(request.body)
+        bulk = Bulk(request, body, {"Users": UsersView, "Groups": GroupsView})
+        return HttpResponse(
+            content=json.dumps(bulk.run()), content_type=constants.SCIM_CONTENT_TYPE
+        )
+
+
+class _PrefetchedSSSD:
+    """
+    Serve the lookups of the record converters from prefetched objects.
+
+    The asyncio views resolve the groups of a user, or the members of a
+    group, concurrently before building the records. The converters then
+    find them here instead of calling the infopipe.
+    """
+
+    def __init__(self, users=(), groups=()):
+        self._users = {user.username: user for user in users}
+        self._groups = {group.name: group for group in groups}
+
+    def find_user_by_name(self, username, retrieve_groups=False):
+        try:
+            return self._users[username]
+        except KeyError:
+            raise SSSDNotFoundException("User {} not found".format(username))
+
+    def find_group_by_name(self, name, retrieve_members=False):
+        try:
+            return self._groups[name]
+        except KeyError:
+            raise SSSDNotFoundException("Group {} not found".format(name))
+
+
+async def _gather_found(lookups):
+    """
+    Run the lookups concurrently and return the objects which were found.
+    """
+    results = await asyncio.gather(*lookups, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(
+            result, SSSDNotFoundException
+        ):
+            raise result
+    return [r for r in results if not isinstance(r, Exception)]
+
+
+_accepts_gzip_re = re.compile(r"\bgzip\b")
+
+
+def _index_unavailable(e):
+    """
+    Return the error of a filter or a sorted listing which needs the
+    directory index, when it cannot be loaded.
+    """
+    logger.warning(f"Directory index unavailable: {e}")
+    return exceptions.SCIMException(str(e), status=501)
+
+
+def _job_location(request, job):
+    path = reverse("provisioning-job", kwargs={"uuid": job.uuid})
+    return urljoin(get_base_scim_location_getter()(request=request), path)
+
+
+def _job_dict(request, job):
+    """
+    Return the status of a job, with the location of the user it wrote.
+    """
+    d = job.to_dict()
+    if (
+        job.status == ProvisioningJob.Status.DONE
+        and job.operation != ProvisioningJob.Operation.DELETE
+    ):
+        path = reverse(get_user_adapter().url_name, kwargs={"uuid": job.resource_id})
+        d["location"] = urljoin(get_base_scim_location_getter()(request=request), path)
+    return d
+
+
+def _streaming():
+    return getattr(settings, "SCIM_STREAMING", False)
+
+
+def _json_response(request, doc):
+    """
+    Return the response of a JSON document, written incrementally from a
+    JSONStream with SCIM_STREAMING, and compressed with gzip when the
+    client accepts it and SCIM_STREAMING_GZIP is set.
+    """
+    if not _streaming():
+        return HttpResponse(
+            content=json.dumps(doc), content_type=constants.SCIM_CONTENT_TYPE
+        )
+    response = StreamingHttpResponse(
+        iter(JSONStream(doc)), content_type=constants.SCIM_CONTENT_TYPE
+    )
+    if getattr(settings, "SCIM_STREAMING_GZIP", True):
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if _accepts_gzip_re.search(request.META.get("HTTP_ACCEPT_ENCODING", "")):
+            response.streaming_content = compress_sequence(response.streaming_content)
+            response["Content-Encoding"] = "gzip"
+    if getattr(settings, "SCIM_ASYNC_READS", False):
+        # ASGI reads the synchronous iterators at once
+        response.streaming_content = _async_chunks(response.streaming_content)
+    return response
+
+
+async def _async_chunks(chunks):
+    """
+    Read the chunks of a synchronous iterator in the thread of the sync
+    views.
+    """
+    read = sync_to_async(next)
+    while True:
+        chunk = await read(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def _resource(adapter, serializer, obj):
+    """
+    Return the SCIM resource of a record, or of a model with its adapter.
+    """
+    if isinstance(obj, Record):
+        return serializer.to_dict(obj)
+    scim_obj = adapter(obj, request=serializer.request)
+    if serializer.streaming:
+        return scim_obj.to_stream()
+    return scim_obj.to_dict()
+
+
+def _error_response(e):
+    """
+    Return the SCIM error response for the exception e.
+    """
+    if not isinstance(e, exceptions.SCIMException):
+        logger.exception("Unable to complete SCIM call.")
+        if scim_settings.EXPOSE_SCIM_EXCEPTIONS:
+            e = exceptions.SCIMException(str(e))
+        else:
+            e = exceptions.SCIMException(
+                "Exception occurred while processing the SCIM request"
+            )
+    return HttpResponse(
+        content=json.dumps(e.to_dict()),
+        content_type=constants.SCIM_CONTENT_TYPE,
+        status=e.status,
+    )
+
+
+async def _get_single(request, uuid, model, sync_view, lookup):
+    """
+    Serve GET /Users/<uuid> or GET /Groups/<uuid> with the asyncio client.
+
+    Objects stored in the local database and the other methods are handed
+    over to the django_scim view, in a thread.
+    """
+    middleware = scim_settings.AUTH_CHECK_MIDDLEWARE()
+    response = await sync_to_async(middleware.process_request)(request)
+    if response is not None:
+        return response
+
+    filter_kwargs = get_extra_model_filter_kwargs_getter(model)(request, uuid)
+    filter_kwargs["scim_id"] = uuid
+    if request.method != "GET" or await model.objects.filter(**filter_kwargs).aexists():
+        return await sync_to_async(sync_view)(request, uuid=uuid)
+
+    try:
+        if not uuid.isdigit():
+            raise exceptions.NotFoundError(uuid)
+        try:
+            obj = await lookup(AsyncSSSD(), uuid, Projection.from_request(request))
+        except SSSDNotFoundException:
+            raise exceptions.NotFoundError(uuid)
+        serializer = RecordSerializer(request)
+        response = HttpResponse(
+            content=json.dumps(serializer.to_dict(obj)),
+            content_type=constants.SCIM_CONTENT_TYPE,
+        )
+        response["Location"] = serializer.location(obj)
+        return response
+    except Exception as e:
+        return _error_response(e)
+
+
+async def _lookup_user(sssd_if, uuid, projection):
+    retrieve_groups = projection.includes("groups")
+    sssduser = await sssd_if.find_user_by_id(uuid, retrieve_groups=retrieve_groups)
+    groups = await _gather_found(
+        sssd_if.find_group_by_name(name) for name in sssduser.groups
+    )
+    return SSSDUserToUserRecord(_PrefetchedSSSD(groups=groups), sssduser)
+
+
+async def _lookup_group(sssd_if, uuid, projection):
+    retrieve_members = projection.includes("members")
+    sssdgroup = await sssd_if.find_group_by_id(uuid, retrieve_members=retrieve_members)
+    users = await _gather_found(
+        sssd_if.find_user_by_name(name) for name in sssdgroup.members
+    )
+    return SSSDGroupToGroupRecord(_PrefetchedSSSD(users=users), sssdgroup)
+
+
+_users_view = UsersView.as_view()
+_groups_view = GroupsView.as_view()
+
+
+@csrf_exempt
+async def user_detail(request, uuid):
+    return await _get_single(request, uuid, User, _users_view, _lookup_user)
+
+
+@csrf_exempt
+async def group_detail(request, uuid):
+    if _streaming() and Projection.from_request(request).includes("members"):
+        # The members are streamed by the sync view
+        return await sync_to_async(_groups_view)(request, uuid=uuid)
+    return await _get_single(request, uuid, Group, _groups_view, _lookup_group)